@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+模型接口的准入控制
+
+所有生成请求共用一个模型，不加限制时并发请求会全部压到模型上，延迟随负载无限增长。
+AdmissionController 在请求进入生成路径之前：
+
+- 最多 max_concurrent 个请求同时执行，其余进入有界的优先级队列（数值越小越优先，同优先级先到先服务）；
+- 队列已满时立即拒绝（AdmissionRejected，reason='queue_full'），排队超过 queue_timeout 秒同样拒绝
+  （reason='timeout'），两者都带有建议的重试间隔；
+- 记录每个请求的排队时间，并用执行耗时的指数滑动平均估算 Retry-After。
+
+与 batch_scheduler 的关系：调度器负责把已准入的请求合并成解码批次，准入控制负责在它之前限流。
+"""
+
+import heapq
+import itertools
+import math
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+
+class AdmissionRejected(Exception):
+    """请求未被准入"""
+
+    def __init__(self, reason: str, retry_after: int, queue_depth: int):
+        super().__init__(f"请求未被准入（{reason}），建议 {retry_after} 秒后重试")
+        self.reason = reason
+        self.retry_after = retry_after
+        self.queue_depth = queue_depth
+
+
+class AdmissionTicket:
+    """已准入请求的凭证；release() 可重复调用，只生效一次"""
+
+    def __init__(self, controller: "AdmissionController", priority: int, wait_sec: float):
+        self.priority = priority
+        self.wait_sec = wait_sec
+        self._controller = controller
+        self._start = time.perf_counter()
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._controller._release(time.perf_counter() - self._start)
+
+
+class _Waiter:
+    __slots__ = ('event', 'admitted', 'cancelled')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.admitted = False
+        self.cancelled = False
+
+
+class AdmissionController:
+    """有界优先级队列 + 并发上限（线程安全）"""
+
+    def __init__(self, max_concurrent: int = 1, max_queue: int = 16, queue_timeout: float = 120.0,
+                 initial_service_sec: float = 10.0):
+        """
+        Args:
+            max_concurrent: 同时执行的请求数上限
+            max_queue: 排队请求数上限（0 表示不排队，没有空闲名额时直接拒绝）
+            queue_timeout: 最长排队时间（秒），<= 0 表示不限
+            initial_service_sec: 还没有完成的请求时，估算 Retry-After 使用的单个请求耗时
+        """
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._active = 0
+        self._heap: List[Tuple[int, int, _Waiter]] = []
+        self._queued = 0
+        self._seq = itertools.count()
+        self._avg_service_sec = initial_service_sec
+        self._admitted = 0
+        self._rejected: Dict[str, int] = {}
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _retry_after_locked(self) -> int:
+        """按平均执行耗时估算排在队尾的请求还需等待多久"""
+        backlog = self._queued + self._active
+        return max(1, int(math.ceil(self._avg_service_sec * backlog / self.max_concurrent)))
+
+    def _reject_locked(self, reason: str) -> AdmissionRejected:
+        self._rejected[reason] = self._rejected.get(reason, 0) + 1
+        return AdmissionRejected(reason, self._retry_after_locked(), self._queued)
+
+    def _admit_locked(self, priority: int, wait_sec: float, reserved: bool = False) -> AdmissionTicket:
+        if not reserved:
+            self._active += 1
+        self._admitted += 1
+        self._wait_total += wait_sec
+        self._wait_max = max(self._wait_max, wait_sec)
+        return AdmissionTicket(self, priority, wait_sec)
+
+    def acquire(self, priority: int = 0) -> AdmissionTicket:
+        """
+        申请执行名额，必要时排队等待
+
+        Returns:
+            AdmissionTicket（wait_sec 为排队时间），请求结束时调用其 release()
+        Raises:
+            AdmissionRejected：队列已满或排队超时
+        """
+        start = time.perf_counter()
+        with self._lock:
+            if self._active < self.max_concurrent and not self._queued:
+                return self._admit_locked(priority, 0.0)
+            if self._queued >= self.max_queue:
+                raise self._reject_locked('queue_full')
+            waiter = _Waiter()
+            heapq.heappush(self._heap, (priority, next(self._seq), waiter))
+            self._queued += 1
+        timeout = self.queue_timeout if self.queue_timeout > 0 else None
+        waiter.event.wait(timeout)
+        with self._lock:
+            if not waiter.admitted:
+                # 超时：留在堆中的条目标记为取消，出队时跳过
+                waiter.cancelled = True
+                self._queued -= 1
+                raise self._reject_locked('timeout')
+            return self._admit_locked(priority, time.perf_counter() - start, reserved=True)
+
+    def _release(self, service_sec: float):
+        with self._lock:
+            self._active -= 1
+            self._avg_service_sec = 0.8 * self._avg_service_sec + 0.2 * service_sec
+            while self._heap and self._active < self.max_concurrent:
+                _, _, waiter = heapq.heappop(self._heap)
+                if waiter.cancelled:
+                    continue
+                waiter.admitted = True
+                self._queued -= 1
+                # 名额在唤醒前就记到该请求名下，避免被新到的请求抢走
+                self._active += 1
+                waiter.event.set()
+                break
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                'queue_timeout': self.queue_timeout,
+                'active': self._active,
+                'queued': self._queued,
+                'admitted': self._admitted,
+                'rejected': dict(self._rejected),
+                'avg_wait_sec': round(self._wait_total / self._admitted, 4) if self._admitted else 0.0,
+                'max_wait_sec': round(self._wait_max, 4),
+                'avg_service_sec': round(self._avg_service_sec, 3),
+                'retry_after_sec': self._retry_after_locked(),
+            }
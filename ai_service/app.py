@@ -7,7 +7,8 @@ AI模拟法庭服务
 
 import os
 import sys
-from flask import Flask, request, jsonify
+from contextlib import nullcontext
+from flask import Flask, request, jsonify, Response, stream_with_context, g, has_request_context
 from flask_cors import CORS
 import logging
 import requests
@@ -19,12 +20,31 @@ import time
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from court_debate_sdk import CourtDebateModel
+from infer import (
+    extract_final, find_stop_sequence, truncate_at_stop_sequence,
+    JUDGE_ROLE_CONFUSION_PHRASES, JUDGE_STYLE_PHRASES, JUDGE_STYLE_BRACKET_PREFIXES,
+)
+from service_metrics import MetricsRegistry, CONTENT_TYPE_LATEST
+from request_tracing import Trace, TraceExporter
+from async_logging import start_async_logging, PromptLog
+from text_similarity import SpeechSimilarity, text_similarity
+from speech_index import DEFAULT_THRESHOLD as SPEECH_INDEX_DEFAULT_THRESHOLD, SpeechIndexStore
+from content_store import ContentStore
+from admission import AdmissionController, AdmissionRejected
+from external_ai_client import ExternalAIClient, ExternalAIBusy
+from debate_sessions import (
+    DebateSessionStore, parse_context_line, turn_to_message, turn_to_speech,
+)
+from speech_postprocess import (
+    SpeechPostprocessor, IncrementalJudgeStyleFilter, ROLE_NAMES, ROLE_PREFIX_RE, SPECIAL_TOKEN_RE,
+)
 
 app = Flask(__name__)
 CORS(app)  # 允许跨域请求
 
-# 配置日志
+# 配置日志（格式化与输出在后台线程完成，不占用请求线程）
 logging.basicConfig(level=logging.INFO)
+start_async_logging()
 logger = logging.getLogger(__name__)
 
 # 全局模型实例
@@ -47,6 +67,337 @@ EXTERNAL_AI_BASE_URL = "https://chatapi.zjt66.top/v1"
 EXTERNAL_AI_MODEL = "gpt-4o-mini"
 
 
+# ==================== 运行指标（GET /metrics，Prometheus 文本格式） ====================
+
+METRICS = MetricsRegistry()
+HTTP_REQUESTS = METRICS.counter(
+    'court_ai_http_requests_total', '按接口、方法、角色和状态码统计的请求数', ('endpoint', 'method', 'role', 'status'))
+HTTP_REQUEST_DURATION = METRICS.histogram(
+    'court_ai_http_request_duration_seconds', '请求耗时（流式响应计到最后一个事件发送完成）', ('endpoint', 'role'))
+HTTP_REQUESTS_IN_FLIGHT = METRICS.gauge('court_ai_http_requests_in_flight', '正在处理的请求数')
+PROMPT_TOKENS = METRICS.counter('court_ai_prompt_tokens_total', '提示词 token 数（含复用 KV 的部分）', ('role',))
+CACHED_PROMPT_TOKENS = METRICS.counter('court_ai_cached_prompt_tokens_total', '复用 KV 缓存、无需 prefill 的提示词 token 数', ('role',))
+GENERATED_TOKENS = METRICS.counter('court_ai_generated_tokens_total', '生成的 token 数', ('role',))
+GENERATION_TTFT = METRICS.histogram('court_ai_generation_ttft_seconds', '生成首 token 耗时', ('role',))
+GENERATION_DURATION = METRICS.histogram('court_ai_generation_duration_seconds', '单次生成总耗时', ('role',))
+GENERATION_STOPS = METRICS.counter('court_ai_generation_stops_total', '按结束原因统计的生成次数', ('role', 'reason'))
+DEBATE_OUTCOMES = METRICS.counter(
+    'court_ai_debate_outcomes_total', '辩论发言的校验结果（ok/重试/跳过/硬编码结束语/重复）', ('role', 'outcome'))
+EXTERNAL_AI_DURATION = METRICS.histogram('court_ai_external_ai_request_duration_seconds', '外部AI API 单次请求耗时')
+EXTERNAL_AI_REQUESTS = METRICS.counter(
+    'court_ai_external_ai_requests_total', '外部AI API 请求结果（HTTP 状态码或异常类型）', ('code',))
+MODEL_LOAD_SECONDS = METRICS.gauge('court_ai_model_load_seconds', '最近一次模型加载耗时')
+METRICS.gauge('court_ai_model_loaded', '模型是否已加载（1/0）', callback=lambda: 1 if _model is not None else 0)
+METRICS.gauge('court_ai_scheduler_queue_depth', '连续批处理调度器中等待的请求数（未启用时不输出）',
+              callback=lambda: _scheduler_stat('queued'))
+METRICS.gauge('court_ai_scheduler_active_sequences', '连续批处理调度器中正在解码的序列数（未启用时不输出）',
+              callback=lambda: _scheduler_stat('active'))
+
+# 指标中的角色标签（英文角色标识归一为中文，未知角色统一计为 other，避免标签无限增长）
+METRICS_ROLE_NAMES = {'judge': '审判员', 'plaintiff': '公诉人', 'defendant': '辩护人'}
+
+
+def _scheduler_stat(key):
+    """读取调度器统计中的一项，未启用连续批处理时返回 None"""
+    scheduler = getattr(_model, 'scheduler', None) if _model is not None else None
+    return scheduler.stats().get(key) if scheduler is not None else None
+
+
+def metrics_role(role):
+    """把请求中的角色归一为指标标签值"""
+    if not role:
+        return 'none'
+    role = METRICS_ROLE_NAMES.get(role, role)
+    return role if role in METRICS_ROLE_NAMES.values() else 'other'
+
+
+def record_debate_outcome(role, outcome):
+    """记录一次辩论发言的校验结果（同时记入当前请求追踪的 outcomes 属性）"""
+    DEBATE_OUTCOMES.labels(role=metrics_role(role), outcome=outcome).inc()
+    trace = current_trace()
+    if trace is not None:
+        trace.set('outcomes', trace.attrs.get('outcomes', []) + [outcome])
+
+
+@app.before_request
+def _metrics_before_request():
+    request.environ['court_ai.start_time'] = time.perf_counter()
+    HTTP_REQUESTS_IN_FLIGHT.inc()
+
+
+@app.after_request
+def _metrics_after_request(response):
+    """请求计数与耗时在响应关闭时记录，流式响应会计入整个推送过程"""
+    start = request.environ.get('court_ai.start_time')
+    if start is None:
+        return response
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    data = request.get_json(silent=True) if request.is_json else None
+    if isinstance(data, dict):
+        role = metrics_role(data.get('agent_role') or data.get('current_role') or data.get('assistant_role'))
+    else:
+        role = metrics_role(None)
+    method = request.method
+    status = str(response.status_code)
+    
+    def record():
+        HTTP_REQUESTS_IN_FLIGHT.dec()
+        HTTP_REQUESTS.labels(endpoint=endpoint, method=method, role=role, status=status).inc()
+        HTTP_REQUEST_DURATION.labels(endpoint=endpoint, role=role).observe(time.perf_counter() - start)
+    
+    response.call_on_close(record)
+    return response
+
+
+# ==================== 完整提示词日志（抽样 / 出错时补写） ====================
+
+# 完整提示词不再逐行写入 INFO 日志：INFO 只输出一行摘要，完整内容按抽样或出错时写入 PROMPT_LOG_PATH
+PROMPT_LOG = PromptLog(
+    os.getenv('PROMPT_LOG_PATH', ''),
+    sample_rate=float(os.getenv('PROMPT_LOG_SAMPLE_RATE', '0.01')),
+    on_error=os.getenv('PROMPT_LOG_ON_ERROR', 'true').lower() == 'true',
+    max_bytes=int(os.getenv('PROMPT_LOG_MAX_BYTES', str(50 * 1024 * 1024))),
+    backup_count=int(os.getenv('PROMPT_LOG_BACKUP_COUNT', '10')),
+)
+
+
+def log_prompt(source, messages, **params):
+    """
+    记录一次模型/外部AI调用的输入提示词
+    
+    INFO 输出一行摘要（消息数、字符数、参数），DEBUG 级别下输出完整内容。
+    完整记录在本请求被抽中时立即写入提示词日志；未抽中时暂存，请求出错时补写（见 flush_pending_prompts）。
+    """
+    total_chars = sum(len(str(msg.get('content', ''))) for msg in messages)
+    logger.info(f"【AI调用 - {source}】消息 {len(messages)} 条，共 {total_chars} 字符，参数: {params}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"【AI调用 - {source}】完整输入:\n" + "\n".join(
+            f"[{msg.get('role', '')}] {msg.get('content', '')}" for msg in messages
+        ))
+    if not PROMPT_LOG.enabled:
+        return
+    trace = current_trace()
+    record = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'request_id': trace.request_id if trace is not None else None,
+        'source': source,
+        'params': params,
+        'messages': messages,
+    }
+    if not has_request_context():
+        if PROMPT_LOG.sampled():
+            PROMPT_LOG.write(dict(record, reason='sampled'))
+        return
+    if 'prompt_sampled' not in g:
+        g.prompt_sampled = PROMPT_LOG.sampled()
+    if g.prompt_sampled:
+        PROMPT_LOG.write(dict(record, reason='sampled'))
+    elif PROMPT_LOG.on_error:
+        g.setdefault('pending_prompts', []).append(record)
+
+
+def flush_pending_prompts(error):
+    """请求出错时补写本请求暂存的提示词"""
+    if not has_request_context():
+        return
+    pending = g.pop('pending_prompts', None)
+    for record in pending or []:
+        PROMPT_LOG.write(dict(record, reason='error', error=str(error)))
+
+
+@app.after_request
+def _prompt_log_after_request(response):
+    if response.status_code >= 500:
+        flush_pending_prompts(f"HTTP {response.status_code}")
+    return response
+
+
+# ==================== 请求阶段追踪（Server-Timing / timings / JSONL 导出） ====================
+
+# 完成的追踪按行写入该 JSONL 文件（为空时不导出）
+TRACE_EXPORT_PATH = os.getenv('TRACE_EXPORT_PATH', '')
+TRACE_EXPORTER = TraceExporter(TRACE_EXPORT_PATH) if TRACE_EXPORT_PATH else None
+
+
+def current_trace():
+    """当前请求的追踪记录（不在请求上下文中时返回 None）"""
+    return g.get('trace') if has_request_context() else None
+
+
+def trace_span(name, **attrs):
+    """记录当前请求的一个阶段（with trace_span('postprocess'): ...），没有追踪时什么也不做"""
+    trace = current_trace()
+    return trace.span(name, **attrs) if trace is not None else nullcontext()
+
+
+def trace_generation(gen_info):
+    """把一次生成的 tokenize / queue / prefill / decode 耗时记入当前请求的追踪"""
+    trace = current_trace()
+    if trace is not None:
+        trace.add_generation(gen_info)
+
+
+def timings_requested(data=None):
+    """请求是否要求在响应中附带 timings（查询参数 ?timings=1 或 JSON 字段 "timings": true）"""
+    if request.args.get('timings', '').lower() in ('1', 'true'):
+        return True
+    if data is None:
+        data = request.get_json(silent=True) if request.is_json else None
+    return isinstance(data, dict) and data.get('timings') is True
+
+
+@app.before_request
+def _trace_before_request():
+    g.trace = Trace(request.headers.get('X-Request-ID', '')[:128] or None, name=f"{request.method} {request.path}")
+    data = request.get_json(silent=True) if request.is_json else None
+    if isinstance(data, dict):
+        role = data.get('agent_role') or data.get('current_role') or data.get('assistant_role')
+        if role:
+            g.trace.set('role', role)
+    else:
+        data = {}
+    trial_id = data.get('trial_id') or data.get('session_id') or (request.view_args or {}).get('session_id')
+    if trial_id:
+        g.trace.set('trial_id', trial_id)
+
+
+@app.after_request
+def _trace_after_request(response):
+    """
+    附加 X-Request-ID 与 Server-Timing 响应头，按需在 JSON 响应中加入 timings
+
+    流式响应的响应头在推送开始前发出，只包含此前的阶段；完整的阶段耗时见 done 事件中的 timings 或导出文件。
+    """
+    trace = current_trace()
+    if trace is None:
+        return response
+    response.headers['X-Request-ID'] = trace.request_id
+    response.headers['Server-Timing'] = trace.server_timing()
+    if not response.is_streamed and response.is_json and timings_requested():
+        payload = response.get_json(silent=True)
+        if isinstance(payload, dict):
+            payload['timings'] = trace.as_dict()
+            response.set_data(app.json.dumps(payload))
+    export = TRACE_EXPORTER is not None and request.path != '/metrics'
+    
+    def finish():
+        trace.finish()
+        if export:
+            try:
+                TRACE_EXPORTER.export(trace)
+            except Exception as e:
+                logger.warning(f"[追踪] 导出失败: {e}")
+    
+    response.call_on_close(finish)
+    return response
+
+
+# ==================== 准入控制（模型接口的并发上限与有界优先级队列） ====================
+
+# 同时执行的模型请求数：启用连续批处理时默认与批大小相同，否则为 1（模型逐个执行，多放进来只会一起变慢）
+_batching_enabled = os.getenv("ENABLE_BATCHING", "false").lower() == "true"
+ADMISSION_MAX_CONCURRENT = int(os.getenv(
+    'ADMISSION_MAX_CONCURRENT', os.getenv("MAX_BATCH_SIZE", "8") if _batching_enabled else '1'))
+ADMISSION = AdmissionController(
+    max_concurrent=ADMISSION_MAX_CONCURRENT,
+    max_queue=int(os.getenv('ADMISSION_MAX_QUEUE', '16')),
+    queue_timeout=float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '60')),
+)
+ADMISSION_ENABLED = os.getenv('ADMISSION_ENABLED', 'true').lower() == 'true'
+
+# 经过准入控制的接口（使用本地模型生成）
+ADMISSION_ENDPOINTS = {
+    '/api/generate',
+    '/api/chat',
+    '/api/debate/generate',
+    '/api/debate/generate/stream',
+    '/api/debate/sessions/<session_id>/generate',
+    '/api/debate/sessions/<session_id>/generate/stream',
+}
+
+# 优先级（数值越小越先执行）：审判员的程序性发言最短、阻塞整场庭审的推进，排在最前；
+# 其次是公诉人/辩护人的辩论发言；通用生成（/api/generate、/api/chat，长度由调用方决定）排在最后
+ADMISSION_PRIORITY_JUDGE = 0
+ADMISSION_PRIORITY_DEBATE = 1
+ADMISSION_PRIORITY_GENERIC = 2
+
+ADMISSION_WAIT = METRICS.histogram(
+    'court_ai_admission_wait_seconds', '模型请求在准入队列中的等待时间', ('priority',))
+ADMISSION_REJECTED = METRICS.counter(
+    'court_ai_admission_rejected_total', '未被准入的模型请求（queue_full/timeout）', ('reason',))
+METRICS.gauge('court_ai_admission_queue_depth', '准入队列中等待的请求数', callback=lambda: ADMISSION.queued)
+METRICS.gauge('court_ai_admission_active', '已准入、正在执行的模型请求数', callback=lambda: ADMISSION.active)
+
+
+def admission_priority(endpoint, data):
+    """按接口和请求中的角色确定优先级"""
+    if not endpoint.startswith('/api/debate/'):
+        return ADMISSION_PRIORITY_GENERIC
+    if data.get('agent_role') == '审判员' or data.get('current_role') == 'judge':
+        return ADMISSION_PRIORITY_JUDGE
+    return ADMISSION_PRIORITY_DEBATE
+
+
+@app.before_request
+def _admission_before_request():
+    """
+    模型接口在执行前申请名额：队列已满立即返回 429，排队超时返回 503，两者都带 Retry-After
+
+    排队时间记入追踪的 admission 阶段（Server-Timing）和 X-Queue-Wait-Ms 响应头。
+    """
+    if not ADMISSION_ENABLED or request.url_rule is None or request.url_rule.rule not in ADMISSION_ENDPOINTS:
+        return None
+    data = request.get_json(silent=True) if request.is_json else None
+    priority = admission_priority(request.url_rule.rule, data if isinstance(data, dict) else {})
+    try:
+        with trace_span('admission', priority=priority):
+            ticket = ADMISSION.acquire(priority)
+    except AdmissionRejected as e:
+        ADMISSION_REJECTED.labels(reason=e.reason).inc()
+        logger.warning(f"[准入控制] 拒绝 {request.path}（{e.reason}），排队 {e.queue_depth}，建议 {e.retry_after} 秒后重试")
+        response = jsonify({
+            'error': '服务繁忙，请稍后重试' if e.reason == 'queue_full' else '排队超时，请稍后重试',
+            'reason': e.reason,
+            'retry_after': e.retry_after,
+            'success': False,
+        })
+        response.status_code = 429 if e.reason == 'queue_full' else 503
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+    g.admission_ticket = ticket
+    ADMISSION_WAIT.labels(priority=str(priority)).observe(ticket.wait_sec)
+    trace = current_trace()
+    if trace is not None:
+        trace.set('queue_wait_ms', round(ticket.wait_sec * 1000, 3))
+    return None
+
+
+@app.after_request
+def _admission_after_request(response):
+    """名额在响应关闭时归还（流式响应推送完成后才归还）"""
+    ticket = g.pop('admission_ticket', None)
+    if ticket is not None:
+        response.headers['X-Queue-Wait-Ms'] = f"{ticket.wait_sec * 1000:.1f}"
+        response.call_on_close(ticket.release)
+    return response
+
+
+@app.teardown_request
+def _admission_teardown_request(error):
+    """视图抛出未处理的异常时不会经过 after_request，在这里归还名额"""
+    ticket = g.pop('admission_ticket', None)
+    if ticket is not None:
+        ticket.release()
+
+
+# ==================== 输出后处理 ====================
+# 全部规则在导入时编译一次，非流式、流式与离线批处理共用
+SPEECH_POSTPROCESSOR = SpeechPostprocessor(
+    judge_style_phrases=JUDGE_STYLE_PHRASES,
+    bracket_prefixes=JUDGE_STYLE_BRACKET_PREFIXES,
+)
+
+
 def clean_special_tokens(text: str) -> str:
     """
     清理文本中的特殊标记（如 <|im_end|>, <|im_start|> 等）
@@ -57,24 +408,7 @@ def clean_special_tokens(text: str) -> str:
     Returns:
         清理后的文本
     """
-    if not text:
-        return text
-    
-    # 移除所有特殊标记
-    special_tokens = [
-        '<|im_end|>',
-        '<|im_start|>',
-        '<|im_end|',
-        '<|im_start|',
-        '|im_end|>',
-        '|im_start|>',
-    ]
-    
-    cleaned = text
-    for token in special_tokens:
-        cleaned = cleaned.replace(token, '')
-    
-    return cleaned.strip()
+    return SPEECH_POSTPROCESSOR.clean_special_tokens(text)
 
 
 def remove_duplicate_role_prefix(text: str, agent_role: str) -> str:
@@ -92,68 +426,104 @@ def remove_duplicate_role_prefix(text: str, agent_role: str) -> str:
     if not text:
         return text
     
-    import re
+    content = SPEECH_POSTPROCESSOR.strip_role_prefix(text)
+    if not content:
+        # 去除前缀后为空，返回原始文本（不应该发生，但保留容错）
+        logger.warning(f"[前缀清理] 去除角色前缀后内容为空，保留原始文本")
+        return text
+    return content
+
+
+class IncrementalSpeechCleaner:
+    """
+    流式输出的增量清理器：逐段输入模型原始输出，产出可以立即发送给前端的文本增量
     
-    # 定义角色名称列表
-    role_names = ['审判员', '公诉人', '辩护人']
+    与非流式路径使用同一套编译好的规则（speech_postprocess）：
+    - 提取 <final>...</final> 中的内容（遇到 </final> 后丢弃其后的所有输出）
+    - 清理特殊标记（clean_special_tokens）
+    - 去除开头的（重复）角色前缀（remove_duplicate_role_prefix）
+    - 过滤审判员口吻（filter_judge_style_speech，按句增量处理）
+    - 在停止序列（如冒充其他角色的"\n辩护人："）处截断
     
-    # 检查文本开头是否有重复的角色前缀
-    for role_name in role_names:
-        # 匹配重复的前缀模式（支持中文和英文冒号，以及可能的空白）
-        # 例如："公诉人：公诉人："、"公诉人: 公诉人："、"公诉人：公诉人:"
-        # 匹配一个或多个"角色名+冒号+空白"的组合
-        pattern = rf'^({re.escape(role_name)}[：:]\s*)+'
-        match = re.match(pattern, text)
-        
-        if match:
-            # 找到匹配的重复前缀
-            matched_prefix = match.group(0)
-            # 去除所有重复的前缀，保留内容部分
-            content = text[len(matched_prefix):].lstrip()
-            
-            # 如果内容不为空，继续检查是否还有嵌套的重复
-            if content:
-                # 检查内容是否还以角色名开头（可能还有嵌套的重复）
-                # 例如："公诉人：公诉人：公诉人：内容"
-                if content.startswith(role_name):
-                    # 递归处理，去除可能存在的嵌套重复
-                    content = remove_duplicate_role_prefix(content, agent_role)
-                
-                # 直接返回内容，不添加角色前缀（前端会自己添加）
-                return content
-            else:
-                # 去除前缀后为空，返回原始文本（不应该发生，但保留容错）
-                logger.warning(f"[前缀清理] 去除重复前缀后内容为空，保留原始文本")
-                return text
+    尚无法确定的尾部（可能是未完整的标记）、开头可能属于角色前缀的部分、以及未结束的句子中
+    可能被过滤的部分会暂缓输出，因此已发送的内容不会被撤回。完整回复的最终清理结果应以流结束时的非流式处理为准。
+    """
     
-    # 如果没有匹配到重复前缀，检查是否有单个角色前缀
-    # 如果有，去除它（因为前端会自己添加角色名）
-    for role_name in role_names:
-        # 匹配单个角色前缀（支持中文和英文冒号）
-        single_prefix_pattern = rf'^{re.escape(role_name)}[：:]\s*'
-        match = re.match(single_prefix_pattern, text)
-        
-        if match:
-            # 找到匹配的前缀
-            matched_prefix = match.group(0)
-            # 去除前缀，保留内容部分
-            content = text[len(matched_prefix):].lstrip()
-            
-            # 如果内容不为空，返回内容（不包含角色前缀）
-            if content:
-                return content
-            else:
-                # 去除前缀后为空，返回原始文本（不应该发生，但保留容错）
-                logger.warning(f"[前缀清理] 去除单个前缀后内容为空，保留原始文本")
-                return text
+    _MARKERS = ['<|im_end|>', '<|im_start|>', '|im_end|>', '|im_start|>', '<final>', '</final>']
     
-    return text
+    def __init__(self, agent_role: str, stop_sequences=None):
+        self.agent_role = agent_role
+        self.stop_sequences = [s for s in stop_sequences or [] if s]
+        self._markers = self._MARKERS + self.stop_sequences
+        self.raw = ''
+        self.emitted = ''
+        self._judge_style_filter = (
+            IncrementalJudgeStyleFilter(SPEECH_POSTPROCESSOR) if agent_role != '审判员' else None
+        )
+    
+    def _held_tail_len(self, text: str) -> int:
+        """末尾可能是某个标记前半部分的长度（这些字符暂不输出）"""
+        for n in range(min(len(text), max(len(m) for m in self._markers) - 1), 0, -1):
+            tail = text[-n:]
+            # 只看标记的真前缀：末尾的完整标记（如 <|im_start|> 的后半 |im_start|>）已可以确定
+            if any(len(m) > n and m.startswith(tail) for m in self._markers):
+                return n
+        return 0
+    
+    def _render(self, final: bool) -> str:
+        text = self.raw
+        cut = find_stop_sequence(text, self.stop_sequences)
+        if cut != -1:
+            text = text[:cut]
+        elif not final:
+            text = text[:len(text) - self._held_tail_len(text)]
+        
+        # 提取 <final> 内容；只有结束标签时截断到结束标签
+        start = text.find('<final>')
+        if start != -1:
+            text = text[start + len('<final>'):]
+        end = text.find('</final>')
+        if end != -1:
+            text = text[:end]
+        
+        text = SPECIAL_TOKEN_RE.sub('', text).lstrip()
+        
+        match = ROLE_PREFIX_RE.match(text)
+        rest = text[match.end():].lstrip() if match else text
+        if not final and (not rest or any(name.startswith(rest) for name in ROLE_NAMES)):
+            # 开头仍可能是角色前缀，暂不输出
+            return self.emitted
+        if self._judge_style_filter is not None:
+            rest = self._judge_style_filter.render(rest, final)
+        return rest
+    
+    def feed(self, delta: str) -> str:
+        """输入一段原始输出，返回本次可以发送的文本增量"""
+        self.raw += delta
+        return self._advance(final=False)
+    
+    def flush(self) -> str:
+        """流结束时调用，返回剩余的文本增量"""
+        return self._advance(final=True)
+    
+    def _advance(self, final: bool) -> str:
+        rendered = self._render(final)
+        if final:
+            rendered = rendered.rstrip()
+        if not rendered.startswith(self.emitted):
+            # 理论上不会发生（已发送内容只会被追加），保守起见不再输出
+            return ''
+        delta = rendered[len(self.emitted):]
+        self.emitted = rendered
+        return delta
 
 
 def filter_judge_style_speech(text: str, agent_role: str) -> str:
     """
     过滤掉审判员式的发言模式（如"现在进入辩论环节"、"首先由XX发表XX意见"等）
     
+    规则见 speech_postprocess；固定短语与解码期约束共用 infer.JUDGE_STYLE_PHRASES，正常情况下模型已无法生成，这里作为兜底
+    
     Args:
         text: 原始文本
         agent_role: 当前角色（'公诉人'、'辩护人'等）
@@ -164,75 +534,22 @@ def filter_judge_style_speech(text: str, agent_role: str) -> str:
     if not text or agent_role == '审判员':
         return text
     
-    import re
-    filtered_text = text
-    
-    # 定义审判员式的发言模式（阶段转换语和总结性表达）
-    judge_style_patterns = [
-        r'现在进入辩论环节[。，]?',
-        r'现在进行法庭辩论[。，]?',
-        r'首先由.*?发表.*?意见[。，]?',
-        r'现在宣布.*?[。，]?',
-        r'现在开始.*?[。，]?',
-        r'进入.*?环节[。，]?',
-        r'现在.*?环节[。，]?',
-        # 新增：总结性表达
-        r'审判员总结.*?[。，]?',
-        r'总结辩论[。，]?',
-        r'总结.*?辩论[。，]?',
-        r'本庭总结[。，]?',
-        r'法庭总结[。，]?',
-    ]
-    
-    # 定义方括号内的审判员式内容模式（如"[审判员总结辩论]"）
-    bracket_patterns = [
-        r'\[审判员.*?\]',
-        r'\[总结.*?\]',
-        r'\[法庭.*?\]',
-        r'\[本庭.*?\]',
-    ]
-    
-    # 先处理方括号内的内容（这些通常是模型生成的注释性内容，应该完全移除）
-    has_bracket_content = False
-    for pattern in bracket_patterns:
-        if re.search(pattern, filtered_text):
-            has_bracket_content = True
-            logger.warning(f"[审判员口吻检测] 检测到方括号内的审判员式内容（角色: {agent_role}）")
-            logger.warning(f"[审判员口吻检测] 匹配模式: {pattern}")
-            logger.warning(f"[审判员口吻检测] 原始内容: {filtered_text[:200]}")
-            # 移除方括号及其内容
-            filtered_text = re.sub(pattern, '', filtered_text)
-    
-    # 检查是否包含审判员式的发言模式
-    has_judge_style = False
-    for pattern in judge_style_patterns:
-        if re.search(pattern, filtered_text):
-            has_judge_style = True
-            logger.warning(f"[审判员口吻检测] 检测到审判员式发言模式（角色: {agent_role}）")
-            logger.warning(f"[审判员口吻检测] 匹配模式: {pattern}")
-            logger.warning(f"[审判员口吻检测] 原始内容: {filtered_text[:200]}")
-            break
+    filtered_text, brackets, styles = SPEECH_POSTPROCESSOR.filter_judge_style(text)
     
-    if has_judge_style:
-        # 尝试移除审判员式的开头和结尾部分
-        for pattern in judge_style_patterns:
-            # 移除匹配的模式及其后面的标点符号和换行
-            filtered_text = re.sub(pattern + r'[\s\n]*', '', filtered_text, flags=re.IGNORECASE)
-            # 也移除文本末尾的模式（如"总结辩论"可能在末尾）
-            filtered_text = re.sub(r'[\s\n]*' + pattern + r'$', '', filtered_text, flags=re.IGNORECASE | re.MULTILINE)
-        
-        # 如果过滤后文本为空或太短，保留原始文本但添加警告
-        if len(filtered_text.strip()) < 10:
+    if brackets:
+        logger.warning(f"[审判员口吻检测] 检测到方括号内的审判员式内容（角色: {agent_role}）: {brackets}")
+        logger.warning(f"[审判员口吻检测] 原始内容: {text[:200]}")
+    if styles:
+        logger.warning(f"[审判员口吻检测] 检测到审判员式发言模式（角色: {agent_role}）: {styles}")
+        logger.warning(f"[审判员口吻检测] 原始内容: {text[:200]}")
+        if filtered_text == text.strip():
             logger.warning(f"[审判员口吻检测] 过滤后文本过短，保留原始文本")
-            filtered_text = text
         else:
             logger.info(f"[审判员口吻检测] 已过滤审判员式发言，过滤后内容: {filtered_text[:200]}")
-    
-    # 如果只检测到方括号内容，也记录日志
-    if has_bracket_content and not has_judge_style:
+    elif brackets:
         logger.info(f"[审判员口吻检测] 已移除方括号内的审判员式内容，过滤后内容: {filtered_text[:200]}")
     
-    return filtered_text.strip()
+    return filtered_text
 
 
 def check_judge_role_confusion(text: str, agent_role: str) -> bool:
@@ -252,16 +569,12 @@ def check_judge_role_confusion(text: str, agent_role: str) -> bool:
     import re
     
     # 定义审判员不应该使用的表达模式
-    confusion_patterns = [
-        r'我方认为',
+    # 固定短语与解码期约束共用 infer.JUDGE_ROLE_CONFUSION_PHRASES；中间插入其他字的变体只能在生成后检测
+    confusion_patterns = [re.escape(phrase) for phrase in JUDGE_ROLE_CONFUSION_PHRASES] + [
         r'我方.*?认为',
-        r'建议法庭',
         r'建议.*?法庭',
-        r'恳请法庭',
         r'恳请.*?法庭',
-        r'希望法庭',
         r'希望.*?法庭',
-        r'请求法庭',
         r'请求.*?法庭',
     ]
     
@@ -353,48 +666,120 @@ def check_judge_ending_without_summary(text: str, agent_role: str) -> bool:
     return False
 
 
-def check_duplicate_speech(new_text: str, messages: list, current_role: str, similarity_threshold: float = 0.85) -> bool:
+def rank_speech_candidates(candidates: list, agent_role: str, context_messages: list = None, trial_id=None):
+    """
+    best-of-N：用与重试循环相同的校验规则挑选候选发言
+    
+    返回第一个通过全部校验的候选；都不通过时返回问题最轻的一个（同级取先生成的）。
+    问题从轻到重：审判员只说"辩论结束"没有总结（可用硬编码结束语替代）< 与历史发言重复 < 审判员角色混淆 < 空回复。
+    
+    Args:
+        candidates: 已清理的候选发言列表
+        agent_role: 当前角色
+        context_messages: 历史发言（parse_context_to_speech_messages 的结果），用于重复检测
+        trial_id: 庭审会话ID（可选，重复检测复用该庭审的近似重复索引）
+    
+    Returns:
+        (最佳候选的下标, 该候选的问题列表)，问题为 'ending_without_summary' / 'duplicate' / 'role_confusion' / 'empty'
+    """
+    penalties = {'ending_without_summary': 1, 'duplicate': 2, 'role_confusion': 3, 'empty': 4}
+    role_map_for_check = {'审判员': 'judge', '公诉人': 'plaintiff', '辩护人': 'defendant'}
+    best_index, best_issues, best_penalty = 0, None, None
+    for i, text in enumerate(candidates):
+        issues = []
+        if not text or not text.strip():
+            issues.append('empty')
+        else:
+            if check_judge_role_confusion(text, agent_role):
+                issues.append('role_confusion')
+            if check_judge_ending_without_summary(text, agent_role):
+                issues.append('ending_without_summary')
+            if (context_messages or trial_id) and check_duplicate_speech(
+                text, context_messages, role_map_for_check.get(agent_role, agent_role), trial_id=trial_id
+            ):
+                issues.append('duplicate')
+        if not issues:
+            return i, []
+        penalty = max(penalties[issue] for issue in issues)
+        if best_penalty is None or penalty < best_penalty:
+            best_index, best_issues, best_penalty = i, issues, penalty
+    return best_index, best_issues
+
+
+# 重复检测中的角色归一（中文角色名与英文角色标识）
+SPEECH_ROLE_MAP = {
+    'judge': 'judge',
+    'plaintiff': 'plaintiff',
+    'defendant': 'defendant',
+    '审判员': 'judge',
+    '公诉人': 'plaintiff',
+    '辩护人': 'defendant'
+}
+
+
+def get_role_speeches(messages: list, current_role: str) -> list:
+    """
+    按时间顺序返回历史消息中同一角色的发言文本
+    
+    既用于生成后的重复检测，也作为解码期重复 n-gram 屏蔽的参考（SDK 的 previous_speeches 参数）
+    """
+    target_role = SPEECH_ROLE_MAP.get(current_role, current_role)
+    return [msg.get('text', '') for msg in messages or [] if msg.get('role', '') == target_role]
+
+
+# 全庭审近似重复检测（MinHash/LSH）：role 只与本角色的历史发言比较（默认），all 与所有人比较，off 关闭；
+# 默认阈值与最短长度的取值依据见 speech_index 模块说明
+# 发言只在出现于之后请求的 context（或会话发言）中时才加入索引：本轮返回的发言在客户端保存之前不参与查重，
+# 同一轮重试（如后端超时后重发）不会与被替换的上一次回复比较
+SPEECH_DEDUP_SCOPE = os.getenv('SPEECH_DEDUP_SCOPE', 'role').lower()
+SPEECH_DEDUP_THRESHOLD = float(os.getenv('SPEECH_DEDUP_THRESHOLD', str(SPEECH_INDEX_DEFAULT_THRESHOLD)))
+SPEECH_INDEX_STORE = SpeechIndexStore(
+    max_trials=int(os.getenv('SPEECH_INDEX_MAX_TRIALS', '256')),
+    ttl_sec=float(os.getenv('SPEECH_INDEX_TTL', '3600')),
+)
+
+
+def get_speech_index(messages: list, trial_id=None):
+    """
+    取出庭审的发言索引并追加 messages 中尚未索引的发言
+    
+    有 trial_id 时索引跨请求保存，每轮只需追加新发言；没有时从 messages 临时构建。
+    """
+    index = SPEECH_INDEX_STORE.get(str(trial_id)) if trial_id else SPEECH_INDEX_STORE.new_index()
+    index.sync((msg.get('role', ''), msg.get('text', '')) for msg in messages or [])
+    return index
+
+
+def check_duplicate_speech(new_text: str, messages: list, current_role: str, similarity_threshold: float = 0.85,
+                           trial_id=None) -> bool:
     """
     检查新生成的发言是否与历史消息重复
     
+    先与同一角色最近3条发言逐一比较相似度；未命中时再查全庭审的近似重复索引（见 SPEECH_DEDUP_SCOPE），
+    覆盖更早的发言。
+    
     Args:
         new_text: 新生成的发言文本
         messages: 历史消息列表
         current_role: 当前角色（'judge', 'plaintiff', 'defendant'）
         similarity_threshold: 相似度阈值（0-1），超过此值视为重复
+        trial_id: 庭审会话ID（可选，提供时复用跨请求保存的索引）
     
     Returns:
         True表示重复，False表示不重复
     """
-    if not new_text or not messages:
+    if not new_text:
         return False
     
     # 只检查同一角色的最近发言
-    role_map = {
-        'judge': 'judge',
-        'plaintiff': 'plaintiff',
-        'defendant': 'defendant',
-        '审判员': 'judge',
-        '公诉人': 'plaintiff',
-        '辩护人': 'defendant'
-    }
-    
-    target_role = role_map.get(current_role, current_role)
+    target_role = SPEECH_ROLE_MAP.get(current_role, current_role)
     
-    # 获取同一角色的最近发言（最多检查最近3条）
-    recent_speeches = []
-    for msg in reversed(messages):
-        msg_role = msg.get('role', '')
-        if msg_role == target_role:
-            recent_speeches.append(msg.get('text', ''))
-            if len(recent_speeches) >= 3:
-                break
-    
-    if not recent_speeches:
-        return False
+    # 获取同一角色的最近发言（最多检查最近3条，从新到旧）
+    recent_speeches = get_role_speeches(messages, current_role)[-3:][::-1]
     
-    # 计算相似度（使用简单的文本相似度算法）
+    # 计算相似度（新发言的字符位图只构建一次，与各条历史发言比较时复用）
     new_text_clean = new_text.strip()
+    new_text_similarity = SpeechSimilarity(new_text_clean)
     
     # 对于审判员的短指令（如"请XX发言"），使用更严格的检测
     is_judge_short_command = target_role == 'judge' and len(new_text_clean) < 50
@@ -422,24 +807,37 @@ def check_duplicate_speech(new_text: str, messages: list, current_role: str, sim
                         logger.warning(f"[重复检测] 历史指令: {old_command_core}")
                         return True
     
-    for old_text in recent_speeches:
-        old_text_clean = old_text.strip()
-        
-        # 如果完全相同，直接判定为重复
-        if new_text_clean == old_text_clean:
-            logger.warning(f"[重复检测] 检测到完全相同的发言（角色: {current_role}）")
-            return True
-        
-        # 计算相似度（使用最长公共子序列或简单的字符重叠率）
-        similarity = calculate_text_similarity(new_text_clean, old_text_clean)
-        
-        # 对于审判员的短指令，使用更低的相似度阈值
-        threshold = 0.80 if is_judge_short_command else similarity_threshold
-        
-        if similarity >= threshold:
-            logger.warning(f"[重复检测] 检测到高度相似的发言（角色: {current_role}, 相似度: {similarity:.2f}）")
+    old_texts_clean = [old_text.strip() for old_text in recent_speeches]
+    
+    # 如果完全相同，直接判定为重复
+    if new_text_clean in old_texts_clean:
+        logger.warning(f"[重复检测] 检测到完全相同的发言（角色: {current_role}）")
+        return True
+    
+    # 对于审判员的短指令，使用更低的相似度阈值
+    threshold = 0.80 if is_judge_short_command else similarity_threshold
+    
+    # 与最近几条发言的阈值判断在一次打包的 LCS 扫描中完成（各条分别提前结束），只在判定重复时计算完整相似度用于日志
+    match = new_text_similarity.first_at_least(old_texts_clean, threshold)
+    if match is not None:
+        old_text_clean = old_texts_clean[match]
+        similarity = new_text_similarity.score(old_text_clean)
+        logger.warning(f"[重复检测] 检测到高度相似的发言（角色: {current_role}, 相似度: {similarity:.2f}）")
+        logger.warning(f"[重复检测] 新发言预览: {new_text_clean[:100]}...")
+        logger.warning(f"[重复检测] 历史发言预览: {old_text_clean[:100]}...")
+        return True
+    
+    if SPEECH_DEDUP_SCOPE != 'off':
+        index = get_speech_index(messages, trial_id)
+        matches = index.near_duplicates(
+            new_text_clean, role=target_role if SPEECH_DEDUP_SCOPE == 'role' else None, threshold=SPEECH_DEDUP_THRESHOLD
+        )
+        if matches:
+            match_role, match_text, jaccard = matches[0]
+            logger.warning(f"[重复检测] 检测到与较早发言近似重复（角色: {current_role}, 原发言角色: {match_role}, "
+                           f"Jaccard: {jaccard:.2f}，共索引 {len(index)} 条发言）")
             logger.warning(f"[重复检测] 新发言预览: {new_text_clean[:100]}...")
-            logger.warning(f"[重复检测] 历史发言预览: {old_text_clean[:100]}...")
+            logger.warning(f"[重复检测] 历史发言预览: {match_text[:100]}...")
             return True
     
     return False
@@ -448,7 +846,7 @@ def check_duplicate_speech(new_text: str, messages: list, current_role: str, sim
 def calculate_text_similarity(text1: str, text2: str) -> float:
     """
     计算两个文本的相似度（0-1之间）
-    使用简单的字符重叠率和最长公共子序列
+    字符重叠率与最长公共子序列的加权平均（位并行 LCS 实现，见 text_similarity 模块）
     
     Args:
         text1: 文本1
@@ -457,45 +855,7 @@ def calculate_text_similarity(text1: str, text2: str) -> float:
     Returns:
         相似度（0-1之间）
     """
-    if not text1 or not text2:
-        return 0.0
-    
-    # 如果文本完全相同
-    if text1 == text2:
-        return 1.0
-    
-    # 计算字符重叠率
-    set1 = set(text1)
-    set2 = set(text2)
-    
-    if not set1 or not set2:
-        return 0.0
-    
-    intersection = len(set1 & set2)
-    union = len(set1 | set2)
-    
-    char_overlap = intersection / union if union > 0 else 0.0
-    
-    # 计算最长公共子序列长度
-    def lcs_length(s1, s2):
-        m, n = len(s1), len(s2)
-        dp = [[0] * (n + 1) for _ in range(m + 1)]
-        for i in range(1, m + 1):
-            for j in range(1, n + 1):
-                if s1[i-1] == s2[j-1]:
-                    dp[i][j] = dp[i-1][j-1] + 1
-                else:
-                    dp[i][j] = max(dp[i-1][j], dp[i][j-1])
-        return dp[m][n]
-    
-    lcs_len = lcs_length(text1, text2)
-    max_len = max(len(text1), len(text2))
-    lcs_ratio = lcs_len / max_len if max_len > 0 else 0.0
-    
-    # 综合相似度（字符重叠率和LCS比率的加权平均）
-    similarity = 0.4 * char_overlap + 0.6 * lcs_ratio
-    
-    return similarity
+    return text_similarity(text1, text2)
 
 
 def resolve_model_path(adapter_dir: str) -> str:
@@ -566,6 +926,81 @@ def resolve_model_path(adapter_dir: str) -> str:
     raise FileNotFoundError(error_msg)
 
 
+def get_model_kwargs_from_env():
+    """
+    从环境变量读取模型加载参数（ADAPTER_DIR 之外的部分）
+    
+    环境变量：
+        LOAD_IN_4BIT: 是否使用4bit量化（默认 true）
+        GPU_ID: GPU设备ID（默认 0）
+        ENABLE_BATCHING: 是否启用连续批处理，把并发请求合并到同一解码批次（默认 false）
+        MAX_BATCH_SIZE: 连续批处理的最大批大小（默认 8）
+        BATCH_MAX_WAIT_MS: 批次空闲时为凑批等待的最长毫秒数（默认 10）
+        PREFIX_CACHE_MB: 系统提示词前缀KV缓存的内存预算（MB，默认 0 即不启用）
+        SESSION_CACHE_MB: 会话级增量KV缓存的内存预算（MB，默认 0 即不启用）
+        SESSION_CACHE_TTL: 会话KV空闲失效时间（秒，默认 1800）
+        SESSION_CACHE_MAX: 最多同时缓存的会话数（默认 64）
+        STOP_SEQUENCES: 按角色配置的停止序列（JSON，如 {"审判员": ["</final>"], "*": ["</final>", "\\n审判员："]}，
+            "*" 只作用于辩论角色），不设置时使用默认值（</final>，辩论角色再加上其他角色的发言前缀）；
+            /api/generate、/api/chat 可以用请求中的 stop 字段覆盖
+        DRAFT_MODEL: 投机解码草稿模型路径（可选，须与基础模型共用 tokenizer，如 Qwen/Qwen2.5-0.5B-Instruct）
+        NUM_ASSISTANT_TOKENS: 草稿模型每轮提出的候选 token 数（默认 5）
+        PROMPT_LOOKUP_TOKENS: prompt lookup 解码每轮从提示词复制的候选 token 数（默认 0 即不启用，无需草稿模型）
+        PROMPT_LOOKUP_MAX_NGRAM: prompt lookup 匹配使用的最长 n-gram（默认 3）
+        MERGED_MODEL_DIR: `python infer.py export-merged` 导出的合并模型目录（可选，设置后忽略 ADAPTER_DIR，
+            直接加载合并后的权重，冷启动更快、解码没有额外的 LoRA 计算）
+        ADAPTERS: 额外的命名 LoRA 适配器（JSON，如 {"judge_strict": "court_debate_model_judge"}），
+            与 ADAPTER_DIR（名为 default）共用一份常驻的基础模型，请求中用 adapter 字段选择
+        MAX_RESIDENT_ADAPTERS: 同时驻留显存的适配器数上限（含 default，默认 0 即不限制），超出时按 LRU 卸载
+        CPU_QUANTIZATION: 无 GPU 时的量化方式，int8（合并适配器后动态 int8 量化）或 none；
+            不设置时跟随 LOAD_IN_4BIT（为 true 时使用 int8）
+        CPU_DTYPE: 无 GPU 且不做 int8 量化时的精度，auto（CPU 支持 bf16 指令时用 bf16）/bf16/fp32（默认 auto）
+        CPU_THREADS: CPU 推理线程数（默认 0 即使用进程可用的全部 CPU）
+        BANNED_PHRASES: 按角色配置解码时禁用的短语（JSON，如 {"审判员": ["我方认为"], "*": []}），
+            不设置时使用默认值（审判员的角色混淆用语、公诉人/辩护人的审判员口吻、聊天模板标记）
+        REPETITION_BLOCKING: 按角色配置解码期重复 n-gram 屏蔽（JSON，如 {"审判员": {"ngram_size": 6}, "公诉人": {"penalty": 5.0}}，
+            字段为 ngram_size/penalty/max_references，penalty 为 null 表示直接屏蔽；{"*": {}} 表示所有角色按默认值
+            屏蔽复现自己最近 3 次发言中 8-gram 的 token），不设置时不启用，未配置的角色也不启用
+        CONTEXT_TOKEN_BUDGET: 提示词（系统提示词 + 历史 + 本轮消息）的 token 预算（默认 0 即不限制），
+            历史发言用真实 tokenizer 计数，从最新一条开始整条保留直到预算用完；系统提示词（含案件背景）占满预算时
+            仍保留最近的 2 条（旧格式 6 条）历史，并输出警告
+        CONTEXT_MAX_TURNS: 提示词中最多保留的历史发言条数（默认 0 即只受 token 预算限制）
+        BEST_OF_N: 按角色配置 best-of-N 候选数（JSON，如 {"审判员": 3}；只写数字时只作用于审判员），
+            启用后一次批量生成 N 个候选并用校验规则挑选，代替串行重试（默认不启用）
+    """
+    adapters = json.loads(os.getenv("ADAPTERS")) if os.getenv("ADAPTERS") else None
+    best_of_n = json.loads(os.getenv("BEST_OF_N")) if os.getenv("BEST_OF_N") else None
+    if isinstance(best_of_n, int):
+        best_of_n = {'审判员': best_of_n}
+    return {
+        'load_in_4bit': os.getenv("LOAD_IN_4BIT", "true").lower() == "true",
+        'gpu_id': int(os.getenv("GPU_ID", "0")),
+        'enable_batching': os.getenv("ENABLE_BATCHING", "false").lower() == "true",
+        'max_batch_size': int(os.getenv("MAX_BATCH_SIZE", "8")),
+        'max_wait_ms': float(os.getenv("BATCH_MAX_WAIT_MS", "10")),
+        'prefix_cache_mb': int(os.getenv("PREFIX_CACHE_MB", "0")),
+        'session_cache_mb': int(os.getenv("SESSION_CACHE_MB", "0")),
+        'session_ttl_sec': float(os.getenv("SESSION_CACHE_TTL", "1800")),
+        'max_sessions': int(os.getenv("SESSION_CACHE_MAX", "64")),
+        'stop_sequences': json.loads(os.getenv("STOP_SEQUENCES")) if os.getenv("STOP_SEQUENCES") else None,
+        'draft_model': os.getenv("DRAFT_MODEL") or None,
+        'num_assistant_tokens': int(os.getenv("NUM_ASSISTANT_TOKENS", "5")),
+        'prompt_lookup_num_tokens': int(os.getenv("PROMPT_LOOKUP_TOKENS", "0")),
+        'prompt_lookup_max_ngram': int(os.getenv("PROMPT_LOOKUP_MAX_NGRAM", "3")),
+        'merged_model_dir': resolve_model_path(os.getenv("MERGED_MODEL_DIR")) if os.getenv("MERGED_MODEL_DIR") else None,
+        'adapters': {name: resolve_model_path(path) for name, path in adapters.items()} if adapters else None,
+        'max_resident_adapters': int(os.getenv("MAX_RESIDENT_ADAPTERS", "0")),
+        'cpu_quantization': os.getenv("CPU_QUANTIZATION") or None,
+        'cpu_dtype': os.getenv("CPU_DTYPE", "auto"),
+        'cpu_threads': int(os.getenv("CPU_THREADS", "0")),
+        'best_of_n': best_of_n,
+        'banned_phrases': json.loads(os.getenv("BANNED_PHRASES")) if os.getenv("BANNED_PHRASES") else None,
+        'context_token_budget': int(os.getenv("CONTEXT_TOKEN_BUDGET", "0")),
+        'context_max_turns': int(os.getenv("CONTEXT_MAX_TURNS", "0")),
+        'repetition_blocking': json.loads(os.getenv("REPETITION_BLOCKING")) if os.getenv("REPETITION_BLOCKING") else None,
+    }
+
+
 def update_init_progress(step, message):
     """更新模型初始化进度"""
     global _model_init_status
@@ -599,25 +1034,24 @@ def init_model_async():
             update_init_progress('start', '正在加载AI模型...')
             
             adapter_dir_env = os.getenv("ADAPTER_DIR", "court_debate_model")
+            model_kwargs = get_model_kwargs_from_env()
             
-            # 解析模型路径
-            adapter_dir = resolve_model_path(adapter_dir_env)
+            # 解析模型路径（使用合并模型时不需要适配器目录）
+            adapter_dir = model_kwargs['merged_model_dir'] or resolve_model_path(adapter_dir_env)
             update_init_progress('path_resolved', f'使用模型目录: {adapter_dir}')
             
-            load_in_4bit = os.getenv("LOAD_IN_4BIT", "true").lower() == "true"
-            gpu_id = int(os.getenv("GPU_ID", "0"))
-            
-            update_init_progress('config', f'配置: 4bit量化={load_in_4bit}, GPU={gpu_id}')
+            update_init_progress('config', f'配置: 4bit量化={model_kwargs["load_in_4bit"]}, GPU={model_kwargs["gpu_id"]}, 连续批处理={model_kwargs["enable_batching"]}')
             
             # 开始加载模型（这一步会花费很长时间，我们添加更多进度点）
             update_init_progress('loading_tokenizer', '正在加载tokenizer...')
             
             _model_lock = True
+            load_start = time.perf_counter()
             _model = CourtDebateModel(
                 adapter_dir=adapter_dir,
-                load_in_4bit=load_in_4bit,
-                gpu_id=gpu_id
+                **model_kwargs
             )
+            MODEL_LOAD_SECONDS.set(time.perf_counter() - load_start)
             
             # 模型加载完成后，更新进度
             update_init_progress('model_loaded', '模型加载完成，正在验证...')
@@ -658,20 +1092,19 @@ def get_model():
         try:
             logger.info("正在加载AI模型...")
             adapter_dir_env = os.getenv("ADAPTER_DIR", "court_debate_model")
+            model_kwargs = get_model_kwargs_from_env()
             
-            # 解析模型路径
-            adapter_dir = resolve_model_path(adapter_dir_env)
+            # 解析模型路径（使用合并模型时不需要适配器目录）
+            adapter_dir = model_kwargs['merged_model_dir'] or resolve_model_path(adapter_dir_env)
             logger.info(f"使用模型目录: {adapter_dir}")
             
-            load_in_4bit = os.getenv("LOAD_IN_4BIT", "true").lower() == "true"
-            gpu_id = int(os.getenv("GPU_ID", "0"))
-            
+            load_start = time.perf_counter()
             _model = CourtDebateModel(
                 adapter_dir=adapter_dir,
-                load_in_4bit=load_in_4bit,
-                gpu_id=gpu_id
+                **model_kwargs
             )
-            logger.info("AI模型加载完成！")
+            MODEL_LOAD_SECONDS.set(time.perf_counter() - load_start)
+            logger.info(f"AI模型加载完成！耗时 {time.perf_counter() - load_start:.1f}秒")
         except Exception as e:
             logger.error(f"模型加载失败: {e}")
             _model_lock = False
@@ -691,6 +1124,12 @@ def health():
     })
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus 抓取接口（文本暴露格式 0.0.4）"""
+    return Response(METRICS.render(), mimetype=None, content_type=CONTENT_TYPE_LATEST)
+
+
 @app.route('/api/model/init', methods=['POST'])
 def init_model():
     """初始化模型（后台异步加载）"""
@@ -735,12 +1174,42 @@ def get_model_status():
             'error': _model_init_status['error']
         }
     
+    # 连续批处理调度统计（仅在启用时返回）
+    if _model is not None and getattr(_model, 'scheduler', None) is not None:
+        status['scheduler'] = _model.scheduler.stats()
+    if _model is not None and getattr(_model, 'prefix_cache', None) is not None:
+        status['prefix_cache'] = _model.prefix_cache.stats()
+    if _model is not None and getattr(_model, 'session_cache', None) is not None:
+        status['session_cache'] = _model.session_cache.stats()
+    if _model is not None and getattr(_model, 'spec_stats', None) is not None:
+        status['speculative'] = _model.spec_stats.as_dict()
+    if _model is not None:
+        status['adapters'] = _model.adapter_stats()
+    if SPEECH_DEDUP_SCOPE != 'off':
+        status['speech_index'] = SPEECH_INDEX_STORE.stats()
+    status['content_store'] = CONTENT_STORE.stats()
+    status['debate_sessions'] = DEBATE_SESSIONS.stats()
+    if ADMISSION_ENABLED:
+        status['admission'] = ADMISSION.stats()
+    status['external_ai'] = EXTERNAL_AI_CLIENT.stats()
+    
     return jsonify({
         'success': True,
         'status': status
     })
 
 
+@app.route('/api/model/adapters', methods=['GET'])
+def list_model_adapters():
+    """列出已注册的命名适配器（请求中通过 adapter 字段选择）"""
+    if _model is None:
+        return jsonify({'error': '模型未加载'}), 500
+    return jsonify({
+        'success': True,
+        'adapters': _model.list_adapters()
+    })
+
+
 @app.route('/api/diagnose/external-ai', methods=['GET'])
 def diagnose_external_ai():
     """
@@ -867,13 +1336,19 @@ def generate():
         top_p = data.get('top_p', 0.9)
         system_prompt = data.get('system_prompt')
         assistant_role = data.get('assistant_role')
+        adapter = data.get('adapter')
+        stop = data.get('stop')
         
         if not prompt:
             return jsonify({'error': 'prompt参数不能为空'}), 400
+        if stop is not None and not (isinstance(stop, list) and all(isinstance(s, str) for s in stop)):
+            return jsonify({'error': 'stop参数必须是字符串列表'}), 400
         
         model = get_model()
         if model is None:
             return jsonify({'error': '模型未加载'}), 500
+        if not model.has_adapter(adapter):
+            return jsonify({'error': f'未注册的适配器: {adapter}'}), 400
         
         # 构建完整的原始输入消息列表（与模型实际接收的格式一致）
         full_messages = []
@@ -881,46 +1356,33 @@ def generate():
             full_messages.append({"role": "system", "content": system_prompt})
         full_messages.append({"role": "user", "content": prompt})
         
-        # 输出最原始的输入提示词（与传递给模型的格式完全一致）
-        logger.info("=" * 80)
-        logger.info("【AI调用 - generate】最原始输入提示词")
-        logger.info("=" * 80)
-        logger.info(f"助手角色: {assistant_role if assistant_role else '(无)'}")
-        logger.info(f"参数: max_new_tokens={max_tokens}, temperature={temperature}, top_p={top_p}")
-        logger.info(f"完整消息列表数量: {len(full_messages)}")
-        logger.info("")
-        logger.info("--- 完整原始输入消息列表（按顺序） ---")
-        for i, msg in enumerate(full_messages):
-            role = msg.get('role', '')
-            content = msg.get('content', '')
-            content_preview = content[:200] + "..." if len(content) > 200 else content
-            logger.info(f"消息[{i}]: role='{role}', content长度={len(content)}字符")
-            logger.info(f"  内容预览: {content_preview}")
-            if len(content) > 200:
-                logger.info(f"  完整内容: {content}")
-        logger.info("--- 原始输入消息列表结束 ---")
-        logger.info("")
-        if system_prompt:
-            logger.info("--- 系统提示词（完整） ---")
-            logger.info(system_prompt)
-            logger.info("--- 系统提示词结束 ---")
-        logger.info("=" * 80)
-        
-        response = model.generate(
-            prompt=prompt,
-            max_new_tokens=max_tokens,
-            temperature=temperature,
-            top_p=top_p,
-            system_prompt=system_prompt,
-            assistant_role=assistant_role
-        )
+        # 输出完整输入提示词（与传递给模型的格式完全一致，抽样写入提示词日志）
+        log_prompt('generate', full_messages, assistant_role=assistant_role, adapter=adapter,
+                   max_new_tokens=max_tokens, temperature=temperature, top_p=top_p)
+        
+        gen_info = {}
+        with trace_span('generate'):
+            response = model.generate(
+                prompt=prompt,
+                max_new_tokens=max_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                system_prompt=system_prompt,
+                assistant_role=assistant_role,
+                stop_sequences=stop,
+                adapter=adapter,
+                gen_info=gen_info,
+            )
+        trace_generation(gen_info)
+        log_generation_stats("[性能]", gen_info)
         
         # 清理特殊标记
         cleaned_response = clean_special_tokens(response)
         
         return jsonify({
             'response': cleaned_response,
-            'success': True
+            'success': True,
+            'generation': gen_info,
         })
     
     except Exception as e:
@@ -942,13 +1404,19 @@ def chat():
         top_p = data.get('top_p', 0.9)
         system_prompt = data.get('system_prompt')
         assistant_role = data.get('assistant_role')
+        adapter = data.get('adapter')
+        stop = data.get('stop')
         
         if not messages:
             return jsonify({'error': 'messages参数不能为空'}), 400
+        if stop is not None and not (isinstance(stop, list) and all(isinstance(s, str) for s in stop)):
+            return jsonify({'error': 'stop参数必须是字符串列表'}), 400
         
         model = get_model()
         if model is None:
             return jsonify({'error': '模型未加载'}), 500
+        if not model.has_adapter(adapter):
+            return jsonify({'error': f'未注册的适配器: {adapter}'}), 400
         
         # 构建完整的原始输入消息列表（与模型实际接收的格式一致）
         full_messages = []
@@ -956,46 +1424,33 @@ def chat():
             full_messages.append({"role": "system", "content": system_prompt})
         full_messages.extend(messages)
         
-        # 输出最原始的输入提示词（与传递给模型的格式完全一致）
-        logger.info("=" * 80)
-        logger.info("【AI调用 - chat】最原始输入提示词")
-        logger.info("=" * 80)
-        logger.info(f"助手角色: {assistant_role if assistant_role else '(无)'}")
-        logger.info(f"参数: max_new_tokens={max_tokens}, temperature={temperature}, top_p={top_p}")
-        logger.info(f"完整消息列表数量: {len(full_messages)}")
-        logger.info("")
-        logger.info("--- 完整原始输入消息列表（按顺序） ---")
-        for i, msg in enumerate(full_messages):
-            role = msg.get('role', '')
-            content = msg.get('content', '')
-            content_preview = content[:200] + "..." if len(content) > 200 else content
-            logger.info(f"消息[{i}]: role='{role}', content长度={len(content)}字符")
-            logger.info(f"  内容预览: {content_preview}")
-            if len(content) > 200:
-                logger.info(f"  完整内容: {content}")
-        logger.info("--- 原始输入消息列表结束 ---")
-        logger.info("")
-        if system_prompt:
-            logger.info("--- 系统提示词（完整） ---")
-            logger.info(system_prompt)
-            logger.info("--- 系统提示词结束 ---")
-        logger.info("=" * 80)
-        
-        response = model.chat(
-            messages=messages,
-            max_new_tokens=max_tokens,
-            temperature=temperature,
-            top_p=top_p,
-            system_prompt=system_prompt,
-            assistant_role=assistant_role
-        )
+        # 输出完整输入提示词（与传递给模型的格式完全一致，抽样写入提示词日志）
+        log_prompt('chat', full_messages, assistant_role=assistant_role, adapter=adapter,
+                   max_new_tokens=max_tokens, temperature=temperature, top_p=top_p)
+        
+        gen_info = {}
+        with trace_span('generate'):
+            response = model.chat(
+                messages=messages,
+                max_new_tokens=max_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                system_prompt=system_prompt,
+                assistant_role=assistant_role,
+                stop_sequences=stop,
+                adapter=adapter,
+                gen_info=gen_info,
+            )
+        trace_generation(gen_info)
+        log_generation_stats("[性能]", gen_info, assistant_role)
         
         # 清理特殊标记
         cleaned_response = clean_special_tokens(response)
         
         return jsonify({
             'response': cleaned_response,
-            'success': True
+            'success': True,
+            'generation': gen_info,
         })
     
     except Exception as e:
@@ -1030,7 +1485,9 @@ def debate_generate():
        }
     """
     try:
-        data = request.json
+        data, error = resolve_content_refs(request.json)
+        if error is not None:
+            return error
         
         # 检查是否为训练数据格式
         if 'agent_role' in data or 'context' in data:
@@ -1050,10 +1507,12 @@ def debate_generate():
         }), 500
 
 
-def debate_generate_training_format(data):
+def debate_generate_training_format(data, session=None):
     """
     使用训练数据格式生成回复（完全按照训练数据格式）
     
+    session 为服务端庭审会话（见 /api/debate/sessions）时，系统提示词与历史发言取自会话，忽略 context。
+    
     输入字段说明（完全匹配训练数据格式）：
     - agent_role: 当前AI扮演的角色（如"审判员"、"公诉人"、"辩护人"等）
     - background: 案件背景（前面保存的案件描述）
@@ -1066,9 +1525,12 @@ def debate_generate_training_format(data):
     - user_strategy: 用户自己的辩论策略（可选，aggressive/conservative/balanced/defensive）
     - instruction: 角色指令（可选，向后兼容，如果提供则直接使用；否则根据业务参数构建）
     - reference_answer: 参考答案（训练时用，推理时不需要）
+    - trial_id / session_id: 庭审会话ID（可选，启用会话级KV缓存时用于跨轮复用 KV；重复检测复用该庭审的近似重复索引）
+    - adapter: 使用的命名适配器（可选，见环境变量 ADAPTERS，默认使用 ADAPTER_DIR）
     """
     agent_role = data.get('agent_role')  # 当前AI扮演的角色
     background = data.get('background', '')  # 案件背景
+    background_hash = data.get('background_hash')  # 案件背景摘要（见 resolve_content_refs，用于缓存系统提示词）
     context = data.get('context', '')  # 上下文（对话历史，用\n分隔）
     role_to_reply = data.get('role_to_reply', agent_role)  # 要回复的角色
     new_content = data.get('new_content', '')  # 新的内容（如审判员的提问）
@@ -1080,6 +1542,8 @@ def debate_generate_training_format(data):
     opponent_strategy = data.get('opponent_strategy')  # 对方策略
     user_strategy = data.get('user_strategy')  # 用户策略
     instruction = data.get('instruction', '')  # 角色指令（向后兼容，如果提供则直接使用）
+    trial_id = data.get('trial_id') or data.get('session_id')  # 庭审会话ID（用于会话级KV缓存）
+    adapter = data.get('adapter')  # 命名适配器（多适配器部署时按请求选择）
     
     if not agent_role:
         return jsonify({'error': 'agent_role参数不能为空'}), 400
@@ -1087,6 +1551,7 @@ def debate_generate_training_format(data):
     # 如果审判员跳过次数达到3次，直接返回硬编码的结束语（不调用AI）
     if agent_role == '审判员' and judge_skip_count >= 3:
         logger.warning(f"[审判员跳过] 跳过次数已达到{judge_skip_count}次，使用硬编码结束语")
+        record_debate_outcome(agent_role, 'skip_limit')
         hardcoded_ending = "综合全案事实、证据及双方辩论意见，本庭认为案件事实清楚，证据确实充分。现宣布法庭辩论结束，将择日宣判。"
         return jsonify({
             'code': 200,
@@ -1106,77 +1571,25 @@ def debate_generate_training_format(data):
     model = get_model()
     if model is None:
         return jsonify({'error': '模型未加载'}), 500
-    
-    # 构建系统提示词（基于训练数据格式）
-    # 如果提供了instruction（向后兼容），直接使用；否则根据业务参数构建
-    if instruction:
-        # 向后兼容：如果后端传递了完整的instruction，直接使用
-        system_prompt = build_system_prompt_from_training_format(
-            agent_role=agent_role,
-            background=background,
-            instruction=instruction
-        )
-    else:
-        # 新方案：根据业务参数统一构建系统提示词
-        system_prompt = build_system_prompt_from_training_format(
-            agent_role=agent_role,
-            background=background,
-            instruction=None,  # 不提供instruction
-            judge_type=judge_type,
-            user_identity=user_identity,
-            opponent_strategy=opponent_strategy,
-            user_strategy=user_strategy
-        )
-    logger.info(f"[训练格式] 系统提示词长度: {len(system_prompt)}")
-    
-    # 将context转换为消息格式（限制消息数量为最近4条，减少上下文长度，提高模型对最新内容的注意力）
-    # 减少历史消息数量可以：
-    # 1. 降低上下文长度，提高模型处理效率
-    # 2. 减少历史干扰，让模型更关注最新消息
-    # 3. 降低重复历史内容的可能性
-    formatted_messages = format_context_to_messages(context, max_messages=2, agent_role=agent_role)
-    logger.info(f"[训练格式] 格式化后的消息数量: {len(formatted_messages)}")
-    
-    # 如果有new_content，将其添加到消息历史中（这是训练数据格式的关键）
-    # new_content格式可能是：
-    # 1. "公诉人，对于辩护人提出的...你方如何评价？"（没有角色名，需要添加role_to_reply）
-    # 2. "审判员：公诉人，对于辩护人提出的...你方如何评价？"（已有角色名和冒号）
-    if new_content:
-        new_content_stripped = new_content.strip()
-        
-        # 检查new_content是否已经包含角色名（以role_to_reply开头）
-        has_role_prefix = new_content_stripped.startswith(role_to_reply)
-        
-        # 检查是否包含冒号（中文或英文）
-        has_colon = '：' in new_content_stripped or ':' in new_content_stripped
-        
-        # 如果已经有角色名和冒号，直接使用
-        if has_role_prefix and has_colon:
-            new_content_with_role = new_content_stripped
-        # 如果只有冒号但没有角色名，或者没有冒号，添加角色名
-        elif has_colon and not has_role_prefix:
-            # 有冒号但没有角色名，说明格式可能是"：内容"，需要添加角色名
-            colon_pos = new_content_stripped.find('：') if '：' in new_content_stripped else new_content_stripped.find(':')
-            content_part = new_content_stripped[colon_pos+1:].strip()
-            new_content_with_role = f"{role_to_reply}：{content_part}"
-        else:
-            # 没有冒号，直接添加角色名和中文冒号
-            new_content_with_role = f"{role_to_reply}：{new_content_stripped}"
-        
-        # 将new_content作为最后一条消息添加到历史中
-        # 根据文档要求：当前角色自己的发言 -> assistant，其他角色的发言 -> user
-        # new_content通常是需要回复的内容，所以应该是其他角色的发言，标记为user
-        # 但如果role_to_reply等于agent_role，说明是当前角色自己的发言，标记为assistant
-        if role_to_reply == agent_role:
-            new_msg_role = 'assistant'
-        else:
-            new_msg_role = 'user'
-        
-        formatted_messages.append({
-            'role': new_msg_role,
-            'content': new_content_with_role
-        })
-        logger.info(f"[训练格式] 已添加new_content到消息历史: {new_content_with_role[:100]}")
+    if not model.has_adapter(adapter):
+        return jsonify({'error': f'未注册的适配器: {adapter}'}), 400
+    
+    # 构建系统提示词和消息列表（基于训练数据格式）
+    system_prompt, formatted_messages, context_usage = build_training_format_messages(
+        model,
+        agent_role=agent_role,
+        background=background,
+        context=context,
+        role_to_reply=role_to_reply,
+        new_content=new_content,
+        instruction=instruction,
+        judge_type=judge_type,
+        user_identity=user_identity,
+        opponent_strategy=opponent_strategy,
+        user_strategy=user_strategy,
+        session=session,
+        background_hash=background_hash,
+    )
     
     # 注意：不再将提示词作为用户消息添加到消息历史中
     # 所有角色约束和提示已经包含在系统提示词（system_prompt）中
@@ -1196,26 +1609,21 @@ def debate_generate_training_format(data):
     except:
         pass
     
-    # 生成回复（优化：进一步降低max_new_tokens并优化参数以加快生成速度）
-    import time
-    start_time = time.time()
-    
-    # 计算输入token数（估算）
-    total_input_chars = sum(len(str(msg.get('content', ''))) for msg in formatted_messages) + len(system_prompt)
-    estimated_input_tokens = total_input_chars // 3  # 粗略估算：1 token ≈ 3字符
-    logger.info(f"[性能] 输入估算: {estimated_input_tokens} tokens, {total_input_chars} 字符")
+    # 最近一次生成的 token 数与耗时（随响应返回）
+    generation_stats = {}
     
     # 定义内部函数：执行一次生成
-    def generate_once(enhanced_prompt=False, identity_enhanced_prompt=False):
-        """执行一次生成并返回清理后的回复
+    def generate_once(enhanced_prompt=False, identity_enhanced_prompt=False, num_candidates=1):
+        """执行一次生成并返回清理后的回复列表
         
         Args:
             enhanced_prompt: 如果为True，在提示词中添加更强的约束（用于重试时）
             identity_enhanced_prompt: 如果为True，在提示词中添加审判员身份约束（用于角色混淆重试时）
-        """
-        import time
-        gen_start_time = time.time()
+            num_candidates: 候选数，大于1时在一个批次中采样多个候选（best-of-N）
         
+        Returns:
+            清理后的回复列表（num_candidates 为 1 时只有一个元素）
+        """
         # 构建完整的原始输入消息列表（与模型实际接收的格式一致）
         full_messages = []
         current_system_prompt = system_prompt
@@ -1240,55 +1648,50 @@ def debate_generate_training_format(data):
             full_messages.append({"role": "system", "content": current_system_prompt})
         full_messages.extend(formatted_messages)
         
-        # 输出最原始的输入提示词（与传递给模型的格式完全一致）
-        logger.info("=" * 80)
-        logger.info("【AI调用 - debate_generate_training_format】最原始输入提示词")
-        logger.info("=" * 80)
-        logger.info(f"助手角色: {agent_role}")
-        logger.info(f"参数: max_new_tokens=400, temperature=0.65, top_p=0.95")
-        logger.info(f"完整消息列表数量: {len(full_messages)}")
-        logger.info("")
-        logger.info("--- 系统提示词（完整） ---")
-        logger.info(current_system_prompt)
-        logger.info("--- 系统提示词结束 ---")
-        logger.info("")
-        logger.info("--- 完整原始输入消息列表（按顺序） ---")
-        for i, msg in enumerate(full_messages):
-            role = msg.get('role', '')
-            content = msg.get('content', '')
-            # 对于system消息，只显示长度和预览，不重复输出完整内容（已在上面单独输出）
-            if role == 'system':
-                logger.info(f"消息[{i}]: role='{role}', content长度={len(content)}字符（完整内容已在上方单独显示）")
-            else:
-                content_preview = content[:200] + "..." if len(content) > 200 else content
-                logger.info(f"消息[{i}]: role='{role}', content长度={len(content)}字符")
-                logger.info(f"  内容预览: {content_preview}")
-                if len(content) > 200:
-                    logger.info(f"  完整内容: {content}")
-        logger.info("--- 原始输入消息列表结束 ---")
-        logger.info("=" * 80)
+        # 输出完整输入提示词（与传递给模型的格式完全一致，抽样写入提示词日志）
+        log_prompt('debate_generate_training_format', full_messages, assistant_role=agent_role, adapter=adapter,
+                   max_new_tokens=400, temperature=0.65, top_p=0.95, num_candidates=num_candidates)
         
         # 提高temperature以增加创造性，避免重复上下文内容
         # temperature=0.6-0.7可以增加多样性，减少重复
         # 限制生成长度：允许生成足够内容，但通过后处理确保简洁
-        response = model.chat(
+        gen_info = {}
+        chat_kwargs = dict(
             messages=formatted_messages,
             max_new_tokens=400,  # 设置为400 tokens，确保内容完整，通过后处理控制长度
             temperature=0.65,  # 提高温度以增加创造性，减少重复上下文内容（从0.3提高到0.65）
             top_p=0.95,  # 提高top_p以增加多样性（从0.9提高到0.95）
             system_prompt=current_system_prompt,
-            assistant_role=agent_role
+            assistant_role=agent_role,
+            # 同一庭审中每个角色的提示词各自只追加，按"庭审ID:角色"区分会话
+            session_id=f"{trial_id}:{agent_role}" if trial_id else None,
+            adapter=adapter,
+            # 解码时避免复现本角色最近发言中的长片段（生成后的 check_duplicate_speech 仍作为兜底）
+            previous_speeches=get_role_speeches(context_messages, agent_role),
         )
+        with trace_span('generate', candidates=num_candidates):
+            if num_candidates > 1:
+                # best-of-N：提示词只 prefill 一次，N 个候选在同一批次中采样
+                responses = model.chat_candidates(num_candidates=num_candidates, gen_info=gen_info, **chat_kwargs)
+            else:
+                responses = [model.chat(gen_info=gen_info, **chat_kwargs)]
+        trace_generation(gen_info)
         
-        elapsed_time = time.time() - gen_start_time
-        tokens_per_sec = len(response) / 3 / elapsed_time if elapsed_time > 0 else 0  # 粗略估算
-        logger.info(f"[性能] 生成耗时: {elapsed_time:.2f}秒, 回复长度: {len(response)}字符, 速度: {tokens_per_sec:.1f} tokens/秒")
+        log_generation_stats("[性能]", gen_info, agent_role)
+        generation_stats.clear()
+        generation_stats.update(gen_info)
         
+        with trace_span('postprocess'):
+            return [postprocess_response(response, gen_info) for response in responses]
+    
+    def postprocess_response(response, gen_info):
+        """清理一条模型回复（特殊标记、重复角色前缀、审判员口吻）"""
         # 【调试】检查是否包含"辩论结束"且长度很短
         if agent_role == '审判员' and '辩论结束' in response and len(response) < 50:
             logger.warning(f"[调试] 检测到模型生成了很短的回复（{len(response)}字符），包含'辩论结束'")
             logger.warning(f"[调试] 完整回复内容: {repr(response)}")
-            logger.warning(f"[调试] 生成耗时: {elapsed_time:.2f}秒，速度: {tokens_per_sec:.1f} tokens/秒")
+            logger.warning(f"[调试] 生成 {gen_info.get('generated_tokens')} tokens，结束原因: "
+                           f"{gen_info.get('stop_reason') or gen_info.get('stop_reasons')}")
             logger.warning(f"[调试] 可能原因分析：")
             logger.warning(f"[调试] 1. 模型在生成'辩论结束'后遇到了EOS token，导致提前停止")
             logger.warning(f"[调试] 2. 模型认为'辩论结束'就是完整的输出（可能是训练时的模式）")
@@ -1318,8 +1721,15 @@ def debate_generate_training_format(data):
         
         return cleaned_response
     
+    # 历史发言（用于 best-of-N 挑选和重复检测）
+    with trace_span('parse_context'):
+        context_messages = session.speech_messages() if session is not None else parse_context_to_speech_messages(context)
+    
+    # best-of-N：一次批量生成多个候选并挑选，不再串行重试
+    num_candidates = model.get_num_candidates(agent_role)
+    
     # 重试机制：对于审判员，如果检测到角色混淆，最多重试2次
-    max_retries = 2 if agent_role == '审判员' else 0
+    max_retries = 2 if agent_role == '审判员' and num_candidates == 1 else 0
     cleaned_response = None
     retry_count = 0
     has_confusion = False
@@ -1336,22 +1746,32 @@ def debate_generate_training_format(data):
                 logger.warning(f"[角色混淆重试] 第{retry_count}次重试生成（角色: {agent_role}）")
         
         # 生成回复（如果是重试且之前检测到结束语问题，使用增强提示词；若是角色混淆重试，使用身份增强提示词）
-        cleaned_response = generate_once(enhanced_prompt=use_enhanced_prompt, identity_enhanced_prompt=use_identity_enhanced_prompt)
+        if num_candidates > 1:
+            candidates = generate_once(num_candidates=num_candidates)
+            with trace_span('rank_candidates'):
+                best_index, issues = rank_speech_candidates(candidates, agent_role, context_messages, trial_id=trial_id)
+            cleaned_response = candidates[best_index]
+            logger.info(f"[best-of-N] 从{len(candidates)}个候选中选择第{best_index + 1}个（问题: {issues or '无'}）")
+        else:
+            cleaned_response = generate_once(enhanced_prompt=use_enhanced_prompt, identity_enhanced_prompt=use_identity_enhanced_prompt)[0]
         
         # 检查审判员的角色混淆和结束语格式
         if agent_role == '审判员':
-            has_confusion = check_judge_role_confusion(cleaned_response, agent_role)
-            has_ending_without_summary = check_judge_ending_without_summary(cleaned_response, agent_role)
+            with trace_span('judge_checks'):
+                has_confusion = check_judge_role_confusion(cleaned_response, agent_role)
+                has_ending_without_summary = check_judge_ending_without_summary(cleaned_response, agent_role)
             
             if has_confusion:
                 if retry_count < max_retries:
                     logger.warning(f"[角色混淆重试] 检测到角色混淆，将进行第{retry_count + 1}次重试")
+                    record_debate_outcome(agent_role, 'retry_role_confusion')
                     retry_count += 1
                     use_enhanced_prompt = False  # 角色混淆重试不使用增强提示词
                     use_identity_enhanced_prompt = True  # 角色混淆重试使用身份增强提示词
                     continue
                 else:
                     logger.error(f"[角色混淆重试] 重试{max_retries}次后仍检测到角色混淆，跳过此次发言")
+                    record_debate_outcome(agent_role, 'skipped_role_confusion')
                     # 跳过此次发言，返回跳过消息
                     judge_skip_count += 1
                     return jsonify({
@@ -1365,12 +1785,14 @@ def debate_generate_training_format(data):
             elif has_ending_without_summary:
                 if retry_count < max_retries:
                     logger.warning(f"[结束语检查重试] 检测到只有\"辩论结束\"而没有总结，将进行第{retry_count + 1}次重试（使用增强提示词）")
+                    record_debate_outcome(agent_role, 'retry_ending_without_summary')
                     retry_count += 1
                     use_enhanced_prompt = True  # 结束语问题重试使用增强提示词
                     use_identity_enhanced_prompt = False  # 结束语重试不使用身份增强提示词
                     continue
                 else:
                     logger.error(f"[结束语检查重试] 重试{max_retries}次后仍检测到只有\"辩论结束\"而没有总结，使用硬编码结束语")
+                    record_debate_outcome(agent_role, 'hardcoded_ending')
                     # 使用硬编码的完整结束语
                     judge_skip_count += 1
                     hardcoded_ending = "综合全案事实、证据及双方辩论意见，本庭认为案件事实清楚，证据确实充分。现宣布法庭辩论结束，将择日宣判。"
@@ -1392,6 +1814,7 @@ def debate_generate_training_format(data):
     # 如果所有重试都失败（理论上不应该到这里，因为上面已经处理了）
     if has_confusion and agent_role == '审判员':
         logger.error(f"[角色混淆] 所有重试都失败，跳过此次发言")
+        record_debate_outcome(agent_role, 'skipped_role_confusion')
         judge_skip_count += 1
         return jsonify({
             'code': 200,
@@ -1402,39 +1825,7 @@ def debate_generate_training_format(data):
             'is_skipped': True
         })
     
-    # 检查是否与历史消息重复（需要将context转换为messages格式进行检查）
-    # 从context中提取历史消息
-    context_messages = []
-    if context:
-        lines = context.strip().split('\n')
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-            # 解析角色和内容
-            if '：' in line:
-                parts = line.split('：', 1)
-                role_name = parts[0].strip()
-                content = parts[1].strip() if len(parts) > 1 else ''
-            elif ':' in line:
-                parts = line.split(':', 1)
-                role_name = parts[0].strip()
-                content = parts[1].strip() if len(parts) > 1 else ''
-            else:
-                continue
-            
-            # 转换为消息格式
-            role_map = {
-                '审判员': 'judge',
-                '公诉人': 'plaintiff',
-                '辩护人': 'defendant'
-            }
-            msg_role = role_map.get(role_name, role_name)
-            context_messages.append({
-                'role': msg_role,
-                'text': content
-            })
-    
+    # 检查是否与历史消息重复（context_messages 已在上方解析）
     # 检查重复
     role_map_for_check = {
         '审判员': 'judge',
@@ -1444,8 +1835,11 @@ def debate_generate_training_format(data):
     check_role = role_map_for_check.get(agent_role, agent_role)
     
     is_duplicate = False
-    if check_duplicate_speech(cleaned_response, context_messages, check_role):
+    with trace_span('duplicate_check'):
+        duplicate = check_duplicate_speech(cleaned_response, context_messages, check_role, trial_id=trial_id)
+    if duplicate:
         logger.warning(f"[重复检测] 检测到重复发言，拒绝生成（角色: {agent_role}）")
+        record_debate_outcome(agent_role, 'duplicate')
         logger.warning(f"[重复检测] 重复内容预览: {cleaned_response[:100]}...")
         is_duplicate = True
         # 如果是重复发言，返回一个提示信息
@@ -1466,6 +1860,8 @@ def debate_generate_training_format(data):
         else:
             cleaned_response = f"{agent_role}：我方已在前面的发言中表达了相关观点，不再重复。"
             logger.warning(f"[重复检测] 已替换为简短提示（角色: {agent_role}）")
+    else:
+        record_debate_outcome(agent_role, 'ok')
     
     return jsonify({
         'code': 200,
@@ -1473,10 +1869,586 @@ def debate_generate_training_format(data):
         'role': agent_role,
         'success': True,
         'judge_skip_count': judge_skip_count if agent_role == '审判员' else 0,
-        'is_duplicate': is_duplicate
+        'is_duplicate': is_duplicate,
+        'context_usage': context_usage,
+        'generation': generation_stats,
     })
 
 
+def _sse_event(event, payload):
+    """格式化一条 Server-Sent Events 消息"""
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+@app.route('/api/debate/generate/stream', methods=['POST'])
+def debate_generate_stream():
+    """
+    法庭辩论流式生成（Server-Sent Events）
+    
+    输入与 /api/debate/generate 的训练数据格式相同。边解码边推送：
+    - event: token  data: {"text": "..."}   已清理的文本增量（<final> 解包、特殊标记、角色前缀已处理）
+    - event: done   data: {...}             与 /api/debate/generate 相同结构的最终结果
+    - event: error  data: {"error": "..."}
+    
+    注意：流式输出无法在发送后重试。审判员角色混淆、只有"辩论结束"或重复发言时，
+    done 事件中的 data / is_skipped / is_hardcoded / is_duplicate 会告知前端替换已显示的内容。
+    """
+    data, error = resolve_content_refs(request.json or {})
+    if error is not None:
+        return error
+    return stream_debate_generation(data)
+
+
+def stream_debate_generation(data, session=None):
+    """流式生成的实现（session 的含义同 debate_generate_training_format）"""
+    agent_role = data.get('agent_role')
+    if not agent_role:
+        return jsonify({'error': 'agent_role参数不能为空'}), 400
+    
+    context = data.get('context', '')
+    role_to_reply = data.get('role_to_reply', agent_role)
+    judge_skip_count = data.get('judge_skip_count', 0)
+    trial_id = data.get('trial_id') or data.get('session_id')
+    adapter = data.get('adapter')
+    hardcoded_ending = "综合全案事实、证据及双方辩论意见，本庭认为案件事实清楚，证据确实充分。现宣布法庭辩论结束，将择日宣判。"
+    
+    include_timings = timings_requested(data)
+    
+    def done_payload(text, **flags):
+        payload = {
+            'code': 200,
+            'data': text,
+            'role': agent_role,
+            'success': True,
+            'judge_skip_count': judge_skip_count if agent_role == '审判员' else 0,
+        }
+        payload.update(flags)
+        if session is not None:
+            record_session_turns(session, data, payload)
+        if include_timings and current_trace() is not None:
+            payload['timings'] = current_trace().as_dict()
+        return payload
+    
+    # 审判员跳过次数达到3次，直接返回硬编码的结束语（与非流式接口一致）
+    if agent_role == '审判员' and judge_skip_count >= 3:
+        logger.warning(f"[流式生成] 审判员跳过次数已达到{judge_skip_count}次，使用硬编码结束语")
+        record_debate_outcome(agent_role, 'skip_limit')
+        body = _sse_event('token', {'text': hardcoded_ending}) + _sse_event('done', done_payload(hardcoded_ending, is_hardcoded=True))
+        return Response(body, mimetype='text/event-stream')
+    
+    model = get_model()
+    if model is None:
+        return jsonify({'error': '模型未加载'}), 500
+    if not model.has_adapter(adapter):
+        return jsonify({'error': f'未注册的适配器: {adapter}'}), 400
+    
+    system_prompt, formatted_messages, context_usage = build_training_format_messages(
+        model,
+        agent_role=agent_role,
+        background=data.get('background', ''),
+        context=context,
+        role_to_reply=role_to_reply,
+        new_content=data.get('new_content', ''),
+        instruction=data.get('instruction', ''),
+        judge_type=data.get('judge_type'),
+        user_identity=data.get('user_identity'),
+        opponent_strategy=data.get('opponent_strategy'),
+        user_strategy=data.get('user_strategy'),
+        session=session,
+        background_hash=data.get('background_hash'),
+    )
+    
+    with trace_span('parse_context'):
+        context_messages = session.speech_messages() if session is not None else parse_context_to_speech_messages(context)
+    
+    def generate_events():
+        nonlocal judge_skip_count
+        start_time = time.time()
+        first_token_time = None
+        gen_info = {}
+        stop_sequences = model.get_stop_sequences(agent_role)
+        cleaner = IncrementalSpeechCleaner(agent_role, stop_sequences=stop_sequences)
+        try:
+            generate_start = time.perf_counter()
+            for delta in model.stream_chat(
+                messages=formatted_messages,
+                max_new_tokens=400,
+                temperature=0.65,
+                top_p=0.95,
+                system_prompt=system_prompt,
+                assistant_role=agent_role,
+                session_id=f"{trial_id}:{agent_role}" if trial_id else None,
+                stop_sequences=stop_sequences,
+                adapter=adapter,
+                previous_speeches=get_role_speeches(context_messages, agent_role),
+                gen_info=gen_info,
+            ):
+                text = cleaner.feed(delta)
+                if text:
+                    if first_token_time is None:
+                        first_token_time = time.time()
+                    yield _sse_event('token', {'text': text})
+            text = cleaner.flush()
+            if text:
+                yield _sse_event('token', {'text': text})
+            trace = current_trace()
+            if trace is not None:
+                trace.add_span('generate', generate_start, time.perf_counter())
+            trace_generation(gen_info)
+            
+            elapsed_time = time.time() - start_time
+            ttft = (first_token_time - start_time) if first_token_time else elapsed_time
+            logger.info(f"[流式生成] 角色: {agent_role}, 首字耗时: {ttft:.2f}秒, 总耗时: {elapsed_time:.2f}秒, 回复长度: {len(cleaner.raw)}字符")
+            log_generation_stats("[流式生成]", gen_info, agent_role)
+            
+            # 对完整输出执行与非流式接口相同的后处理
+            with trace_span('postprocess'):
+                raw = truncate_at_stop_sequence(cleaner.raw, stop_sequences)
+                response = extract_final(raw) or raw.strip()
+                cleaned_response = clean_special_tokens(response)
+                cleaned_response = remove_duplicate_role_prefix(cleaned_response, agent_role)
+                cleaned_response = filter_judge_style_speech(cleaned_response, agent_role)
+            
+            if agent_role == '审判员':
+                with trace_span('judge_checks'):
+                    has_confusion = check_judge_role_confusion(cleaned_response, agent_role)
+                    has_ending_without_summary = check_judge_ending_without_summary(cleaned_response, agent_role)
+                if has_confusion:
+                    logger.warning(f"[流式生成] 检测到审判员角色混淆，跳过此次发言")
+                    record_debate_outcome(agent_role, 'skipped_role_confusion')
+                    judge_skip_count += 1
+                    yield _sse_event('done', done_payload("不需要发言", is_skipped=True))
+                    return
+                if has_ending_without_summary:
+                    logger.warning(f"[流式生成] 检测到只有\"辩论结束\"而没有总结，使用硬编码结束语")
+                    record_debate_outcome(agent_role, 'hardcoded_ending')
+                    judge_skip_count += 1
+                    yield _sse_event('done', done_payload(hardcoded_ending, is_hardcoded=True))
+                    return
+            
+            role_map_for_check = {
+                '审判员': 'judge',
+                '公诉人': 'plaintiff',
+                '辩护人': 'defendant'
+            }
+            check_role = role_map_for_check.get(agent_role, agent_role)
+            with trace_span('duplicate_check'):
+                duplicate = check_duplicate_speech(cleaned_response, context_messages, check_role, trial_id=trial_id)
+            if duplicate:
+                logger.warning(f"[流式生成] 检测到重复发言（角色: {agent_role}）")
+                record_debate_outcome(agent_role, 'duplicate')
+                if agent_role == '审判员':
+                    yield _sse_event('done', done_payload("不需要发言", is_skipped=True, is_duplicate=True))
+                else:
+                    yield _sse_event('done', done_payload(
+                        f"{agent_role}：我方已在前面的发言中表达了相关观点，不再重复。", is_duplicate=True
+                    ))
+                return
+            
+            record_debate_outcome(agent_role, 'ok')
+            yield _sse_event('done', done_payload(cleaned_response, is_duplicate=False, context_usage=context_usage, generation=gen_info))
+        except Exception as e:
+            logger.error(f"流式生成失败: {e}")
+            import traceback
+            logger.error(traceback.format_exc())
+            flush_pending_prompts(e)
+            yield _sse_event('error', {'error': str(e), 'success': False})
+    
+    return Response(
+        stream_with_context(generate_events()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',  # 禁止 nginx 等反向代理缓冲
+        },
+    )
+
+
+# ==================== 按内容寻址的背景存储（上传一次，之后只发送摘要） ====================
+CONTENT_STORE = ContentStore(
+    max_bytes=int(float(os.getenv('CONTENT_STORE_MAX_MB', '256')) * 1024 * 1024),
+    ttl_sec=float(os.getenv('CONTENT_STORE_TTL', '0')),
+)
+
+# 可以用摘要代替的请求字段：请求中带 "<字段>_hash" 而不带字段本身时从存储中取出
+CONTENT_REF_FIELDS = ('background', 'case_description')
+
+
+def resolve_content_refs(data):
+    """
+    把请求中的内容摘要替换为内容，并为直接提交的内容登记摘要（用于缓存派生结果）
+    
+    Returns:
+        (data, error_response)：摘要未知时 error_response 为 409 响应，客户端应先 POST /api/blobs 上传
+    """
+    if not isinstance(data, dict):
+        return data, None
+    data = dict(data)
+    for field in CONTENT_REF_FIELDS:
+        hash_key = f'{field}_hash'
+        text = data.get(field)
+        if text:
+            data[hash_key] = CONTENT_STORE.put(text)
+            continue
+        digest = data.get(hash_key)
+        if not digest:
+            continue
+        text = CONTENT_STORE.get(digest)
+        if text is None:
+            logger.info(f"[内容存储] 未知的{field}摘要: {digest}")
+            return data, (jsonify({
+                'error': f'未知的{field}摘要，请先上传内容',
+                'success': False,
+                'missing': {'field': field, 'hash': digest},
+                'upload_url': '/api/blobs',
+            }), 409)
+        data[field] = text
+    return data, None
+
+
+@app.route('/api/blobs', methods=['POST'])
+def upload_blob():
+    """上传内容（如案件背景），返回摘要：{"content": "..."} -> {"hash": "<sha256>"}"""
+    data = request.json or {}
+    content = data.get('content')
+    if not isinstance(content, str) or not content:
+        return jsonify({'error': 'content参数不能为空', 'success': False}), 400
+    digest = CONTENT_STORE.put(content)
+    return jsonify({'success': True, 'hash': digest, 'size': len(content.encode('utf-8'))})
+
+
+@app.route('/api/blobs/<digest>', methods=['GET'])
+def get_blob(digest):
+    """查询内容是否已登记（HEAD 同样可用）；?content=1 时返回内容本身"""
+    content = CONTENT_STORE.get(digest)
+    if content is None:
+        return jsonify({'error': f'未知的摘要: {digest}', 'success': False}), 404
+    result = {'success': True, 'hash': digest, 'size': len(content.encode('utf-8'))}
+    if request.args.get('content') in ('1', 'true'):
+        result['content'] = content
+    return jsonify(result)
+
+
+# ==================== 服务端庭审会话（只提交新增发言） ====================
+DEBATE_SESSIONS = DebateSessionStore(
+    max_sessions=int(os.getenv('DEBATE_SESSION_MAX', '256')),
+    ttl_sec=float(os.getenv('DEBATE_SESSION_TTL', '7200')),
+)
+
+# 每轮生成请求中有效的字段（其余业务参数在创建会话时确定，系统提示词按此缓存）
+SESSION_TURN_KEYS = ('agent_role', 'role_to_reply', 'new_content', 'judge_skip_count', 'timings')
+
+
+def session_not_found(session_id):
+    return jsonify({'error': f'会话不存在或已过期: {session_id}', 'success': False}), 404
+
+
+def session_request_data(session, data):
+    """把会话中的背景与业务参数和本轮字段合并为训练数据格式的请求"""
+    merged = {key: value for key, value in session.params.items() if value is not None}
+    merged['background'] = session.background
+    merged['trial_id'] = session.session_id
+    for key in SESSION_TURN_KEYS:
+        if key in data:
+            merged[key] = data[key]
+    merged.setdefault('judge_skip_count', session.judge_skip_count)
+    return merged
+
+
+def record_session_turns(session, data, payload):
+    """把本轮的 new_content 与最终发言追加到会话（跳过发言时只追加 new_content）"""
+    agent_role = data.get('agent_role')
+    new_content = data.get('new_content')
+    if new_content:
+        turn = parse_context_line(format_new_content(new_content, data.get('role_to_reply', agent_role)))
+        if turn is not None:
+            session.append_turn(*turn)
+    if not payload.get('is_skipped') and payload.get('data'):
+        session.append_turn(agent_role, remove_duplicate_role_prefix(payload['data'], agent_role))
+    if agent_role == '审判员':
+        session.judge_skip_count = payload.get('judge_skip_count', session.judge_skip_count)
+
+
+@app.route('/api/debate/sessions', methods=['POST'])
+def create_debate_session():
+    """
+    创建庭审会话
+    
+    请求体：
+    {
+      "session_id": "...",       // 可选，默认自动生成；同时作为 trial_id（会话级 KV 缓存、近似重复索引）
+      "background": "...",       // 案件背景（只在创建时提交一次）
+      "context": "...",          // 可选，已有的对话历史（格式同 /api/debate/generate 的 context）
+      "judge_type" / "user_identity" / "opponent_strategy" / "user_strategy" / "instruction" / "adapter"
+    }
+    """
+    data, error = resolve_content_refs(request.json or {})
+    if error is not None:
+        return error
+    session_id = data.get('session_id') or data.get('trial_id')
+    session = DEBATE_SESSIONS.create(
+        session_id=str(session_id) if session_id else None,
+        background=data.get('background', ''),
+        params=data,
+    )
+    if session is None:
+        return jsonify({'error': f'会话已存在: {session_id}', 'success': False}), 409
+    session.append_context(data.get('context', ''))
+    logger.info(f"[会话] 创建会话 {session.session_id}，background长度: {len(session.background)}，已有发言 {len(session)} 条")
+    return jsonify({'success': True, 'session': session.info()})
+
+
+@app.route('/api/debate/sessions/<session_id>', methods=['GET'])
+def get_debate_session(session_id):
+    """查询会话状态"""
+    session = DEBATE_SESSIONS.get(session_id)
+    if session is None:
+        return session_not_found(session_id)
+    return jsonify({'success': True, 'session': session.info()})
+
+
+@app.route('/api/debate/sessions/<session_id>', methods=['DELETE'])
+def delete_debate_session(session_id):
+    """结束会话"""
+    if not DEBATE_SESSIONS.delete(session_id):
+        return session_not_found(session_id)
+    return jsonify({'success': True})
+
+
+@app.route('/api/debate/sessions/<session_id>/turns', methods=['POST'])
+def append_debate_session_turns(session_id):
+    """
+    追加发言（用户发言等不经过本服务生成的内容）
+    
+    请求体三选一：
+    - {"role": "公诉人", "content": "..."}
+    - {"turns": [{"role": "公诉人", "content": "..."}, ...]}
+    - {"context": "公诉人：...\n辩护人：..."}
+    """
+    session = DEBATE_SESSIONS.get(session_id)
+    if session is None:
+        return session_not_found(session_id)
+    data = request.json or {}
+    if 'turns' in data or 'role' in data:
+        turns = data.get('turns') if 'turns' in data else [data]
+        if not isinstance(turns, list) or not all(isinstance(t, dict) and t.get('role') for t in turns):
+            return jsonify({'error': 'turns 中每条发言都需要 role 和 content', 'success': False}), 400
+        for turn in turns:
+            session.append_turn(turn['role'], turn.get('content', ''))
+        added = len(turns)
+    else:
+        added = session.append_context(data.get('context', ''))
+    return jsonify({'success': True, 'added': added, 'turns': len(session)})
+
+
+@app.route('/api/debate/sessions/<session_id>/generate', methods=['POST'])
+def generate_debate_session_turn(session_id):
+    """
+    在会话中生成下一轮发言
+    
+    请求体只需本轮字段：{"agent_role": "公诉人", "role_to_reply": "审判员", "new_content": "..."}。
+    返回结构与 /api/debate/generate 相同；new_content 与最终发言（跳过时除外）会自动追加到会话。
+    """
+    session = DEBATE_SESSIONS.get(session_id)
+    if session is None:
+        return session_not_found(session_id)
+    data = session_request_data(session, request.json or {})
+    try:
+        result = debate_generate_training_format(data, session=session)
+    except Exception as e:
+        logger.error(f"会话生成失败: {e}")
+        import traceback
+        logger.error(traceback.format_exc())
+        return jsonify({
+            'error': str(e),
+            'success': False
+        }), 500
+    response = result[0] if isinstance(result, tuple) else result
+    if response.status_code == 200:
+        record_session_turns(session, data, response.get_json())
+    return result
+
+
+@app.route('/api/debate/sessions/<session_id>/generate/stream', methods=['POST'])
+def stream_debate_session_turn(session_id):
+    """会话中的流式生成（事件格式同 /api/debate/generate/stream，done 时追加发言）"""
+    session = DEBATE_SESSIONS.get(session_id)
+    if session is None:
+        return session_not_found(session_id)
+    return stream_debate_generation(session_request_data(session, request.json or {}), session=session)
+
+
+def build_training_format_messages(model, agent_role, background, context, role_to_reply, new_content,
+                                    instruction=None, judge_type=None, user_identity=None,
+                                    opponent_strategy=None, user_strategy=None, session=None, background_hash=None):
+    """
+    按训练数据格式构建系统提示词和对话消息列表（普通生成与流式生成共用）
+    
+    历史发言由 model.pack_messages 按 token 预算（CONTEXT_TOKEN_BUDGET）从最新一条开始整条保留，
+    系统提示词和 new_content 总是保留，预算不足时也至少保留最近 TRAINING_FORMAT_MIN_HISTORY_TURNS 条历史。
+    
+    传入 session（服务端庭审会话）时忽略 background/context 等参数：系统提示词与历史消息取自会话缓存。
+    传入 background_hash 时，系统提示词按（背景摘要, 角色, 业务参数）缓存在内容存储中。
+    
+    Returns:
+        (system_prompt, formatted_messages, context_usage)：context_usage 为各部分占用的 token 数
+    """
+    # 构建系统提示词（基于训练数据格式）
+    # 如果提供了instruction（向后兼容），直接使用；否则根据业务参数构建
+    def build_system_prompt_for_role():
+        if instruction:
+            # 向后兼容：如果后端传递了完整的instruction，直接使用
+            return build_system_prompt_from_training_format(
+                agent_role=agent_role,
+                background=background,
+                instruction=instruction
+            )
+        # 新方案：根据业务参数统一构建系统提示词
+        return build_system_prompt_from_training_format(
+            agent_role=agent_role,
+            background=background,
+            instruction=None,  # 不提供instruction
+            judge_type=judge_type,
+            user_identity=user_identity,
+            opponent_strategy=opponent_strategy,
+            user_strategy=user_strategy
+        )
+    
+    with trace_span('build_prompt'):
+        if session is not None:
+            system_prompt = session.system_prompt(agent_role, build_system_prompt_for_role)
+        else:
+            system_prompt = CONTENT_STORE.derived(
+                background_hash,
+                ('training_system_prompt', agent_role, instruction or None, judge_type, user_identity,
+                 opponent_strategy, user_strategy),
+                build_system_prompt_for_role,
+            )
+    logger.info(f"[训练格式] 系统提示词长度: {len(system_prompt)}")
+    
+    # 将context转换为消息格式（全部解析，由下方按 token 预算裁剪）；会话中的历史已增量解析
+    with trace_span('parse_context'):
+        if session is not None:
+            history_messages = session.history_messages(agent_role)
+        else:
+            history_messages = format_context_to_messages(context, max_messages=0, agent_role=agent_role)
+    pinned_messages = []
+    
+    # 如果有new_content，将其添加到消息历史中（这是训练数据格式的关键）
+    if new_content:
+        new_content_with_role = format_new_content(new_content, role_to_reply)
+        
+        # 将new_content作为最后一条消息添加到历史中
+        # 根据文档要求：当前角色自己的发言 -> assistant，其他角色的发言 -> user
+        # new_content通常是需要回复的内容，所以应该是其他角色的发言，标记为user
+        # 但如果role_to_reply等于agent_role，说明是当前角色自己的发言，标记为assistant
+        if role_to_reply == agent_role:
+            new_msg_role = 'assistant'
+        else:
+            new_msg_role = 'user'
+        
+        pinned_messages.append({
+            'role': new_msg_role,
+            'content': new_content_with_role
+        })
+        logger.info(f"[训练格式] 已添加new_content到消息历史: {new_content_with_role[:100]}")
+    
+    # 按 token 预算保留最近的历史（整条保留，从新到旧），new_content 总是保留
+    with trace_span('pack_context'):
+        formatted_messages, context_usage = model.pack_messages(
+            history_messages, pinned=pinned_messages, system_prompt=system_prompt, assistant_role=agent_role,
+            min_turns=TRAINING_FORMAT_MIN_HISTORY_TURNS,
+        )
+    log_context_usage("[训练格式]", context_usage)
+    return system_prompt, formatted_messages, context_usage
+
+
+def format_new_content(new_content, role_to_reply):
+    """
+    为 new_content 补全角色名，返回"角色名：内容"
+    
+    new_content格式可能是：
+    1. "公诉人，对于辩护人提出的...你方如何评价？"（没有角色名，需要添加role_to_reply）
+    2. "审判员：公诉人，对于辩护人提出的...你方如何评价？"（已有角色名和冒号）
+    """
+    new_content_stripped = new_content.strip()
+    
+    # 检查new_content是否已经包含角色名（以role_to_reply开头）
+    has_role_prefix = new_content_stripped.startswith(role_to_reply)
+    
+    # 检查是否包含冒号（中文或英文）
+    has_colon = '：' in new_content_stripped or ':' in new_content_stripped
+    
+    # 如果已经有角色名和冒号，直接使用
+    if has_role_prefix and has_colon:
+        return new_content_stripped
+    # 如果只有冒号但没有角色名，或者没有冒号，添加角色名
+    if has_colon and not has_role_prefix:
+        # 有冒号但没有角色名，说明格式可能是"：内容"，需要添加角色名
+        colon_pos = new_content_stripped.find('：') if '：' in new_content_stripped else new_content_stripped.find(':')
+        content_part = new_content_stripped[colon_pos+1:].strip()
+        return f"{role_to_reply}：{content_part}"
+    # 没有冒号，直接添加角色名和中文冒号
+    return f"{role_to_reply}：{new_content_stripped}"
+
+
+def log_generation_stats(tag, gen_info, role=None):
+    """输出一次生成的实际 token 数与耗时（见 infer.generate_one 的 gen_info），并计入 /metrics"""
+    if not gen_info:
+        return
+    label = metrics_role(role)
+    PROMPT_TOKENS.labels(role=label).inc(gen_info['prompt_tokens'])
+    CACHED_PROMPT_TOKENS.labels(role=label).inc(gen_info['cached_tokens'])
+    GENERATED_TOKENS.labels(role=label).inc(gen_info['generated_tokens'])
+    GENERATION_TTFT.labels(role=label).observe(gen_info['ttft_sec'])
+    GENERATION_DURATION.labels(role=label).observe(gen_info['total_sec'])
+    for reason in ([gen_info['stop_reason']] if gen_info.get('stop_reason') else gen_info.get('stop_reasons', [])):
+        GENERATION_STOPS.labels(role=label, reason=reason).inc()
+    stop = gen_info.get('stop_reason') or ','.join(str(r) for r in gen_info.get('stop_reasons', []))
+    logger.info(f"{tag} 提示词 {gen_info['prompt_tokens']} tokens（复用KV {gen_info['cached_tokens']}），"
+                f"生成 {gen_info['generated_tokens']} tokens，prefill {gen_info['prefill_sec']:.3f}秒，"
+                f"首 token {gen_info['ttft_sec']:.3f}秒，解码 {gen_info['decode_tokens_per_sec']:.1f} tokens/秒，"
+                f"总耗时 {gen_info['total_sec']:.2f}秒，结束原因: {stop}")
+    if 'speculative' in gen_info:
+        spec = gen_info['speculative']
+        logger.info(f"{tag} 投机解码: 候选 {spec['proposed_tokens']} 个, 接受 {spec['accepted_tokens']} 个, "
+                    f"接受率 {spec['acceptance_rate']:.1%}, 每次前向 {spec['tokens_per_target_pass']:.2f} tokens")
+
+
+# token 预算被系统提示词（含完整案件背景）占满时仍保留的最近历史条数（即原来按条数截断时的条数）
+TRAINING_FORMAT_MIN_HISTORY_TURNS = 2
+LEGACY_FORMAT_MIN_HISTORY_TURNS = 6
+
+
+def log_context_usage(tag, usage):
+    """输出提示词各部分占用的 token 数（为保留最近的历史而超出预算时输出警告）"""
+    logger.info(f"{tag} 提示词 token: 总计 {usage['total_tokens']}（预算 {usage['budget'] or '不限'}），"
+                f"系统提示词 {usage['system_tokens']}，必留消息 {usage['pinned_tokens']}，"
+                f"历史 {usage['history_tokens']}（保留 {usage['history_turns']} 条，丢弃 {usage['dropped_turns']} 条）")
+    if usage.get('over_budget'):
+        logger.warning(f"{tag} 系统提示词与必留消息已占用 {usage['system_tokens'] + usage['pinned_tokens']} tokens，"
+                       f"超出或接近预算 {usage['budget']}，仍保留最近 {usage['history_turns']} 条历史"
+                       f"（实际 {usage['total_tokens']} tokens），请调大 CONTEXT_TOKEN_BUDGET")
+
+
+def parse_context_to_speech_messages(context):
+    """
+    将context（用\n分隔，格式：角色名：内容）解析为重复检测使用的消息格式
+    
+    Returns:
+        [{'role': 'judge'/'plaintiff'/'defendant'/原角色名, 'text': 内容}, ...]
+    """
+    context_messages = []
+    if context:
+        for line in context.strip().split('\n'):
+            turn = parse_context_line(line)
+            speech = turn_to_speech(turn) if turn is not None else None
+            if speech is not None:
+                context_messages.append(speech)
+    
+    return context_messages
+
+
 def debate_generate_legacy_format(data):
     """使用旧格式生成回复（向后兼容）"""
     user_identity = data.get('user_identity')  # 'plaintiff' 或 'defendant'
@@ -1510,26 +2482,33 @@ def debate_generate_legacy_format(data):
     # 构建系统提示词
     # case_description 现在可能包含完整的background（身份信息、文件列表、案件描述、诉讼策略等）
     # 如果是用户代理模式，需要根据用户策略更新case_description中的策略信息
-    if is_user_proxy and user_strategy:
-        case_description = update_strategy_in_background(case_description, user_identity, user_strategy)
-    
+    # 改写结果和系统提示词按 case_description 的摘要缓存，同一案件每轮不再重复处理
+    case_hash = data.get('case_description_hash')
+    proxy_strategy = user_strategy if is_user_proxy and user_strategy else None
     logger.info(f"[角色调试] 构建系统提示词 - current_role: {current_role}, judge_type: {judge_type}")
-    system_prompt = build_system_prompt(user_identity, current_role, judge_type, case_description)
+    with trace_span('build_prompt'):
+        if proxy_strategy:
+            case_description = CONTENT_STORE.derived(
+                case_hash,
+                ('strategy_background', user_identity, proxy_strategy),
+                lambda: update_strategy_in_background(case_description, user_identity, proxy_strategy),
+            )
+        system_prompt = CONTENT_STORE.derived(
+            case_hash,
+            ('legacy_system_prompt', user_identity, current_role, judge_type, proxy_strategy),
+            lambda: build_system_prompt(user_identity, current_role, judge_type, case_description),
+        )
     assistant_role = get_assistant_role_name(current_role)
     logger.info(f"[角色调试] assistant_role: {assistant_role}")
     logger.info(f"[角色调试] 系统提示词开头(前200字符): {system_prompt[:200]}")
     
     # 构建消息历史
-    formatted_messages = format_messages_for_ai(messages)
+    with trace_span('parse_context'):
+        formatted_messages = format_messages_for_ai(messages)
     logger.info(f"[角色调试] 格式化后的消息数量: {len(formatted_messages)}")
     if formatted_messages:
         logger.info(f"[角色调试] 最后一条格式化消息: role={formatted_messages[-1].get('role')}, content预览={formatted_messages[-1].get('content', '')[:100]}")
     
-    # 限制消息历史长度为最近6条
-    if len(formatted_messages) > 6:
-        logger.debug(f"[优化] 消息历史过长({len(formatted_messages)}条)，截断为最近6条")
-        formatted_messages = formatted_messages[-6:]
-    
     # 如果是判断模式且有特殊提示词，添加提示词
     if check_mode and prompt:
         # 在判断模式下，明确告诉法官当前的发言顺序和下一个应该发言的角色
@@ -1579,14 +2558,13 @@ def debate_generate_legacy_format(data):
         })
         logger.info(f"[角色调试] 已添加角色提示消息: 请以{role_name}的身份继续发言（包含审判员口吻禁止提示）")
     
-    # 生成回复（优化：进一步降低max_new_tokens并优化参数以加快生成速度）
-    import time
-    start_time = time.time()
-    
-    # 计算输入token数（估算）
-    total_input_chars = sum(len(str(msg.get('content', ''))) for msg in formatted_messages) + len(system_prompt)
-    estimated_input_tokens = total_input_chars // 3  # 粗略估算：1 token ≈ 3字符
-    logger.info(f"[性能] 输入估算: {estimated_input_tokens} tokens, {total_input_chars} 字符")
+    # 按 token 预算保留最近的消息历史（整条保留，从新到旧），最后添加的提示消息总是保留
+    with trace_span('pack_context'):
+        formatted_messages, context_usage = model.pack_messages(
+            formatted_messages[:-1], pinned=formatted_messages[-1:], system_prompt=system_prompt, assistant_role=assistant_role,
+            min_turns=LEGACY_FORMAT_MIN_HISTORY_TURNS,
+        )
+    log_context_usage("[旧格式]", context_usage)
     
     # 构建完整的原始输入消息列表（与模型实际接收的格式一致）
     full_messages = []
@@ -1594,73 +2572,59 @@ def debate_generate_legacy_format(data):
         full_messages.append({"role": "system", "content": system_prompt})
     full_messages.extend(formatted_messages)
     
-    # 输出最原始的输入提示词（与传递给模型的格式完全一致）
-    logger.info("=" * 80)
-    logger.info("【AI调用 - debate_generate_legacy_format】最原始输入提示词")
-    logger.info("=" * 80)
-    logger.info(f"助手角色: {assistant_role}")
-    logger.info(f"参数: max_new_tokens=350, temperature=0.3, top_p=0.9")
-    logger.info(f"完整消息列表数量: {len(full_messages)}")
-    logger.info("")
-    logger.info("--- 完整原始输入消息列表（按顺序） ---")
-    for i, msg in enumerate(full_messages):
-        role = msg.get('role', '')
-        content = msg.get('content', '')
-        content_preview = content[:200] + "..." if len(content) > 200 else content
-        logger.info(f"消息[{i}]: role='{role}', content长度={len(content)}字符")
-        logger.info(f"  内容预览: {content_preview}")
-        if len(content) > 200:
-            logger.info(f"  完整内容: {content}")
-    logger.info("--- 原始输入消息列表结束 ---")
-    logger.info("")
-    logger.info("--- 系统提示词（完整） ---")
-    logger.info(system_prompt)
-    logger.info("--- 系统提示词结束 ---")
-    logger.info("=" * 80)
+    # 输出完整输入提示词（与传递给模型的格式完全一致，抽样写入提示词日志）
+    log_prompt('debate_generate_legacy_format', full_messages, assistant_role=assistant_role,
+               max_new_tokens=350, temperature=0.3, top_p=0.9)
     
     # 限制生成长度：500字左右 ≈ 300-350 tokens（中文字符token化更高效）
-    response = model.chat(
-        messages=formatted_messages,
-        max_new_tokens=350,  # 限制为350 tokens，约对应500字左右的中文
-        temperature=0.3,  # 使用适中的temperature，平衡速度和生成质量
-        top_p=0.9,
-        system_prompt=system_prompt,
-        assistant_role=assistant_role
-    )
-    
-    elapsed_time = time.time() - start_time
-    tokens_per_sec = len(response) / 3 / elapsed_time if elapsed_time > 0 else 0  # 粗略估算
-    logger.info(f"[性能] 生成耗时: {elapsed_time:.2f}秒, 回复长度: {len(response)}字符, 速度: {tokens_per_sec:.1f} tokens/秒")
+    gen_info = {}
+    with trace_span('generate'):
+        response = model.chat(
+            messages=formatted_messages,
+            max_new_tokens=350,  # 限制为350 tokens，约对应500字左右的中文
+            temperature=0.3,  # 使用适中的temperature，平衡速度和生成质量
+            top_p=0.9,
+            system_prompt=system_prompt,
+            assistant_role=assistant_role,
+            previous_speeches=get_role_speeches(messages, current_role),
+            gen_info=gen_info,
+        )
+    trace_generation(gen_info)
+    log_generation_stats("[性能]", gen_info, current_role)
     
     logger.debug(f"[旧格式] 生成回复长度: {len(response)}")
     
-    # 清理特殊标记（移除模型生成时可能出现的特殊标记，如 <|im_end|>, <|im_start|> 等）
-    cleaned_response = clean_special_tokens(response)
-    if cleaned_response != response:
-        logger.info(f"[旧格式] 清理特殊标记后回复内容: {cleaned_response[:500] if len(cleaned_response) > 500 else cleaned_response}")
+    with trace_span('postprocess'):
+        # 清理特殊标记（移除模型生成时可能出现的特殊标记，如 <|im_end|>, <|im_start|> 等）
+        cleaned_response = clean_special_tokens(response)
+        if cleaned_response != response:
+            logger.info(f"[旧格式] 清理特殊标记后回复内容: {cleaned_response[:500] if len(cleaned_response) > 500 else cleaned_response}")
     
-    # 去除重复的角色前缀（去除重复前缀如"辩护人：辩护人："或单个前缀"辩护人："，因为前端会自己添加角色名）
-    role_name_map = {
-        'judge': '审判员',
-        'plaintiff': '公诉人',
-        'defendant': '辩护人'
-    }
-    agent_role_name = role_name_map.get(current_role, current_role)
-    before_prefix = cleaned_response
-    cleaned_response = remove_duplicate_role_prefix(cleaned_response, agent_role_name)
-    if cleaned_response != before_prefix:
-        logger.info(f"[旧格式] 去除重复前缀后回复内容: {cleaned_response[:500] if len(cleaned_response) > 500 else cleaned_response}")
-    
-    # 过滤审判员式的发言模式（对于公诉人和辩护人，过滤掉审判员式的发言模式，如"现在进入辩论环节"等）
-    before_filter = cleaned_response
-    cleaned_response = filter_judge_style_speech(cleaned_response, agent_role_name)
-    if cleaned_response != before_filter:
-        logger.info(f"[旧格式] 过滤审判员口吻后回复内容: {cleaned_response[:500] if len(cleaned_response) > 500 else cleaned_response}")
+        # 去除重复的角色前缀（去除重复前缀如"辩护人：辩护人："或单个前缀"辩护人："，因为前端会自己添加角色名）
+        role_name_map = {
+            'judge': '审判员',
+            'plaintiff': '公诉人',
+            'defendant': '辩护人'
+        }
+        agent_role_name = role_name_map.get(current_role, current_role)
+        before_prefix = cleaned_response
+        cleaned_response = remove_duplicate_role_prefix(cleaned_response, agent_role_name)
+        if cleaned_response != before_prefix:
+            logger.info(f"[旧格式] 去除重复前缀后回复内容: {cleaned_response[:500] if len(cleaned_response) > 500 else cleaned_response}")
+    
+        # 过滤审判员式的发言模式（对于公诉人和辩护人，过滤掉审判员式的发言模式，如"现在进入辩论环节"等）
+        before_filter = cleaned_response
+        cleaned_response = filter_judge_style_speech(cleaned_response, agent_role_name)
+        if cleaned_response != before_filter:
+            logger.info(f"[旧格式] 过滤审判员口吻后回复内容: {cleaned_response[:500] if len(cleaned_response) > 500 else cleaned_response}")
     
     # 检查是否与历史消息重复
     is_duplicate = False
-    if check_duplicate_speech(cleaned_response, messages, current_role):
+    with trace_span('duplicate_check'):
+        duplicate = check_duplicate_speech(cleaned_response, messages, current_role)
+    if duplicate:
         logger.warning(f"[重复检测] 检测到重复发言，拒绝生成（角色: {current_role}）")
+        record_debate_outcome(current_role, 'duplicate')
         logger.warning(f"[重复检测] 重复内容预览: {cleaned_response[:100]}...")
         is_duplicate = True
         # 如果是重复发言，返回一个提示信息，让前端知道需要重新生成
@@ -1687,13 +2651,17 @@ def debate_generate_legacy_format(data):
             role_name = role_name_map.get(current_role, '')
             cleaned_response = f"{role_name}：我方已在前面的发言中表达了相关观点，不再重复。"
             logger.warning(f"[重复检测] 已替换为简短提示（角色: {current_role}）")
+    else:
+        record_debate_outcome(current_role, 'ok')
     
     return jsonify({
         'code': 200,
         'data': cleaned_response,
         'role': current_role,
         'success': True,
-        'is_duplicate': is_duplicate
+        'is_duplicate': is_duplicate,
+        'context_usage': context_usage,
+        'generation': gen_info,
     })
 
 
@@ -1923,7 +2891,7 @@ def format_context_to_messages(context, max_messages=2, agent_role=None):
     
     Args:
         context: 对话历史文本
-        max_messages: 最大消息数量（默认2，只保留最近的对话）
+        max_messages: 最大消息数量（默认2，只保留最近的对话；0 表示全部保留，交给 pack_messages 按 token 预算裁剪）
         agent_role: 当前AI扮演的角色（如"审判员"、"公诉人"、"辩护人"），只有这个角色的发言标记为assistant，其他都是user
     """
     if not context:
@@ -1933,47 +2901,15 @@ def format_context_to_messages(context, max_messages=2, agent_role=None):
     lines = context.strip().split('\n')
     
     # 优化：只保留最近的消息，减少输入长度
-    if len(lines) > max_messages:
+    if max_messages and len(lines) > max_messages:
         logger.debug(f"[优化] 对话历史过长({len(lines)}条)，截断为最近{max_messages}条以削弱历史干扰")
         lines = lines[-max_messages:]
     
-    for i, line in enumerate(lines):
-        line = line.strip()
-        if not line:
-            continue
-        
-        # 解析角色和内容（支持英文冒号:和中文冒号：）
-        role_name = ''
-        content = line
-        
-        # 优先匹配中文冒号（更常见）
-        if '：' in line:
-            parts = line.split('：', 1)
-            role_name = parts[0].strip()
-            content = parts[1].strip() if len(parts) > 1 else ''
-        elif ':' in line:
-            # 支持英文冒号（训练数据格式）
-            parts = line.split(':', 1)
-            role_name = parts[0].strip()
-            content = parts[1].strip() if len(parts) > 1 else ''
-        
-        # 根据实际角色名称确定消息角色
-        # 只有当前AI自己的角色标记为assistant，其他所有角色都标记为user
-        if agent_role and role_name == agent_role:
-            msg_role = 'assistant'
-        else:
-            msg_role = 'user'
-        
-        # 构建消息内容（统一使用中文冒号）
-        if role_name:
-            msg_content = f"{role_name}：{content}"
-        else:
-            msg_content = content
-        
-        messages.append({
-            'role': msg_role,
-            'content': msg_content
-        })
+    # 逐行解析（支持中文冒号：和英文冒号:），只有当前AI自己的角色标记为assistant，其他所有角色都标记为user
+    for line in lines:
+        turn = parse_context_line(line)
+        if turn is not None:
+            messages.append(turn_to_message(turn, agent_role))
     
     return messages
 
@@ -2138,25 +3074,79 @@ def format_messages_for_ai(messages):
     return formatted
 
 
-def call_external_ai(prompt, system_prompt=None, max_tokens=2000, max_retries=3):
+# ==================== 外部AI客户端（连接池 + 并发上限 + 退避重试） ====================
+
+
+def external_ai_error_code(exc):
+    """外部AI请求异常在指标中的 code 标签（SSLError 是 ConnectionError 的子类，需先判断）"""
+    if isinstance(exc, requests.exceptions.Timeout):
+        return 'timeout'
+    if isinstance(exc, requests.exceptions.SSLError):
+        return 'ssl_error'
+    if isinstance(exc, requests.exceptions.ConnectionError):
+        return 'connection_error'
+    return 'request_error'
+
+
+def _record_external_ai_attempt(attempt, result, duration):
+    """外部AI每次尝试（在客户端线程中调用）：记录耗时与结果，失败时输出一行警告"""
+    EXTERNAL_AI_DURATION.observe(duration)
+    if isinstance(result, Exception):
+        EXTERNAL_AI_REQUESTS.labels(code=external_ai_error_code(result)).inc()
+        logger.warning(f"[外部AI] 第 {attempt} 次尝试失败（{duration:.1f}s）: {type(result).__name__}: {result}")
+    else:
+        EXTERNAL_AI_REQUESTS.labels(code=str(result.status_code)).inc()
+        if result.status_code in EXTERNAL_AI_CLIENT.retry_statuses:
+            logger.warning(f"[外部AI] 第 {attempt} 次尝试返回 HTTP {result.status_code}（{duration:.1f}s）")
+
+
+EXTERNAL_AI_CLIENT = ExternalAIClient(
+    EXTERNAL_AI_BASE_URL,
+    EXTERNAL_AI_API_KEY,
+    pool_size=int(os.getenv('EXTERNAL_AI_POOL_SIZE', '10')),
+    max_concurrent=int(os.getenv('EXTERNAL_AI_MAX_CONCURRENT', '4')),
+    max_pending=int(os.getenv('EXTERNAL_AI_MAX_PENDING', '32')),
+    connect_timeout=float(os.getenv('EXTERNAL_AI_CONNECT_TIMEOUT', '10')),
+    read_timeout=float(os.getenv('EXTERNAL_AI_READ_TIMEOUT', '90')),
+    max_retries=int(os.getenv('EXTERNAL_AI_MAX_RETRIES', '3')),
+    backoff_base=float(os.getenv('EXTERNAL_AI_BACKOFF_BASE', '1')),
+    backoff_max=float(os.getenv('EXTERNAL_AI_BACKOFF_MAX', '20')),
+    on_attempt=_record_external_ai_attempt,
+)
+METRICS.gauge('court_ai_external_ai_pending', '已提交、尚未完成的外部AI请求数（含退避等待中）',
+              callback=lambda: EXTERNAL_AI_CLIENT.stats()['pending'])
+
+
+def external_ai_busy(e):
+    """外部AI请求过多时的 429 响应"""
+    logger.warning(f"[外部AI] {e}")
+    response = jsonify({'error': '服务繁忙，请稍后重试', 'reason': 'external_ai_busy',
+                        'retry_after': e.retry_after, 'success': False})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+def call_external_ai(prompt, system_prompt=None, max_tokens=2000, max_retries=None, reservation=None):
     """
     调用外部AI API（OpenAI兼容接口）
     
+    请求由 EXTERNAL_AI_CLIENT 在复用的连接上发出，网络错误与限流状态码按带抖动的指数退避重试
+    （退避期间不占用线程），当前线程只等待结果。
+    
     Args:
         prompt: 用户提示词
         system_prompt: 系统提示词（可选）
         max_tokens: 最大生成token数
-        max_retries: 最大重试次数（默认3次）
+        max_retries: 最大尝试次数（默认 EXTERNAL_AI_MAX_RETRIES）
+        reservation: EXTERNAL_AI_CLIENT.reserve() 预留的名额（可选，多步操作用来保证后续请求不会因繁忙被拒绝）
     
     Returns:
         AI生成的文本
+    Raises:
+        ExternalAIBusy: 等待中的外部AI请求已达上限（调用方返回 429）
     """
-    url = f"{EXTERNAL_AI_BASE_URL}/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {EXTERNAL_AI_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
+    max_retries = max_retries or EXTERNAL_AI_CLIENT.max_retries
     messages = []
     if system_prompt:
         messages.append({
@@ -2176,295 +3166,235 @@ def call_external_ai(prompt, system_prompt=None, max_tokens=2000, max_retries=3)
     }
     
     # 记录请求详情
-    prompt_length = len(prompt)
-    system_prompt_length = len(system_prompt) if system_prompt else 0
-    total_messages_length = sum(len(str(msg.get("content", ""))) for msg in messages)
-    
-    logger.info("=" * 80)
-    logger.info("【AI调用 - call_external_ai】完整提示词")
-    logger.info("=" * 80)
-    logger.info(f"URL: {url}")
-    logger.info(f"模型: {EXTERNAL_AI_MODEL}")
-    logger.info(f"系统提示词: {system_prompt if system_prompt else '(无)'}")
-    logger.info(f"用户提示词: {prompt}")
-    logger.info(f"消息总数: {len(messages)}")
-    for i, msg in enumerate(messages):
-        logger.info(f"消息[{i}]: role={msg.get('role')}, content={msg.get('content', '')}")
-    logger.info(f"参数: max_tokens={max_tokens}, temperature=0.7")
-    logger.info(f"最大重试次数: {max_retries}")
-    logger.info(f"API密钥前缀: {EXTERNAL_AI_API_KEY[:10]}...{EXTERNAL_AI_API_KEY[-4:] if len(EXTERNAL_AI_API_KEY) > 14 else ''}")
-    logger.info("=" * 80)
+    log_prompt('call_external_ai', messages, url=f"{EXTERNAL_AI_BASE_URL}/chat/completions", model=EXTERNAL_AI_MODEL,
+               max_tokens=max_tokens, temperature=0.7, max_retries=max_retries)
+    
+    try:
+        with trace_span('external_ai'):
+            response = EXTERNAL_AI_CLIENT.post('chat/completions', payload, max_retries=max_retries,
+                                               reservation=reservation)
+    except requests.exceptions.Timeout as e:
+        error_str = str(e)
+        logger.error("=" * 60)
+        logger.error(f"❌ 请求超时（共 {max_retries} 次尝试）")
+        logger.error("=" * 60)
+        logger.error(f"错误详情: {error_str}")
+        logger.error("可能的原因：")
+        logger.error("1. 网络连接慢或不稳定")
+        logger.error("2. 外部API响应时间过长")
+        logger.error("3. 请求内容过大，处理时间过长")
+        logger.error("=" * 60)
+        raise RuntimeError(f"调用外部AI API超时（已重试{max_retries}次）: {error_str}")
+    except requests.exceptions.SSLError as e:
+        error_str = str(e)
+        logger.error("=" * 60)
+        logger.error(f"❌ SSL连接错误（共 {max_retries} 次尝试）")
+        logger.error("=" * 60)
+        logger.error(f"错误详情: {error_str}")
+        logger.error("可能的原因：")
+        logger.error("1. SSL证书验证失败")
+        logger.error("2. SSL握手过程中连接意外中断")
+        logger.error("3. 服务器SSL配置问题")
+        logger.error("4. 网络不稳定导致SSL连接中断")
+        logger.error("5. 防火墙或代理干扰SSL连接")
+        logger.error("")
+        logger.error("诊断建议：")
+        logger.error("1. 检查网络连接是否稳定")
+        logger.error("2. 检查防火墙和代理设置")
+        logger.error("3. 尝试使用curl测试API端点")
+        logger.error("4. 联系API服务提供商确认服务状态")
+        logger.error("=" * 60)
+        raise RuntimeError(f"无法连接到外部AI API（SSL错误，已重试{max_retries}次）: {error_str}")
+    except requests.exceptions.ConnectionError as e:
+        error_str = str(e)
+        logger.error("=" * 60)
+        logger.error(f"❌ 连接错误（共 {max_retries} 次尝试）")
+        logger.error("=" * 60)
+        logger.error(f"错误详情: {error_str}")
+        logger.error("可能的原因：")
+        logger.error("1. 无法连接到外部API服务器")
+        logger.error("2. DNS解析失败")
+        logger.error("3. 防火墙或代理阻止连接")
+        logger.error("4. 外部API服务器已关闭")
+        logger.error("=" * 60)
+        raise RuntimeError(f"无法连接到外部AI API（已重试{max_retries}次）: {error_str}")
+    except requests.exceptions.RequestException as e:
+        error_str = str(e)
+        logger.error("=" * 60)
+        logger.error(f"❌ 请求异常（共 {max_retries} 次尝试）")
+        logger.error("=" * 60)
+        logger.error(f"错误类型: {type(e).__name__}")
+        logger.error(f"错误详情: {error_str}")
+        logger.error("=" * 60)
+        raise RuntimeError(f"调用外部AI API失败（已重试{max_retries}次）: {error_str}")
+    
+    try:
+        return handle_external_ai_response(response)
+    except requests.exceptions.HTTPError as e:
+        # HTTP错误（如500、503等）通常不需要重试，直接抛出
+        error_str = str(e)
+        status_code = getattr(e.response, 'status_code', None) if hasattr(e, 'response') else None
+        if status_code:
+            logger.error(f"❌ HTTP错误: {error_str} (状态码: {status_code})")
+            raise RuntimeError(f"调用外部AI API失败: HTTP {status_code} - {error_str}")
+        else:
+            logger.error(f"❌ HTTP错误: {error_str}")
+            raise RuntimeError(f"调用外部AI API失败: {error_str}")
+    except Exception as e:
+        # 其他异常（如JSON解析错误等）通常不需要重试
+        logger.error("=" * 60)
+        logger.error("❌ 处理外部AI API响应失败")
+        logger.error("=" * 60)
+        logger.error(f"错误类型: {type(e).__name__}")
+        logger.error(f"错误详情: {e}")
+        import traceback
+        logger.error(f"堆栈跟踪:\n{traceback.format_exc()}")
+        logger.error("=" * 60)
+        raise RuntimeError(f"处理外部AI API响应失败: {str(e)}")
+
+
+def handle_external_ai_response(response):
+    """记录外部AI API的响应详情与错误诊断，返回生成的文本（HTTP 错误时抛出 HTTPError）"""
+    # 记录响应详情
+    status_code = response.status_code
+    response_headers = dict(response.headers)
     
-    # 重试机制
-    import time
-    last_exception = None
+    logger.info("=" * 60)
+    logger.info("外部AI API - 响应详情")
+    logger.info("=" * 60)
+    logger.info(f"HTTP状态码: {status_code}")
+    logger.info(f"响应头: {response_headers}")
     
-    for attempt in range(max_retries):
+    # 尝试读取和解析响应体
+    api_error_info = None
+    try:
+        response_text = response.text
+        response_length = len(response_text)
+        logger.info(f"响应体长度: {response_length} 字符")
+        
+        # 如果响应体不太长，记录完整内容；否则只记录前500字符
+        if response_length < 1000:
+            logger.info(f"响应体内容: {response_text}")
+        else:
+            logger.info(f"响应体预览（前500字符）: {response_text[:500]}...")
+        
+        # 尝试解析JSON
         try:
-            if attempt > 0:
-                # 指数退避：第1次重试等待2秒，第2次等待4秒，第3次等待8秒
-                wait_time = 2 ** attempt
-                logger.info(f"等待 {wait_time} 秒后重试（第 {attempt + 1}/{max_retries} 次尝试）...")
-                time.sleep(wait_time)
-            
-            # 增加超时时间
-            response = requests.post(
-                url, 
-                headers=headers, 
-                json=payload, 
-                timeout=90,  # 增加超时时间到90秒
-                verify=True  # 保持SSL验证，但如果遇到SSL错误，会在异常处理中提供建议
-            )
-            
-            # 记录响应详情
-            status_code = response.status_code
-            response_headers = dict(response.headers)
-            
-            logger.info("=" * 60)
-            logger.info("外部AI API - 响应详情")
-            logger.info("=" * 60)
-            logger.info(f"HTTP状态码: {status_code}")
-            logger.info(f"响应头: {response_headers}")
-            
-            # 尝试读取和解析响应体
-            api_error_info = None
-            try:
-                response_text = response.text
-                response_length = len(response_text)
-                logger.info(f"响应体长度: {response_length} 字符")
-                
-                # 如果响应体不太长，记录完整内容；否则只记录前500字符
-                if response_length < 1000:
-                    logger.info(f"响应体内容: {response_text}")
-                else:
-                    logger.info(f"响应体预览（前500字符）: {response_text[:500]}...")
-                
-                # 尝试解析JSON
-                try:
-                    response_json = response.json()
-                    logger.info(f"响应JSON解析成功")
-                    if "error" in response_json:
-                        api_error_info = response_json.get('error')
-                        if isinstance(api_error_info, dict):
-                            error_code = api_error_info.get('code', '')
-                            error_message = api_error_info.get('message', '')
-                            error_type = api_error_info.get('type', '')
-                            
-                            logger.error("=" * 60)
-                            logger.error("❌ API返回错误详情")
-                            logger.error("=" * 60)
-                            logger.error(f"错误代码: {error_code}")
-                            logger.error(f"错误类型: {error_type}")
-                            logger.error(f"错误消息: {error_message}")
-                            
-                            # 针对特定错误提供详细诊断
-                            if error_code == 'model_not_found':
-                                logger.error("")
-                                logger.error("🔍 模型未找到错误分析：")
-                                logger.error(f"  请求的模型: {EXTERNAL_AI_MODEL}")
-                                logger.error(f"  错误消息: {error_message}")
-                                logger.error("")
-                                logger.error("可能的原因和解决方案：")
-                                logger.error("1. 模型名称不正确")
-                                logger.error("   - 检查API服务商文档，确认正确的模型名称")
-                                logger.error("   - 可能需要的名称：gpt-4o-mini, gpt-4o-mini-2024-08-06, gpt-4o-mini-2024-07-18 等")
-                                logger.error("")
-                                logger.error("2. 模型在指定分组下不可用")
-                                logger.error("   - 错误消息提到'分组 default 下模型无可用渠道'")
-                                logger.error("   - 可能需要：")
-                                logger.error("     a) 使用不同的分组名称")
-                                logger.error("     b) 在API请求中指定分组参数")
-                                logger.error("     c) 联系API服务商配置模型渠道")
-                                logger.error("")
-                                logger.error("3. API密钥权限问题")
-                                logger.error("   - 当前API密钥可能没有权限使用该模型")
-                                logger.error("   - 检查API密钥对应的账户是否有该模型的访问权限")
-                                logger.error("   - 可能需要升级账户或购买模型访问权限")
-                                logger.error("")
-                                logger.error("4. 模型暂时不可用")
-                                logger.error("   - 该模型可能暂时下架或维护中")
-                                logger.error("   - 尝试使用其他可用的模型（如 gpt-3.5-turbo）")
-                                logger.error("=" * 60)
-                            elif error_code == 'invalid_api_key':
-                                logger.error("")
-                                logger.error("🔍 API密钥无效")
-                                logger.error("   - 检查API密钥是否正确")
-                                logger.error("   - 确认API密钥是否已过期")
-                                logger.error("   - 验证API密钥是否有权限访问该模型")
-                                logger.error("=" * 60)
-                            elif error_code == 'insufficient_quota':
-                                logger.error("")
-                                logger.error("🔍 配额不足")
-                                logger.error("   - 账户余额不足")
-                                logger.error("   - 需要充值或升级账户")
-                                logger.error("=" * 60)
-                        else:
-                            logger.error(f"API返回错误信息: {api_error_info}")
-                except:
-                    logger.warning("响应体不是有效的JSON格式")
-            except Exception as e:
-                logger.warning(f"读取响应体失败: {e}")
-            
-            # 检查HTTP状态码
-            if status_code == 503:
-                logger.error("=" * 60)
-                logger.error("❌ 503 Service Unavailable - 服务不可用")
-                logger.error("=" * 60)
-                
-                # 如果API返回了具体的错误信息，优先显示
-                if api_error_info and isinstance(api_error_info, dict):
+            response_json = response.json()
+            logger.info(f"响应JSON解析成功")
+            if "error" in response_json:
+                api_error_info = response_json.get('error')
+                if isinstance(api_error_info, dict):
                     error_code = api_error_info.get('code', '')
+                    error_message = api_error_info.get('message', '')
+                    error_type = api_error_info.get('type', '')
+                    
+                    logger.error("=" * 60)
+                    logger.error("❌ API返回错误详情")
+                    logger.error("=" * 60)
+                    logger.error(f"错误代码: {error_code}")
+                    logger.error(f"错误类型: {error_type}")
+                    logger.error(f"错误消息: {error_message}")
+                    
+                    # 针对特定错误提供详细诊断
                     if error_code == 'model_not_found':
-                        # model_not_found错误已经在上面详细处理了，这里只显示简要提示
-                        logger.error("注意：虽然HTTP状态码是503，但实际错误是模型未找到")
-                        logger.error("请查看上面的详细错误分析")
-                    else:
-                        logger.error(f"API错误代码: {error_code}")
-                        logger.error(f"API错误消息: {api_error_info.get('message', '')}")
+                        logger.error("")
+                        logger.error("🔍 模型未找到错误分析：")
+                        logger.error(f"  请求的模型: {EXTERNAL_AI_MODEL}")
+                        logger.error(f"  错误消息: {error_message}")
+                        logger.error("")
+                        logger.error("可能的原因和解决方案：")
+                        logger.error("1. 模型名称不正确")
+                        logger.error("   - 检查API服务商文档，确认正确的模型名称")
+                        logger.error("   - 可能需要的名称：gpt-4o-mini, gpt-4o-mini-2024-08-06, gpt-4o-mini-2024-07-18 等")
+                        logger.error("")
+                        logger.error("2. 模型在指定分组下不可用")
+                        logger.error("   - 错误消息提到'分组 default 下模型无可用渠道'")
+                        logger.error("   - 可能需要：")
+                        logger.error("     a) 使用不同的分组名称")
+                        logger.error("     b) 在API请求中指定分组参数")
+                        logger.error("     c) 联系API服务商配置模型渠道")
+                        logger.error("")
+                        logger.error("3. API密钥权限问题")
+                        logger.error("   - 当前API密钥可能没有权限使用该模型")
+                        logger.error("   - 检查API密钥对应的账户是否有该模型的访问权限")
+                        logger.error("   - 可能需要升级账户或购买模型访问权限")
+                        logger.error("")
+                        logger.error("4. 模型暂时不可用")
+                        logger.error("   - 该模型可能暂时下架或维护中")
+                        logger.error("   - 尝试使用其他可用的模型（如 gpt-3.5-turbo）")
+                        logger.error("=" * 60)
+                    elif error_code == 'invalid_api_key':
+                        logger.error("")
+                        logger.error("🔍 API密钥无效")
+                        logger.error("   - 检查API密钥是否正确")
+                        logger.error("   - 确认API密钥是否已过期")
+                        logger.error("   - 验证API密钥是否有权限访问该模型")
+                        logger.error("=" * 60)
+                    elif error_code == 'insufficient_quota':
+                        logger.error("")
+                        logger.error("🔍 配额不足")
+                        logger.error("   - 账户余额不足")
+                        logger.error("   - 需要充值或升级账户")
+                        logger.error("=" * 60)
                 else:
-                    logger.error("可能的原因：")
-                    logger.error("1. 外部API服务正在维护或升级")
-                    logger.error("2. 服务器过载，无法处理请求")
-                    logger.error("3. 网络连接问题或DNS解析失败")
-                    logger.error("4. API服务提供商临时故障")
-                    logger.error("5. 请求频率过高，被限流")
-                    logger.error("")
-                    logger.error("诊断建议：")
-                    logger.error("1. 检查外部API服务状态页面（如果有）")
-                    logger.error("2. 使用curl或postman直接测试API端点")
-                    logger.error("3. 检查网络连接和DNS解析")
-                    logger.error("4. 等待一段时间后重试")
-                    logger.error("5. 联系API服务提供商确认服务状态")
-                logger.error("=" * 60)
-            elif status_code == 401:
-                logger.error("❌ 401 Unauthorized - 认证失败")
-                logger.error("可能的原因：API密钥无效或过期")
-            elif status_code == 429:
-                logger.error("❌ 429 Too Many Requests - 请求频率过高")
-                logger.error("可能的原因：超过了API的速率限制")
-            elif status_code >= 500:
-                logger.error(f"❌ {status_code} Server Error - 服务器错误")
-                logger.error("可能的原因：外部API服务器内部错误")
-            
-            response.raise_for_status()
-            
-            result = response.json()
-            if "choices" in result and len(result["choices"]) > 0:
-                content = result["choices"][0]["message"]["content"]
-                logger.info(f"✅ 外部AI API调用成功，生成了 {len(content)} 个字符")
-                return content
+                    logger.error(f"API返回错误信息: {api_error_info}")
+        except:
+            logger.warning("响应体不是有效的JSON格式")
+    except Exception as e:
+        logger.warning(f"读取响应体失败: {e}")
+    
+    # 检查HTTP状态码
+    if status_code == 503:
+        logger.error("=" * 60)
+        logger.error("❌ 503 Service Unavailable - 服务不可用")
+        logger.error("=" * 60)
+        
+        # 如果API返回了具体的错误信息，优先显示
+        if api_error_info and isinstance(api_error_info, dict):
+            error_code = api_error_info.get('code', '')
+            if error_code == 'model_not_found':
+                # model_not_found错误已经在上面详细处理了，这里只显示简要提示
+                logger.error("注意：虽然HTTP状态码是503，但实际错误是模型未找到")
+                logger.error("请查看上面的详细错误分析")
             else:
-                logger.error(f"❌ 外部AI API返回格式异常: {result}")
-                raise ValueError("外部AI API返回格式异常")
-    
-        except requests.exceptions.Timeout as e:
-            last_exception = e
-            error_str = str(e)
-            logger.error("=" * 60)
-            logger.error(f"❌ 请求超时（第 {attempt + 1}/{max_retries} 次尝试）")
-            logger.error("=" * 60)
-            logger.error(f"错误详情: {error_str}")
-            logger.error("可能的原因：")
-            logger.error("1. 网络连接慢或不稳定")
-            logger.error("2. 外部API响应时间过长")
-            logger.error("3. 请求内容过大，处理时间过长")
-            logger.error("=" * 60)
-            
-            # 如果是最后一次尝试，抛出异常
-            if attempt == max_retries - 1:
-                raise RuntimeError(f"调用外部AI API超时（已重试{max_retries}次）: {error_str}")
-            # 否则继续重试
-            continue
-    
-        except requests.exceptions.SSLError as e:
-            last_exception = e
-            error_str = str(e)
-            logger.error("=" * 60)
-            logger.error(f"❌ SSL连接错误（第 {attempt + 1}/{max_retries} 次尝试）")
-            logger.error("=" * 60)
-            logger.error(f"错误详情: {error_str}")
+                logger.error(f"API错误代码: {error_code}")
+                logger.error(f"API错误消息: {api_error_info.get('message', '')}")
+        else:
             logger.error("可能的原因：")
-            logger.error("1. SSL证书验证失败")
-            logger.error("2. SSL握手过程中连接意外中断")
-            logger.error("3. 服务器SSL配置问题")
-            logger.error("4. 网络不稳定导致SSL连接中断")
-            logger.error("5. 防火墙或代理干扰SSL连接")
+            logger.error("1. 外部API服务正在维护或升级")
+            logger.error("2. 服务器过载，无法处理请求")
+            logger.error("3. 网络连接问题或DNS解析失败")
+            logger.error("4. API服务提供商临时故障")
+            logger.error("5. 请求频率过高，被限流")
             logger.error("")
             logger.error("诊断建议：")
-            logger.error("1. 检查网络连接是否稳定")
-            logger.error("2. 检查防火墙和代理设置")
-            logger.error("3. 尝试使用curl测试API端点")
-            logger.error("4. 联系API服务提供商确认服务状态")
-            logger.error("=" * 60)
-            
-            # 如果是最后一次尝试，抛出异常
-            if attempt == max_retries - 1:
-                raise RuntimeError(f"无法连接到外部AI API（SSL错误，已重试{max_retries}次）: {error_str}")
-            # 否则继续重试
-            continue
-            
-        except requests.exceptions.ConnectionError as e:
-            last_exception = e
-            error_str = str(e)
-            logger.error("=" * 60)
-            logger.error(f"❌ 连接错误（第 {attempt + 1}/{max_retries} 次尝试）")
-            logger.error("=" * 60)
-            logger.error(f"错误详情: {error_str}")
-            logger.error("可能的原因：")
-            logger.error("1. 无法连接到外部API服务器")
-            logger.error("2. DNS解析失败")
-            logger.error("3. 防火墙或代理阻止连接")
-            logger.error("4. 外部API服务器已关闭")
-            logger.error("=" * 60)
-            
-            # 如果是最后一次尝试，抛出异常
-            if attempt == max_retries - 1:
-                raise RuntimeError(f"无法连接到外部AI API（已重试{max_retries}次）: {error_str}")
-            # 否则继续重试
-            continue
-    
-        except requests.exceptions.HTTPError as e:
-            # HTTP错误（如500、503等）通常不需要重试，直接抛出
-            error_str = str(e)
-            status_code = getattr(e.response, 'status_code', None) if hasattr(e, 'response') else None
-            if status_code:
-                logger.error(f"❌ HTTP错误: {error_str} (状态码: {status_code})")
-                raise RuntimeError(f"调用外部AI API失败: HTTP {status_code} - {error_str}")
-            else:
-                logger.error(f"❌ HTTP错误: {error_str}")
-                raise RuntimeError(f"调用外部AI API失败: {error_str}")
-        
-        except requests.exceptions.RequestException as e:
-            last_exception = e
-            error_str = str(e)
-            logger.error("=" * 60)
-            logger.error(f"❌ 请求异常（第 {attempt + 1}/{max_retries} 次尝试）")
-            logger.error("=" * 60)
-            logger.error(f"错误类型: {type(e).__name__}")
-            logger.error(f"错误详情: {error_str}")
-            logger.error("=" * 60)
-            
-            # 如果是最后一次尝试，抛出异常
-            if attempt == max_retries - 1:
-                raise RuntimeError(f"调用外部AI API失败（已重试{max_retries}次）: {error_str}")
-            # 否则继续重试
-            continue
-        
-        except Exception as e:
-            # 其他异常（如JSON解析错误等）通常不需要重试
-            logger.error("=" * 60)
-            logger.error("❌ 处理外部AI API响应失败")
-            logger.error("=" * 60)
-            logger.error(f"错误类型: {type(e).__name__}")
-            logger.error(f"错误详情: {e}")
-            import traceback
-            logger.error(f"堆栈跟踪:\n{traceback.format_exc()}")
-            logger.error("=" * 60)
-            raise RuntimeError(f"处理外部AI API响应失败: {str(e)}")
-    
-    # 如果所有重试都失败了，抛出最后一个异常
-    if last_exception:
-        raise RuntimeError(f"调用外部AI API失败（已重试{max_retries}次）: {str(last_exception)}")
+            logger.error("1. 检查外部API服务状态页面（如果有）")
+            logger.error("2. 使用curl或postman直接测试API端点")
+            logger.error("3. 检查网络连接和DNS解析")
+            logger.error("4. 等待一段时间后重试")
+            logger.error("5. 联系API服务提供商确认服务状态")
+        logger.error("=" * 60)
+    elif status_code == 401:
+        logger.error("❌ 401 Unauthorized - 认证失败")
+        logger.error("可能的原因：API密钥无效或过期")
+    elif status_code == 429:
+        logger.error("❌ 429 Too Many Requests - 请求频率过高")
+        logger.error("可能的原因：超过了API的速率限制")
+    elif status_code >= 500:
+        logger.error(f"❌ {status_code} Server Error - 服务器错误")
+        logger.error("可能的原因：外部API服务器内部错误")
+    
+    response.raise_for_status()
+    
+    result = response.json()
+    if "choices" in result and len(result["choices"]) > 0:
+        content = result["choices"][0]["message"]["content"]
+        logger.info(f"✅ 外部AI API调用成功，生成了 {len(content)} 个字符")
+        return content
+    else:
+        logger.error(f"❌ 外部AI API返回格式异常: {result}")
+        raise ValueError("外部AI API返回格式异常")
 
 
 @app.route('/api/case/summarize', methods=['POST'])
@@ -2550,6 +3480,8 @@ def summarize_case():
             'success': True
         })
     
+    except ExternalAIBusy as e:
+        return external_ai_busy(e)
     except Exception as e:
         logger.error(f"案件总结失败: {e}")
         return jsonify({
@@ -2564,9 +3496,14 @@ def generate_verdict():
     庭后宣判 - 生成判决书和点评
     1. 先让法官AI给出最终判决
     2. 然后调用外部API对辩论过程进行点评
+    
+    两次外部AI调用的名额在开始前一并预留：繁忙时直接返回 429，不会在判决书生成之后才因点评被拒绝而作废
     """
+    reservation = None
     try:
-        data = request.json
+        data, error = resolve_content_refs(request.json)
+        if error is not None:
+            return error
         case_description = data.get('case_description', '')
         messages = data.get('messages', [])  # 庭审对话历史
         identity = data.get('identity', '')  # 用户身份
@@ -2610,8 +3547,10 @@ def generate_verdict():
 
 请生成一份完整的民事判决书，包含所有必要的部分。"""
         
-        # 调用外部AI API生成法官判决
-        final_verdict = call_external_ai(judge_user_prompt, judge_system_prompt, max_tokens=4000)
+        # 调用外部AI API生成法官判决（同时预留点评所需的名额）
+        reservation = EXTERNAL_AI_CLIENT.reserve(2)
+        final_verdict = call_external_ai(judge_user_prompt, judge_system_prompt, max_tokens=4000,
+                                         reservation=reservation)
         logger.info(f"法官最终判决生成完成，长度: {len(final_verdict)} 字符")
         
         # 第二步：调用外部API对辩论过程进行点评
@@ -2643,7 +3582,8 @@ def generate_verdict():
 请提供详细、专业的点评。"""
         
         # 调用外部AI API生成点评
-        review = call_external_ai(review_user_prompt, review_system_prompt, max_tokens=2000)
+        review = call_external_ai(review_user_prompt, review_system_prompt, max_tokens=2000,
+                                  reservation=reservation)
         logger.info(f"辩论过程点评生成完成，长度: {len(review)} 字符")
         
         return jsonify({
@@ -2652,12 +3592,17 @@ def generate_verdict():
             'success': True
         })
     
+    except ExternalAIBusy as e:
+        return external_ai_busy(e)
     except Exception as e:
         logger.error(f"判决书生成失败: {e}")
         return jsonify({
             'error': str(e),
             'success': False
         }), 500
+    finally:
+        if reservation is not None:
+            reservation.release()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ai_service 下各测试共用的配置与 fixture
+
+- 把仓库根目录加入 sys.path，测试直接 import 根目录下的模块（infer、kv_cache 等）
+- fake_clock：替换模块中的 time，手动推进时间测试 TTL 过期
+- tokenizer：court_debate_model 的 tokenizer（未安装 transformers 时跳过）
+- model：随机初始化的小型 Qwen2 模型（词表与上面的 tokenizer 相同），用于与 model.generate 比较输出
+"""
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+class FakeClock:
+    """代替 time 模块，只提供 time()；测试中直接修改 now 推进时间"""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def fake_clock(monkeypatch):
+    """
+    返回 patch(*modules)：把这些模块中的 time 换成同一个 FakeClock 并返回它
+
+    用法：clock = fake_clock(kv_cache); clock.now += 60
+    """
+    clock = FakeClock()
+
+    def patch(*modules):
+        for module in modules:
+            monkeypatch.setattr(module, 'time', clock)
+        return clock
+
+    return patch
+
+
+@pytest.fixture(scope='session')
+def tokenizer():
+    transformers = pytest.importorskip('transformers')
+    return transformers.AutoTokenizer.from_pretrained(os.path.join(ROOT, 'court_debate_model'))
+
+
+@pytest.fixture(scope='module')
+def model(tokenizer):
+    """
+    每个测试模块一个新模型（测试会修改 generation_config 或加载适配器）
+
+    词嵌入与输出层共享且初始化范围较大，repetition_penalty 会改变贪心结果，能发现采样处理器的差异。
+    """
+    torch = pytest.importorskip('torch')
+    from transformers import Qwen2Config, Qwen2ForCausalLM
+
+    torch.manual_seed(0)
+    config = Qwen2Config(
+        vocab_size=len(tokenizer),
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=512,
+        initializer_range=0.1,
+        tie_word_embeddings=True,
+    )
+    model = Qwen2ForCausalLM(config).eval()
+    model.generation_config.repetition_penalty = 1.3
+    model.generation_config.top_k = 20
+    model.generation_config.eos_token_id = [tokenizer.eos_token_id]
+    return model
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+测试批处理解码期间加载/卸载 LoRA 适配器
+
+加载与卸载会修改 PEFT 模块，必须在调度器的 token 边界进行（ContinuousBatchScheduler.paused()）：
+期间调度器不能再做前向计算，批次中已有的序列继续解码后输出与未加载时完全相同，
+新加载的适配器随后可以直接在批次中使用。
+
+运行：python -m pytest ai_service/test_adapter_paging.py
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('transformers')
+peft = pytest.importorskip('peft')
+
+from batch_scheduler import ContinuousBatchScheduler
+from court_debate_sdk import DEFAULT_ADAPTER, CourtDebateModel
+
+PROMPTS = [
+    '审判员：现在开庭。',
+    '公诉人：被告人张某多次秘密窃取他人财物，数额较大，其行为已构成盗窃罪，请依法判处。',
+    '辩护人：被告人系初犯、偶犯，',
+]
+MAX_NEW_TOKENS = 160
+
+
+def lora_config():
+    return peft.LoraConfig(r=4, lora_alpha=8, target_modules=['q_proj', 'v_proj'], init_lora_weights=False)
+
+
+@pytest.fixture(scope='module')
+def peft_model(model):
+    torch.manual_seed(1)
+    return peft.get_peft_model(model, lora_config()).eval()
+
+
+@pytest.fixture(scope='module')
+def adapter_dirs(tokenizer, tmp_path_factory):
+    """两个与 peft_model 结构相同、权重不同的适配器目录"""
+    from transformers import Qwen2Config, Qwen2ForCausalLM
+
+    dirs = {}
+    for seed, name in enumerate(['judge_strict', 'judge_lenient'], start=2):
+        base = Qwen2ForCausalLM(Qwen2Config(
+            vocab_size=len(tokenizer), hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+            num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=512, tie_word_embeddings=True,
+        ))
+        torch.manual_seed(seed)
+        path = tmp_path_factory.mktemp(name)
+        peft.get_peft_model(base, lora_config()).save_pretrained(str(path))
+        dirs[name] = str(path)
+    return dirs
+
+
+def generate_reference(model, tokenizer, prompt_ids, adapter_name=None):
+    kwargs = {'adapter_names': [adapter_name]} if adapter_name else {}
+    output = model.generate(
+        input_ids=torch.tensor([prompt_ids]),
+        attention_mask=torch.ones((1, len(prompt_ids)), dtype=torch.long),
+        max_new_tokens=MAX_NEW_TOKENS,
+        do_sample=False,
+        pad_token_id=tokenizer.eos_token_id,
+        **kwargs,
+    )
+    return output[0, len(prompt_ids):].tolist()
+
+
+def wait_until(predicate, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, '等待超时'
+        time.sleep(0.001)
+
+
+def make_sdk(peft_model, tokenizer, scheduler, adapter_dirs, max_resident_adapters=0):
+    """只设置 _use_adapter 用到的属性，不加载真实模型"""
+    sdk = CourtDebateModel.__new__(CourtDebateModel)
+    sdk.model = peft_model
+    sdk.tokenizer = tokenizer
+    sdk.scheduler = scheduler
+    sdk.max_resident_adapters = max_resident_adapters
+    sdk._adapter_paths = {DEFAULT_ADAPTER: '', **adapter_dirs}
+    sdk._resident_adapters = OrderedDict([(DEFAULT_ADAPTER, None)])
+    sdk._adapter_refs = {}
+    sdk._adapter_lock = threading.Lock()
+    sdk._generate_lock = threading.Lock()
+    sdk._adapter_stats = {'loads': 0, 'evictions': 0}
+    return sdk
+
+
+def test_adapters_load_and_unload_at_a_token_boundary(peft_model, tokenizer, adapter_dirs, monkeypatch):
+    prompts = [tokenizer.encode(text) for text in PROMPTS]
+    expected = [generate_reference(peft_model, tokenizer, ids) for ids in prompts]
+
+    scheduler = ContinuousBatchScheduler(peft_model, tokenizer, max_batch_size=4, max_wait_ms=200)
+    sdk = make_sdk(peft_model, tokenizer, scheduler, adapter_dirs, max_resident_adapters=2)
+    # 在加载/卸载过程中检查调度器是否还在前向计算
+    steps_during_change = []
+    load_adapter, delete_adapter = peft_model.load_adapter, peft_model.delete_adapter
+
+    def checked(change):
+        def wrapper(*args, **kwargs):
+            before = scheduler.stats()['decode_steps']
+            result = change(*args, **kwargs)
+            time.sleep(0.05)
+            steps_during_change.append((before, scheduler.stats()['active'], scheduler.stats()['decode_steps']))
+            return result
+        return wrapper
+
+    monkeypatch.setattr(peft_model, 'load_adapter', checked(load_adapter))
+    monkeypatch.setattr(peft_model, 'delete_adapter', checked(delete_adapter))
+    try:
+        futures = [
+            scheduler.submit(ids, MAX_NEW_TOKENS, temperature=0, top_p=1.0) for ids in prompts
+        ]
+        wait_until(lambda: scheduler.stats()['decode_steps'] > 0)
+        with sdk._use_adapter('judge_strict') as adapter_name:
+            assert adapter_name == 'judge_strict'
+            strict = scheduler.generate(prompts[0], MAX_NEW_TOKENS, 0, 1.0, adapter_name=adapter_name, timeout=60)
+        # 驻留上限为 2：加载 judge_lenient 前卸载空闲的 judge_strict
+        with sdk._use_adapter('judge_lenient') as adapter_name:
+            lenient = scheduler.generate(prompts[0], MAX_NEW_TOKENS, 0, 1.0, adapter_name=adapter_name, timeout=60)
+        outputs = [future.result(timeout=60) for future in futures]
+    finally:
+        scheduler.shutdown()
+
+    assert len(steps_during_change) == 3
+    before, active, after = steps_during_change[0]
+    assert active > 0 and after == before
+    assert all(before == after for before, _, after in steps_during_change)
+    assert outputs == expected
+    assert sdk.adapter_stats()['loads'] == 2 and sdk.adapter_stats()['evictions'] == 1
+    assert list(sdk._resident_adapters) == [DEFAULT_ADAPTER, 'judge_lenient']
+    assert lenient == generate_reference(peft_model, tokenizer, prompts[0], 'judge_lenient')
+    assert strict != expected[0] and lenient != strict
+
+
+def test_paused_blocks_decode_until_released(peft_model, tokenizer):
+    prompt = tokenizer.encode(PROMPTS[1])
+    scheduler = ContinuousBatchScheduler(peft_model, tokenizer)
+    try:
+        future = scheduler.submit(prompt, MAX_NEW_TOKENS, temperature=0, top_p=1.0)
+        wait_until(lambda: scheduler.stats()['decode_steps'] > 0)
+        with scheduler.paused():
+            steps = scheduler.stats()['decode_steps']
+            time.sleep(0.05)
+            assert scheduler.stats()['decode_steps'] == steps
+            assert not future.done()
+        output = future.result(timeout=60)
+    finally:
+        scheduler.shutdown()
+    assert output == generate_reference(peft_model, tokenizer, prompt)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+测试模型接口的准入控制（admission）：并发上限、优先级排队、队列满/排队超时拒绝，以及超时请求留在堆中的取消条目
+
+运行：python -m pytest ai_service/test_admission.py
+"""
+
+import threading
+import time
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, '等待超时'
+        time.sleep(0.005)
+
+
+class Requester(threading.Thread):
+    """在后台线程申请名额；准入后记录顺序，按需立即释放"""
+
+    def __init__(self, controller, name, priority=0, order=None, release=True):
+        super().__init__(daemon=True)
+        self.controller = controller
+        self.label = name
+        self.priority = priority
+        self.order = order if order is not None else []
+        self.release_on_admit = release
+        self.ticket = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.ticket = self.controller.acquire(self.priority)
+        except AdmissionRejected as e:
+            self.error = e
+            return
+        self.order.append(self.label)
+        if self.release_on_admit:
+            self.ticket.release()
+
+
+def test_admits_up_to_max_concurrent_without_queueing():
+    controller = AdmissionController(max_concurrent=2, max_queue=0)
+    first = controller.acquire()
+    second = controller.acquire()
+    assert first.wait_sec == second.wait_sec == 0.0
+
+    with pytest.raises(AdmissionRejected) as e:
+        controller.acquire()
+    assert e.value.reason == 'queue_full' and e.value.retry_after >= 1
+
+    first.release()
+    first.release()  # 重复释放只生效一次
+    assert controller.active == 1
+    controller.acquire().release()
+    second.release()
+    stats = controller.stats()
+    assert (stats['active'], stats['admitted'], stats['rejected']) == (0, 3, {'queue_full': 1})
+
+
+def test_queued_requests_are_admitted_by_priority_then_arrival():
+    controller = AdmissionController(max_concurrent=1, max_queue=8, queue_timeout=10)
+    holder = controller.acquire()
+    order = []
+    threads = []
+    for name, priority in [('low-1', 5), ('high', 0), ('low-2', 5), ('mid', 1)]:
+        thread = Requester(controller, name, priority, order)
+        thread.start()
+        threads.append(thread)
+        wait_until(lambda: controller.queued == len(threads))
+
+    holder.release()
+    for thread in threads:
+        thread.join(5)
+
+    assert order == ['high', 'mid', 'low-1', 'low-2']
+    assert all(thread.ticket.wait_sec > 0 for thread in threads)
+    assert (controller.active, controller.queued) == (0, 0)
+
+
+def test_released_slot_goes_to_the_waiter_not_a_new_arrival():
+    controller = AdmissionController(max_concurrent=1, max_queue=4, queue_timeout=10)
+    holder = controller.acquire()
+    waiter = Requester(controller, 'queued', release=False)
+    waiter.start()
+    wait_until(lambda: controller.queued == 1)
+
+    holder.release()
+    # 名额在唤醒前已记到排队请求名下，此时新到的请求只能排队
+    assert (controller.active, controller.queued) == (1, 0)
+    controller.queue_timeout = 0.05
+    with pytest.raises(AdmissionRejected) as e:
+        controller.acquire()
+    assert e.value.reason == 'timeout'
+
+    waiter.join(5)
+    assert waiter.ticket is not None and waiter.ticket.wait_sec > 0
+    waiter.ticket.release()
+    assert controller.active == 0
+
+
+def test_queue_timeout_rejects_and_frees_the_queue_slot():
+    controller = AdmissionController(max_concurrent=1, max_queue=1, queue_timeout=0.05)
+    holder = controller.acquire()
+
+    with pytest.raises(AdmissionRejected) as e:
+        controller.acquire()
+    assert e.value.reason == 'timeout'
+    assert controller.queued == 0
+
+    # 超时请求让出的排队名额可以被新请求使用
+    with pytest.raises(AdmissionRejected) as e:
+        controller.acquire()
+    assert e.value.reason == 'timeout'
+    holder.release()
+    assert controller.stats()['rejected'] == {'timeout': 2}
+
+
+def test_cancelled_waiter_is_skipped_on_release():
+    """超时请求的条目仍留在堆中：释放名额时要跳过它，把名额交给后面仍在等待的请求"""
+    controller = AdmissionController(max_concurrent=1, max_queue=4, queue_timeout=0.2)
+    holder = controller.acquire()
+    expired = Requester(controller, 'expired', priority=0)
+    expired.start()
+    expired.join(5)
+    assert expired.error is not None and expired.error.reason == 'timeout'
+    assert controller.queued == 0
+
+    controller.queue_timeout = 10
+    order = []
+    waiting = Requester(controller, 'waiting', priority=5, order=order)
+    waiting.start()
+    wait_until(lambda: controller.queued == 1)
+    # 优先级更高的取消条目仍排在堆顶
+    assert len(controller._heap) == 2
+
+    holder.release()
+    waiting.join(5)
+    assert order == ['waiting']
+    stats = controller.stats()
+    assert (stats['active'], stats['queued'], stats['admitted']) == (0, 0, 2)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+测试异步日志（async_logging）：提示词日志的抽样与出错补写、按大小轮转并压缩，以及 start_async_logging
+
+运行：python -m pytest ai_service/test_async_logging.py
+"""
+
+import gzip
+import io
+import json
+import logging
+import time
+from logging.handlers import QueueHandler
+
+import pytest
+
+from async_logging import PromptLog, start_async_logging
+
+MESSAGES = [{'role': 'system', 'content': '你是本案的辩护人。'}, {'role': 'user', 'content': '公诉人：请辩护人发表意见。'}]
+
+
+def read_records(path):
+    if not path.exists():
+        return []
+    return [json.loads(line) for line in path.read_text(encoding='utf-8').splitlines()]
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, '等待超时'
+        time.sleep(0.005)
+
+
+def test_sampled_respects_rate_and_disabled_log(tmp_path):
+    never = PromptLog(str(tmp_path / 'never.jsonl'), sample_rate=0)
+    always = PromptLog(str(tmp_path / 'always.jsonl'), sample_rate=1)
+    disabled = PromptLog('', sample_rate=1)
+    try:
+        assert not any(never.sampled() for _ in range(1000))
+        assert all(always.sampled() for _ in range(1000))
+        assert not disabled.enabled and not disabled.sampled()
+        disabled.write({'source': 'x'})
+        assert disabled.stats()['written'] == 0
+        # 多个实例互不影响：记录只写入自己的文件
+        always.write({'source': 'x'})
+    finally:
+        never.close()
+        always.close()
+    assert read_records(tmp_path / 'always.jsonl') == [{'source': 'x'}]
+    assert read_records(tmp_path / 'never.jsonl') == []
+
+
+@pytest.fixture
+def app_module():
+    pytest.importorskip('flask')
+    pytest.importorskip('torch')
+    import app
+    return app
+
+
+@pytest.mark.parametrize('sample_rate,on_error,expected', [
+    (1, True, ['sampled', 'sampled']),
+    (0, True, ['error', 'error']),
+    (0, False, []),
+])
+def test_log_prompt_writes_sampled_and_error_records(app_module, tmp_path, monkeypatch, sample_rate, on_error, expected):
+    path = tmp_path / 'prompts.jsonl'
+    prompt_log = PromptLog(str(path), sample_rate=sample_rate, on_error=on_error)
+    monkeypatch.setattr(app_module, 'PROMPT_LOG', prompt_log)
+    with app_module.app.test_request_context('/api/generate'):
+        app_module.log_prompt('本地模型', MESSAGES, temperature=0.7)
+        app_module.log_prompt('外部AI', MESSAGES[1:], temperature=0.3)
+        # 请求出错时只补写未抽中的提示词
+        app_module.flush_pending_prompts('HTTP 500')
+    prompt_log.close()
+
+    records = read_records(path)
+    assert [r['reason'] for r in records] == expected
+    assert prompt_log.stats()['written'] == len(expected)
+    if records:
+        assert [(r['source'], r['params']) for r in records] == [
+            ('本地模型', {'temperature': 0.7}), ('外部AI', {'temperature': 0.3})]
+        assert records[0]['messages'] == MESSAGES
+    if expected[:1] == ['error']:
+        assert all(r['error'] == 'HTTP 500' for r in records)
+
+
+def test_rotation_compresses_old_files(tmp_path):
+    path = tmp_path / 'logs' / 'prompts.jsonl'
+    prompt_log = PromptLog(str(path), sample_rate=1, max_bytes=300, backup_count=2)
+    for i in range(30):
+        prompt_log.write({'seq': i, 'messages': MESSAGES})
+    prompt_log.close()
+
+    assert sorted(p.name for p in path.parent.iterdir()) == ['prompts.jsonl', 'prompts.jsonl.1.gz', 'prompts.jsonl.2.gz']
+    # 从旧到新：.2.gz、.1.gz、当前文件，序号连续且以最后一条结束
+    seqs = []
+    for name in ['prompts.jsonl.2.gz', 'prompts.jsonl.1.gz']:
+        with gzip.open(path.parent / name, 'rt', encoding='utf-8') as f:
+            seqs.extend(json.loads(line)['seq'] for line in f)
+    seqs.extend(r['seq'] for r in read_records(path))
+    assert seqs == list(range(30 - len(seqs), 30)) and len(seqs) < 30
+
+
+def test_start_async_logging_moves_handlers_once():
+    logger = logging.getLogger('test_async_logging.moves_handlers_once')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    assert start_async_logging(logger) is None  # 没有 handler 时不做处理
+
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+    handler.setLevel(logging.WARNING)
+    logger.addHandler(handler)
+
+    listener = start_async_logging(logger)
+    assert listener is not None and listener.handlers == (handler,)
+    (queue_handler,) = logger.handlers
+    assert isinstance(queue_handler, QueueHandler)
+
+    # 第二次调用不再切换：仍是同一个 QueueHandler
+    assert start_async_logging(logger) is None
+    assert logger.handlers == [queue_handler]
+
+    logger.info('不输出')  # handler 的级别在后台线程中同样生效
+    logger.warning('已切换到后台线程')
+    wait_until(lambda: stream.getvalue())
+    assert stream.getvalue() == 'WARNING 已切换到后台线程\n'
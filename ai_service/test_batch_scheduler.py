@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+测试连续批处理调度器与 model.generate 的一致性
+
+用随机初始化的小型 Qwen2 模型（词表与 court_debate_model 的 tokenizer 相同）贪心解码：
+不同长度的提示词同时提交给调度器（左填充对齐后合批解码），结果必须与逐条调用 model.generate 完全相同，
+包括 generation_config 中的 repetition_penalty 和多个 EOS；复用系统提示词前缀 KV 或会话上一轮的 KV 时
+结果也不能改变。
+
+运行：python -m pytest ai_service/test_batch_scheduler.py
+"""
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('transformers')
+
+from batch_scheduler import ContinuousBatchScheduler
+from infer import _encode_messages, build_logits_processors, generate_candidates, resolve_eos_token_ids
+from kv_cache import PrefixKVCache, SessionKVCache
+
+PROMPTS = [
+    '审判员：现在开庭。',
+    '公诉人：被告人张某多次秘密窃取他人财物，数额较大，其行为已构成盗窃罪，请依法判处。',
+    '辩护人：',
+    '审判员：请辩护人发表辩护意见。辩护人：被告人系初犯、偶犯，',
+]
+SYSTEM_PREFIX = '系统：你是本案的审判员，请依照法定程序主持庭审。\n'
+MAX_NEW_TOKENS = 16
+
+
+def generate_reference(model, tokenizer, prompt_ids):
+    output = model.generate(
+        torch.tensor([prompt_ids]),
+        attention_mask=torch.ones((1, len(prompt_ids)), dtype=torch.long),
+        max_new_tokens=MAX_NEW_TOKENS,
+        do_sample=False,
+        pad_token_id=tokenizer.eos_token_id,
+    )
+    return output[0, len(prompt_ids):].tolist()
+
+
+def generate_batched(model, tokenizer, prompts, prefix_len=0, **scheduler_kwargs):
+    scheduler = ContinuousBatchScheduler(
+        model, tokenizer, max_batch_size=len(prompts), max_wait_ms=500, **scheduler_kwargs
+    )
+    try:
+        futures = [
+            scheduler.submit(ids, MAX_NEW_TOKENS, temperature=0, top_p=1.0, prefix_len=prefix_len)
+            for ids in prompts
+        ]
+        outputs = [future.result(timeout=60) for future in futures]
+        return outputs, scheduler.stats()
+    finally:
+        scheduler.shutdown()
+
+
+def test_greedy_batched_output_matches_generate(model, tokenizer):
+    prompts = [tokenizer.encode(text) for text in PROMPTS]
+    assert len({len(ids) for ids in prompts}) == len(prompts)
+
+    expected = [generate_reference(model, tokenizer, ids) for ids in prompts]
+    outputs, stats = generate_batched(model, tokenizer, prompts)
+
+    assert outputs == expected
+    assert stats['max_batch_size_seen'] > 1
+    # 这个模型上 repetition_penalty 会改变贪心结果，忽略 generation_config 的调度器无法通过上面的比较
+    model.generation_config.repetition_penalty = 1.0
+    try:
+        assert [generate_reference(model, tokenizer, ids) for ids in prompts] != expected
+    finally:
+        model.generation_config.repetition_penalty = 1.3
+
+
+def test_stops_on_every_generation_config_eos(model, tokenizer):
+    """generation_config 中的第二个 EOS（如 <|endoftext|>）也要结束序列，而不只是 tokenizer.eos_token_id"""
+    prompts = [tokenizer.encode(text) for text in PROMPTS]
+    extra_eos = generate_reference(model, tokenizer, prompts[1])[4]
+    eos_token_ids = list(model.generation_config.eos_token_id)
+    model.generation_config.eos_token_id = eos_token_ids + [extra_eos]
+    try:
+        assert extra_eos in resolve_eos_token_ids(model, tokenizer)
+        expected = [generate_reference(model, tokenizer, ids) for ids in prompts]
+        outputs, _ = generate_batched(model, tokenizer, prompts)
+    finally:
+        model.generation_config.eos_token_id = eos_token_ids
+
+    assert outputs == expected
+    assert outputs[1][-1] == extra_eos and len(outputs[1]) <= 5
+
+
+def test_prefix_cache_reuse_keeps_output(model, tokenizer):
+    prefix = tokenizer.encode(SYSTEM_PREFIX)
+    prompts = [prefix + tokenizer.encode(text) for text in PROMPTS]
+    expected = [generate_reference(model, tokenizer, ids) for ids in prompts]
+    prefix_cache = PrefixKVCache(max_bytes=1 << 24)
+
+    first, _ = generate_batched(model, tokenizer, prompts, prefix_len=len(prefix), prefix_cache=prefix_cache)
+    second, _ = generate_batched(model, tokenizer, prompts, prefix_len=len(prefix), prefix_cache=prefix_cache)
+
+    assert first == expected and second == expected
+    stats = prefix_cache.stats()
+    assert stats['entries'] == 1
+    assert stats['misses'] == 1 and stats['hits'] == 2 * len(prompts) - 1
+
+
+def test_session_cache_reuse_keeps_output(model, tokenizer):
+    """第二轮在第一轮的提示词+回复之后追加新发言，只 prefill 新追加部分，结果与完整 prefill 相同"""
+    session_cache = SessionKVCache(max_bytes=1 << 24, min_reuse_tokens=4)
+    scheduler = ContinuousBatchScheduler(model, tokenizer, session_cache=session_cache)
+    try:
+        turn1 = tokenizer.encode(PROMPTS[1])
+        reply1 = scheduler.generate(turn1, MAX_NEW_TOKENS, temperature=0, top_p=1.0, session_id='trial-1')
+        turn2 = turn1 + reply1 + tokenizer.encode(PROMPTS[3])
+        info = {}
+        reply2 = scheduler.generate(
+            turn2, MAX_NEW_TOKENS, temperature=0, top_p=1.0, session_id='trial-1', gen_info=info
+        )
+    finally:
+        scheduler.shutdown()
+
+    assert reply1 == generate_reference(model, tokenizer, turn1)
+    assert reply2 == generate_reference(model, tokenizer, turn2)
+    # 第一轮写回的是提示词+回复（最后一个采样 token 尚未写入 KV）
+    assert info['cached_tokens'] == len(turn1) + len(reply1) - 1
+    assert session_cache.stats()['hits'] == 1
+
+
+def test_best_of_n_candidates_do_not_overwrite_session_kv(model, tokenizer):
+    """best-of-N 的候选只读取会话 KV：采用哪个候选由调用方决定，任何候选都不能写回"""
+    session_cache = SessionKVCache(max_bytes=1 << 24, min_reuse_tokens=4)
+    scheduler = ContinuousBatchScheduler(model, tokenizer, max_wait_ms=200, session_cache=session_cache)
+    messages = [{'role': 'system', 'content': SYSTEM_PREFIX}, {'role': 'user', 'content': PROMPTS[1]}]
+    try:
+        turn1 = _encode_messages(tokenizer, messages)['input_ids'][0].tolist()
+        reply1 = scheduler.generate(turn1, MAX_NEW_TOKENS, temperature=0, top_p=1.0, session_id='trial-1:审判员')
+        cached_ids = turn1 + reply1[:-1]
+        cached_bytes = session_cache.stats()['bytes']
+
+        messages += [{'role': 'assistant', 'content': tokenizer.decode(reply1)}, {'role': 'user', 'content': PROMPTS[3]}]
+        info = {}
+        candidates = generate_candidates(
+            model, tokenizer, messages, num_candidates=3, max_new_tokens=MAX_NEW_TOKENS, temperature=1.0, top_p=1.0,
+            assistant_role='审判员', scheduler=scheduler, session_cache=session_cache, session_id='trial-1:审判员',
+            gen_info=info,
+        )
+    finally:
+        scheduler.shutdown()
+
+    assert len(candidates) == 3
+    stats = session_cache.stats()
+    assert stats['sessions'] == 1 and stats['hits'] == 3
+    # 缓存的仍是第一轮的 KV（候选写回会换成更长的 第二轮提示词+候选）
+    assert stats['bytes'] == cached_bytes
+    assert session_cache.lookup('trial-1:审判员', cached_ids + [0])[0] == len(cached_ids)
+
+
+def test_logits_processors_follow_generation_config(model):
+    sampling = [type(p).__name__ for p in build_logits_processors(model.generation_config, 0.7, 0.9)]
+    assert sampling == [
+        'RepetitionPenaltyLogitsProcessor', 'TemperatureLogitsWarper', 'TopKLogitsWarper', 'TopPLogitsWarper',
+    ]
+    greedy = [type(p).__name__ for p in build_logits_processors(model.generation_config, 0, 0.9)]
+    assert greedy == ['RepetitionPenaltyLogitsProcessor']
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+测试按内容寻址的文本存储（content_store）：相同内容只存一份、派生结果只计算一次，以及 LRU/TTL 淘汰
+
+运行：python -m pytest ai_service/test_content_store.py
+"""
+
+import content_store
+from content_store import ContentStore, content_hash
+
+BACKGROUND = '被告人张某于2024年3月至5月间，多次在本市某小区内秘密窃取他人电动车电瓶共计十二块，价值人民币八千余元。'
+
+
+def test_same_content_is_stored_once():
+    store = ContentStore()
+    digest = store.put(BACKGROUND)
+    assert digest == content_hash(BACKGROUND)
+    assert store.put(BACKGROUND) == digest
+
+    stats = store.stats()
+    assert stats['entries'] == 1
+    assert stats['bytes'] == len(BACKGROUND.encode('utf-8'))
+    assert store.get(digest) == BACKGROUND and digest in store
+    assert store.get(content_hash('其他案件')) is None
+    assert (store.stats()['hits'], store.stats()['misses']) == (1, 1)
+
+
+def test_derived_result_is_built_once_per_content():
+    store = ContentStore()
+    digest = store.put(BACKGROUND)
+    calls = []
+
+    def build():
+        calls.append(1)
+        return f'【案件背景】{BACKGROUND}'
+
+    first = store.derived(digest, ('background', 'strict'), build)
+    assert store.derived(digest, ('background', 'strict'), build) == first
+    store.derived(digest, ('background', 'lenient'), build)
+    assert len(calls) == 2
+
+    stats = store.stats()
+    assert (stats['derived_hits'], stats['derived_misses']) == (1, 2)
+    assert stats['bytes'] > len(BACKGROUND.encode('utf-8'))
+
+
+def test_derived_without_stored_content_is_not_cached():
+    store = ContentStore()
+    calls = []
+    for digest in (None, '', content_hash(BACKGROUND)):
+        assert store.derived(digest, 'key', lambda: calls.append(1) or 'value') == 'value'
+        assert store.derived(digest, 'key', lambda: calls.append(1) or 'value') == 'value'
+    assert len(calls) == 6
+    assert store.stats()['entries'] == 0 and store.stats()['bytes'] == 0
+
+
+def test_evicts_least_recently_used_content():
+    texts = ['甲' * 100, '乙' * 100, '丙' * 100]
+    store = ContentStore(max_bytes=2 * len(texts[0].encode('utf-8')))
+    a = store.put(texts[0])
+    b = store.put(texts[1])
+    assert store.get(a) == texts[0]  # b 成为最久未使用的内容
+    c = store.put(texts[2])
+
+    assert store.get(b) is None
+    assert store.get(a) == texts[0] and store.get(c) == texts[2]
+    assert store.stats()['evictions'] == 1
+
+
+def test_derived_results_count_towards_the_budget():
+    store = ContentStore(max_bytes=len(BACKGROUND.encode('utf-8')) * 2)
+    old = store.put(BACKGROUND)
+    new = store.put(BACKGROUND[::-1])
+    # 给 new 添加一个大的派生结果后总量超限，最久未使用的 old 被淘汰
+    store.derived(new, 'prompt', lambda: BACKGROUND * 2)
+    assert old not in store and new in store
+    # 最后一条内容即使超限也保留
+    assert store.stats()['entries'] == 1
+
+
+def test_content_expires_after_ttl(fake_clock):
+    clock = fake_clock(content_store)
+    store = ContentStore(ttl_sec=60)
+    idle = store.put('甲' * 10)
+    active = store.put(BACKGROUND)
+    clock.now += 40
+    assert store.put(BACKGROUND) == active  # 重复上传只刷新使用时间
+    clock.now += 40
+
+    assert store.get(idle) is None
+    assert store.get(active) == BACKGROUND
+    stats = store.stats()
+    assert stats['entries'] == 1 and stats['evictions'] == 1
+    assert stats['bytes'] == len(BACKGROUND.encode('utf-8'))
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+测试服务端庭审会话（debate_sessions）：增量维护的对话消息/发言列表，以及会话的 TTL 与 LRU 淘汰
+
+运行：python -m pytest ai_service/test_debate_sessions.py
+"""
+
+import debate_sessions
+from debate_sessions import DebateSession, DebateSessionStore, parse_context_line
+
+CONTEXT = '审判员：现在开庭。\n\n公诉人: 宣读起诉书。\n（被告人低头不语）\n辩护人：对起诉书指控的事实无异议。'
+
+
+def test_parse_context_line():
+    assert parse_context_line('  ') is None
+    assert parse_context_line('审判员：现在开庭：请坐') == ('审判员', '现在开庭：请坐')
+    assert parse_context_line('公诉人: 宣读起诉书') == ('公诉人', '宣读起诉书')
+    assert parse_context_line('（被告人低头不语）') == (None, '（被告人低头不语）')
+
+
+def test_append_context_updates_history_for_each_role():
+    session = DebateSession('s1')
+    assert session.append_context(CONTEXT) == 4
+
+    assert session.history_messages('公诉人') == [
+        {'role': 'user', 'content': '审判员：现在开庭。'},
+        {'role': 'assistant', 'content': '公诉人：宣读起诉书。'},
+        {'role': 'user', 'content': '（被告人低头不语）'},
+        {'role': 'user', 'content': '辩护人：对起诉书指控的事实无异议。'},
+    ]
+    # 没有角色名的行不参与重复检测
+    assert session.speech_messages() == [
+        {'role': 'judge', 'text': '现在开庭。'},
+        {'role': 'plaintiff', 'text': '宣读起诉书。'},
+        {'role': 'defendant', 'text': '对起诉书指控的事实无异议。'},
+    ]
+
+
+def test_history_is_extended_incrementally_after_new_turns():
+    session = DebateSession('s1')
+    session.append_context(CONTEXT)
+    before = session.history_messages('辩护人')
+    assert session.append_turn('辩护人', ' 被告人系初犯。 ') == 5
+
+    after = session.history_messages('辩护人')
+    assert after[:len(before)] == before
+    assert after[-1] == {'role': 'assistant', 'content': '辩护人：被告人系初犯。'}
+    # 返回的是副本，调用方修改不影响会话
+    after.append({'role': 'user', 'content': 'x'})
+    assert len(session.history_messages('辩护人')) == 5
+    assert session.history_messages('审判员')[-1]['role'] == 'user'
+    assert session.speech_messages()[-1] == {'role': 'defendant', 'text': '被告人系初犯。'}
+
+
+def test_system_prompt_is_built_once_per_role():
+    session = DebateSession('s1')
+    calls = []
+
+    def build():
+        calls.append(1)
+        return f'prompt-{len(calls)}'
+
+    assert session.system_prompt('审判员', build) == 'prompt-1'
+    assert session.system_prompt('审判员', build) == 'prompt-1'
+    assert session.system_prompt('公诉人', build) == 'prompt-2'
+    assert session.info()['cached_system_prompts'] == ['公诉人', '审判员']
+
+
+def test_store_create_get_and_expire(fake_clock):
+    clock = fake_clock(debate_sessions)
+    store = DebateSessionStore(ttl_sec=60)
+    session = store.create('s1', background='案件背景', params={'judge_type': 'strict', 'unknown': 1})
+    assert session.params['judge_type'] == 'strict' and 'unknown' not in session.params
+    assert store.create('s1') is None
+
+    clock.now += 50
+    assert store.get('s1') is session  # 访问会刷新空闲时间
+    clock.now += 50
+    assert store.get('s1') is session
+    clock.now += 61
+
+    assert store.get('s1') is None
+    assert store.create('s1') is not None
+    assert store.stats()['expired'] == 1 and store.stats()['created'] == 2
+
+
+def test_store_recreates_expired_session_id(fake_clock):
+    clock = fake_clock(debate_sessions)
+    store = DebateSessionStore(ttl_sec=60)
+    store.create('s1').append_turn('审判员', '现在开庭。')
+    clock.now += 61
+    session = store.create('s1')
+    assert session is not None and len(session) == 0
+    assert store.stats()['expired'] == 1
+
+
+def test_store_evicts_least_recently_used(fake_clock):
+    fake_clock(debate_sessions)
+    store = DebateSessionStore(max_sessions=2)
+    store.create('a')
+    store.create('b')
+    store.get('a')
+    store.create('c')
+
+    assert store.get('b') is None
+    assert store.get('a') is not None and store.get('c') is not None
+    assert store.stats()['evictions'] == 1
+    assert store.delete('a') and not store.delete('a')
+    assert store.stats()['sessions'] == 1
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+测试解码期约束（停止序列、重复 n-gram 屏蔽）的默认行为
+
+- 只有辩论角色在其他角色的换行发言前缀处停止，通用生成中以角色名开头的行不能被截断
+- 法庭发言会有意重复法条引用、当事人姓名和程序用语，重复 n-gram 屏蔽默认不能启用：
+  模型想再次完整引用上一轮出现过的法条时，解码结果必须与不加约束时相同
+
+运行：python -m pytest ai_service/test_decode_constraints.py
+"""
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('transformers')
+
+from infer import (
+    DEFAULT_REPETITION_CONFIG,
+    FINAL_END_TAG,
+    _decode_constraints,
+    compile_repeated_ngrams,
+    resolve_repetition_config,
+    resolve_stop_sequences,
+    truncate_at_stop_sequence,
+)
+
+CITATION = '依照《中华人民共和国刑法》第二百六十四条之规定，被告人张某构成盗窃罪'
+PREVIOUS_SPEECHES = [
+    f'公诉人认为，{CITATION}，应当依法惩处。',
+    '被告人张某多次秘密窃取他人财物，数额较大。',
+]
+
+
+def greedy_decode(tokenizer, target_ids, repetition_config):
+    """模拟一个逐 token 想要复现 target_ids 的模型：每步目标 token 的 logit 最高，次优 token 略低"""
+    repeat_index = compile_repeated_ngrams(tokenizer, PREVIOUS_SPEECHES, repetition_config)
+    processors = _decode_constraints(tokenizer, None, repeat_index, repetition_config, prompt_len=0)
+    vocab_size = len(tokenizer)
+    generated = []
+    for target in target_ids:
+        scores = torch.zeros((1, vocab_size))
+        scores[0, target] = 10.0
+        scores[0, (target + 1) % vocab_size] = 9.0
+        if processors is not None:
+            scores = processors(torch.tensor([generated], dtype=torch.long), scores)
+        generated.append(int(torch.argmax(scores, dim=-1).item()))
+    return generated
+
+
+def test_role_handoff_stops_only_for_debate_roles():
+    text = '会议纪要如下：\n审判员：宣布开庭。\n公诉人：宣读起诉书。'
+    for role in ('', '书记员'):
+        assert resolve_stop_sequences(role) == [FINAL_END_TAG]
+        assert truncate_at_stop_sequence(text, resolve_stop_sequences(role)) == text
+    assert truncate_at_stop_sequence(text, resolve_stop_sequences('辩护人')) == '会议纪要如下：'
+    assert truncate_at_stop_sequence(text, resolve_stop_sequences('审判员')) == '会议纪要如下：\n审判员：宣布开庭。'
+
+
+def test_wildcard_stop_sequences_apply_to_debate_roles_only():
+    config = {'*': [FINAL_END_TAG, '\n审判员：'], '': []}
+    assert resolve_stop_sequences('公诉人', config) == [FINAL_END_TAG, '\n审判员：']
+    assert resolve_stop_sequences('', config) == []
+    assert resolve_stop_sequences('书记员', config) == [FINAL_END_TAG]
+
+
+def test_repetition_blocking_is_opt_in():
+    assert resolve_repetition_config('公诉人') is None
+    assert resolve_repetition_config('审判员', {}) is None
+    assert resolve_repetition_config('辩护人', {'审判员': {'ngram_size': 6}}) is None
+    assert resolve_repetition_config('审判员', {'审判员': {'ngram_size': 6}})['ngram_size'] == 6
+    assert resolve_repetition_config('公诉人', {'*': {}}) == DEFAULT_REPETITION_CONFIG
+    assert resolve_repetition_config('公诉人', {'*': {}, '公诉人': None}) is None
+    assert resolve_repetition_config('公诉人', {'*': {'ngram_size': 0}}) is None
+
+
+def test_repeated_citation_still_decodes_by_default(tokenizer):
+    target_ids = tokenizer.encode(CITATION, add_special_tokens=False)
+    generated = greedy_decode(tokenizer, target_ids, resolve_repetition_config('公诉人'))
+    assert tokenizer.decode(generated) == CITATION
+
+
+def test_repeated_citation_decodes_with_soft_penalty(tokenizer):
+    """软惩罚只压低复现的 token，模型足够确定时仍能完整引用"""
+    target_ids = tokenizer.encode(CITATION, add_special_tokens=False)
+    config = resolve_repetition_config('公诉人', {'公诉人': {'penalty': 0.5}})
+    assert tokenizer.decode(greedy_decode(tokenizer, target_ids, config)) == CITATION
+
+
+def test_explicit_hard_block_rewrites_repeated_citation(tokenizer):
+    """显式开启直接屏蔽时，同一引用的后半段会被改写（说明上面的用例确实覆盖了复现场景）"""
+    target_ids = tokenizer.encode(CITATION, add_special_tokens=False)
+    config = resolve_repetition_config('公诉人', {'公诉人': {}})
+    assert tokenizer.decode(greedy_decode(tokenizer, target_ids, config)) != CITATION
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+测试外部 AI 接口客户端（external_ai_client）：pending 计数与名额预留、按 retry_statuses 重试与退避
+
+不发出真实请求：client.session 换成按预设顺序返回响应（或抛出异常）的假会话。
+
+运行：python -m pytest ai_service/test_external_ai_client.py
+"""
+
+import threading
+import time
+
+import pytest
+
+requests = pytest.importorskip('requests')
+
+from external_ai_client import ExternalAIBusy, ExternalAIClient
+
+
+def make_response(status_code, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response._content = b'{}'
+    response._content_consumed = True
+    return response
+
+
+class FakeSession:
+    """按顺序返回 results 中的响应或抛出其中的异常；release 未设置时阻塞，模拟执行中的请求"""
+
+    def __init__(self, results=None, blocking=False):
+        self.results = list(results or [])
+        self.calls = []
+        self.release = threading.Event()
+        if not blocking:
+            self.release.set()
+
+    def post(self, url, json=None, timeout=None):
+        self.calls.append(url)
+        self.release.wait(5)
+        result = self.results.pop(0) if self.results else make_response(200)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, '等待超时'
+        time.sleep(0.005)
+
+
+@pytest.fixture
+def make_client():
+    clients = []
+
+    def make(session, **kwargs):
+        kwargs.setdefault('backoff_base', 0.0)
+        client = ExternalAIClient('https://api.example.com/v1/', 'test-key', **kwargs)
+        client.session = session
+        clients.append(client)
+        return client
+
+    yield make
+    for client in clients:
+        client._executor.shutdown(wait=False)
+
+
+# ==================== pending 计数 ====================
+
+def test_submit_counts_pending_until_done(make_client):
+    session = FakeSession(blocking=True)
+    client = make_client(session, max_concurrent=1, max_pending=2)
+
+    first = client.submit('/chat/completions', {})
+    second = client.submit('chat/completions', {})
+    assert client.stats()['pending'] == 2
+    with pytest.raises(ExternalAIBusy) as e:
+        client.submit('chat/completions', {})
+    assert e.value.pending == 2 and e.value.retry_after >= 1
+
+    session.release.set()
+    assert first.result(5).status_code == second.result(5).status_code == 200
+    wait_until(lambda: client.stats()['pending'] == 0)
+    stats = client.stats()
+    assert (stats['requests'], stats['attempts'], stats['rejected']) == (2, 2, 1)
+    assert session.calls == ['https://api.example.com/v1/chat/completions'] * 2
+
+
+def test_failed_request_also_releases_pending(make_client):
+    client = make_client(FakeSession([requests.exceptions.ConnectionError('refused')]), max_retries=1)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.post('chat/completions', {})
+    wait_until(lambda: client.stats()['pending'] == 0)
+
+
+def test_reservation_guarantees_follow_up_requests(make_client):
+    session = FakeSession(blocking=True)
+    client = make_client(session, max_concurrent=1, max_pending=2)
+
+    reservation = client.reserve(2)
+    assert client.stats()['pending'] == 2
+    # 名额已全部预留：不带预留的请求被拒绝，带预留的请求照常提交
+    with pytest.raises(ExternalAIBusy):
+        client.submit('chat/completions', {})
+    with pytest.raises(ExternalAIBusy):
+        client.reserve(1)
+    verdict = client.submit('chat/completions', {}, reservation=reservation)
+    assert reservation.remaining == 1 and client.stats()['pending'] == 2
+
+    session.release.set()
+    verdict.result(5)
+    wait_until(lambda: client.stats()['pending'] == 1)
+    # 点评没有发出：归还剩余的预留名额
+    with reservation:
+        pass
+    assert reservation.remaining == 0 and client.stats()['pending'] == 0
+    reservation.release()
+    assert client.stats()['pending'] == 0
+
+
+def test_exhausted_reservation_falls_back_to_current_load(make_client):
+    client = make_client(FakeSession(blocking=True), max_concurrent=1, max_pending=1)
+    reservation = client.reserve(1)
+    client.submit('chat/completions', {}, reservation=reservation)
+    with pytest.raises(ExternalAIBusy):
+        client.submit('chat/completions', {}, reservation=reservation)
+    client.session.release.set()
+    wait_until(lambda: client.stats()['pending'] == 0)
+
+
+# ==================== 重试与退避 ====================
+
+def test_retries_retry_statuses_until_success(make_client):
+    attempts = []
+    session = FakeSession([make_response(429), requests.exceptions.ReadTimeout('slow'), make_response(200)])
+    client = make_client(session, max_retries=3, on_attempt=lambda n, result, sec: attempts.append(n))
+
+    assert client.post('chat/completions', {}).status_code == 200
+    assert attempts == [1, 2, 3]
+    wait_until(lambda: client.stats()['pending'] == 0)
+    assert (client.stats()['attempts'], client.stats()['retries']) == (3, 2)
+
+
+def test_other_statuses_are_returned_without_retry(make_client):
+    session = FakeSession([make_response(500), make_response(200)])
+    client = make_client(session, retry_statuses=(429,))
+    assert client.post('chat/completions', {}).status_code == 500
+    assert len(session.calls) == 1 and client.stats()['retries'] == 0
+
+
+def test_last_attempt_result_is_returned_after_max_retries(make_client):
+    session = FakeSession([make_response(502), make_response(504), make_response(200)])
+    client = make_client(session, max_retries=3)
+    assert client.post('chat/completions', {}, max_retries=2).status_code == 504
+    assert len(session.calls) == 2
+
+    session = FakeSession([requests.exceptions.ConnectionError('refused')] * 2)
+    client = make_client(session, max_retries=2)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.post('chat/completions', {})
+    assert len(session.calls) == 2
+
+
+def test_backoff_is_capped_and_respects_retry_after(make_client, monkeypatch):
+    client = make_client(FakeSession(), backoff_base=1.0, backoff_max=5.0)
+    monkeypatch.setattr('external_ai_client.random.uniform', lambda low, high: high)
+    assert [client.backoff_delay(n) for n in (1, 2, 3)] == [2.0, 4.0, 5.0]
+
+    # 服务端的 Retry-After 大于随机退避时取前者（不超过 backoff_max）
+    session = FakeSession([make_response(429, {'Retry-After': '30'}), make_response(200)])
+    client = make_client(session, backoff_base=0.0, backoff_max=0.2)
+    delays = []
+    schedule = client._schedule
+
+    def record(future, url, payload, attempt, max_attempts, delay):
+        delays.append(delay)
+        schedule(future, url, payload, attempt, max_attempts, delay)
+
+    client._schedule = record
+    start = time.perf_counter()
+    assert client.post('chat/completions', {}).status_code == 200
+    assert delays == [0.0, 0.2]
+    assert time.perf_counter() - start >= 0.2
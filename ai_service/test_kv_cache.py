@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+测试 kv_cache 中前缀/会话 KV 缓存的键、淘汰与复用长度
+
+KV 用形状 [1, 1, 序列长度, 2] 的小张量代替，第 i 个位置的值为 i，便于检查截取是否正确。
+
+运行：python -m pytest ai_service/test_kv_cache.py
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('transformers')
+
+import kv_cache
+from kv_cache import PrefixKVCache, SessionKVCache, _layers_nbytes
+
+
+def make_layers(length, num_layers=2):
+    positions = torch.arange(length, dtype=torch.float32).view(1, 1, length, 1).repeat(1, 1, 1, 2)
+    return [(positions.clone(), positions.clone()) for _ in range(num_layers)]
+
+
+class PrefillModel:
+    """记录每次 prefill 使用的适配器，返回与输入等长的 KV"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, input_ids, use_cache=True, adapter_names=None):
+        self.calls.append(adapter_names)
+        return SimpleNamespace(past_key_values=tuple(make_layers(input_ids.shape[-1])))
+
+
+# ==================== PrefixKVCache ====================
+
+def test_prefix_cache_is_keyed_per_adapter():
+    cache = PrefixKVCache(max_bytes=1 << 20)
+    model = PrefillModel()
+    prefix = [11, 12, 13, 14]
+
+    cache.get_or_prefill(model, prefix, torch.device('cpu'))
+    cache.get_or_prefill(model, prefix, torch.device('cpu'), adapter_name='judge_strict')
+    cache.get_or_prefill(model, prefix, torch.device('cpu'), adapter_name='judge_strict')
+    cache.get_or_prefill(model, prefix, torch.device('cpu'))
+
+    assert model.calls == [None, ['judge_strict']]
+    assert cache.get(prefix, 'other') is None
+    stats = cache.stats()
+    assert (stats['entries'], stats['hits'], stats['misses']) == (2, 2, 3)
+
+
+def test_prefix_cache_evicts_least_recently_used():
+    entry_bytes = _layers_nbytes(make_layers(4))
+    cache = PrefixKVCache(max_bytes=2 * entry_bytes)
+    cache.put([1], make_layers(4))
+    cache.put([2], make_layers(4))
+    assert cache.get([1]) is not None  # [2] 成为最久未使用的条目
+    cache.put([3], make_layers(4))
+
+    assert cache.get([2]) is None
+    assert cache.get([1]) is not None and cache.get([3]) is not None
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['bytes'] == 2 * entry_bytes
+
+
+def test_prefix_cache_skips_entries_over_budget():
+    cache = PrefixKVCache(max_bytes=_layers_nbytes(make_layers(4)))
+    cache.put([1], make_layers(8))
+    assert cache.get([1]) is None
+    assert cache.stats()['bytes'] == 0
+
+
+# ==================== SessionKVCache ====================
+
+def test_session_lookup_always_leaves_a_token_to_prefill():
+    cache = SessionKVCache(max_bytes=1 << 20, min_reuse_tokens=4)
+    ids = list(range(100, 120))
+    cache.put('trial-1', ids, make_layers(len(ids)))
+
+    # 与缓存完全相同：最后一个 token 必须重新 prefill 才能得到下一位置的 logits
+    reuse_len, layers = cache.lookup('trial-1', ids)
+    assert reuse_len == len(ids) - 1
+    # 比缓存短（客户端截断了最后几条）：同样只复用到 len-1
+    reuse_len, layers = cache.lookup('trial-1', ids[:10])
+    assert reuse_len == 9
+    assert layers[0][0].shape[-2] == 9
+    # 只追加：复用整段缓存
+    reuse_len, _ = cache.lookup('trial-1', ids + [1, 2, 3])
+    assert reuse_len == len(ids)
+
+
+def test_session_lookup_reuses_common_prefix_after_divergence():
+    cache = SessionKVCache(max_bytes=1 << 20, min_reuse_tokens=4)
+    ids = list(range(100, 140))
+    cache.put('trial-1', ids, make_layers(len(ids)))
+
+    diverged = ids[:25] + [7, 8, 9] + ids[25:]
+    reuse_len, layers = cache.lookup('trial-1', diverged)
+    assert reuse_len == 25
+    for key, value in layers:
+        assert key.shape[-2] == value.shape[-2] == 25
+        assert key[0, 0, :, 0].tolist() == list(range(25))
+
+    # 公共前缀短于 min_reuse_tokens：视为分叉，完整 prefill
+    assert cache.lookup('trial-1', ids[:3] + [7] + ids[3:]) == (0, None)
+    stats = cache.stats()
+    assert (stats['hits'], stats['diverged'], stats['reused_tokens']) == (1, 1, 25)
+
+
+def test_session_put_rejects_mismatched_lengths():
+    cache = SessionKVCache(max_bytes=1 << 20)
+    with pytest.raises(ValueError):
+        cache.put('trial-1', [1, 2, 3], make_layers(4))
+
+
+def test_session_entries_expire_after_ttl(fake_clock):
+    clock = fake_clock(kv_cache)
+    cache = SessionKVCache(max_bytes=1 << 20, ttl_sec=60, min_reuse_tokens=1)
+    ids = list(range(10))
+    cache.put('idle', ids, make_layers(len(ids)))
+    cache.put('active', ids, make_layers(len(ids)))
+
+    clock.now += 40
+    assert cache.lookup('active', ids)[1] is not None  # 访问会刷新空闲时间
+    clock.now += 40
+
+    assert cache.lookup('idle', ids) == (0, None)
+    assert cache.lookup('active', ids)[1] is not None
+    stats = cache.stats()
+    assert stats['sessions'] == 1 and stats['evictions'] == 1
+    assert stats['bytes'] == _layers_nbytes(make_layers(len(ids)))
+
+
+def test_session_cache_evicts_least_recently_used(fake_clock):
+    fake_clock(kv_cache)
+    ids = list(range(10))
+    entry_bytes = _layers_nbytes(make_layers(len(ids)))
+
+    by_count = SessionKVCache(max_bytes=1 << 20, max_sessions=2, min_reuse_tokens=1)
+    by_count.put('a', ids, make_layers(len(ids)))
+    by_count.put('b', ids, make_layers(len(ids)))
+    by_count.lookup('a', ids)
+    by_count.put('c', ids, make_layers(len(ids)))
+    assert by_count.lookup('b', ids) == (0, None)
+    assert by_count.lookup('a', ids)[1] is not None and by_count.lookup('c', ids)[1] is not None
+
+    by_bytes = SessionKVCache(max_bytes=2 * entry_bytes, max_sessions=10, min_reuse_tokens=1)
+    by_bytes.put('a', ids, make_layers(len(ids)))
+    by_bytes.put('b', ids, make_layers(len(ids)))
+    by_bytes.put('c', ids, make_layers(len(ids)))
+    assert by_bytes.lookup('a', ids) == (0, None)
+    assert by_bytes.stats()['bytes'] == 2 * entry_bytes
+
+    by_count.drop('a')
+    assert by_count.stats()['sessions'] == 1
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+测试按 token 预算组装对话消息（infer.pack_messages）
+
+使用 court_debate_model 的 tokenizer 计算真实 token 数：历史从最新一条开始整条保留，放不下的一条及更早的都丢弃；
+最新的 min_turns 条不受预算限制（此时 over_budget 为 True）；系统提示词与 pinned（如本轮需要回应的 new_content）
+在预算用完时也总是保留。
+
+运行：python -m pytest ai_service/test_pack_messages.py
+"""
+
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('transformers')
+
+from infer import _encode_messages, _generation_prompt_tokens, count_message_tokens, pack_messages
+
+SYSTEM_PROMPT = '你是本案的辩护人，请依据事实和法律为被告人辩护。'
+HISTORY = [
+    {'role': 'user', 'content': '审判员：现在开庭。'},
+    {'role': 'user', 'content': '公诉人：被告人张某多次秘密窃取他人财物，数额较大，其行为已构成盗窃罪，请依法判处。'},
+    {'role': 'assistant', 'content': '辩护人：对起诉书指控的事实无异议。'},
+    {'role': 'user', 'content': '审判员：请公诉人发表公诉意见。'},
+    {'role': 'user', 'content': '公诉人：被告人到案后虽如实供述，但其多次作案，主观恶性较大，' * 3},
+    {'role': 'user', 'content': '审判员：请辩护人发表辩护意见。'},
+]
+PINNED = [{'role': 'user', 'content': '公诉人：请辩护人说明被告人是否已退赔被害人的全部损失。'}]
+
+
+def prompt_tokens(tokenizer, messages):
+    """messages（不含系统消息）套用 chat template 后的实际 token 数"""
+    rendered = [{'role': 'system', 'content': SYSTEM_PROMPT}] + messages
+    return int(_encode_messages(tokenizer, rendered)['input_ids'].shape[-1])
+
+
+def fixed_tokens(tokenizer, usage):
+    """系统提示词、pinned 与生成提示占用的 token 数（不随保留的历史变化）"""
+    return usage['system_tokens'] + usage['pinned_tokens'] + _generation_prompt_tokens(tokenizer)
+
+
+def test_no_budget_keeps_everything_and_counts_each_part(tokenizer):
+    messages, usage = pack_messages(tokenizer, SYSTEM_PROMPT, HISTORY, pinned=PINNED)
+
+    assert messages == HISTORY + PINNED
+    assert usage['history_turns'] == len(HISTORY) and usage['dropped_turns'] == 0
+    assert usage['history_tokens'] == sum(count_message_tokens(tokenizer, m) for m in HISTORY)
+    assert usage['pinned_tokens'] == count_message_tokens(tokenizer, PINNED[0])
+    # 各部分之和即最终提示词的实际 token 数
+    assert usage['total_tokens'] == prompt_tokens(tokenizer, messages) == fixed_tokens(tokenizer, usage) + usage['history_tokens']
+    assert not usage['over_budget']
+
+
+@pytest.mark.parametrize('keep', [0, 1, 2, 3, len(HISTORY)])
+def test_keeps_whole_messages_newest_first(tokenizer, keep):
+    _, usage = pack_messages(tokenizer, SYSTEM_PROMPT, [], pinned=PINNED)
+    costs = [count_message_tokens(tokenizer, m) for m in HISTORY]
+    kept_cost = sum(costs[len(HISTORY) - keep:])
+    # 预算比保留 keep 条所需多出下一条的 cost - 1：下一条放不下，且不会被截断后放入
+    budget = fixed_tokens(tokenizer, usage) + kept_cost
+    if keep < len(HISTORY):
+        budget += costs[len(HISTORY) - keep - 1] - 1
+
+    messages, usage = pack_messages(tokenizer, SYSTEM_PROMPT, HISTORY, pinned=PINNED, token_budget=budget)
+    assert messages == HISTORY[len(HISTORY) - keep:] + PINNED
+    assert usage['history_tokens'] == kept_cost
+    assert (usage['history_turns'], usage['dropped_turns']) == (keep, len(HISTORY) - keep)
+    assert usage['total_tokens'] == prompt_tokens(tokenizer, messages) <= budget
+    assert not usage['over_budget']
+
+
+def test_stops_at_first_message_that_does_not_fit(tokenizer):
+    """放不下的一条之前更早、更短的消息也不保留（历史保持连续）"""
+    _, usage = pack_messages(tokenizer, SYSTEM_PROMPT, [], pinned=PINNED)
+    costs = [count_message_tokens(tokenizer, m) for m in HISTORY]
+    # 最新一条放得下，倒数第二条（很长）放不下，剩余预算仍足够放下更早的任何一条
+    budget = fixed_tokens(tokenizer, usage) + costs[-1] + costs[-2] - 1
+    assert costs[-2] - 1 >= max(costs[:-2])
+
+    messages, usage = pack_messages(tokenizer, SYSTEM_PROMPT, HISTORY, pinned=PINNED, token_budget=budget)
+    assert messages == HISTORY[-1:] + PINNED
+    assert usage['dropped_turns'] == len(HISTORY) - 1
+
+
+def test_max_turns_limits_history(tokenizer):
+    messages, usage = pack_messages(tokenizer, SYSTEM_PROMPT, HISTORY, pinned=PINNED, max_turns=2)
+    assert messages == HISTORY[-2:] + PINNED
+    assert usage['dropped_turns'] == len(HISTORY) - 2
+
+
+def test_min_turns_are_kept_over_budget(tokenizer):
+    _, usage = pack_messages(tokenizer, SYSTEM_PROMPT, [], pinned=PINNED)
+    budget = fixed_tokens(tokenizer, usage) + count_message_tokens(tokenizer, HISTORY[-1])
+
+    messages, usage = pack_messages(tokenizer, SYSTEM_PROMPT, HISTORY, pinned=PINNED, token_budget=budget, min_turns=3)
+    assert messages == HISTORY[-3:] + PINNED
+    assert usage['over_budget'] and usage['total_tokens'] > budget
+
+    # 预算内本来就能保留 min_turns 条时不算超出预算
+    messages, usage = pack_messages(tokenizer, SYSTEM_PROMPT, HISTORY, pinned=PINNED, token_budget=budget, min_turns=1)
+    assert messages == HISTORY[-1:] + PINNED
+    assert not usage['over_budget'] and usage['total_tokens'] <= budget
+
+
+def test_system_prompt_and_pinned_are_kept_when_budget_is_exhausted(tokenizer):
+    messages, usage = pack_messages(tokenizer, SYSTEM_PROMPT, HISTORY, pinned=PINNED, token_budget=10)
+    assert messages == PINNED
+    assert usage['history_turns'] == 0 and usage['dropped_turns'] == len(HISTORY)
+    assert usage['system_tokens'] > 0 and usage['total_tokens'] == prompt_tokens(tokenizer, PINNED) > 10
+
+    # min_turns 条历史同样保留在 pinned 之前
+    messages, usage = pack_messages(tokenizer, SYSTEM_PROMPT, HISTORY, pinned=PINNED, token_budget=10, min_turns=1)
+    assert messages == HISTORY[-1:] + PINNED and usage['over_budget']
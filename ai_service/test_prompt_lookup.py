@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+测试 prompt lookup 解码（infer._prompt_lookup_generate）与 model.generate 的一致性
+
+候选是确定性的，目标模型一次前向验证全部候选：贪心解码时输出必须与逐 token 的 model.generate 完全相同
+（包括 generation_config 中的 repetition_penalty 和 EOS）。proposed_tokens / accepted_tokens / target_passes
+按参考输出独立重放候选查找得到，必须与解码返回的统计一致。
+
+运行：python -m pytest ai_service/test_prompt_lookup.py
+"""
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('transformers')
+
+from infer import _prompt_lookup_candidates, _prompt_lookup_generate
+
+# 多处重复的庭审用语，使提示词和生成内容中能查到候选续写
+SPEECHES = [
+    '审判员：现在开庭。',
+    '公诉人：被告人张某多次秘密窃取他人财物，数额较大，其行为已构成盗窃罪，请依法判处。',
+    '辩护人：被告人系初犯、偶犯，到案后如实供述，请求法庭依法从轻处罚。',
+    '审判员：请公诉人发表公诉意见。请辩护人发表辩护意见。',
+]
+PROMPTS = [SPEECHES[i % 4] + SPEECHES[(i * 3 + 1) % 4] * (1 + i % 3) + SPEECHES[i % 4][:4 + i] for i in range(20)]
+MAX_NEW_TOKENS = 48
+NUM_TOKENS = 10
+MAX_NGRAM = 3
+
+
+def generate_reference(model, tokenizer, prompt_ids):
+    output = model.generate(
+        input_ids=torch.tensor([prompt_ids]),
+        attention_mask=torch.ones((1, len(prompt_ids)), dtype=torch.long),
+        max_new_tokens=MAX_NEW_TOKENS,
+        do_sample=False,
+        pad_token_id=tokenizer.eos_token_id,
+    )
+    return output[0, len(prompt_ids):].tolist()
+
+
+def replay_counters(prompt_ids, generated):
+    """按参考输出重放每一轮的候选查找：候选与参考输出的公共前缀被接受，再加上目标模型自己产出的一个 token"""
+    ids = prompt_ids + generated
+    prompt_len = pos = len(prompt_ids)
+    proposed = accepted = passes = 0
+    while pos < len(ids):
+        remaining = MAX_NEW_TOKENS - (pos - prompt_len)
+        candidates = []
+        if pos > prompt_len:
+            candidates = _prompt_lookup_candidates(torch.tensor(ids[:pos]), MAX_NGRAM, min(NUM_TOKENS, remaining - 1))
+        match = 0
+        while match < len(candidates) and pos + match < len(ids) and candidates[match] == ids[pos + match]:
+            match += 1
+        proposed += len(candidates)
+        accepted += match
+        passes += 1
+        pos += match + 1
+    return {'generated_tokens': len(generated), 'proposed_tokens': proposed,
+            'accepted_tokens': accepted, 'target_passes': passes}
+
+
+def test_greedy_output_and_counters_match_generate(model, tokenizer):
+    totals = {'proposed_tokens': 0, 'accepted_tokens': 0}
+    with torch.inference_mode():
+        for text in PROMPTS:
+            prompt_ids = tokenizer.encode(text)
+            expected = generate_reference(model, tokenizer, prompt_ids)
+            output_ids, _, counters = _prompt_lookup_generate(
+                model, tokenizer, torch.tensor([prompt_ids]), MAX_NEW_TOKENS, temperature=0, top_p=1.0,
+                num_tokens=NUM_TOKENS, max_ngram=MAX_NGRAM,
+            )
+            assert output_ids[0, len(prompt_ids):].tolist() == expected, text
+            assert counters == replay_counters(prompt_ids, expected), text
+            assert counters['accepted_tokens'] <= counters['proposed_tokens']
+            for key in totals:
+                totals[key] += counters[key]
+    # 候选确实被提出并部分接受（否则上面的一致性只覆盖了逐 token 解码）
+    assert totals['accepted_tokens'] > 0
+    assert totals['proposed_tokens'] > totals['accepted_tokens']
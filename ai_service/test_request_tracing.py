@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+测试请求级阶段追踪（request_tracing）：Server-Timing 响应头、按生成统计拆出的子阶段、JSONL 导出
+
+运行：python -m pytest ai_service/test_request_tracing.py
+"""
+
+import json
+import logging
+import re
+import threading
+
+import pytest
+
+from request_tracing import Trace, TraceExporter
+
+
+def test_server_timing_accumulates_repeated_stages():
+    trace = Trace()
+    t0 = trace._start
+    trace.add_span('build_prompt', t0, t0 + 0.002)
+    trace.add_span('generate', t0 + 0.002, t0 + 0.012)
+    trace.add_span('generate', t0 + 0.020, t0 + 0.0255)
+    trace.add_span('generate', t0 + 0.030, t0 + 0.031)
+    trace.finish()
+
+    parts = trace.server_timing().split(', ')
+    assert parts[:2] == ['build_prompt;dur=2.0', 'generate;dur=16.5;desc="x3"']
+    assert re.fullmatch(r'total;dur=\d+\.\d', parts[2])
+    assert trace.stages()['generate'] == {'dur_ms': 16.5, 'count': 3}
+
+
+def test_server_timing_sanitises_metric_names():
+    trace = Trace()
+    t0 = trace._start
+    trace.add_span('kv cache/lookup(prefix)', t0, t0 + 0.001)
+    trace.add_span('a,b;c="d"', t0, t0 + 0.001)
+
+    names = [part.split(';')[0] for part in trace.server_timing().split(', ')]
+    assert names == ['kv_cache_lookup_prefix_', 'a_b_c__d_', 'total']
+    # 原始名称保留在 JSON 导出中
+    assert list(trace.as_dict()['stages']) == ['kv cache/lookup(prefix)', 'a,b;c="d"']
+
+
+def test_span_records_errors():
+    trace = Trace()
+    with pytest.raises(ValueError):
+        with trace.span('postprocess', role='公诉人'):
+            raise ValueError('bad')
+    span = trace.as_dict()['spans'][0]
+    assert (span['name'], span['error'], span['role']) == ('postprocess', 'ValueError', '公诉人')
+
+
+def test_add_generation_reconstructs_stages():
+    trace = Trace()
+    end = trace._start + 1.0
+    trace.add_generation({'tokenize_sec': 0.001, 'queue_sec': 0.002, 'prefill_sec': 0.003, 'decode_sec': 0.004}, end=end)
+
+    spans = [(s['name'], s['start_ms'], s['dur_ms']) for s in trace.as_dict()['spans']]
+    # 各阶段首尾相接，以生成结束时刻倒推起点
+    assert spans == [('tokenize', 990.0, 1.0), ('queue', 991.0, 2.0), ('prefill', 993.0, 3.0), ('decode', 996.0, 4.0)]
+
+    # 没有排队（未经调度器）时不记录 queue，缺失的耗时按 0 计
+    trace = Trace()
+    trace.add_generation({'prefill_sec': 0.003, 'decode_sec': None}, end=trace._start + 0.5)
+    spans = [(s['name'], s['start_ms'], s['dur_ms']) for s in trace.as_dict()['spans']]
+    assert spans == [('tokenize', 497.0, 0.0), ('prefill', 497.0, 3.0), ('decode', 500.0, 0.0)]
+
+    trace.add_generation(None)
+    trace.add_generation({})
+    assert len(trace.as_dict()['spans']) == 3
+
+
+def test_exporter_writes_on_a_background_thread(tmp_path, monkeypatch):
+    path = tmp_path / 'traces.jsonl'
+    writers = set()
+    emit = logging.FileHandler.emit
+
+    def record_thread(handler, record):
+        writers.add(threading.get_ident())
+        emit(handler, record)
+
+    monkeypatch.setattr(logging.FileHandler, 'emit', record_thread)
+    exporter = TraceExporter(str(path))
+    traces = [Trace(name=f'/api/{i}') for i in range(20)]
+    threads = [threading.Thread(target=exporter.export, args=(trace,)) for trace in traces[1:]]
+    exporter.export(traces[0])
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    exporter.close()
+    exporter.export(Trace())  # 关闭后的导出被丢弃
+
+    records = [json.loads(line) for line in path.read_text(encoding='utf-8').splitlines()]
+    assert sorted(r['request_id'] for r in records) == sorted(t.request_id for t in traces)
+    assert exporter.stats()['written'] == 20
+    assert threading.get_ident() not in writers and len(writers) == 1
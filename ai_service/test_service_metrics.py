@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+测试服务运行指标（service_metrics）的 Prometheus 文本暴露格式
+
+运行：python -m pytest ai_service/test_service_metrics.py
+"""
+
+import pytest
+
+from service_metrics import MetricsRegistry
+
+
+def test_render_counter_histogram_and_callback_gauges():
+    registry = MetricsRegistry()
+    requests = registry.counter('court_requests_total', '请求数', ['endpoint', 'status'])
+    latency = registry.histogram('court_generate_seconds', '生成耗时', ['role'], buckets=[1.0, 0.1, float('inf')])
+    depth = {'value': 3}
+    registry.gauge('court_queue_depth', '队列深度', callback=lambda: depth['value'])
+    registry.gauge('court_none', '暂无数据', callback=lambda: None)
+    registry.gauge('court_broken', '回调出错', callback=lambda: 1 / 0)
+
+    requests.labels('/api/generate', '200').inc()
+    requests.labels(endpoint='/api/generate', status='200').inc(2)
+    requests.labels('路径"a\\b"\n', '500').inc()
+    for value in (0.05, 0.1, 0.5, 7.25):
+        latency.labels(role='公诉人').observe(value)
+
+    assert registry.render() == '\n'.join([
+        '# HELP court_requests_total 请求数',
+        '# TYPE court_requests_total counter',
+        'court_requests_total{endpoint="/api/generate",status="200"} 3',
+        'court_requests_total{endpoint="路径\\"a\\\\b\\"\\n",status="500"} 1',
+        '# HELP court_generate_seconds 生成耗时',
+        '# TYPE court_generate_seconds histogram',
+        # 分桶累计计数，边界值计入该桶（le 包含等号），+Inf 桶等于总数
+        'court_generate_seconds_bucket{role="公诉人",le="0.1"} 2',
+        'court_generate_seconds_bucket{role="公诉人",le="1"} 3',
+        'court_generate_seconds_bucket{role="公诉人",le="+Inf"} 4',
+        'court_generate_seconds_sum{role="公诉人"} 7.9',
+        'court_generate_seconds_count{role="公诉人"} 4',
+        '# HELP court_queue_depth 队列深度',
+        '# TYPE court_queue_depth gauge',
+        'court_queue_depth 3',
+        # 回调返回 None 或抛出异常的 Gauge 只输出 HELP/TYPE，不输出样本
+        '# HELP court_none 暂无数据',
+        '# TYPE court_none gauge',
+        '# HELP court_broken 回调出错',
+        '# TYPE court_broken gauge',
+    ]) + '\n'
+
+    # 回调在每次抓取时调用
+    depth['value'] = 0.5
+    assert 'court_queue_depth 0.5\n' in registry.render()
+
+
+def test_invalid_usage_is_rejected():
+    registry = MetricsRegistry()
+    counter = registry.counter('c_total', 'c', ['role'])
+    with pytest.raises(ValueError):
+        registry.counter('c_total', 'c')
+    with pytest.raises(ValueError):
+        counter.inc()
+    with pytest.raises(ValueError):
+        counter.labels('a', role='b')
+    with pytest.raises(ValueError):
+        counter.labels(other='a')
+    with pytest.raises(ValueError):
+        registry.counter('d_total', 'd').inc(-1)
+    with pytest.raises(ValueError):
+        registry.histogram('h', 'h', ['le'])
+    with pytest.raises(ValueError):
+        registry.gauge('g', 'g', ['role'], callback=lambda: 1)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+测试庭审级近似重复发言索引（speech_index）
+
+样例发言来自同一场盗窃案庭审：公诉人围绕同一案情的不同发言（共享人名、法条、金额）、
+审判员按模板宣布的各轮辩论，以及模型几乎原样重复较早发言的情况。
+默认阈值与最短长度必须把前两类判为不重复、把最后一类判为重复。
+
+运行：python -m pytest ai_service/test_speech_index.py
+"""
+
+import pytest
+
+pytest.importorskip('numpy')
+
+import speech_index
+from speech_index import SpeechIndex, SpeechIndexStore
+
+PROSECUTOR_SPEECHES = [
+    '审判员，公诉人认为，被告人张某于2024年3月至5月间，多次在本市某小区内趁无人之机，秘密窃取他人电动车电瓶共计十二块，'
+    '价值人民币八千余元，数额较大，其行为已触犯《中华人民共和国刑法》第二百六十四条，应当以盗窃罪追究其刑事责任。',
+    '针对辩护人提出的被告人系初犯、偶犯的意见，公诉人认为，被告人张某在三个月内作案多次，作案手段相对固定，并非偶然犯罪，'
+    '虽然系初犯，但其主观恶性不能认定为较小，量刑时不应过度从宽，请法庭依法考量。',
+    '关于赃物价值的认定，公诉人认为，本案的价格认定结论书由具有资质的价格认证中心依法作出，鉴定程序合法，依据充分，'
+    '被告人张某盗窃电动车电瓶十二块价值八千余元的事实清楚，辩护人对价格认定的质疑缺乏依据。',
+    '公诉人注意到，被告人张某到案后如实供述了自己的罪行，并退赔了部分被害人的经济损失，依照《中华人民共和国刑法》'
+    '第六十七条第三款的规定，可以从轻处罚，公诉人建议对被告人张某判处有期徒刑八个月至一年，并处罚金。',
+    '审判员，关于辩护人提出的被告人张某具有自首情节的意见，公诉人认为不能成立。被告人张某系公安机关根据监控录像锁定后'
+    '抓获归案，并非主动投案，不符合自首的构成要件，只能认定为坦白，请法庭不予采纳。',
+    '综上所述，公诉人认为，本案事实清楚，证据确实充分，被告人张某以非法占有为目的，多次秘密窃取他人财物，数额较大，'
+    '其行为已构成盗窃罪，请法庭综合考虑其坦白、退赔等情节，依法作出公正判决。',
+]
+
+# 模型几乎原样重复上面的第 1、6 条
+REPEATED_SPEECHES = [
+    (0, '审判员，公诉人认为，被告人张某于2024年3月至5月期间，多次在本市某小区内趁无人之机，秘密窃取他人电动车电瓶共十二块，'
+        '价值人民币八千余元，数额较大，其行为已经触犯《中华人民共和国刑法》第二百六十四条，应当以盗窃罪追究刑事责任。'),
+    (5, '公诉人认为，被告人张某以非法占有为目的，多次秘密窃取他人财物，数额较大，其行为已构成盗窃罪。综上所述，'
+        '本案事实清楚，证据确实充分，请法庭综合考虑其坦白、退赔等情节，依法作出公正判决。'),
+]
+
+# 审判员每轮按模板宣布辩论，彼此高度相似但都是正常发言
+JUDGE_ANNOUNCEMENTS = [
+    '现在进行第一轮法庭辩论。法庭辩论应当围绕本案的争议焦点进行，请控辩双方注意发言不要重复。首先由公诉人发表公诉意见。',
+    '现在进行第二轮法庭辩论。法庭辩论应当围绕本案的争议焦点进行，请控辩双方注意发言不要重复。首先由公诉人发表答辩意见。',
+]
+
+
+def build_index(speeches, role='plaintiff', **kwargs):
+    index = SpeechIndex(**kwargs)
+    index.sync((role, text) for text in speeches)
+    return index
+
+
+def test_distinct_speeches_about_the_same_case_are_not_duplicates():
+    for i, text in enumerate(PROSECUTOR_SPEECHES):
+        index = build_index(PROSECUTOR_SPEECHES[:i] + PROSECUTOR_SPEECHES[i + 1:])
+        assert len(index) == len(PROSECUTOR_SPEECHES) - 1
+        assert index.near_duplicates(text, role='plaintiff') == []
+
+
+def test_near_verbatim_repeat_of_an_early_speech_is_found():
+    index = build_index(PROSECUTOR_SPEECHES)
+    for source, text in REPEATED_SPEECHES:
+        matches = index.near_duplicates(text, role='plaintiff')
+        assert matches and matches[0][1] == PROSECUTOR_SPEECHES[source]
+        assert matches[0][2] >= speech_index.DEFAULT_THRESHOLD
+
+
+def test_templated_judge_announcements_are_not_indexed():
+    index = build_index(JUDGE_ANNOUNCEMENTS[:1], role='judge')
+    assert len(index) == 0
+    assert index.near_duplicates(JUDGE_ANNOUNCEMENTS[1], role='judge') == []
+
+
+def test_add_and_sync_only_append_new_speeches():
+    index = SpeechIndex()
+    assert index.add('plaintiff', PROSECUTOR_SPEECHES[0])
+    assert not index.add('plaintiff', '  ' + PROSECUTOR_SPEECHES[0] + '\n')
+    assert not index.add('judge', '请辩护人发言。')
+    # 客户端截断 context 后重发：只追加新出现的发言，更早的发言仍在索引中
+    assert index.sync([('plaintiff', text) for text in PROSECUTOR_SPEECHES[:3]]) == 2
+    assert index.sync([('plaintiff', text) for text in PROSECUTOR_SPEECHES[2:4]]) == 1
+    assert len(index) == 4
+    assert index.near_duplicates(REPEATED_SPEECHES[0][1])
+
+
+def test_near_duplicates_filters_by_role():
+    index = SpeechIndex()
+    index.add('plaintiff', PROSECUTOR_SPEECHES[0])
+    text = REPEATED_SPEECHES[0][1]
+    assert index.near_duplicates(text, role='defendant') == []
+    assert [m[0] for m in index.near_duplicates(text, role='plaintiff')] == ['plaintiff']
+    assert [m[0] for m in index.near_duplicates(text)] == ['plaintiff']
+
+
+def test_store_expires_idle_trials(fake_clock):
+    clock = fake_clock(speech_index)
+    store = SpeechIndexStore(ttl_sec=60)
+    store.get('trial-1').add('plaintiff', PROSECUTOR_SPEECHES[0])
+    clock.now += 30
+    assert len(store.get('trial-1')) == 1
+    clock.now += 61
+
+    assert len(store.get('trial-1')) == 0
+    stats = store.stats()
+    assert (stats['created'], stats['expired'], stats['trials']) == (2, 1, 1)
+
+
+def test_store_evicts_least_recently_used_trials(fake_clock):
+    fake_clock(speech_index)
+    store = SpeechIndexStore(max_trials=2)
+    store.get('a').add('plaintiff', PROSECUTOR_SPEECHES[0])
+    store.get('b')
+    store.get('a')
+    store.get('c')
+
+    stats = store.stats()
+    assert (stats['trials'], stats['evictions']) == (2, 1)
+    assert len(store.get('a')) == 1
+    assert store.stats()['created'] == 3  # a 仍在，b 被淘汰
+    store.get('b')
+    assert store.stats()['created'] == 4
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+测试输出后处理与最初逐条正则处理的一致性
+
+reference_filter_judge_style 是 speech_postprocess 之前 app.py 中 filter_judge_style_speech 的规则部分
+（去掉日志，逻辑逐行保留），SpeechPostprocessor.filter_judge_style 在随机输入上必须与它完全一致。
+流式输出（IncrementalJudgeStyleFilter、app.IncrementalSpeechCleaner）按随机切分的片段逐段输入，
+每次的结果只能在上一次的基础上追加，拼接后与非流式处理的结果相同。
+
+运行：python -m pytest ai_service/test_speech_postprocess.py
+"""
+
+import random
+import re
+
+import pytest
+
+from speech_postprocess import IncrementalJudgeStyleFilter, SpeechPostprocessor
+
+
+def reference_filter_judge_style(text: str) -> str:
+    """最初的 filter_judge_style_speech（非审判员角色）"""
+    if not text:
+        return text
+
+    filtered_text = text
+
+    judge_style_patterns = [
+        r'现在进入辩论环节[。，]?',
+        r'现在进行法庭辩论[。，]?',
+        r'首先由.*?发表.*?意见[。，]?',
+        r'现在宣布.*?[。，]?',
+        r'现在开始.*?[。，]?',
+        r'进入.*?环节[。，]?',
+        r'现在.*?环节[。，]?',
+        r'审判员总结.*?[。，]?',
+        r'总结辩论[。，]?',
+        r'总结.*?辩论[。，]?',
+        r'本庭总结[。，]?',
+        r'法庭总结[。，]?',
+    ]
+
+    bracket_patterns = [
+        r'\[审判员.*?\]',
+        r'\[总结.*?\]',
+        r'\[法庭.*?\]',
+        r'\[本庭.*?\]',
+    ]
+
+    for pattern in bracket_patterns:
+        if re.search(pattern, filtered_text):
+            filtered_text = re.sub(pattern, '', filtered_text)
+
+    has_judge_style = False
+    for pattern in judge_style_patterns:
+        if re.search(pattern, filtered_text):
+            has_judge_style = True
+            break
+
+    if has_judge_style:
+        for pattern in judge_style_patterns:
+            filtered_text = re.sub(pattern + r'[\s\n]*', '', filtered_text, flags=re.IGNORECASE)
+            filtered_text = re.sub(r'[\s\n]*' + pattern + r'$', '', filtered_text, flags=re.IGNORECASE | re.MULTILINE)
+
+        if len(filtered_text.strip()) < 10:
+            filtered_text = text
+
+    return filtered_text.strip()
+
+
+# 随机输入的组成片段：覆盖各规则的起点文字、方括号、标点、空白换行与大小写
+FRAGMENTS = [
+    '现在', '进入', '进行', '辩论', '法庭', '环节', '总结', '本庭', '审判员', '首先由', '发表', '意见',
+    '宣布', '开始', '被告人', '公诉人', '[', ']', '。', '，', '！', ' ', '\n', 'A', 'a',
+]
+
+
+def random_texts(count, seed=0, max_fragments=16):
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield ''.join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, max_fragments)))
+
+
+def assert_equivalent(postprocessor, count):
+    mismatches = [
+        text for text in random_texts(count)
+        if postprocessor.filter_judge_style(text)[0] != reference_filter_judge_style(text)
+    ]
+    assert not mismatches, f"{len(mismatches)} 条结果不一致，例如: {mismatches[:3]!r}"
+
+
+def test_rule_order_example():
+    """前面规则的删除会改变后面规则的匹配，顺序必须与原来相同"""
+    text = '本庭总结被告人总结， 辩论]开始总结本庭本庭'
+    assert SpeechPostprocessor().filter_judge_style(text)[0] == reference_filter_judge_style(text) == '本庭]开始总结本庭本庭'
+
+
+def test_matches_reference_on_random_inputs():
+    assert_equivalent(SpeechPostprocessor(), 50000)
+
+
+def test_matches_reference_with_decode_time_phrase_lists():
+    """app.py 中的配置（传入解码期约束共用的短语表）同样与原来一致"""
+    pytest.importorskip('torch')
+    from infer import JUDGE_STYLE_PHRASES, JUDGE_STYLE_BRACKET_PREFIXES
+    assert_equivalent(SpeechPostprocessor(JUDGE_STYLE_PHRASES, JUDGE_STYLE_BRACKET_PREFIXES), 50000)
+
+
+# ==================== 流式增量处理 ====================
+# 流式输出逐段到达：每次的结果必须以上一次的结果为前缀（已发送的内容不能撤回），
+# 结束后拼接的结果与对完整文本的非流式处理相同（跨句匹配与过短回退只在非流式处理中生效，随机输入避开这两种情况）
+
+SENTENCES = [
+    '被告人系初犯、偶犯。', '其行为已构成盗窃罪，', '请依法从轻处罚。', '证据确实充分', '被害人的损失已获赔偿？',
+]
+LONG_SENTENCE = '案发后被告人如实供述犯罪事实！'
+JUDGE_STYLE_SENTENCES = [
+    '现在进入辩论环节。', '本庭总结。', '首先由公诉人发表公诉意见。', '现在进行法庭辩论！', '[审判员：请控制时间]', '[总结：略]',
+]
+SPECIAL_TOKENS = ['<|im_end|>', '<|im_start|>']
+
+
+def random_chunks(rng, text):
+    """把 text 随机切成 1~8 个字符的片段"""
+    chunks = []
+    while text:
+        n = rng.randint(1, 8)
+        chunks.append(text[:n])
+        text = text[n:]
+    return chunks
+
+
+def random_output(rng, role):
+    """随机拼出一条模型原始输出：角色前缀、审判员口吻、特殊标记，以及可选的 <final> 标签和其后的多余输出"""
+    pieces = [LONG_SENTENCE] + [rng.choice(SENTENCES + JUDGE_STYLE_SENTENCES) for _ in range(rng.randint(0, 6))]
+    rng.shuffle(pieces)
+    body = ''
+    for piece in pieces:
+        if rng.random() < 0.2:
+            body += rng.choice(SPECIAL_TOKENS)
+        body += piece
+    body = rng.choice(['', f'{role}：', f'{role}：{role}: ', f'{role}:\n']) + body
+    head = rng.choice(['', ' \n', '<|im_start|>'])
+    if rng.random() < 0.5:
+        # 删除审判员口吻时会连同其后的换行一起删除（跨句），换行只出现在被截断的其他角色发言前
+        other = '公诉人' if role == '辩护人' else '辩护人'
+        tail = rng.choice(['', '<|im_end|>', f'\n{other}：我方认为', f'\n{other}:'])
+        return head + body + tail
+    return head + '<final>' + body + '</final>' + rng.choice(['', '<|im_end|>', '多余的输出'])
+
+
+@pytest.fixture(scope='module')
+def app():
+    pytest.importorskip('flask')
+    pytest.importorskip('torch')
+    import app
+    return app
+
+
+def app_stop_sequences(role):
+    from infer import default_stop_sequences
+    return default_stop_sequences(role)
+
+
+def non_streaming(app, raw, role):
+    """与 app.py 中流结束后对完整输出的处理相同"""
+    from infer import extract_final, truncate_at_stop_sequence
+
+    raw = truncate_at_stop_sequence(raw, app_stop_sequences(role))
+    response = extract_final(raw) or raw.strip()
+    text = app.clean_special_tokens(response)
+    text = app.remove_duplicate_role_prefix(text, role)
+    return app.filter_judge_style_speech(text, role)
+
+
+def test_incremental_filter_only_appends_and_matches_sentence_filter():
+    postprocessor = SpeechPostprocessor()
+    rng = random.Random(1)
+    for text in random_texts(2000, seed=1, max_fragments=24):
+        incremental = IncrementalJudgeStyleFilter(postprocessor)
+        rendered = ''
+        for end in sorted(rng.sample(range(len(text) + 1), min(len(text) + 1, 6))):
+            current = incremental.render(text[:end])
+            assert current.startswith(rendered), (text, end)
+            rendered = current
+        final = incremental.render(text, final=True)
+        assert final.startswith(rendered)
+        # 完整文本的结果即逐句过滤的结果
+        sentences = re.findall(r'[^\n。！？!?]*[\n。！？!?]|[^\n。！？!?]+$', text)
+        assert final == ''.join(postprocessor.filter_segment(s) for s in sentences)
+
+
+def test_safe_prefix_len_holds_back_possible_matches():
+    postprocessor = SpeechPostprocessor()
+    hold = postprocessor._max_trigger_len - 1
+    text = '被告人系初犯，其行为已构成盗窃罪'
+    # 后续输出可能在末尾开始一个匹配，删除后又可能与前面的文字拼出新的起点文字
+    assert postprocessor.safe_prefix_len(text) == len(text) - hold
+    # 末尾是起点文字的前半部分（连同前面的空白）
+    assert postprocessor.safe_prefix_len(text + ' 现') == len(text) + 1 - hold
+    assert postprocessor.safe_prefix_len(text + '[审') == len(text) - hold
+    # 已出现起点文字
+    assert postprocessor.safe_prefix_len(text + '总结请法庭依法从轻处罚') == len(text) - hold
+    assert postprocessor.safe_prefix_len('被告人' + ' ' * hold + '现在') == 3
+    assert postprocessor.safe_prefix_len('现在进入') == 0
+
+
+def test_streaming_cleaner_matches_non_streaming(app):
+    rng = random.Random(2)
+    for role in ['公诉人', '辩护人', '审判员']:
+        for _ in range(300):
+            raw = random_output(rng, role)
+            cleaner = app.IncrementalSpeechCleaner(role, stop_sequences=app_stop_sequences(role))
+            # 记录每次的完整结果：_advance 遇到不是追加的结果时只会静默停止输出
+            rendered = []
+            render = cleaner._render
+            cleaner._render = lambda final: rendered.append(render(final)) or rendered[-1]
+
+            streamed = ''.join(cleaner.feed(chunk) for chunk in random_chunks(rng, raw)) + cleaner.flush()
+            assert all(b.startswith(a) for a, b in zip(rendered, rendered[1:-1])), raw
+            assert rendered[-1].rstrip().startswith(rendered[-2]), raw
+            assert streamed == cleaner.emitted == non_streaming(app, raw, role), raw
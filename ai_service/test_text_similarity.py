@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+测试发言相似度（text_similarity）与最初 calculate_text_similarity 的一致性
+
+reference_similarity 是 text_similarity 之前 app.py 中 calculate_text_similarity 的实现（二维 LCS 表，逐行保留）。
+score / scores 在随机输入上必须与它的结果完全相同（浮点值逐位相等），
+at_least / first_at_least（扫描途中按上下界提前结束）必须与按完整相似度判断阈值的结果相同。
+
+运行：python -m pytest ai_service/test_text_similarity.py
+"""
+
+import random
+
+from text_similarity import SpeechSimilarity, lcs_length, text_similarity
+
+THRESHOLDS = [0.0, 0.3, 0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 1.0]
+
+
+def reference_similarity(text1: str, text2: str) -> float:
+    """最初的 calculate_text_similarity"""
+    if not text1 or not text2:
+        return 0.0
+
+    # 如果文本完全相同
+    if text1 == text2:
+        return 1.0
+
+    # 计算字符重叠率
+    set1 = set(text1)
+    set2 = set(text2)
+
+    if not set1 or not set2:
+        return 0.0
+
+    intersection = len(set1 & set2)
+    union = len(set1 | set2)
+
+    char_overlap = intersection / union if union > 0 else 0.0
+
+    # 计算最长公共子序列长度
+    def lcs_length(s1, s2):
+        m, n = len(s1), len(s2)
+        dp = [[0] * (n + 1) for _ in range(m + 1)]
+        for i in range(1, m + 1):
+            for j in range(1, n + 1):
+                if s1[i-1] == s2[j-1]:
+                    dp[i][j] = dp[i-1][j-1] + 1
+                else:
+                    dp[i][j] = max(dp[i-1][j], dp[i][j-1])
+        return dp[m][n]
+
+    lcs_len = lcs_length(text1, text2)
+    max_len = max(len(text1), len(text2))
+    lcs_ratio = lcs_len / max_len if max_len > 0 else 0.0
+
+    # 综合相似度（字符重叠率权重0.4，LCS权重0.6）
+    similarity = 0.4 * char_overlap + 0.6 * lcs_ratio
+
+    return similarity
+
+
+def mutate(rng: random.Random, text: str, alphabet: str, rate: float) -> str:
+    """随机替换/删除/插入部分字符，得到与 text 相似度各不相同的文本"""
+    out = []
+    for ch in text:
+        r = rng.random()
+        if r < rate / 3:
+            out.append(rng.choice(alphabet))
+        elif r < rate * 2 / 3:
+            continue
+        elif r < rate:
+            out.extend([ch, rng.choice(alphabet)])
+        else:
+            out.append(ch)
+    return ''.join(out)
+
+
+def random_case(rng: random.Random):
+    alphabet = '审判员公诉人辩护被告盗窃罪数额较大依法从轻处罚事实清楚证据充分，。'[:rng.randint(3, 34)]
+    base = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 200)))
+    candidate = mutate(rng, base, alphabet, rng.random() * 0.5)
+    history = [mutate(rng, base, alphabet, rng.random()) for _ in range(rng.randint(0, 5))]
+    if history and rng.random() < 0.1:
+        history[rng.randrange(len(history))] = candidate
+    if history and rng.random() < 0.1:
+        history[rng.randrange(len(history))] = ''
+    return candidate, history
+
+
+def test_score_matches_reference():
+    rng = random.Random(0)
+    for _ in range(100):
+        candidate, history = random_case(rng)
+        for other in history:
+            expected = reference_similarity(candidate, other)
+            assert SpeechSimilarity(candidate).score(other) == expected
+            assert text_similarity(candidate, other) == expected
+            assert text_similarity(other, candidate) == reference_similarity(other, candidate)
+
+
+def test_batch_scores_match_reference():
+    rng = random.Random(1)
+    for _ in range(100):
+        candidate, history = random_case(rng)
+        assert SpeechSimilarity(candidate).scores(history) == [
+            reference_similarity(candidate, other) for other in history
+        ]
+        assert SpeechSimilarity(candidate).first_at_least(history, 0.5) == next(
+            (i for i, other in enumerate(history) if reference_similarity(candidate, other) >= 0.5), None
+        )
+
+
+def test_threshold_checks_match_reference():
+    """at_least / first_at_least 会在扫描途中提前结束，判断结果仍须与完整相似度一致"""
+    rng = random.Random(2)
+    for _ in range(100):
+        candidate, history = random_case(rng)
+        similarity = SpeechSimilarity(candidate)
+        expected_scores = [reference_similarity(candidate, other) for other in history]
+        for threshold in THRESHOLDS:
+            for other, expected in zip(history, expected_scores):
+                assert similarity.at_least(other, threshold) == (expected >= threshold)
+            expected_first = next((i for i, s in enumerate(expected_scores) if s >= threshold), None)
+            assert similarity.first_at_least(history, threshold) == expected_first
+
+
+def test_early_exit_is_taken_on_long_speeches():
+    rng = random.Random(3)
+    alphabet = '审判员公诉人辩护被告盗窃罪数额较大依法从轻处罚事实清楚证据充分'
+    base = ''.join(rng.choice(alphabet) for _ in range(400))
+    near = mutate(rng, base, alphabet, 0.05)
+    far = ''.join(rng.choice(alphabet) for _ in range(400))
+    similarity = SpeechSimilarity(base)
+
+    for other, decided in ((near, True), (far, False)):
+        threshold = 0.7
+        char_overlap = similarity._char_overlap(other)
+        max_len = max(len(base), len(other))
+        lcs_len, result = similarity._scan(other, bound=(char_overlap, threshold, max_len))
+        # 扫描到结尾才判定时 result 为 None
+        assert result is decided
+        assert lcs_len <= lcs_length(base, other)
+        assert similarity.at_least(other, threshold) == (reference_similarity(base, other) >= threshold)
+
+    assert similarity.first_at_least([far, near, far], 0.7) == 1
+    assert similarity.first_at_least([far, far], 0.7) is None
+
+
+def test_packed_lanes_do_not_interfere(monkeypatch):
+    """批量接口只做一次打包扫描（不逐条调用 _scan），各段的 LCS 与单独计算相同"""
+    def scan_one(self, other, bound=None):
+        raise AssertionError('批量接口不应逐条扫描')
+
+    monkeypatch.setattr(SpeechSimilarity, '_scan', scan_one)
+    rng = random.Random(4)
+    history = [''.join(rng.choice('甲乙丙') for _ in range(n)) for n in (1, 63, 64, 65, 130)]
+    for _ in range(20):
+        candidate = ''.join(rng.choice('甲乙丙丁') for _ in range(rng.randint(1, 150)))
+        assert SpeechSimilarity(candidate).scores(history) == [
+            reference_similarity(candidate, other) for other in history
+        ]
+        assert SpeechSimilarity(candidate).first_at_least(history, 0.5) == next(
+            (i for i, other in enumerate(history) if reference_similarity(candidate, other) >= 0.5), None
+        )
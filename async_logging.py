@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+异步日志
+
+- start_async_logging：把根 logger 现有的 handler 挪到后台线程（QueueHandler + QueueListener），
+  请求线程只负责把日志记录放入队列，格式化与写终端/文件都在后台完成。
+- PromptLog：完整提示词的抽样落盘。每条记录为一行 JSON，经队列由后台线程写入按大小轮转的文件，
+  轮转出的旧文件用 gzip 压缩（prompts.jsonl.1.gz、prompts.jsonl.2.gz ...）。
+  抽样由调用方决定（sampled()），出错时补写的逻辑见 ai_service/app.py。
+"""
+
+import atexit
+import gzip
+import json
+import logging
+import os
+import queue
+import random
+import shutil
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Any, Dict, Optional
+
+
+def start_async_logging(logger: Optional[logging.Logger] = None) -> Optional[QueueListener]:
+    """
+    把 logger（默认根 logger）的 handler 移到后台线程
+
+    已经切换过（只剩一个 QueueHandler）或没有 handler 时不做处理，返回 None。
+    进程退出时自动停止监听线程并写完队列中剩余的记录。
+    """
+    logger = logger or logging.getLogger()
+    handlers = list(logger.handlers)
+    if not handlers or any(isinstance(h, QueueHandler) for h in handlers):
+        return None
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def _gzip_rotator(source: str, dest: str):
+    """RotatingFileHandler 的轮转函数：把写满的文件压缩为 dest（已带 .gz 后缀）"""
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+class PromptLog:
+    """
+    完整提示词的 JSONL 日志（异步写入、按大小轮转并压缩）
+
+    path 为空时不写文件，write() 直接丢弃。
+    """
+
+    def __init__(self, path: str, sample_rate: float = 0.01, on_error: bool = True,
+                 max_bytes: int = 50 * 1024 * 1024, backup_count: int = 10):
+        """
+        Args:
+            path: 当前日志文件路径（轮转后的文件为 path.1.gz、path.2.gz ...）
+            sample_rate: 抽样比例（0-1），0 表示只在出错时记录（见 on_error）
+            on_error: 请求出错时是否补写该请求的提示词
+            max_bytes: 当前文件超过该大小后轮转
+            backup_count: 保留的压缩文件个数
+        """
+        self.path = path
+        self.sample_rate = max(0.0, min(1.0, sample_rate))
+        self.on_error = on_error
+        self._written = 0
+        self._lock = threading.Lock()
+        self._listener: Optional[QueueListener] = None
+        # 不注册到 logging 的 logger 树中：多个实例各自写自己的文件，关闭后也不会残留 handler
+        self._logger = logging.Logger(f"{__name__}.prompts", logging.INFO)
+        if not path:
+            return
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+        handler.namer = lambda name: name + '.gz'
+        handler.rotator = _gzip_rotator
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+        self._logger.addHandler(QueueHandler(log_queue))
+        self._listener = QueueListener(log_queue, handler)
+        self._listener.start()
+        atexit.register(self.close)
+
+    @property
+    def enabled(self) -> bool:
+        return self._listener is not None
+
+    def sampled(self) -> bool:
+        """按抽样比例决定是否记录（每个请求调用一次）"""
+        return self.enabled and self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def write(self, record: Dict[str, Any]):
+        """把一条记录放入写入队列（不阻塞请求线程）"""
+        if not self.enabled:
+            return
+        self._logger.info(json.dumps(record, ensure_ascii=False, default=str))
+        with self._lock:
+            self._written += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            written = self._written
+        return {
+            'path': self.path,
+            'sample_rate': self.sample_rate,
+            'on_error': self.on_error,
+            'written': written,
+        }
+
+    def close(self):
+        """停止后台线程（会先写完队列中的记录）并关闭文件"""
+        if self._listener is not None:
+            self._listener.stop()
+            for handler in self._listener.handlers:
+                handler.close()
+            self._listener = None
@@ -0,0 +1,515 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+连续批处理调度器（continuous batching）
+
+把并发的 chat/generate 请求合并进同一个正在运行的解码批次，而不是让它们排队或争抢同一份权重：
+- 新请求在 token 边界加入批次：先单独 prefill，再把 KV 缓存左填充对齐后拼接进批次
+- 已结束的请求在 token 边界离开批次：按行裁剪 KV 缓存，并去掉全部为填充的列
+- max_batch_size 限制同时解码的序列数，max_wait_ms 限制空闲时为凑批而等待的时间
+- 使用不同 LoRA 适配器的请求可以在同一批次中解码（PEFT 的 adapter_names 按行选择适配器）
+- 采样按 model.generation_config 组装与 model.generate 相同的 logits 处理器（repetition_penalty、top_k 等），
+  结束条件使用 generation_config 中的全部 EOS，开启批处理不改变输出分布
+
+调度器独占模型：启用后所有生成都应通过 submit()/generate() 进入，由后台线程统一执行前向计算。
+需要修改模型结构时（加载/卸载 LoRA 适配器），在 paused() 内进行：调度器在当前 token 边界停下，
+期间不做任何前向计算，退出后批次继续解码。
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional
+
+import torch
+
+from infer import (
+    _cache_to_layers,
+    _layers_to_cache,
+    build_logits_processors,
+    find_stop_sequence,
+    resolve_eos_token_ids,
+    sample_next_token,
+    stop_sequence_window,
+    STOP_REASON_EOS,
+    STOP_REASON_STOP_SEQUENCE,
+    STOP_REASON_LENGTH,
+)
+
+
+def _pad_layers_left(layers: List[Any], pad: int) -> List[Any]:
+    """在序列维（dim=-2）左侧补零，使批次内各序列的 KV 长度对齐"""
+    if pad <= 0:
+        return layers
+    padded = []
+    for k, v in layers:
+        k_pad = k.new_zeros(k.shape[:-2] + (pad, k.shape[-1]))
+        v_pad = v.new_zeros(v.shape[:-2] + (pad, v.shape[-1]))
+        padded.append((torch.cat([k_pad, k], dim=-2), torch.cat([v_pad, v], dim=-2)))
+    return padded
+
+
+class _Sequence:
+    """调度器内部的一条生成序列"""
+
+    def __init__(
+        self,
+        input_ids: List[int],
+        max_new_tokens: int,
+        do_sample: bool,
+        processors,
+        future: Future,
+        prefix_len: int = 0,
+        session_id: Optional[str] = None,
+        streamer=None,
+        stop_sequences: Optional[List[str]] = None,
+        adapter_name: Optional[str] = None,
+        gen_info: Optional[Dict[str, Any]] = None,
+        update_session: bool = True,
+    ):
+        self.input_ids = input_ids
+        self.update_session = update_session
+        self.gen_info = gen_info
+        self.adapter_name = adapter_name
+        self.processors = processors
+        self.prefix_len = prefix_len
+        self.session_id = session_id
+        self.streamer = streamer
+        self.stop_sequences = [s for s in stop_sequences or [] if s]
+        self.stop_window = stop_sequence_window(self.stop_sequences)
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.future = future
+        self.generated: List[int] = []
+        # 已写入 KV 缓存的真实 token 数（不含左填充），也是下一个输入 token 的 position id
+        self.length = 0
+        self.enqueue_time = time.time()
+        self.start_time: Optional[float] = None
+        self.first_token_time: Optional[float] = None
+        self.cached_tokens = 0
+
+    def append(self, token_id: int):
+        """记录新采样的 token，并推送给流式输出（与 model.generate 一致：先推送提示词，再逐个推送新 token）"""
+        if self.streamer is not None:
+            if not self.generated:
+                self.streamer.put(torch.tensor([self.input_ids]))
+            self.streamer.put(torch.tensor([token_id]))
+        self.generated.append(token_id)
+
+    def sample(self, logits: torch.Tensor) -> int:
+        """对该序列的下一位置 logits 采样（先经过 build_logits_processors 组装的处理器）"""
+        scores = logits.unsqueeze(0).to(dtype=torch.float32, copy=True)
+        if self.processors:
+            seen_ids = torch.tensor([self.input_ids + self.generated], dtype=torch.long, device=scores.device)
+            scores = self.processors(seen_ids, scores)
+        return sample_next_token(scores[0], self.do_sample)
+
+    def end_stream(self):
+        if self.streamer is not None:
+            self.streamer.end()
+            self.streamer = None
+
+
+class ContinuousBatchScheduler:
+    """
+    连续批处理调度器
+
+    用法：
+        scheduler = ContinuousBatchScheduler(model, tokenizer, max_batch_size=8, max_wait_ms=10)
+        new_token_ids = scheduler.generate(input_ids, max_new_tokens=400, temperature=0.65, top_p=0.95)
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10.0,
+        max_queue_size: int = 0,
+        prefix_cache=None,
+        session_cache=None,
+    ):
+        """
+        Args:
+            model: 已加载的因果语言模型（可以是 PeftModel），采样参数与 EOS 取自其 generation_config
+            tokenizer: 对应的 tokenizer，用于确定 EOS 和检测停止序列
+            max_batch_size: 同时处于解码批次中的最大序列数
+            max_wait_ms: 批次为空时，收到第一个请求后为凑批最多等待的毫秒数
+            max_queue_size: 等待队列上限（0 表示不限制），队列满时 submit 直接报错
+            prefix_cache: 可选的 kv_cache.PrefixKVCache，新序列 prefill 时复用系统提示词前缀的 KV
+            session_cache: 可选的 kv_cache.SessionKVCache，带 session_id 的序列复用/写回会话 KV
+        """
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size 必须 >= 1")
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.prefix_cache = prefix_cache
+        self.session_cache = session_cache
+        self.generation_config = getattr(model, "generation_config", None)
+        self.eos_token_ids = set(resolve_eos_token_ids(model, tokenizer))
+        self._queue: "queue.Queue[_Sequence]" = queue.Queue(maxsize=max_queue_size)
+        self._running = True
+        # 后台线程每个 token 边界的前向计算都持有 _model_lock；_pausers > 0 时不再重新获取，让 paused() 先拿到
+        self._model_lock = threading.Lock()
+        self._pause_cond = threading.Condition()
+        self._pausers = 0
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'submitted': 0,
+            'completed': 0,
+            'stopped': 0,
+            'failed': 0,
+            'decode_steps': 0,
+            'decode_rows': 0,
+            'max_batch_size_seen': 0,
+            'active': 0,
+            'queue_wait_total_sec': 0.0,
+        }
+        self._thread = threading.Thread(target=self._loop, name="continuous-batch-scheduler", daemon=True)
+        self._thread.start()
+
+    # ==================== 对外接口 ====================
+
+    def submit(
+        self,
+        input_ids: List[int],
+        max_new_tokens: int,
+        temperature: float,
+        top_p: float,
+        prefix_len: int = 0,
+        session_id: Optional[str] = None,
+        streamer=None,
+        stop_sequences: Optional[List[str]] = None,
+        adapter_name: Optional[str] = None,
+        logits_processor=None,
+        gen_info: Optional[Dict[str, Any]] = None,
+        update_session: bool = True,
+    ) -> Future:
+        """
+        提交一条已 tokenize 的请求，返回 Future，结果为新生成的 token id 列表（含 EOS，如有）。
+        prefix_len > 0 时，input_ids 的前 prefix_len 个 token 会通过 prefix_cache 复用 KV；
+        session_id 非空时优先复用该会话上一轮的 KV，结束后写回（update_session=False 时只读取不写回，
+        用于同一提示词的多个候选，避免最后结束的候选覆盖会话 KV）；
+        streamer（transformers 的 BaseStreamer，如 TextIteratorStreamer）非空时每个新 token 都会实时推送；
+        stop_sequences 非空时，新生成内容末尾出现任一停止序列即结束该序列；
+        adapter_name 非空时该序列使用指定的 LoRA 适配器（须已加载到 PeftModel），为空时使用激活适配器；
+        temperature <= 0 时贪心解码；采样前依次经过 generation_config 的 repetition_penalty 等处理器、
+        logits_processor（以 (提示词+已生成 token[1, n], logits[1, V]) 调用）和 temperature/top_k/top_p；
+        gen_info（dict）非空时，序列结束时写入 queue_sec（排队）、prefill_sec（prefill 并采样第一个 token）、
+        cached_tokens（复用 KV 的提示词 token 数）和 stop_reason（eos / stop_sequence / length）。
+        """
+        if not self._running:
+            raise RuntimeError("调度器已关闭")
+        if not input_ids:
+            raise ValueError("input_ids 不能为空")
+        future: Future = Future()
+        seq = _Sequence(
+            list(input_ids), max(1, int(max_new_tokens)), temperature is not None and temperature > 0,
+            build_logits_processors(self.generation_config, temperature, top_p, logits_processor), future,
+            prefix_len, session_id, streamer, stop_sequences, adapter_name, gen_info, update_session,
+        )
+        try:
+            self._queue.put_nowait(seq)
+        except queue.Full:
+            raise RuntimeError(f"调度队列已满（上限 {self._queue.maxsize}）")
+        with self._stats_lock:
+            self._stats['submitted'] += 1
+        return future
+
+    def generate(
+        self,
+        input_ids: List[int],
+        max_new_tokens: int,
+        temperature: float,
+        top_p: float,
+        timeout: Optional[float] = None,
+        prefix_len: int = 0,
+        session_id: Optional[str] = None,
+        streamer=None,
+        stop_sequences: Optional[List[str]] = None,
+        adapter_name: Optional[str] = None,
+        logits_processor=None,
+        gen_info: Optional[Dict[str, Any]] = None,
+        update_session: bool = True,
+    ) -> List[int]:
+        """阻塞版本的 submit：等待生成完成并返回新 token id 列表"""
+        return self.submit(
+            input_ids, max_new_tokens, temperature, top_p, prefix_len, session_id, streamer, stop_sequences,
+            adapter_name, logits_processor, gen_info, update_session,
+        ).result(timeout=timeout)
+
+    @contextmanager
+    def paused(self):
+        """
+        暂停解码：等待当前 token 边界的前向计算结束，期间后台线程不再访问模型（可以安全地加载/卸载适配器）
+
+        批次中的序列与 KV 缓存原样保留，退出后从下一个 token 继续；新请求仍可提交，恢复后再加入批次。
+        """
+        with self._pause_cond:
+            self._pausers += 1
+        try:
+            with self._model_lock:
+                yield
+        finally:
+            with self._pause_cond:
+                self._pausers -= 1
+                self._pause_cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        """返回调度统计（平均批大小、队列深度等）"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['queued'] = self._queue.qsize()
+        stats['avg_batch_size'] = (stats['decode_rows'] / stats['decode_steps']) if stats['decode_steps'] else 0.0
+        stats['max_batch_size'] = self.max_batch_size
+        stats['max_wait_ms'] = self.max_wait_ms
+        return stats
+
+    def shutdown(self, timeout: Optional[float] = 5.0):
+        """停止后台线程，未完成的请求以异常结束"""
+        self._running = False
+        self._thread.join(timeout=timeout)
+        while True:
+            try:
+                seq = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            seq.end_stream()
+            if not seq.future.done():
+                seq.future.set_exception(RuntimeError("调度器已关闭"))
+
+    # ==================== 后台调度循环 ====================
+
+    def _model_device(self) -> torch.device:
+        return next(self.model.parameters()).device
+
+    def _adapter_kwargs(self, seqs: List[_Sequence]) -> Dict[str, Any]:
+        """批次中有序列指定了适配器时，按行传入 adapter_names；未指定的行使用模型的激活适配器"""
+        if not any(seq.adapter_name for seq in seqs):
+            return {}
+        default = getattr(self.model, "active_adapter", None) or "default"
+        return {"adapter_names": [seq.adapter_name or default for seq in seqs]}
+
+    def _collect(self, active_count: int) -> List[_Sequence]:
+        """从队列中取出可加入批次的新请求"""
+        free = self.max_batch_size - active_count
+        if free <= 0:
+            return []
+        new: List[_Sequence] = []
+        if active_count == 0:
+            # 批次为空：阻塞等待第一个请求，然后在 max_wait_ms 内尽量凑批
+            try:
+                new.append(self._queue.get(timeout=0.1))
+            except queue.Empty:
+                return []
+            deadline = time.time() + self.max_wait_ms / 1000.0
+            while len(new) < free:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    new.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+        # 批次正在运行（或凑批窗口已结束）：非阻塞地把已到达的请求并入下一个 token 边界
+        while len(new) < free:
+            try:
+                new.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return new
+
+    def _loop(self):
+        active: List[_Sequence] = []
+        cache = None  # 批次 KV 缓存，形状 [B, H, T, D]，左填充对齐
+        mask: Optional[torch.Tensor] = None  # [B, T]，填充位置为 0
+
+        while self._running:
+            new = self._collect(len(active))
+            with self._pause_cond:
+                while self._pausers and self._running:
+                    self._pause_cond.wait(0.1)
+            with self._model_lock:
+                active, cache, mask = self._step(new, active, cache, mask)
+
+        self._fail(active, RuntimeError("调度器已关闭"))
+
+    def _step(self, new: List[_Sequence], active: List[_Sequence], cache, mask: Optional[torch.Tensor]):
+        """一个 token 边界：新序列加入批次，批次前进一个 token，移除已结束的序列"""
+        for seq in new:
+            try:
+                cache, mask = self._admit(seq, cache, mask, len(active))
+                active.append(seq)
+            except Exception as e:
+                self._fail([seq], e)
+
+        active, cache, mask = self._retire(active, cache, mask)
+        with self._stats_lock:
+            self._stats['active'] = len(active)
+        if not active:
+            return active, cache, mask
+
+        try:
+            cache, mask = self._decode_step(active, cache, mask)
+        except Exception as e:
+            self._fail(active, e)
+            return [], None, None
+
+        return self._retire(active, cache, mask)
+
+    @torch.inference_mode()
+    def _admit(self, seq: _Sequence, cache, mask: Optional[torch.Tensor], batch_size: int):
+        """单独 prefill 新序列并采样第一个 token，然后把它的 KV 拼接进当前批次"""
+        device = self._model_device()
+        seq.start_time = time.time()
+        with self._stats_lock:
+            self._stats['queue_wait_total_sec'] += seq.start_time - seq.enqueue_time
+
+        input_ids = torch.tensor([seq.input_ids], dtype=torch.long, device=device)
+        # 优先复用会话 KV，其次复用系统提示词前缀 KV，只 prefill 剩余部分
+        reuse_len, past_layers = 0, None
+        if self.session_cache is not None and seq.session_id:
+            reuse_len, past_layers = self.session_cache.lookup(seq.session_id, seq.input_ids)
+        if past_layers is None and self.prefix_cache is not None and 0 < seq.prefix_len < len(seq.input_ids):
+            past_layers = self.prefix_cache.get_or_prefill(
+                self.model, seq.input_ids[:seq.prefix_len], device, adapter_name=seq.adapter_name
+            )
+            reuse_len = seq.prefix_len
+        adapter_kwargs = self._adapter_kwargs([seq])
+        if past_layers is not None:
+            out = self.model(
+                input_ids=input_ids[:, reuse_len:],
+                past_key_values=_layers_to_cache(past_layers),
+                use_cache=True,
+                **adapter_kwargs,
+            )
+        else:
+            out = self.model(input_ids=input_ids, use_cache=True, **adapter_kwargs)
+        seq.length = input_ids.shape[-1]
+        seq.cached_tokens = reuse_len if past_layers is not None else 0
+        seq.append(seq.sample(out.logits[0, -1, :]))
+        seq.first_token_time = time.time()
+        seq_layers = _cache_to_layers(out.past_key_values)
+        seq_mask = torch.ones((1, seq.length), dtype=torch.long, device=device)
+
+        if cache is None or batch_size == 0:
+            return _layers_to_cache(seq_layers), seq_mask
+
+        batch_layers = _cache_to_layers(cache)
+        width = max(mask.shape[1], seq.length)
+        batch_layers = _pad_layers_left(batch_layers, width - mask.shape[1])
+        seq_layers = _pad_layers_left(seq_layers, width - seq.length)
+        merged = [
+            (torch.cat([bk, sk], dim=0), torch.cat([bv, sv], dim=0))
+            for (bk, bv), (sk, sv) in zip(batch_layers, seq_layers)
+        ]
+        mask = torch.cat([
+            torch.nn.functional.pad(mask, (width - mask.shape[1], 0)),
+            torch.nn.functional.pad(seq_mask, (width - seq.length, 0)),
+        ], dim=0)
+        return _layers_to_cache(merged), mask
+
+    @torch.inference_mode()
+    def _decode_step(self, active: List[_Sequence], cache, mask: torch.Tensor):
+        """对批次内所有序列前进一个 token"""
+        device = mask.device
+        input_ids = torch.tensor([[seq.generated[-1]] for seq in active], dtype=torch.long, device=device)
+        position_ids = torch.tensor([[seq.length] for seq in active], dtype=torch.long, device=device)
+        mask = torch.cat([mask, torch.ones((len(active), 1), dtype=mask.dtype, device=device)], dim=1)
+
+        out = self.model(
+            input_ids=input_ids,
+            attention_mask=mask,
+            position_ids=position_ids,
+            past_key_values=cache,
+            use_cache=True,
+            **self._adapter_kwargs(active),
+        )
+        logits = out.logits[:, -1, :]
+        for i, seq in enumerate(active):
+            seq.length += 1
+            seq.append(seq.sample(logits[i]))
+
+        with self._stats_lock:
+            self._stats['decode_steps'] += 1
+            self._stats['decode_rows'] += len(active)
+            self._stats['max_batch_size_seen'] = max(self._stats['max_batch_size_seen'], len(active))
+        return out.past_key_values, mask
+
+    def _hit_stop_sequence(self, seq: _Sequence) -> bool:
+        if not seq.stop_sequences or not seq.generated:
+            return False
+        tail = self.tokenizer.decode(seq.generated[-seq.stop_window:], skip_special_tokens=True)
+        return find_stop_sequence(tail, seq.stop_sequences) != -1
+
+    def _retire(self, active: List[_Sequence], cache, mask: Optional[torch.Tensor]):
+        """移除已结束的序列（遇到 EOS、停止序列或达到 max_new_tokens），并压缩 KV 缓存"""
+        keep: List[int] = []
+        batch_layers = None
+        for i, seq in enumerate(active):
+            stopped = self._hit_stop_sequence(seq)
+            finished = (
+                stopped
+                or (seq.generated and seq.generated[-1] in self.eos_token_ids)
+                or len(seq.generated) >= seq.max_new_tokens
+            )
+            if finished:
+                if seq.gen_info is not None:
+                    seq.gen_info.update({
+                        'queue_sec': round(seq.start_time - seq.enqueue_time, 4),
+                        'prefill_sec': round(seq.first_token_time - seq.start_time, 4),
+                        'cached_tokens': seq.cached_tokens,
+                        'stop_reason': (
+                            STOP_REASON_EOS if seq.generated[-1] in self.eos_token_ids
+                            else STOP_REASON_STOP_SEQUENCE if stopped
+                            else STOP_REASON_LENGTH
+                        ),
+                    })
+                if stopped:
+                    with self._stats_lock:
+                        self._stats['stopped'] += 1
+                if self.session_cache is not None and seq.session_id and seq.update_session:
+                    # 批次内各行右对齐，该序列的真实 KV 位于最后 seq.length 列
+                    if batch_layers is None:
+                        batch_layers = _cache_to_layers(cache)
+                    row_layers = [
+                        (k[i:i + 1, :, -seq.length:, :].clone(), v[i:i + 1, :, -seq.length:, :].clone())
+                        for k, v in batch_layers
+                    ]
+                    self.session_cache.put(seq.session_id, seq.input_ids + seq.generated[:-1], row_layers)
+                seq.end_stream()
+                if not seq.future.done():
+                    seq.future.set_result(list(seq.generated))
+                with self._stats_lock:
+                    self._stats['completed'] += 1
+            else:
+                keep.append(i)
+
+        if len(keep) == len(active):
+            return active, cache, mask
+        if not keep:
+            return [], None, None
+
+        index = torch.tensor(keep, dtype=torch.long, device=mask.device)
+        mask = mask.index_select(0, index)
+        # 去掉剩余序列全部为填充的前导列
+        offset = int((mask.sum(dim=0) == 0).long().cumprod(dim=0).sum().item())
+        mask = mask[:, offset:]
+        layers = [
+            (k.index_select(0, index.to(k.device))[:, :, offset:, :],
+             v.index_select(0, index.to(v.device))[:, :, offset:, :])
+            for k, v in _cache_to_layers(cache)
+        ]
+        return [active[i] for i in keep], _layers_to_cache(layers), mask
+
+    def _fail(self, seqs: List[_Sequence], error: Exception):
+        for seq in seqs:
+            seq.end_stream()
+            if not seq.future.done():
+                seq.future.set_exception(error)
+            with self._stats_lock:
+                self._stats['failed'] += 1
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+按内容寻址的文本存储（案件背景等大段提示词组件）
+
+- 内容以 UTF-8 编码的 SHA-256 十六进制摘要为键，客户端可以在本地计算摘要，上传一次后每轮只发送摘要。
+- 每条内容附带派生结果缓存（derived）：如按策略改写后的背景、渲染好的系统提示词，
+  同一内容的派生结果只计算一次，随内容一起淘汰。
+- 按总字节数（内容 + 派生结果中的字符串）做 LRU 淘汰，可选 TTL。
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+def content_hash(text: str) -> str:
+    """内容摘要（SHA-256 十六进制）"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _artifact_nbytes(value: Any) -> int:
+    """派生结果的近似大小（只统计字符串，其余按固定开销计）"""
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, (list, tuple)):
+        return sum(_artifact_nbytes(v) for v in value) + 8 * len(value)
+    return 64
+
+
+class _Entry:
+    def __init__(self, text: str):
+        self.text = text
+        self.nbytes = len(text.encode('utf-8'))
+        self.derived: Dict[Hashable, Any] = {}
+        self.last_used = time.time()
+
+
+class ContentStore:
+    """内容寻址存储（线程安全，LRU + TTL 淘汰）"""
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, ttl_sec: float = 0.0):
+        """
+        Args:
+            max_bytes: 内容与派生结果的总字节数上限
+            ttl_sec: 闲置多少秒后过期，0 表示只按容量淘汰
+        """
+        self.max_bytes = max_bytes
+        self.ttl_sec = ttl_sec
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._derived_hits = 0
+        self._derived_misses = 0
+        self._evictions = 0
+
+    def _evict_locked(self):
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.nbytes
+            self._evictions += 1
+
+    def _lookup_locked(self, digest: str) -> Optional[_Entry]:
+        entry = self._entries.get(digest)
+        if entry is None:
+            return None
+        now = time.time()
+        if self.ttl_sec > 0 and now - entry.last_used > self.ttl_sec:
+            del self._entries[digest]
+            self._bytes -= entry.nbytes
+            self._evictions += 1
+            return None
+        entry.last_used = now
+        self._entries.move_to_end(digest)
+        return entry
+
+    def put(self, text: str) -> str:
+        """保存内容，返回摘要（已存在时只刷新使用时间）"""
+        digest = content_hash(text)
+        with self._lock:
+            if self._lookup_locked(digest) is None:
+                entry = _Entry(text)
+                self._entries[digest] = entry
+                self._bytes += entry.nbytes
+                self._evict_locked()
+        return digest
+
+    def get(self, digest: str) -> Optional[str]:
+        """按摘要取出内容，不存在（或已淘汰）时返回 None"""
+        with self._lock:
+            entry = self._lookup_locked(digest)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            return entry.text
+
+    def __contains__(self, digest: str) -> bool:
+        with self._lock:
+            return self._lookup_locked(digest) is not None
+
+    def derived(self, digest: Optional[str], key: Hashable, build: Callable[[], Any]) -> Any:
+        """
+        取出内容 digest 的派生结果 key，不存在时调用 build() 计算并缓存
+
+        digest 为空或内容已被淘汰时直接返回 build() 的结果（不缓存）。
+        """
+        if digest:
+            with self._lock:
+                entry = self._lookup_locked(digest)
+                if entry is not None and key in entry.derived:
+                    self._derived_hits += 1
+                    return entry.derived[key]
+        value = build()
+        if digest:
+            with self._lock:
+                entry = self._lookup_locked(digest)
+                self._derived_misses += 1
+                if entry is not None and key not in entry.derived:
+                    entry.derived[key] = value
+                    size = _artifact_nbytes(value)
+                    entry.nbytes += size
+                    self._bytes += size
+                    self._evict_locked()
+        return value
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'ttl_sec': self.ttl_sec,
+                'hits': self._hits,
+                'misses': self._misses,
+                'derived_hits': self._derived_hits,
+                'derived_misses': self._derived_misses,
+                'evictions': self._evictions,
+            }
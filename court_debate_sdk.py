@@ -7,7 +7,10 @@
 
 import os
 import json
-from typing import List, Dict, Any, Optional
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from typing import List, Dict, Any, Optional, Iterator, Tuple
 import torch
 from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
 from peft import PeftModel
@@ -18,9 +21,48 @@ from infer import (
     load_case_file,
     generate_one,
     generate_with_retries,
+    generate_candidates,
+    stream_generate,
+    resolve_stop_sequences,
+    resolve_banned_phrases,
+    compile_banned_phrases,
+    resolve_repetition_config,
+    pack_messages,
+    DEBATE_ROLE_NAMES,
+    SpeculativeStats,
+    load_merged_manifest,
     _build_messages,
     add_no_thought_constraint,
 )
+from batch_scheduler import ContinuousBatchScheduler
+from kv_cache import PrefixKVCache, SessionKVCache
+
+
+DEFAULT_ADAPTER = "default"
+
+CPU_QUANTIZATION_MODES = ("int8", "none")
+CPU_DTYPES = ("auto", "bf16", "fp32")
+
+
+def _cpu_supports_bf16() -> bool:
+    """CPU 是否有原生 bf16 指令（AVX512-BF16 或 AMX），没有时 bf16 矩阵乘反而比 fp32 慢"""
+    for check_name in ("_is_avx512_bf16_supported", "_is_amx_tile_supported"):
+        check = getattr(torch.cpu, check_name, None)
+        if callable(check) and check():
+            return True
+    return False
+
+
+def _assistant_speeches(messages: List[Dict[str, str]]) -> List[str]:
+    """对话历史中 assistant（即当前角色自己）的发言，作为重复 n-gram 屏蔽的参考"""
+    return [m.get("content", "") for m in messages if m.get("role") == "assistant"]
+
+
+def _available_cpu_count() -> int:
+    """当前进程可用的 CPU 数（考虑 taskset/cgroup 绑核）"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
 
 
 class CourtDebateModel:
@@ -32,6 +74,29 @@ class CourtDebateModel:
         base_model: Optional[str] = None,
         load_in_4bit: bool = True,
         gpu_id: int = 0,
+        enable_batching: bool = False,
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10.0,
+        prefix_cache_mb: int = 0,
+        session_cache_mb: int = 0,
+        session_ttl_sec: float = 1800.0,
+        max_sessions: int = 64,
+        stop_sequences: Optional[Dict[str, List[str]]] = None,
+        draft_model: Optional[str] = None,
+        num_assistant_tokens: int = 5,
+        prompt_lookup_num_tokens: int = 0,
+        prompt_lookup_max_ngram: int = 3,
+        merged_model_dir: Optional[str] = None,
+        adapters: Optional[Dict[str, str]] = None,
+        max_resident_adapters: int = 0,
+        cpu_quantization: Optional[str] = None,
+        cpu_dtype: str = "auto",
+        cpu_threads: int = 0,
+        best_of_n: Optional[Dict[str, int]] = None,
+        banned_phrases: Optional[Dict[str, List[str]]] = None,
+        repetition_blocking: Optional[Dict[str, Optional[Dict[str, Any]]]] = None,
+        context_token_budget: int = 0,
+        context_max_turns: int = 0,
     ):
         """
         初始化模型
@@ -41,14 +106,134 @@ class CourtDebateModel:
             base_model: 基础模型路径（可选，默认从adapter_config.json读取）
             load_in_4bit: 是否使用4bit量化
             gpu_id: GPU设备ID
+            enable_batching: 是否启用连续批处理调度器（并发的 chat/generate 合并到同一解码批次）
+            max_batch_size: 连续批处理的最大批大小
+            max_wait_ms: 批次空闲时为凑批等待的最长时间（毫秒）
+            prefix_cache_mb: 系统提示词前缀 KV 缓存的内存预算（MB），0 表示不启用
+            session_cache_mb: 会话级增量 KV 缓存的内存预算（MB），0 表示不启用；
+                启用后 chat/generate 传入 session_id 即可跨轮复用 KV
+            session_ttl_sec: 会话 KV 空闲多久后失效（秒）
+            max_sessions: 最多同时缓存的会话数
+            stop_sequences: 按角色配置的停止序列 {角色: [停止序列, ...]}，"*" 表示其他角色；
+                "*" 只作用于辩论角色；未配置时使用 infer.default_stop_sequences（</final>，
+                辩论角色再加上其他角色的发言前缀）
+            draft_model: 投机解码的草稿模型路径（可选，须与基础模型共用 tokenizer，如 Qwen2.5-0.5B）；
+                启用后由草稿模型提出候选 token、适配器模型一次前向验证，输出分布不变
+            num_assistant_tokens: 草稿模型每轮提出的候选 token 数（初始值，transformers 会按接受情况动态调整）
+            prompt_lookup_num_tokens: prompt lookup 解码每轮从提示词中复制的候选 token 数，0 表示不启用；
+                不需要草稿模型，适合显存不足以放下第二个模型的机器（配置了 draft_model 时以草稿模型为准）
+            prompt_lookup_max_ngram: prompt lookup 匹配时使用的最长 n-gram
+            merged_model_dir: `python infer.py export-merged` 导出的合并模型目录（可选）；
+                设置后直接以内存映射方式加载合并后的 safetensors，不再加载基础模型+PEFT 适配器
+            adapters: 额外的命名 LoRA 适配器 {名称: 目录}（可选），须基于同一基础模型训练；
+                所有适配器共用一份常驻的基础模型，调用时用 adapter 参数按请求选择，
+                adapter_dir 对应的适配器名为 "default"；额外适配器在首次使用时才加载
+            max_resident_adapters: 同时驻留显存的适配器数上限（含 default），0 表示不限制；
+                超出时按 LRU 卸载当前没有请求在使用的适配器，再次使用时重新加载；
+                启用 enable_batching 时不同适配器的请求可以在同一解码批次中执行，否则注册了
+                多个适配器后请求会逐个执行
+            cpu_quantization: CUDA 不可用时的量化方式："int8"（合并适配器后对全部 Linear 层做动态 int8 量化，
+                权重内存约为 fp32 的 1/4）或 "none"；默认 None 表示跟随 load_in_4bit（开启时使用 int8）
+            cpu_dtype: CUDA 不可用且不做 int8 量化时的权重精度："auto"（CPU 支持 AVX512-BF16/AMX 时用 bf16，
+                否则 fp32）、"bf16" 或 "fp32"
+            cpu_threads: CPU 推理的线程数，0 表示使用当前进程可用的全部 CPU
+            best_of_n: 按角色配置 best-of-N 的候选数 {角色: N}，"*" 表示其他角色，未配置时为 1；
+                见 chat_candidates
+            banned_phrases: 按角色配置的禁用短语 {角色: [短语, ...]}，"*" 表示其他角色；
+                未配置时使用 infer.default_banned_phrases（审判员的角色混淆用语、公诉人/辩护人的审判员口吻等），
+                解码时直接屏蔽会拼出这些短语的 token，空列表表示不做约束
+            repetition_blocking: 按角色配置的重复 n-gram 屏蔽参数 {角色: {"ngram_size": 8, "penalty": None,
+                "max_references": 3}}，"*" 表示其他角色，每项只需写出要覆盖的字段（默认值见
+                infer.DEFAULT_REPETITION_CONFIG）；解码时屏蔽（penalty 为 None）或按 penalty 惩罚会复现
+                同一角色最近几次发言中长 n-gram 的 token；默认不启用，未配置的角色、值为 None 或
+                ngram_size 为 0 表示不启用
+            context_token_budget: pack_messages 的默认提示词 token 预算（含系统提示词），0 表示不限制
+            context_max_turns: pack_messages 默认最多保留的历史消息条数，0 表示不限制
         """
         self.adapter_dir = adapter_dir
         self.base_model = base_model
         self.load_in_4bit = load_in_4bit
         self.gpu_id = gpu_id
+        self.merged_model_dir = merged_model_dir
+        self.role_stop_sequences = stop_sequences
+        self.role_best_of_n = best_of_n or {}
+        self.role_banned_phrases = banned_phrases
+        self.role_repetition_blocking = repetition_blocking
+        self.context_token_budget = context_token_budget
+        self.context_max_turns = context_max_turns
+        self.draft_model_name = draft_model
+        self.num_assistant_tokens = num_assistant_tokens
+        self.prompt_lookup_num_tokens = prompt_lookup_num_tokens
+        self.prompt_lookup_max_ngram = prompt_lookup_max_ngram
         self.model = None
+        self.draft_model = None
+        self.spec_stats = None
         self.tokenizer = None
+        self.scheduler = None
+        self.prefix_cache = None
+        self.session_cache = None
+        self.max_resident_adapters = max_resident_adapters
+        self._adapter_paths: Dict[str, str] = {DEFAULT_ADAPTER: merged_model_dir or adapter_dir}
+        self._resident_adapters: "OrderedDict[str, None]" = OrderedDict()
+        self._adapter_refs: Dict[str, int] = {}
+        self._adapter_lock = threading.Lock()
+        # PEFT 通过模型级的前向钩子注入 adapter_names，不走调度器时不同适配器的请求不能并发执行
+        self._generate_lock = threading.Lock()
+        self._adapter_stats = {'loads': 0, 'evictions': 0}
+        if adapters and merged_model_dir:
+            raise ValueError("合并模型（merged_model_dir）不支持加载额外的 LoRA 适配器")
+        
+        if cpu_quantization is not None and cpu_quantization not in CPU_QUANTIZATION_MODES:
+            raise ValueError(f"cpu_quantization 必须是 {CPU_QUANTIZATION_MODES} 之一，当前为 {cpu_quantization}")
+        if cpu_dtype not in CPU_DTYPES:
+            raise ValueError(f"cpu_dtype 必须是 {CPU_DTYPES} 之一，当前为 {cpu_dtype}")
+        self.cpu_dtype = cpu_dtype
+        self.cpu_threads = cpu_threads
+        # int8 量化前要把适配器合并进基础模型，因此与多适配器互斥
+        self.cpu_quantization = cpu_quantization or ("int8" if load_in_4bit else "none")
+        if self.cpu_quantization == "int8" and adapters and not torch.cuda.is_available():
+            if cpu_quantization == "int8":
+                raise ValueError("CPU int8 量化会合并适配器，不能同时加载额外的 LoRA 适配器")
+            print("[SDK] 警告: 配置了额外的适配器，CPU 上不做 int8 量化")
+            self.cpu_quantization = "none"
         self._load_model()
+        self._resident_adapters[DEFAULT_ADAPTER] = None
+        # 预先编译各角色的禁用短语（首次编译需要逐个解码词表），避免第一个请求变慢
+        for role in DEBATE_ROLE_NAMES + [""]:
+            compile_banned_phrases(self.tokenizer, self.get_banned_phrases(role))
+        for name, path in (adapters or {}).items():
+            self.register_adapter(name, path)
+        
+        if draft_model:
+            self._load_draft_model()
+        elif prompt_lookup_num_tokens > 0:
+            self.spec_stats = SpeculativeStats()
+            print(f"[SDK] 已启用 prompt lookup 解码: num_tokens={prompt_lookup_num_tokens}, max_ngram={prompt_lookup_max_ngram}")
+        
+        if prefix_cache_mb > 0:
+            self.prefix_cache = PrefixKVCache(max_bytes=prefix_cache_mb * 1024 * 1024)
+            print(f"[SDK] 已启用系统提示词前缀KV缓存: {prefix_cache_mb}MB")
+        
+        if session_cache_mb > 0:
+            self.session_cache = SessionKVCache(
+                max_bytes=session_cache_mb * 1024 * 1024,
+                max_sessions=max_sessions,
+                ttl_sec=session_ttl_sec,
+            )
+            print(f"[SDK] 已启用会话级KV缓存: {session_cache_mb}MB, max_sessions={max_sessions}, ttl={session_ttl_sec}s")
+        
+        if enable_batching:
+            self.scheduler = ContinuousBatchScheduler(
+                self.model,
+                self.tokenizer,
+                max_batch_size=max_batch_size,
+                max_wait_ms=max_wait_ms,
+                prefix_cache=self.prefix_cache,
+                session_cache=self.session_cache,
+            )
+            print(f"[SDK] 已启用连续批处理: max_batch_size={max_batch_size}, max_wait_ms={max_wait_ms}")
+            if self.draft_model is not None:
+                print("[SDK] 警告: 连续批处理调度器不支持投机解码，启用批处理后草稿模型不会被使用")
     
     def _load_model(self):
         """加载模型和tokenizer"""
@@ -56,16 +241,21 @@ class CourtDebateModel:
         
         # 检查CUDA
         if not torch.cuda.is_available():
-            print("[SDK] 警告: CUDA不可用，将使用CPU（速度很慢）")
+            print("[SDK] 警告: CUDA不可用，将使用CPU推理")
             self.gpu_id = None
             device_map = "cpu"
-            torch_dtype = torch.float32
+            torch_dtype = self._configure_cpu()
         else:
             print(f"[SDK] 使用GPU: {self.gpu_id} ({torch.cuda.get_device_name(self.gpu_id)})")
             torch.cuda.set_device(self.gpu_id)
             device_map = {"": self.gpu_id}
             torch_dtype = torch.float16
         
+        if self.merged_model_dir:
+            self._load_merged_model(device_map, torch_dtype)
+            self._quantize_for_cpu()
+            return
+        
         # 加载基础模型名称
         base_model_name = self.base_model or _load_base_model_name(self.adapter_dir, None)
         print(f"[SDK] 基础模型: {base_model_name}")
@@ -74,17 +264,7 @@ class CourtDebateModel:
         self.tokenizer = AutoTokenizer.from_pretrained(self.adapter_dir, use_fast=True)
         
         # 量化配置
-        quant_config = None
-        if self.load_in_4bit:
-            if not torch.cuda.is_available():
-                print("[SDK] 警告: 4bit量化需要GPU支持")
-            else:
-                quant_config = BitsAndBytesConfig(
-                    load_in_4bit=True,
-                    bnb_4bit_use_double_quant=True,
-                    bnb_4bit_quant_type="nf4",
-                    bnb_4bit_compute_dtype=torch.float16,
-                )
+        quant_config = self._build_quant_config()
         
         # 加载基础模型
         print(f"[SDK] 加载基础模型...")
@@ -105,6 +285,7 @@ class CourtDebateModel:
             device_map=device_map if self.gpu_id is not None else None
         )
         self.model.eval()
+        self._quantize_for_cpu()
         
         # 验证模型设备
         if torch.cuda.is_available() and self.gpu_id is not None:
@@ -117,6 +298,275 @@ class CourtDebateModel:
         
         print(f"[SDK] 模型加载完成！")
     
+    def _configure_cpu(self) -> torch.dtype:
+        """CPU 推理：设置线程数，并返回加载权重使用的精度"""
+        threads = self.cpu_threads or _available_cpu_count()
+        torch.set_num_threads(threads)
+        
+        if self.cpu_quantization == "int8":
+            # 动态 int8 量化作用于 fp32 的 Linear 层，激活值在运行时按行量化
+            torch_dtype = torch.float32
+        elif self.cpu_dtype == "bf16" or (self.cpu_dtype == "auto" and _cpu_supports_bf16()):
+            torch_dtype = torch.bfloat16
+        else:
+            torch_dtype = torch.float32
+        print(f"[SDK] CPU推理配置: 线程数={threads}, 量化={self.cpu_quantization}, 精度={torch_dtype}")
+        return torch_dtype
+    
+    def _quantize_for_cpu(self):
+        """
+        CPU int8 模式：合并 LoRA 适配器后对全部 Linear 层做动态 int8 量化。
+        
+        激活值的量化 scale 按整个输入张量计算，复用 KV 或合批时的输出可能与逐条完整 prefill 有细微差异。
+        """
+        if torch.cuda.is_available() or self.cpu_quantization != "int8":
+            return
+        if isinstance(self.model, PeftModel):
+            print(f"[SDK] 合并PEFT适配器到基础模型...")
+            self.model = self.model.merge_and_unload()
+        print(f"[SDK] 对 Linear 层做动态 int8 量化...")
+        self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model.eval()
+    
+    def _build_quant_config(self):
+        """4bit 量化配置（CUDA 不可用时返回 None）"""
+        if not self.load_in_4bit:
+            return None
+        if not torch.cuda.is_available():
+            # CPU 上由 _quantize_for_cpu 做 int8 量化（见 cpu_quantization）
+            return None
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.float16,
+        )
+    
+    def _load_merged_model(self, device_map, torch_dtype):
+        """加载 export-merged 导出的合并模型（safetensors 以内存映射方式读取，无需 PEFT）"""
+        manifest = load_merged_manifest(self.merged_model_dir)
+        if manifest is None:
+            print(f"[SDK] 警告: {self.merged_model_dir} 中没有 merged_manifest.json，可能不是 export-merged 的导出结果")
+        else:
+            print(f"[SDK] 合并模型: 基础模型 {manifest.get('base_model')}，精度 {manifest.get('dtype')}，导出于 {manifest.get('created_at')}")
+        
+        self.tokenizer = AutoTokenizer.from_pretrained(self.merged_model_dir, use_fast=True)
+        
+        print(f"[SDK] 加载合并模型: {self.merged_model_dir}")
+        self.model = AutoModelForCausalLM.from_pretrained(
+            self.merged_model_dir,
+            device_map=device_map,
+            torch_dtype=torch_dtype,
+            quantization_config=self._build_quant_config(),
+            low_cpu_mem_usage=True,
+            use_safetensors=True,
+        )
+        self.model.eval()
+        print(f"[SDK] 模型设备: {next(self.model.parameters()).device}")
+        print(f"[SDK] 模型加载完成！")
+    
+    def _load_draft_model(self):
+        """加载投机解码的草稿模型（与基础模型放在同一设备上，不做量化）"""
+        print(f"[SDK] 加载投机解码草稿模型: {self.draft_model_name}")
+        first_param = next(self.model.parameters())
+        if first_param.device.type == 'cuda':
+            device_map = {"": first_param.device.index}
+            torch_dtype = torch.float16
+        else:
+            device_map = "cpu"
+            torch_dtype = torch.float32
+        
+        self.draft_model = AutoModelForCausalLM.from_pretrained(
+            self.draft_model_name,
+            device_map=device_map,
+            torch_dtype=torch_dtype,
+            low_cpu_mem_usage=True,
+            trust_remote_code=True,
+        )
+        self.draft_model.eval()
+        self.draft_model.generation_config.num_assistant_tokens = self.num_assistant_tokens
+        
+        try:
+            draft_tokenizer = AutoTokenizer.from_pretrained(self.draft_model_name, use_fast=True)
+            if draft_tokenizer.get_vocab() != self.tokenizer.get_vocab():
+                print("[SDK] 警告: 草稿模型的词表与基础模型不一致，投机解码的接受率会很低")
+        except Exception as e:
+            print(f"[SDK] 警告: 无法加载草稿模型的 tokenizer 进行校验: {e}")
+        
+        self.spec_stats = SpeculativeStats()
+        print(f"[SDK] 已启用投机解码: num_assistant_tokens={self.num_assistant_tokens}")
+    
+    # ==================== 多适配器 ====================
+    
+    def register_adapter(self, name: str, path: str):
+        """注册一个命名适配器（不立即加载，首次使用时加载到常驻的基础模型上）"""
+        if not name or name == DEFAULT_ADAPTER:
+            raise ValueError(f"适配器名不能为空或 \"{DEFAULT_ADAPTER}\"")
+        if self.merged_model_dir:
+            raise ValueError("合并模型（merged_model_dir）不支持加载额外的 LoRA 适配器")
+        if not isinstance(self.model, PeftModel):
+            raise ValueError("适配器已合并进基础模型（CPU int8 量化），不支持加载额外的 LoRA 适配器")
+        if not os.path.isfile(os.path.join(path, "adapter_config.json")):
+            raise ValueError(f"适配器目录无效（缺少 adapter_config.json）: {path}")
+        with self._adapter_lock:
+            if name in self._adapter_paths and self._adapter_paths[name] != path and name in self._resident_adapters:
+                raise ValueError(f"适配器 {name} 已加载，不能更换目录")
+            self._adapter_paths[name] = path
+        print(f"[SDK] 已注册适配器: {name} -> {path}")
+    
+    def has_adapter(self, name: Optional[str]) -> bool:
+        """适配器名是否可用（None/空串表示默认适配器）"""
+        return not name or name in self._adapter_paths
+    
+    def list_adapters(self) -> List[Dict[str, Any]]:
+        """列出已注册的适配器及其驻留/使用状态"""
+        with self._adapter_lock:
+            return [
+                {
+                    'name': name,
+                    'path': path,
+                    'resident': name in self._resident_adapters,
+                    'in_use': self._adapter_refs.get(name, 0),
+                }
+                for name, path in self._adapter_paths.items()
+            ]
+    
+    def adapter_stats(self) -> Dict[str, Any]:
+        with self._adapter_lock:
+            return {
+                'registered': len(self._adapter_paths),
+                'resident': list(self._resident_adapters),
+                'max_resident': self.max_resident_adapters,
+                **self._adapter_stats,
+            }
+    
+    def _evict_adapters_locked(self):
+        """驻留数达到上限时按 LRU 卸载空闲的适配器（default 与正在使用的适配器不卸载）"""
+        if self.max_resident_adapters <= 0:
+            return
+        while len(self._resident_adapters) >= self.max_resident_adapters:
+            victim = next(
+                (name for name in self._resident_adapters
+                 if name != DEFAULT_ADAPTER and not self._adapter_refs.get(name)),
+                None,
+            )
+            if victim is None:
+                print(f"[SDK] 警告: 驻留适配器已达上限 {self.max_resident_adapters} 且都在使用中，暂时超出上限")
+                return
+            self.model.delete_adapter(victim)
+            del self._resident_adapters[victim]
+            self._adapter_stats['evictions'] += 1
+            print(f"[SDK] 已卸载适配器: {victim}")
+    
+    @contextmanager
+    def _pause_generation(self):
+        """
+        暂停对模型的前向计算（加载/卸载适配器会修改 PEFT 模块，不能与正在进行的解码同时发生）
+        
+        启用批处理时让调度器停在 token 边界（批次保留，退出后继续解码）；否则等待正在执行的生成结束。
+        """
+        if self.scheduler is not None:
+            with self.scheduler.paused():
+                yield
+        else:
+            with self._generate_lock:
+                yield
+    
+    @contextmanager
+    def _use_adapter(self, name: Optional[str]):
+        """
+        在一次请求期间占用某个适配器：未驻留时先加载，期间不会被卸载。
+        加载与 LRU 卸载都在 _pause_generation() 内进行，不会与其他请求的解码交错。
+        
+        产出传给 generate_one 的 adapter_name；默认适配器产出 None（直接使用激活适配器）。
+        """
+        serial = self._generate_lock if self.scheduler is None and len(self._adapter_paths) > 1 else nullcontext()
+        if not name or name == DEFAULT_ADAPTER:
+            with serial:
+                yield None
+            return
+        if name not in self._adapter_paths:
+            raise ValueError(f"未注册的适配器: {name}")
+        with self._adapter_lock:
+            if name not in self._resident_adapters:
+                with self._pause_generation():
+                    self._evict_adapters_locked()
+                    print(f"[SDK] 加载适配器: {name} ({self._adapter_paths[name]})")
+                    self.model.load_adapter(self._adapter_paths[name], adapter_name=name)
+                    self.model.eval()
+                self._resident_adapters[name] = None
+                self._adapter_stats['loads'] += 1
+            self._resident_adapters.move_to_end(name)
+            self._adapter_refs[name] = self._adapter_refs.get(name, 0) + 1
+        try:
+            with serial:
+                yield name
+        finally:
+            with self._adapter_lock:
+                self._adapter_refs[name] -= 1
+    
+    def get_stop_sequences(self, assistant_role: Optional[str] = None) -> List[str]:
+        """返回某个角色生成时使用的停止序列"""
+        return resolve_stop_sequences(assistant_role or "", self.role_stop_sequences)
+    
+    def get_banned_phrases(self, assistant_role: Optional[str] = None) -> List[str]:
+        """返回某个角色生成时禁用的短语"""
+        return resolve_banned_phrases(assistant_role or "", self.role_banned_phrases)
+    
+    def get_repetition_config(self, assistant_role: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """返回某个角色的重复 n-gram 屏蔽参数，未启用时返回 None"""
+        return resolve_repetition_config(assistant_role or "", self.role_repetition_blocking)
+    
+    def get_num_candidates(self, assistant_role: Optional[str] = None) -> int:
+        """返回某个角色 best-of-N 的候选数（至少为 1）"""
+        n = self.role_best_of_n.get(assistant_role or "", self.role_best_of_n.get("*", 1))
+        return max(1, int(n))
+    
+    def pack_messages(
+        self,
+        history: List[Dict[str, str]],
+        pinned: Optional[List[Dict[str, str]]] = None,
+        system_prompt: Optional[str] = None,
+        assistant_role: Optional[str] = None,
+        token_budget: Optional[int] = None,
+        max_turns: Optional[int] = None,
+        min_turns: int = 0,
+    ) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+        """
+        按 token 预算组装传给 chat / stream_chat / chat_candidates 的 messages（见 infer.pack_messages）
+        
+        系统提示词按 chat 的方式补全（默认提示词、禁止思考约束）后计入预算，pinned 总是保留，
+        历史从最新的一条开始整条保留，直到预算用完（最新的 min_turns 条总是保留）。
+        
+        Args:
+            history: 对话历史（按时间顺序）
+            pinned: 必须保留、放在历史之后的消息（如本轮需要回应的发言）
+            system_prompt: 系统提示词（与之后调用 chat 时传入的相同）
+            assistant_role: 助手角色（与之后调用 chat 时传入的相同）
+            token_budget: 整个提示词的 token 上限（可选，默认使用构造参数 context_token_budget，0 表示不限制）
+            max_turns: 最多保留的历史消息条数（可选，默认使用构造参数 context_max_turns，0 表示不限制）
+            min_turns: 预算不足时也要保留的最新历史消息条数
+        
+        Returns:
+            (messages, usage)：usage 为各部分的 token 数（system_tokens、pinned_tokens、history_tokens、
+            total_tokens 等），为保留 min_turns 条历史而超出预算时 over_budget 为 True
+        """
+        if not system_prompt:
+            system_prompt = "你是一位专业的法律从业者，需要根据角色定位参与法庭辩论。"
+        
+        if assistant_role:
+            system_prompt = add_no_thought_constraint(system_prompt, assistant_role)
+        
+        return pack_messages(
+            self.tokenizer,
+            system_prompt,
+            history,
+            pinned=pinned,
+            token_budget=self.context_token_budget if token_budget is None else token_budget,
+            max_turns=self.context_max_turns if max_turns is None else max_turns,
+            min_turns=min_turns,
+        )
+    
     def generate(
         self,
         prompt: str,
@@ -125,6 +575,11 @@ class CourtDebateModel:
         top_p: float = 0.9,
         system_prompt: Optional[str] = None,
         assistant_role: Optional[str] = None,
+        session_id: Optional[str] = None,
+        stop_sequences: Optional[List[str]] = None,
+        gen_info: Optional[Dict[str, Any]] = None,
+        adapter: Optional[str] = None,
+        previous_speeches: Optional[List[str]] = None,
     ) -> str:
         """
         单次生成
@@ -136,6 +591,12 @@ class CourtDebateModel:
             top_p: 核采样参数
             system_prompt: 系统提示词
             assistant_role: 助手角色
+            session_id: 会话ID（可选，启用会话级KV缓存时用于跨轮复用 KV，建议按"庭审ID:角色"区分）
+            stop_sequences: 本次调用的停止序列（可选，默认按 assistant_role 取构造时的配置，传 [] 表示不使用）
+            gen_info: 可选的 dict，生成完成后写入本次请求的统计：prompt_tokens、generated_tokens、prefill_sec、
+                ttft_sec、decode_tokens_per_sec、stop_reason 等（见 infer.generate_one），投机解码时另有 speculative
+            adapter: 使用的命名适配器（可选，见构造参数 adapters，默认使用 adapter_dir 对应的适配器）
+            previous_speeches: 当前角色此前的发言（可选），解码时避免复现其中的长 n-gram（见构造参数 repetition_blocking）
         
         Returns:
             生成的回复
@@ -148,15 +609,30 @@ class CourtDebateModel:
         
         messages = _build_messages(system_prompt, [], prompt)
         
-        response = generate_with_retries(
-            model=self.model,
-            tokenizer=self.tokenizer,
-            messages=messages,
-            max_new_tokens=max_new_tokens,
-            temperature=temperature,
-            top_p=top_p,
-            assistant_role=assistant_role or "",
-        )
+        with self._use_adapter(adapter) as adapter_name:
+            response = generate_with_retries(
+                model=self.model,
+                tokenizer=self.tokenizer,
+                messages=messages,
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                assistant_role=assistant_role or "",
+                scheduler=self.scheduler,
+                prefix_cache=self.prefix_cache,
+                session_cache=self.session_cache,
+                session_id=session_id,
+                stop_sequences=stop_sequences if stop_sequences is not None else self.get_stop_sequences(assistant_role),
+                banned_phrases=self.get_banned_phrases(assistant_role),
+                repetition_config=self.get_repetition_config(assistant_role),
+                previous_speeches=previous_speeches,
+                assistant_model=self.draft_model,
+                spec_stats=self.spec_stats,
+                prompt_lookup_num_tokens=self.prompt_lookup_num_tokens,
+                prompt_lookup_max_ngram=self.prompt_lookup_max_ngram,
+                gen_info=gen_info,
+                adapter_name=adapter_name,
+            )
         
         return response
     
@@ -168,6 +644,11 @@ class CourtDebateModel:
         top_p: float = 0.9,
         system_prompt: Optional[str] = None,
         assistant_role: Optional[str] = None,
+        session_id: Optional[str] = None,
+        stop_sequences: Optional[List[str]] = None,
+        gen_info: Optional[Dict[str, Any]] = None,
+        adapter: Optional[str] = None,
+        previous_speeches: Optional[List[str]] = None,
     ) -> str:
         """
         对话生成（带历史）
@@ -179,6 +660,13 @@ class CourtDebateModel:
             top_p: 核采样参数
             system_prompt: 系统提示词
             assistant_role: 助手角色
+            session_id: 会话ID（可选，启用会话级KV缓存时用于跨轮复用 KV，建议按"庭审ID:角色"区分）
+            stop_sequences: 本次调用的停止序列（可选，默认按 assistant_role 取构造时的配置，传 [] 表示不使用）
+            gen_info: 可选的 dict，生成完成后写入本次请求的统计：prompt_tokens、generated_tokens、prefill_sec、
+                ttft_sec、decode_tokens_per_sec、stop_reason 等（见 infer.generate_one），投机解码时另有 speculative
+            adapter: 使用的命名适配器（可选，见构造参数 adapters，默认使用 adapter_dir 对应的适配器）
+            previous_speeches: 当前角色此前的发言（可选，默认取 messages 中 assistant 消息的内容），
+                解码时避免复现其中的长 n-gram（见构造参数 repetition_blocking）
         
         Returns:
             生成的回复
@@ -195,18 +683,155 @@ class CourtDebateModel:
             full_messages.append({"role": "system", "content": system_prompt})
         full_messages.extend(messages)
         
-        response = generate_with_retries(
-            model=self.model,
-            tokenizer=self.tokenizer,
-            messages=full_messages,
-            max_new_tokens=max_new_tokens,
-            temperature=temperature,
-            top_p=top_p,
-            assistant_role=assistant_role or "",
-        )
+        with self._use_adapter(adapter) as adapter_name:
+            response = generate_with_retries(
+                model=self.model,
+                tokenizer=self.tokenizer,
+                messages=full_messages,
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                assistant_role=assistant_role or "",
+                scheduler=self.scheduler,
+                prefix_cache=self.prefix_cache,
+                session_cache=self.session_cache,
+                session_id=session_id,
+                stop_sequences=stop_sequences if stop_sequences is not None else self.get_stop_sequences(assistant_role),
+                banned_phrases=self.get_banned_phrases(assistant_role),
+                repetition_config=self.get_repetition_config(assistant_role),
+                previous_speeches=previous_speeches if previous_speeches is not None else _assistant_speeches(messages),
+                assistant_model=self.draft_model,
+                spec_stats=self.spec_stats,
+                prompt_lookup_num_tokens=self.prompt_lookup_num_tokens,
+                prompt_lookup_max_ngram=self.prompt_lookup_max_ngram,
+                gen_info=gen_info,
+                adapter_name=adapter_name,
+            )
         
         return response
     
+    def chat_candidates(
+        self,
+        messages: List[Dict[str, str]],
+        num_candidates: Optional[int] = None,
+        max_new_tokens: int = 512,
+        temperature: float = 0.6,
+        top_p: float = 0.9,
+        system_prompt: Optional[str] = None,
+        assistant_role: Optional[str] = None,
+        session_id: Optional[str] = None,
+        stop_sequences: Optional[List[str]] = None,
+        adapter: Optional[str] = None,
+        previous_speeches: Optional[List[str]] = None,
+        gen_info: Optional[Dict[str, Any]] = None,
+    ) -> List[str]:
+        """
+        best-of-N 对话生成：提示词只 prefill 一次，在同一批次中采样多个候选回复
+        
+        用于需要校验输出的场景（如审判员的角色混淆检查）：一次生成 N 个候选再挑选，
+        代替"生成-校验-重试"的串行循环。不使用投机解码。
+        
+        Args:
+            num_candidates: 候选数（可选，默认按 assistant_role 取构造参数 best_of_n 的配置）
+            gen_info: 可选的 dict，写入整批的统计（generated_tokens 为各候选之和，另有 stop_reasons）
+            其余参数与 chat 相同
+        
+        Returns:
+            候选回复列表（按生成顺序，每个候选的处理方式与 chat 的返回值相同）
+        """
+        if not system_prompt:
+            system_prompt = "你是一位专业的法律从业者，需要根据角色定位参与法庭辩论。"
+        
+        if assistant_role:
+            system_prompt = add_no_thought_constraint(system_prompt, assistant_role)
+        
+        full_messages = []
+        if system_prompt:
+            full_messages.append({"role": "system", "content": system_prompt})
+        full_messages.extend(messages)
+        
+        with self._use_adapter(adapter) as adapter_name:
+            return generate_candidates(
+                model=self.model,
+                tokenizer=self.tokenizer,
+                messages=full_messages,
+                num_candidates=num_candidates or self.get_num_candidates(assistant_role),
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                assistant_role=assistant_role or "",
+                scheduler=self.scheduler,
+                prefix_cache=self.prefix_cache,
+                session_cache=self.session_cache,
+                session_id=session_id,
+                stop_sequences=stop_sequences if stop_sequences is not None else self.get_stop_sequences(assistant_role),
+                banned_phrases=self.get_banned_phrases(assistant_role),
+                repetition_config=self.get_repetition_config(assistant_role),
+                previous_speeches=previous_speeches if previous_speeches is not None else _assistant_speeches(messages),
+                adapter_name=adapter_name,
+                gen_info=gen_info,
+            )
+    
+    def stream_chat(
+        self,
+        messages: List[Dict[str, str]],
+        max_new_tokens: int = 512,
+        temperature: float = 0.6,
+        top_p: float = 0.9,
+        system_prompt: Optional[str] = None,
+        assistant_role: Optional[str] = None,
+        session_id: Optional[str] = None,
+        stop_sequences: Optional[List[str]] = None,
+        adapter: Optional[str] = None,
+        previous_speeches: Optional[List[str]] = None,
+        gen_info: Optional[Dict[str, Any]] = None,
+    ) -> Iterator[str]:
+        """
+        流式对话生成（带历史），参数与 chat 相同
+        
+        逐段产出模型解码出的文本增量。注意产出的是原始输出：<final> 标签、角色前缀等
+        需要调用方自行处理（chat 会在返回前提取 <final> 中的内容）；解码在停止序列处结束，
+        但命中的停止序列本身也会被产出，可用 infer.truncate_at_stop_sequence 截断。
+        传入 gen_info 时，迭代结束后其中为本次生成的统计（与 chat 相同）。
+        
+        Yields:
+            新解码出的文本片段
+        """
+        if not system_prompt:
+            system_prompt = "你是一位专业的法律从业者，需要根据角色定位参与法庭辩论。"
+        
+        if assistant_role:
+            system_prompt = add_no_thought_constraint(system_prompt, assistant_role)
+        
+        full_messages = []
+        if system_prompt:
+            full_messages.append({"role": "system", "content": system_prompt})
+        full_messages.extend(messages)
+        
+        with self._use_adapter(adapter) as adapter_name:
+            yield from stream_generate(
+                model=self.model,
+                tokenizer=self.tokenizer,
+                messages=full_messages,
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                scheduler=self.scheduler,
+                prefix_cache=self.prefix_cache,
+                session_cache=self.session_cache,
+                session_id=session_id,
+                stop_sequences=stop_sequences if stop_sequences is not None else self.get_stop_sequences(assistant_role),
+                banned_phrases=self.get_banned_phrases(assistant_role),
+                repetition_config=self.get_repetition_config(assistant_role),
+                previous_speeches=previous_speeches if previous_speeches is not None else _assistant_speeches(messages),
+                assistant_model=self.draft_model,
+                spec_stats=self.spec_stats,
+                prompt_lookup_num_tokens=self.prompt_lookup_num_tokens,
+                prompt_lookup_max_ngram=self.prompt_lookup_max_ngram,
+                adapter_name=adapter_name,
+                gen_info=gen_info,
+            )
+    
     def generate_from_case(
         self,
         case_file: str,
@@ -243,6 +868,10 @@ class CourtDebateModel:
     
     def __del__(self):
         """清理资源"""
+        if getattr(self, "scheduler", None) is not None:
+            self.scheduler.shutdown()
+        if getattr(self, "draft_model", None) is not None:
+            del self.draft_model
         if self.model is not None:
             del self.model
         if self.tokenizer is not None:
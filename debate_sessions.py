@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+服务端庭审会话
+
+无会话时，客户端每轮都要重新发送完整的 background（可能包含整份上传文件）和全部 context，
+服务端每轮再把 context 解析两遍（构建提示词、重复检测）。使用会话后：
+
+- DebateSession：保存一场庭审的背景、业务参数和已解析的发言。每轮只需提交新增的发言，
+  按角色区分的对话消息（本角色为 assistant，其他为 user）、重复检测用的发言列表都增量维护，
+  各角色渲染好的系统提示词也会缓存，请求体和解析开销都与庭审长度无关。
+- DebateSessionStore：按会话 id 保存，TTL 过期与 LRU 淘汰（与 speech_index.SpeechIndexStore 相同的策略）。
+
+context 文本的逐行解析（parse_context_line）与 ai_service 的无会话接口共用。
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# 重复检测使用的角色标识
+SPEECH_ROLE_KEYS = {
+    '审判员': 'judge',
+    '公诉人': 'plaintiff',
+    '辩护人': 'defendant',
+}
+
+# 系统提示词相关的业务参数（创建会话时提交，之后每轮复用）
+SESSION_PARAM_KEYS = ('judge_type', 'user_identity', 'opponent_strategy', 'user_strategy', 'instruction', 'adapter')
+
+# (角色名, 内容)；角色名为 None 表示该行没有冒号（整行都是内容）
+Turn = Tuple[Optional[str], str]
+
+
+def parse_context_line(line: str) -> Optional[Turn]:
+    """解析一行"角色名：内容"（优先中文冒号，其次英文冒号），空行返回 None"""
+    line = line.strip()
+    if not line:
+        return None
+    for colon in ('：', ':'):
+        if colon in line:
+            role_name, content = line.split(colon, 1)
+            return role_name.strip(), content.strip()
+    return None, line
+
+
+def turn_to_message(turn: Turn, agent_role: Optional[str] = None) -> Dict[str, str]:
+    """发言 → 对话消息：只有 agent_role 自己的发言为 assistant，内容统一为"角色名：内容" """
+    role_name, content = turn
+    return {
+        'role': 'assistant' if agent_role and role_name == agent_role else 'user',
+        'content': f"{role_name}：{content}" if role_name else content,
+    }
+
+
+def turn_to_speech(turn: Turn) -> Optional[Dict[str, str]]:
+    """发言 → 重复检测使用的消息（没有角色名的行不参与）"""
+    role_name, content = turn
+    if role_name is None:
+        return None
+    return {'role': SPEECH_ROLE_KEYS.get(role_name, role_name), 'text': content}
+
+
+def new_session_id() -> str:
+    return uuid.uuid4().hex
+
+
+class DebateSession:
+    """一场庭审的服务端状态（线程安全）"""
+
+    def __init__(self, session_id: str, background: str = '', params: Optional[Dict[str, Any]] = None):
+        self.session_id = session_id
+        self.background = background or ''
+        self.params = {key: (params or {}).get(key) for key in SESSION_PARAM_KEYS}
+        self.judge_skip_count = 0
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self._turns: List[Turn] = []
+        self._speeches: List[Dict[str, str]] = []
+        # agent_role -> 对话消息（增量扩展到与 _turns 等长）
+        self._messages: Dict[str, List[Dict[str, str]]] = {}
+        # agent_role -> 系统提示词
+        self._system_prompts: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._turns)
+
+    def touch(self):
+        self.last_used = time.time()
+
+    def append_turn(self, role_name: Optional[str], content: str) -> int:
+        """追加一条发言，返回追加后的发言总数"""
+        turn = (role_name.strip() if role_name else role_name, (content or '').strip())
+        speech = turn_to_speech(turn)
+        with self._lock:
+            self._turns.append(turn)
+            if speech is not None:
+                self._speeches.append(speech)
+            self.touch()
+            return len(self._turns)
+
+    def append_context(self, context: str) -> int:
+        """按行追加 context 文本（格式同无会话接口的 context），返回新增的发言数"""
+        added = 0
+        for line in (context or '').strip().split('\n'):
+            turn = parse_context_line(line)
+            if turn is not None:
+                self.append_turn(*turn)
+                added += 1
+        return added
+
+    def history_messages(self, agent_role: str) -> List[Dict[str, str]]:
+        """以 agent_role 视角的对话消息（已缓存的部分不再转换）"""
+        with self._lock:
+            messages = self._messages.setdefault(agent_role, [])
+            for turn in self._turns[len(messages):]:
+                messages.append(turn_to_message(turn, agent_role))
+            self.touch()
+            return list(messages)
+
+    def speech_messages(self) -> List[Dict[str, str]]:
+        """重复检测使用的历史发言 [{'role': 'judge'/'plaintiff'/'defendant'/原角色名, 'text': 内容}]"""
+        with self._lock:
+            return list(self._speeches)
+
+    def system_prompt(self, agent_role: str, build: Callable[[], str]) -> str:
+        """agent_role 的系统提示词（首次调用 build() 渲染，之后复用）"""
+        with self._lock:
+            prompt = self._system_prompts.get(agent_role)
+        if prompt is None:
+            prompt = build()
+            with self._lock:
+                self._system_prompts.setdefault(agent_role, prompt)
+        return prompt
+
+    def info(self) -> Dict[str, Any]:
+        with self._lock:
+            turns = len(self._turns)
+            roles: Dict[str, int] = {}
+            for role_name, _ in self._turns:
+                if role_name:
+                    roles[role_name] = roles.get(role_name, 0) + 1
+            cached_prompts = sorted(self._system_prompts)
+        return {
+            'session_id': self.session_id,
+            'turns': turns,
+            'turns_by_role': roles,
+            'background_length': len(self.background),
+            'params': {key: value for key, value in self.params.items() if value},
+            'judge_skip_count': self.judge_skip_count,
+            'cached_system_prompts': cached_prompts,
+            'created_at': round(self.created_at, 3),
+            'idle_sec': round(time.time() - self.last_used, 3),
+        }
+
+
+class DebateSessionStore:
+    """按会话 id 保存 DebateSession（线程安全，TTL 过期 + LRU 淘汰）"""
+
+    def __init__(self, max_sessions: int = 256, ttl_sec: float = 7200.0):
+        self.max_sessions = max_sessions
+        self.ttl_sec = ttl_sec
+        self._sessions: "OrderedDict[str, DebateSession]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._expired = 0
+        self._evictions = 0
+
+    def _expired_locked(self, session: DebateSession, now: float) -> bool:
+        return self.ttl_sec > 0 and now - session.last_used > self.ttl_sec
+
+    def create(self, session_id: Optional[str] = None, background: str = '',
+               params: Optional[Dict[str, Any]] = None) -> Optional[DebateSession]:
+        """创建会话；session_id 已存在（且未过期）时返回 None"""
+        session_id = session_id or new_session_id()
+        now = time.time()
+        with self._lock:
+            existing = self._sessions.get(session_id)
+            if existing is not None:
+                if not self._expired_locked(existing, now):
+                    return None
+                del self._sessions[session_id]
+                self._expired += 1
+            session = DebateSession(session_id, background=background, params=params)
+            self._sessions[session_id] = session
+            self._created += 1
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self._evictions += 1
+            return session
+
+    def get(self, session_id: str) -> Optional[DebateSession]:
+        """取出会话（不存在或已过期时返回 None）"""
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            if self._expired_locked(session, now):
+                del self._sessions[session_id]
+                self._expired += 1
+                return None
+            self._sessions.move_to_end(session_id)
+            session.touch()
+            return session
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'turns': sum(len(session) for session in self._sessions.values()),
+                'max_sessions': self.max_sessions,
+                'ttl_sec': self.ttl_sec,
+                'created': self._created,
+                'expired': self._expired,
+                'evictions': self._evictions,
+            }
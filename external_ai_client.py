@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+外部 OpenAI 兼容接口的客户端（案件总结、判决书生成使用）
+
+原来每次调用都新建连接（requests.post），每个请求都要重新做 TCP 与 TLS 握手，
+失败重试时还在 Flask 工作线程里 time.sleep()。ExternalAIClient：
+
+- 一个 requests.Session + HTTPAdapter 连接池，连接保持复用；连接超时与读取超时分开配置；
+- 固定大小的线程池执行请求，同时进行的请求数不超过 max_concurrent，
+  等待执行的请求超过 max_pending 时立即拒绝（ExternalAIBusy），不会让请求线程无限堆积；
+- 网络错误与 retry_statuses 中的状态码按"指数退避 + 随机抖动"重试（服务端给出 Retry-After 时取两者较大值），
+  退避期间由定时器等待，不占用线程池和请求线程；
+- 提交后返回 Future（submit），也提供 asyncio 接口（apost）和同步接口（post）；
+- 一个操作需要先后发出多个请求时（如判决书之后再生成点评），用 reserve(n) 一次预留全部名额，
+  避免前面的请求已经完成、后面的请求才因繁忙被拒绝，前面的结果白白作废。
+
+请求的结果是最后一次尝试的 requests.Response（由调用方解析），或最后一次尝试的 requests 异常。
+"""
+
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Sequence, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# 每次尝试结束时的回调：(第几次尝试（从 1 开始）, 响应或异常, 耗时秒数)
+AttemptHook = Callable[[int, Union[requests.Response, Exception], float], None]
+
+
+class ExternalAIBusy(Exception):
+    """等待执行的外部AI请求已达上限"""
+
+    def __init__(self, pending: int, retry_after: int):
+        super().__init__(f"外部AI请求过多（{pending} 个等待中），建议 {retry_after} 秒后重试")
+        self.pending = pending
+        self.retry_after = retry_after
+
+
+class ExternalAIReservation:
+    """预留的请求名额：submit 时传入即使用其中一个，release()（或 with 语句结束）归还未使用的名额"""
+
+    def __init__(self, client: "ExternalAIClient", count: int):
+        self._client = client
+        self.remaining = count
+
+    def release(self):
+        self._client._release_reservation(self)
+
+    def __enter__(self) -> "ExternalAIReservation":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def _retry_after_header(response: requests.Response) -> Optional[float]:
+    value = response.headers.get('Retry-After')
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+class ExternalAIClient:
+    """连接池 + 并发上限 + 不占线程的重试退避（线程安全）"""
+
+    def __init__(self, base_url: str, api_key: str, pool_size: int = 10, max_concurrent: int = 4,
+                 max_pending: int = 32, connect_timeout: float = 10.0, read_timeout: float = 90.0,
+                 max_retries: int = 3, backoff_base: float = 1.0, backoff_max: float = 20.0,
+                 retry_statuses: Sequence[int] = (429, 502, 504), on_attempt: Optional[AttemptHook] = None):
+        """
+        Args:
+            base_url: 接口地址（如 https://api.example.com/v1）
+            api_key: Bearer 令牌
+            pool_size: 连接池保持的连接数
+            max_concurrent: 同时进行的请求数
+            max_pending: 已提交、尚未完成的请求数上限（含执行中与退避等待中的请求）
+            connect_timeout / read_timeout: 连接超时与读取超时（秒）
+            max_retries: 每个请求最多尝试的次数
+            backoff_base / backoff_max: 第 n 次重试前随机等待 [0, min(backoff_max, backoff_base * 2^n)] 秒
+            retry_statuses: 需要重试的 HTTP 状态码（其余状态码直接返回给调用方）
+            on_attempt: 每次尝试结束时的回调（记录指标和日志）
+        """
+        self.base_url = base_url.rstrip('/')
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_pending = max(self.max_concurrent, max_pending)
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max(1, max_retries)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_statuses = frozenset(retry_statuses)
+        self.on_attempt = on_attempt
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, self.max_concurrent))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Authorization': f"Bearer {api_key}",
+            'Content-Type': 'application/json',
+        })
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix='external-ai')
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._requests = 0
+        self._attempts = 0
+        self._retries = 0
+        self._rejected = 0
+        self._avg_duration = read_timeout / 4
+
+    def backoff_delay(self, attempt: int) -> float:
+        """第 attempt 次重试前的等待秒数（full jitter）"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _busy_locked(self) -> ExternalAIBusy:
+        self._rejected += 1
+        retry_after = max(1, int(self._avg_duration * self._pending / self.max_concurrent))
+        return ExternalAIBusy(self._pending, retry_after)
+
+    def reserve(self, count: int) -> ExternalAIReservation:
+        """
+        一次预留 count 个请求名额（计入 pending），之后的 submit(..., reservation=...) 不会因繁忙被拒绝
+
+        Raises:
+            ExternalAIBusy：剩余名额不足 count 个
+        """
+        with self._lock:
+            if self._pending + count > self.max_pending:
+                raise self._busy_locked()
+            self._pending += count
+        return ExternalAIReservation(self, count)
+
+    def _release_reservation(self, reservation: ExternalAIReservation):
+        with self._lock:
+            self._pending -= reservation.remaining
+            reservation.remaining = 0
+
+    def submit(self, path: str, payload: Dict[str, Any], max_retries: Optional[int] = None,
+               reservation: Optional[ExternalAIReservation] = None) -> "Future[requests.Response]":
+        """
+        提交一个 POST 请求（JSON），立即返回 Future
+
+        传入 reservation 且仍有预留名额时使用预留的名额，否则按当前负载申请。
+
+        Raises:
+            ExternalAIBusy：等待执行的请求已达 max_pending
+        """
+        with self._lock:
+            if reservation is not None and reservation.remaining > 0:
+                reservation.remaining -= 1
+            elif self._pending >= self.max_pending:
+                raise self._busy_locked()
+            else:
+                self._pending += 1
+            self._requests += 1
+        future: "Future[requests.Response]" = Future()
+        future.set_running_or_notify_cancel()
+        future.add_done_callback(self._on_done)
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        self._schedule(future, url, payload, 1, max_retries or self.max_retries, 0.0)
+        return future
+
+    def post(self, path: str, payload: Dict[str, Any], max_retries: Optional[int] = None,
+             reservation: Optional[ExternalAIReservation] = None) -> requests.Response:
+        """同步接口：提交后等待结果（调用线程只等待，不执行请求和退避）"""
+        return self.submit(path, payload, max_retries, reservation).result()
+
+    async def apost(self, path: str, payload: Dict[str, Any], max_retries: Optional[int] = None,
+                    reservation: Optional[ExternalAIReservation] = None) -> requests.Response:
+        """asyncio 接口"""
+        return await asyncio.wrap_future(self.submit(path, payload, max_retries, reservation))
+
+    def _on_done(self, future: Future):
+        with self._lock:
+            self._pending -= 1
+
+    def _schedule(self, future: Future, url: str, payload: Dict[str, Any], attempt: int, max_attempts: int,
+                  delay: float):
+        if delay <= 0:
+            self._executor.submit(self._attempt, future, url, payload, attempt, max_attempts)
+            return
+        timer = threading.Timer(delay, self._executor.submit,
+                                args=(self._attempt, future, url, payload, attempt, max_attempts))
+        timer.daemon = True
+        timer.start()
+
+    def _attempt(self, future: Future, url: str, payload: Dict[str, Any], attempt: int, max_attempts: int):
+        start = time.perf_counter()
+        try:
+            response = self.session.post(url, json=payload, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            result: Union[requests.Response, Exception] = e
+        except Exception as e:
+            future.set_exception(e)
+            return
+        else:
+            result = response
+        duration = time.perf_counter() - start
+        with self._lock:
+            self._attempts += 1
+            self._avg_duration = 0.8 * self._avg_duration + 0.2 * duration
+        if self.on_attempt is not None:
+            try:
+                self.on_attempt(attempt, result, duration)
+            except Exception:
+                pass
+        if isinstance(result, requests.Response):
+            retryable = result.status_code in self.retry_statuses
+        else:
+            retryable = True
+        if not retryable or attempt >= max_attempts:
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+            return
+        delay = self.backoff_delay(attempt)
+        if isinstance(result, requests.Response):
+            server_delay = _retry_after_header(result)
+            if server_delay is not None:
+                delay = max(delay, min(server_delay, self.backoff_max))
+            result.close()
+        with self._lock:
+            self._retries += 1
+        self._schedule(future, url, payload, attempt + 1, max_attempts, delay)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'max_concurrent': self.max_concurrent,
+                'max_pending': self.max_pending,
+                'pending': self._pending,
+                'requests': self._requests,
+                'attempts': self._attempts,
+                'retries': self._retries,
+                'rejected': self._rejected,
+                'avg_attempt_sec': round(self._avg_duration, 3),
+                'connect_timeout': self.timeout[0],
+                'read_timeout': self.timeout[1],
+            }
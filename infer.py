@@ -6,13 +6,21 @@
 说明：
 - court_debate_model/ 是 LoRA 适配器目录，不是完整 base model。
 - 默认会从 court_debate_model/adapter_config.json 读取 base_model_name_or_path。
+- python infer.py export-merged --output_dir court_debate_model_merged
+  可把适配器合并进基础模型并导出 safetensors，SDK 通过 merged_model_dir 直接加载。
 """
 
 import argparse
+import contextlib
+import datetime
+import hashlib
 import json
 import os
 import sys
-from typing import List, Dict, Any, Optional
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Iterator, Set, Tuple
 
 import torch
 from transformers import (
@@ -20,7 +28,19 @@ from transformers import (
     AutoModelForCausalLM,
     AutoConfig,
     BitsAndBytesConfig,
+    GenerationConfig,
+    LogitsProcessor,
+    LogitsProcessorList,
+    NoRepeatNGramLogitsProcessor,
+    RepetitionPenaltyLogitsProcessor,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TemperatureLogitsWarper,
+    TextIteratorStreamer,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
 )
+from transformers.generation.streamers import BaseStreamer
 from peft import PeftModel
 
 # 设置 Hugging Face 镜像站点（解决网络连接问题）
@@ -86,6 +106,76 @@ def _load_base_model_name(adapter_dir: str, override: Optional[str]) -> str:
     return base
 
 
+def _cache_to_layers(past_key_values) -> List[Any]:
+    """
+    把 past_key_values 统一转换为每层 (key, value) 的列表，张量形状 [batch, heads, seq, dim]。
+    兼容旧版 tuple 缓存、transformers 4.x 的 DynamicCache（key_cache/value_cache）
+    以及 5.x 的分层 DynamicCache（layers[i].keys/values）。
+    """
+    if past_key_values is None:
+        return []
+    if isinstance(past_key_values, (tuple, list)):
+        return [(layer[0], layer[1]) for layer in past_key_values]
+    if hasattr(past_key_values, "layers"):
+        return [(layer.keys, layer.values) for layer in past_key_values.layers]
+    if hasattr(past_key_values, "key_cache"):
+        return list(zip(past_key_values.key_cache, past_key_values.value_cache))
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return [(k, v) for k, v in past_key_values.to_legacy_cache()]
+    raise TypeError(f"不支持的 past_key_values 类型: {type(past_key_values).__name__}")
+
+
+def _layers_to_cache(layers: List[Any]):
+    """_cache_to_layers 的逆操作：由每层 (key, value) 重新构建模型可接受的缓存对象"""
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        return tuple(layers)
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(tuple(layers))
+    return DynamicCache(ddp_cache_data=list(layers))
+
+
+# 单独渲染的系统消息 token id：同一场庭审中每个角色每轮的系统提示词（含大段案件背景）完全相同，
+# 按（tokenizer, 内容）缓存，避免每轮重复渲染和 tokenize
+_SYSTEM_IDS_CACHE: "OrderedDict[Tuple[int, str], List[int]]" = OrderedDict()
+_SYSTEM_IDS_CACHE_SIZE = 64
+_SYSTEM_IDS_LOCK = threading.Lock()
+
+
+def _system_message_ids(tokenizer, content: str) -> List[int]:
+    """系统消息单独套用 chat template 后的 token id（LRU 缓存，调用方不得修改返回的列表）"""
+    key = (id(tokenizer), content)
+    with _SYSTEM_IDS_LOCK:
+        ids = _SYSTEM_IDS_CACHE.get(key)
+        if ids is not None:
+            _SYSTEM_IDS_CACHE.move_to_end(key)
+            return ids
+    text = tokenizer.apply_chat_template([{"role": "system", "content": content}], tokenize=False, add_generation_prompt=False)
+    ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+    with _SYSTEM_IDS_LOCK:
+        _SYSTEM_IDS_CACHE[key] = ids
+        while len(_SYSTEM_IDS_CACHE) > _SYSTEM_IDS_CACHE_SIZE:
+            _SYSTEM_IDS_CACHE.popitem(last=False)
+    return ids
+
+
+def _system_prefix_length(tokenizer, messages: List[Dict[str, str]], input_ids: torch.Tensor) -> int:
+    """
+    计算完整输入中"渲染后的系统消息"所占的 token 数，用作前缀 KV 缓存的键。
+    只有当系统消息单独渲染的 token 恰好是完整输入的前缀（且后面还有内容）时才返回非零值。
+    """
+    if not messages or messages[0].get("role") != "system":
+        return 0
+    prefix_ids = _system_message_ids(tokenizer, messages[0].get("content", ""))
+    n = len(prefix_ids)
+    if n == 0 or n >= input_ids.shape[-1]:
+        return 0
+    if input_ids[:n].tolist() != prefix_ids:
+        return 0
+    return n
+
+
 def _build_messages(system_prompt: str, history: List[Dict[str, str]], user_text: str) -> List[Dict[str, str]]:
     msgs: List[Dict[str, str]] = []
     if system_prompt.strip():
@@ -234,6 +324,786 @@ def load_case_file(path: str) -> Dict[str, Any]:
         raise RuntimeError(f"加载案件文件失败: {e}")
 
 
+# ==================== 上下文打包（按 token 预算） ====================
+# 按消息条数截断历史（只留最近 N 条）不考虑实际长度：一段很长的辩护意见就能把提示词撑爆，
+# 而十条很短的审判员指令却会被丢掉。这里用真实 tokenizer 计算每条消息的 token 数，
+# 在预算内从最新的一轮开始按整轮保留历史，系统提示词和必须回应的内容（如 new_content）总是保留。
+
+_MESSAGE_OVERHEAD: Dict[Tuple[int, str], int] = {}
+
+
+def _render_token_count(tokenizer, messages: List[Dict[str, str]], add_generation_prompt: bool = False) -> int:
+    """按 chat template 渲染后的 token 数"""
+    text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=add_generation_prompt)
+    return len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+
+def _message_overhead(tokenizer, role: str) -> int:
+    """chat template 为一条该角色的消息额外添加的 token 数（角色标记、结束符、换行），按 tokenizer 缓存"""
+    key = (id(tokenizer), role)
+    overhead = _MESSAGE_OVERHEAD.get(key)
+    if overhead is None:
+        probe = [{"role": "system", "content": "x"}]
+        overhead = max(
+            _render_token_count(tokenizer, probe + [{"role": role, "content": ""}])
+            - _render_token_count(tokenizer, probe),
+            0,
+        )
+        _MESSAGE_OVERHEAD[key] = overhead
+    return overhead
+
+
+def _generation_prompt_tokens(tokenizer) -> int:
+    """生成提示（如 "<|im_start|>assistant\\n"）的 token 数，按 tokenizer 缓存"""
+    key = (id(tokenizer), "")
+    count = _MESSAGE_OVERHEAD.get(key)
+    if count is None:
+        probe = [{"role": "system", "content": "x"}]
+        count = max(_render_token_count(tokenizer, probe, True) - _render_token_count(tokenizer, probe), 0)
+        _MESSAGE_OVERHEAD[key] = count
+    return count
+
+
+def count_message_tokens(tokenizer, message: Dict[str, str]) -> int:
+    """一条消息在渲染后的提示词中占用的 token 数（内容 + 模板开销）"""
+    content = message.get("content", "")
+    content_tokens = len(tokenizer(content, add_special_tokens=False)["input_ids"]) if content else 0
+    return content_tokens + _message_overhead(tokenizer, message.get("role", "user"))
+
+
+def pack_messages(
+    tokenizer,
+    system_prompt: str,
+    history: List[Dict[str, str]],
+    pinned: Optional[List[Dict[str, str]]] = None,
+    token_budget: int = 0,
+    max_turns: int = 0,
+    min_turns: int = 0,
+) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+    """
+    在 token 预算内组装对话消息。
+
+    系统提示词与 pinned（放在历史之后，如本轮需要回应的发言）总是保留；剩余预算从最新的历史消息开始
+    按整条填充（不截断单条发言），遇到放不下的一条即停止，保留的历史保持原有顺序。
+    token_budget 为整个提示词（含系统提示词和生成提示）的 token 上限，<= 0 表示不限制；
+    max_turns > 0 时历史最多保留这么多条；最新的 min_turns 条历史不受预算限制总是保留
+    （系统提示词很长、预算所剩无几时不至于丢掉全部对话历史）。
+
+    Returns:
+        (messages, usage)：messages 为历史 + pinned（不含系统消息）；usage 为各部分的 token 数
+        {budget, system_tokens, pinned_tokens, history_tokens, history_turns, dropped_turns, over_budget, total_tokens}，
+        over_budget 表示为保留最少历史条数而超出了预算，total_tokens 是最终提示词的实际 token 数
+    """
+    pinned = list(pinned or [])
+    system_messages = [{"role": "system", "content": system_prompt}] if system_prompt.strip() else []
+    system_tokens = len(_system_message_ids(tokenizer, system_prompt)) if system_messages else 0
+    pinned_tokens = sum(count_message_tokens(tokenizer, m) for m in pinned)
+    # 生成提示同样占用预算
+    generation_tokens = _generation_prompt_tokens(tokenizer)
+    remaining = token_budget - system_tokens - pinned_tokens - generation_tokens if token_budget > 0 else None
+
+    kept: List[Dict[str, str]] = []
+    history_tokens = 0
+    over_budget = False
+    for message in reversed(history):
+        if max_turns > 0 and len(kept) >= max_turns:
+            break
+        cost = count_message_tokens(tokenizer, message)
+        if remaining is not None and history_tokens + cost > remaining:
+            if len(kept) >= min_turns:
+                break
+            over_budget = True
+        kept.append(message)
+        history_tokens += cost
+    kept.reverse()
+
+    messages = kept + pinned
+    usage = {
+        'budget': token_budget,
+        'system_tokens': system_tokens,
+        'pinned_tokens': pinned_tokens,
+        'history_tokens': history_tokens,
+        'history_turns': len(kept),
+        'dropped_turns': len(history) - len(kept),
+        'over_budget': over_budget,
+        'total_tokens': int(_encode_messages(tokenizer, system_messages + messages)["input_ids"].shape[-1]),
+    }
+    return messages, usage
+
+
+# ==================== 停止序列 ====================
+# 模型输出完 </final>，或者开始冒充下一位发言人（"\n辩护人：..."）时立即停止解码，
+# 这些 token 之后都会被 extract_final / 后处理丢弃，继续解码只是浪费时间。
+
+FINAL_END_TAG = "</final>"
+DEBATE_ROLE_NAMES = ["审判员", "公诉人", "辩护人"]
+
+
+def default_stop_sequences(assistant_role: str = "") -> List[str]:
+    """
+    默认停止序列：</final>；当前角色是辩论角色时再加上其他角色的换行发言前缀。
+    通用生成（没有角色或不是辩论角色）的内容可能正常地以角色名开头一行，不能按发言交接截断。
+    """
+    stops = [FINAL_END_TAG]
+    if assistant_role in DEBATE_ROLE_NAMES:
+        for role in DEBATE_ROLE_NAMES:
+            if role != assistant_role:
+                stops.extend([f"\n{role}：", f"\n{role}:"])
+    return stops
+
+
+def resolve_stop_sequences(
+    assistant_role: str = "",
+    role_stop_sequences: Optional[Dict[str, List[str]]] = None,
+) -> List[str]:
+    """
+    按角色确定停止序列。
+
+    role_stop_sequences 为 {角色: [停止序列, ...]} 的配置，"*" 表示未单独配置的辩论角色
+    （通用生成只使用以空字符串或其角色名为键的配置）；都没有配置时使用 default_stop_sequences。
+    空列表表示该角色不使用停止序列。
+    """
+    if role_stop_sequences:
+        if assistant_role in role_stop_sequences:
+            return list(role_stop_sequences[assistant_role])
+        if "*" in role_stop_sequences and assistant_role in DEBATE_ROLE_NAMES:
+            return list(role_stop_sequences["*"])
+    return default_stop_sequences(assistant_role)
+
+
+def find_stop_sequence(text: str, stop_sequences: Optional[List[str]]) -> int:
+    """返回文本中最早出现的停止序列之后应截断的位置，没有则返回 -1（</final> 本身保留，以便 extract_final 提取）"""
+    cut = -1
+    for stop in stop_sequences or []:
+        if not stop:
+            continue
+        pos = text.find(stop)
+        if pos == -1:
+            continue
+        end = pos + len(stop) if stop == FINAL_END_TAG else pos
+        if cut == -1 or end < cut:
+            cut = end
+    return cut
+
+
+def truncate_at_stop_sequence(text: str, stop_sequences: Optional[List[str]]) -> str:
+    """在最早出现的停止序列处截断文本"""
+    cut = find_stop_sequence(text, stop_sequences)
+    return text if cut == -1 else text[:cut]
+
+
+def stop_sequence_window(stop_sequences: Optional[List[str]]) -> int:
+    """检测停止序列时需要解码的末尾 token 数（每个 token 至少对应一个字符，再留一些余量）"""
+    return max((len(s) for s in stop_sequences or []), default=0) + 4
+
+
+class StopSequenceCriteria(StoppingCriteria):
+    """model.generate 的停止条件：新生成部分的末尾出现任一停止序列时结束该行"""
+
+    def __init__(self, tokenizer, stop_sequences: List[str], prompt_len: int):
+        self.tokenizer = tokenizer
+        self.stop_sequences = [s for s in stop_sequences if s]
+        self.prompt_len = prompt_len
+        self.window = stop_sequence_window(self.stop_sequences)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        tails = input_ids[:, self.prompt_len:][:, -self.window:]
+        done = [
+            find_stop_sequence(self.tokenizer.decode(row, skip_special_tokens=True), self.stop_sequences) != -1
+            for row in tails
+        ]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+# ==================== 禁用短语（解码期约束） ====================
+# 审判员不应使用的公诉人/辩护人用语、公诉人/辩护人不应使用的审判员口吻，以及聊天模板的特殊标记。
+# 这些规则原先只在生成后由 ai_service 的过滤/检测函数修补（修补不了就重试或丢弃），
+# 这里把它们编译成 token 级约束，解码时直接屏蔽会拼出这些短语的 token。
+# ai_service/app.py 的后处理函数使用同一份短语列表作为兜底检查。
+
+JUDGE_ROLE_CONFUSION_PHRASES = ["我方认为", "建议法庭", "恳请法庭", "希望法庭", "请求法庭"]
+JUDGE_STYLE_PHRASES = ["现在进入辩论环节", "现在进行法庭辩论", "审判员总结", "总结辩论", "本庭总结", "法庭总结"]
+JUDGE_STYLE_BRACKET_PREFIXES = ["[审判员", "[总结", "[法庭", "[本庭"]
+SPECIAL_TOKEN_PHRASES = ["<|im_start|>"]
+
+
+def default_banned_phrases(assistant_role: str = "") -> List[str]:
+    """默认禁用短语：审判员禁用角色混淆用语，公诉人/辩护人禁用审判员口吻，所有角色禁用聊天模板标记"""
+    if assistant_role == "审判员":
+        return JUDGE_ROLE_CONFUSION_PHRASES + SPECIAL_TOKEN_PHRASES
+    if assistant_role in DEBATE_ROLE_NAMES:
+        return JUDGE_STYLE_PHRASES + JUDGE_STYLE_BRACKET_PREFIXES + SPECIAL_TOKEN_PHRASES
+    return list(SPECIAL_TOKEN_PHRASES)
+
+
+def resolve_banned_phrases(
+    assistant_role: str = "",
+    role_banned_phrases: Optional[Dict[str, List[str]]] = None,
+) -> List[str]:
+    """
+    按角色确定禁用短语：
+    先取角色自己的配置，其次 "*"，都没有时使用 default_banned_phrases；空列表表示不做约束。
+    """
+    if role_banned_phrases:
+        if assistant_role in role_banned_phrases:
+            return list(role_banned_phrases[assistant_role])
+        if "*" in role_banned_phrases:
+            return list(role_banned_phrases["*"])
+    return default_banned_phrases(assistant_role)
+
+
+_VOCAB_STRINGS: Dict[int, List[str]] = {}
+_BANNED_PHRASE_INDEXES: Dict[Any, "BannedPhraseIndex"] = {}
+_BANNED_PHRASE_LOCK = threading.Lock()
+
+
+def _vocab_strings(tokenizer) -> List[str]:
+    """每个 token 单独解码后的文本（按 tokenizer 缓存）"""
+    key = id(tokenizer)
+    strings = _VOCAB_STRINGS.get(key)
+    if strings is None:
+        strings = tokenizer.batch_decode([[i] for i in range(len(tokenizer))], skip_special_tokens=False)
+        _VOCAB_STRINGS[key] = strings
+    return strings
+
+
+class BannedPhraseIndex:
+    """
+    把禁用短语编译成 token 级查表结构
+
+    对短语 p 的每个切分点 k：已生成文本以 p[:k] 结尾时，文本以 p[k:] 开头的 token 会把 p 补全，需要屏蔽；
+    k=0 时屏蔽本身就包含 p 的 token。按文本而不是按某一种固定切分匹配，因此 p 无论被切成哪些 token 都拼不出来。
+    EOS 永远不会被屏蔽。
+    """
+
+    def __init__(self, tokenizer, phrases: List[str]):
+        self.phrases = sorted({p for p in phrases if p})
+        strings = _vocab_strings(tokenizer)
+        exempt = {tokenizer.eos_token_id, tokenizer.pad_token_id} - {None}
+        by_first_char: Dict[str, List[int]] = {}
+        for token_id, text in enumerate(strings):
+            if text and token_id not in exempt:
+                by_first_char.setdefault(text[0], []).append(token_id)
+
+        # (短语, k) -> 需要屏蔽的 token id
+        self.bans: Dict[Any, torch.Tensor] = {}
+        for phrase in self.phrases:
+            contains = [i for i, text in enumerate(strings) if i not in exempt and phrase in text]
+            self.bans[(phrase, 0)] = torch.tensor(contains, dtype=torch.long)
+            for k in range(1, len(phrase)):
+                rest = phrase[k:]
+                ids = [i for i in by_first_char.get(rest[0], []) if strings[i].startswith(rest)]
+                self.bans[(phrase, k)] = torch.tensor(ids, dtype=torch.long)
+        self.window = max((len(p) for p in self.phrases), default=0) + 4
+
+    def banned_ids(self, generated_text: str) -> List[torch.Tensor]:
+        """根据已生成文本的末尾，返回下一步需要屏蔽的 token id 张量列表"""
+        banned = []
+        for phrase in self.phrases:
+            banned.append(self.bans[(phrase, 0)])
+            for k in range(1, len(phrase)):
+                if generated_text.endswith(phrase[:k]):
+                    banned.append(self.bans[(phrase, k)])
+        return banned
+
+
+def compile_banned_phrases(tokenizer, phrases: Optional[List[str]]) -> Optional[BannedPhraseIndex]:
+    """编译禁用短语（按 tokenizer 和短语集合缓存），没有短语时返回 None"""
+    phrases = [p for p in phrases or [] if p]
+    if not phrases:
+        return None
+    key = (id(tokenizer), tuple(sorted(set(phrases))))
+    with _BANNED_PHRASE_LOCK:
+        index = _BANNED_PHRASE_INDEXES.get(key)
+        if index is None:
+            index = BannedPhraseIndex(tokenizer, phrases)
+            _BANNED_PHRASE_INDEXES[key] = index
+    return index
+
+
+class BannedPhraseLogitsProcessor(LogitsProcessor):
+    """解码期约束：屏蔽会让新生成部分出现禁用短语的 token（model.generate 与自定义解码循环共用）"""
+
+    def __init__(self, tokenizer, index: BannedPhraseIndex, prompt_len: int):
+        self.tokenizer = tokenizer
+        self.index = index
+        self.prompt_len = prompt_len
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        for row in range(input_ids.shape[0]):
+            tail = input_ids[row, self.prompt_len:][-self.index.window:]
+            text = self.tokenizer.decode(tail, skip_special_tokens=True) if tail.numel() else ""
+            for ids in self.index.banned_ids(text):
+                if ids.numel():
+                    ids = ids[ids < scores.shape[-1]].to(scores.device)
+                    scores[row, ids] = -float("inf")
+        return scores
+
+
+# ==================== 重复 n-gram 屏蔽（解码期约束） ====================
+# 模型有时会把自己上一轮的发言几乎原样再说一遍，ai_service 的 check_duplicate_speech 只能在整段生成完后
+# 判定重复并丢弃结果。这里在解码时直接屏蔽（或惩罚）会复现同一角色历史发言中长 n-gram 的 token，
+# 让这次生成仍然可用。历史发言按 token 建表，与生成内容的切分在边界处可能略有差异，只影响边界上的 n-gram。
+# 法庭发言本来就会有意重复（法条引用、当事人姓名、审判员的固定程序用语），也与 prompt lookup 的
+# 从上下文复制相冲突，所以默认不启用，只对显式配置了的角色生效。
+
+# 启用某个角色时未写出的字段取这里的值
+DEFAULT_REPETITION_CONFIG: Dict[str, Any] = {
+    "ngram_size": 8,        # 连续多少个 token 与历史发言相同视为复现
+    "penalty": None,        # None 表示直接屏蔽；数值表示从对应 logit 中减去该值（软惩罚）
+    "max_references": 3,    # 只参考同一角色最近几次发言（与 check_duplicate_speech 一致）
+}
+
+
+def resolve_repetition_config(
+    assistant_role: str = "",
+    role_repetition: Optional[Dict[str, Optional[Dict[str, Any]]]] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    按角色确定重复 n-gram 屏蔽的参数。
+
+    role_repetition 为 {角色: {ngram_size, penalty, max_references}} 的配置，"*" 表示未单独配置的角色，
+    每项只需写出要覆盖 DEFAULT_REPETITION_CONFIG 的字段（{} 表示全部使用默认值）。
+    没有配置该角色（也没有 "*"）、值为 None 或 ngram_size <= 0 时返回 None（不启用）。
+    """
+    if not role_repetition:
+        return None
+    override = role_repetition.get(assistant_role, role_repetition.get("*"))
+    if override is None:
+        return None
+    config = dict(DEFAULT_REPETITION_CONFIG)
+    config.update(override)
+    if int(config.get("ngram_size") or 0) <= 0:
+        return None
+    return config
+
+
+class RepeatedNgramIndex:
+    """历史发言的 n-gram 查表：前 n-1 个 token -> 会把它补成历史 n-gram 的下一个 token（EOS 不会被屏蔽）"""
+
+    def __init__(self, tokenizer, references: List[str], ngram_size: int):
+        self.ngram_size = ngram_size
+        self.table: Dict[Tuple[int, ...], Set[int]] = {}
+        exempt = {tokenizer.eos_token_id, tokenizer.pad_token_id} - {None}
+        for text in references:
+            ids = tokenizer.encode(text, add_special_tokens=False) if text else []
+            for i in range(len(ids) - ngram_size + 1):
+                next_id = ids[i + ngram_size - 1]
+                if next_id not in exempt:
+                    self.table.setdefault(tuple(ids[i:i + ngram_size - 1]), set()).add(next_id)
+
+    def next_ids(self, generated: List[int]) -> List[int]:
+        """根据已生成 token 的末尾，返回下一步会复现历史 n-gram 的 token id"""
+        if len(generated) < self.ngram_size - 1:
+            return []
+        key = tuple(generated[len(generated) - self.ngram_size + 1:])
+        return list(self.table.get(key, ()))
+
+
+def compile_repeated_ngrams(
+    tokenizer,
+    previous_speeches: Optional[List[str]],
+    config: Optional[Dict[str, Any]],
+) -> Optional[RepeatedNgramIndex]:
+    """用同一角色最近的历史发言建表；未启用、没有历史发言或发言都短于 n-gram 时返回 None"""
+    if not config or not previous_speeches:
+        return None
+    references = [t for t in previous_speeches if t and t.strip()]
+    max_references = int(config.get("max_references") or 0)
+    if max_references > 0:
+        references = references[-max_references:]
+    index = RepeatedNgramIndex(tokenizer, references, int(config["ngram_size"]))
+    return index if index.table else None
+
+
+class RepeatedNgramLogitsProcessor(LogitsProcessor):
+    """解码期约束：屏蔽或惩罚会让新生成部分复现历史发言 n-gram 的 token"""
+
+    def __init__(self, index: RepeatedNgramIndex, prompt_len: int, penalty: Optional[float] = None):
+        self.index = index
+        self.prompt_len = prompt_len
+        self.penalty = penalty
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        window = self.index.ngram_size - 1
+        for row in range(input_ids.shape[0]):
+            generated = input_ids[row, self.prompt_len:]
+            tail = generated[max(0, generated.shape[-1] - window):].tolist()
+            ids = [i for i in self.index.next_ids(tail) if i < scores.shape[-1]]
+            if not ids:
+                continue
+            ids = torch.tensor(ids, dtype=torch.long, device=scores.device)
+            if self.penalty is None:
+                scores[row, ids] = -float("inf")
+            else:
+                scores[row, ids] -= float(self.penalty)
+        return scores
+
+
+def _decode_constraints(
+    tokenizer,
+    banned_index: Optional[BannedPhraseIndex],
+    repeat_index: Optional[RepeatedNgramIndex],
+    repetition_config: Optional[Dict[str, Any]],
+    prompt_len: int,
+) -> Optional[LogitsProcessorList]:
+    """组合禁用短语与重复 n-gram 两类解码期约束，都没有时返回 None"""
+    processors = LogitsProcessorList()
+    if banned_index is not None:
+        processors.append(BannedPhraseLogitsProcessor(tokenizer, banned_index, prompt_len=prompt_len))
+    if repeat_index is not None:
+        processors.append(RepeatedNgramLogitsProcessor(
+            repeat_index, prompt_len=prompt_len, penalty=repetition_config.get("penalty")
+        ))
+    return processors or None
+
+
+# ==================== 采样 ====================
+# 连续批处理调度器和 prompt lookup 解码自己执行解码循环，不经过 model.generate。
+# 它们按 model.generate 的方式从 generation_config 组装 logits 处理器并采样，
+# 使用同一组 EOS，保证开启这些路径不会改变输出分布和结束条件。
+
+def resolve_eos_token_ids(model, tokenizer) -> List[int]:
+    """
+    生成时视为结束的全部 token：tokenizer.eos_token_id 以及 generation_config.eos_token_id
+    （可能是列表，如 Qwen 的 <|im_end|> 与 <|endoftext|>）
+    """
+    config_eos = getattr(getattr(model, "generation_config", None), "eos_token_id", None)
+    if not isinstance(config_eos, (list, tuple)):
+        config_eos = [config_eos]
+    return list(dict.fromkeys(i for i in [tokenizer.eos_token_id, *config_eos] if i is not None))
+
+
+def build_logits_processors(
+    generation_config: Optional[GenerationConfig],
+    temperature: float,
+    top_p: float,
+    logits_processor: Optional[LogitsProcessorList] = None,
+) -> LogitsProcessorList:
+    """
+    按 model.generate 的顺序组装 logits 处理器：generation_config 中的 repetition_penalty、
+    no_repeat_ngram_size，然后是调用方传入的 logits_processor，采样时（temperature > 0）最后是
+    temperature、generation_config 的 top_k 和 top_p。temperature/top_p 以参数为准（与 generate_one 一致）。
+    处理器以 (提示词+已生成 token[1, n], logits[1, V]) 调用。
+    """
+    config = generation_config or GenerationConfig()
+    processors = LogitsProcessorList()
+    if config.repetition_penalty is not None and config.repetition_penalty != 1.0:
+        processors.append(RepetitionPenaltyLogitsProcessor(penalty=config.repetition_penalty))
+    if config.no_repeat_ngram_size is not None and config.no_repeat_ngram_size > 0:
+        processors.append(NoRepeatNGramLogitsProcessor(config.no_repeat_ngram_size))
+    if logits_processor:
+        processors.extend(logits_processor)
+    if temperature is not None and temperature > 0:
+        if temperature != 1.0:
+            processors.append(TemperatureLogitsWarper(temperature))
+        if config.top_k is not None and config.top_k != 0:
+            processors.append(TopKLogitsWarper(top_k=config.top_k, min_tokens_to_keep=1))
+        if top_p is not None and top_p < 1.0:
+            processors.append(TopPLogitsWarper(top_p=top_p, min_tokens_to_keep=1))
+    return processors
+
+
+def sample_next_token(scores: torch.Tensor, do_sample: bool) -> int:
+    """对经过 build_logits_processors 处理的单行 scores 取下一个 token：采样或贪心，与 model.generate 相同"""
+    if not do_sample:
+        return int(torch.argmax(scores, dim=-1).item())
+    probs = torch.softmax(scores, dim=-1)
+    return int(torch.multinomial(probs, num_samples=1).item())
+
+
+# ==================== 生成统计 ====================
+# 每次生成的 token 数与耗时（gen_info 中的 prompt_tokens、ttft_sec、decode_tokens_per_sec、stop_reason 等），
+# 按实际 token 计数，不再按字符数估算。
+
+STOP_REASON_EOS = "eos"
+STOP_REASON_STOP_SEQUENCE = "stop_sequence"
+STOP_REASON_LENGTH = "length"
+
+
+class _TimingStreamer(BaseStreamer):
+    """记录第一个新 token 产生的时间，调用原样转发给内层 streamer（可为空）"""
+
+    def __init__(self, inner=None):
+        self.inner = inner
+        self.first_token_time: Optional[float] = None
+        self._prompt_seen = False
+
+    def put(self, value):
+        # model.generate 与调度器都是先推送一次提示词，之后每次推送新 token
+        if not self._prompt_seen:
+            self._prompt_seen = True
+        elif self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+        if self.inner is not None:
+            self.inner.put(value)
+
+    def end(self):
+        if self.inner is not None:
+            self.inner.end()
+
+
+def _stop_reason(
+    new_tokens: List[int],
+    eos_token_ids: List[int],
+    text: str,
+    stop_sequences: Optional[List[str]],
+    max_new_tokens: int,
+) -> str:
+    """判断一次生成结束的原因：EOS、停止序列或达到 max_new_tokens"""
+    if new_tokens and new_tokens[-1] in eos_token_ids:
+        return STOP_REASON_EOS
+    if find_stop_sequence(text, stop_sequences) != -1:
+        return STOP_REASON_STOP_SEQUENCE
+    if len(new_tokens) >= max_new_tokens:
+        return STOP_REASON_LENGTH
+    return STOP_REASON_EOS
+
+
+def _generation_stats(
+    prompt_tokens: int,
+    cached_tokens: int,
+    generated_tokens: int,
+    start: float,
+    first_token_time: Optional[float],
+    end: float,
+    prefill_sec: Optional[float] = None,
+    tokenize_sec: float = 0.0,
+) -> Dict[str, Any]:
+    """
+    汇总一次生成的统计（时间均为秒）：
+    ttft_sec 从开始处理请求（含 tokenize、排队）到第一个新 token；tokenize_sec 为渲染模板、编码提示词和编译解码约束
+    的耗时；prefill_sec 为提示词前向（含采样第一个 token）的耗时，未单独测量时与 ttft_sec 相同；
+    decode_tokens_per_sec 只统计第一个 token 之后的解码阶段。
+    """
+    first = first_token_time if first_token_time is not None else end
+    decode_sec = max(end - first, 0.0)
+    ttft_sec = first - start
+    return {
+        'prompt_tokens': prompt_tokens,
+        'cached_tokens': cached_tokens,
+        'generated_tokens': generated_tokens,
+        'tokenize_sec': round(tokenize_sec, 4),
+        'prefill_sec': round(ttft_sec if prefill_sec is None else prefill_sec, 4),
+        'ttft_sec': round(ttft_sec, 4),
+        'decode_sec': round(decode_sec, 4),
+        'decode_tokens_per_sec': round((generated_tokens - 1) / decode_sec, 2) if generated_tokens > 1 and decode_sec > 0 else 0.0,
+        'total_sec': round(end - start, 4),
+    }
+
+
+# ==================== 投机解码统计 ====================
+
+class SpeculativeStats:
+    """
+    投机解码（草稿模型 / prompt lookup）的累计统计（线程安全）
+
+    - proposed_tokens: 草稿提出的候选 token 数
+    - accepted_tokens: 被目标模型验证通过的候选 token 数
+    - target_passes: 目标模型的前向次数（每次前向至少产出一个 token）
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.generated_tokens = 0
+        self.proposed_tokens = 0
+        self.accepted_tokens = 0
+        self.target_passes = 0
+
+    def record(
+        self,
+        generated_tokens: int,
+        proposed_tokens: int,
+        target_passes: int,
+        accepted_tokens: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """累计一次请求的统计，并返回该请求自身的统计（accepted_tokens 未知时按 生成数-前向次数 估计）"""
+        if accepted_tokens is None:
+            accepted_tokens = generated_tokens - target_passes
+        accepted = max(0, min(proposed_tokens, accepted_tokens))
+        with self._lock:
+            self.requests += 1
+            self.generated_tokens += generated_tokens
+            self.proposed_tokens += proposed_tokens
+            self.accepted_tokens += accepted
+            self.target_passes += target_passes
+        return self._summary(generated_tokens, proposed_tokens, accepted, target_passes)
+
+    @staticmethod
+    def _summary(generated: int, proposed: int, accepted: int, passes: int) -> Dict[str, Any]:
+        return {
+            'generated_tokens': generated,
+            'proposed_tokens': proposed,
+            'accepted_tokens': accepted,
+            'target_passes': passes,
+            'acceptance_rate': (accepted / proposed) if proposed else 0.0,
+            'tokens_per_target_pass': (generated / passes) if passes else 0.0,
+        }
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = self._summary(self.generated_tokens, self.proposed_tokens, self.accepted_tokens, self.target_passes)
+            stats['requests'] = self.requests
+        return stats
+
+
+class _ForwardCounter:
+    """统计当前线程内某个模块的前向调用次数（其他线程的并发请求不计入）"""
+
+    def __init__(self, module):
+        self.module = module
+        self.count = 0
+        self._thread_id = threading.get_ident()
+        self._handle = None
+
+    def _hook(self, module, args, output):
+        if threading.get_ident() == self._thread_id:
+            self.count += 1
+
+    def __enter__(self):
+        self._handle = self.module.register_forward_hook(self._hook)
+        return self
+
+    def __exit__(self, *exc):
+        self._handle.remove()
+        return False
+
+
+def _prompt_lookup_candidates(ids: torch.Tensor, max_ngram: int, num_tokens: int) -> List[int]:
+    """
+    prompt lookup：用末尾 n-gram（从 max_ngram 到 1 依次尝试）在已有 token（提示词+已生成）中查找
+    最早出现的位置，把其后的 num_tokens 个 token 作为候选续写
+    """
+    length = ids.shape[-1]
+    if num_tokens <= 0:
+        return []
+    for n in range(min(max_ngram, length - 1), 0, -1):
+        # 只在 ids[:-1] 中找，保证匹配位置之后至少还有一个 token 可以作为候选
+        windows = ids[:-1].unfold(0, n, 1)
+        matches = (windows == ids[-n:]).all(dim=1).nonzero()
+        if matches.numel():
+            start = int(matches[0].item()) + n
+            return ids[start:start + num_tokens].tolist()
+    return []
+
+
+def _crop_cache(past_key_values, length: int):
+    """把 KV 缓存截到前 length 个位置（丢弃未被接受的候选 token）"""
+    return _layers_to_cache([(k[:, :, :length, :], v[:, :, :length, :]) for k, v in _cache_to_layers(past_key_values)])
+
+
+def _prompt_lookup_generate(
+    model,
+    tokenizer,
+    input_ids: torch.Tensor,
+    max_new_tokens: int,
+    temperature: float,
+    top_p: float,
+    past_key_values=None,
+    streamer=None,
+    stop_sequences: Optional[List[str]] = None,
+    num_tokens: int = 10,
+    max_ngram: int = 3,
+    adapter_name: Optional[str] = None,
+    logits_processor=None,
+):
+    """
+    prompt lookup 解码（无需草稿模型的投机解码，batch=1）
+
+    每步从提示词中查找候选续写，目标模型一次前向同时验证全部候选：逐位置按目标分布采样，
+    与候选一致则接受并继续，不一致则采用目标模型的采样结果并结束本轮。候选是确定性的，
+    因此输出分布与逐 token 解码相同（贪心解码时结果完全一致）。
+    采样与 model.generate 一致（见 build_logits_processors）；logits_processor 以
+    (提示词+已生成 token[1, n], logits[1, V]) 调用，在每个验证位置采样前生效。
+
+    Returns:
+        (output_ids[1, 提示词+新 token], past_key_values, 本次统计 dict)
+    """
+    ids = input_ids[0].tolist()
+    prompt_len = len(ids)
+    cache = past_key_values
+    cached_len = _cache_to_layers(cache)[0][0].shape[-2] if cache is not None else 0
+    eos_token_ids = resolve_eos_token_ids(model, tokenizer)
+    processors = build_logits_processors(
+        getattr(model, "generation_config", None), temperature, top_p, logits_processor
+    )
+    do_sample = temperature > 0
+    window = stop_sequence_window(stop_sequences)
+    proposed = accepted = passes = 0
+    finished = False
+    forward_kwargs = {"adapter_names": [adapter_name]} if adapter_name else {}
+
+    if streamer is not None:
+        streamer.put(input_ids.cpu())
+
+    while not finished and len(ids) - prompt_len < max_new_tokens:
+        remaining = max_new_tokens - (len(ids) - prompt_len)
+        candidates = []
+        if len(ids) > prompt_len:
+            candidates = _prompt_lookup_candidates(
+                torch.tensor(ids, dtype=torch.long), max_ngram, min(num_tokens, remaining - 1)
+            )
+        feed = ids[cached_len:] + candidates
+        out = model(
+            input_ids=torch.tensor([feed], dtype=torch.long, device=input_ids.device),
+            past_key_values=cache,
+            use_cache=True,
+            **forward_kwargs,
+        )
+        passes += 1
+        proposed += len(candidates)
+        logits = out.logits[0, -(len(candidates) + 1):, :]
+
+        new_tokens: List[int] = []
+        for i in range(len(candidates) + 1):
+            row_logits = logits[i].unsqueeze(0).to(dtype=torch.float32, copy=True)
+            if processors:
+                seen_ids = torch.tensor([ids + candidates[:i]], dtype=torch.long, device=row_logits.device)
+                row_logits = processors(seen_ids, row_logits)
+            token = sample_next_token(row_logits[0], do_sample)
+            new_tokens.append(token)
+            if i >= len(candidates) or token != candidates[i]:
+                break
+        accepted += len(new_tokens) - 1
+        # KV 中有效的部分：原有 token + 被接受的候选（最后一个新 token 尚未写入 KV）
+        valid_len = len(ids) + len(new_tokens) - 1
+
+        for token in new_tokens:
+            ids.append(token)
+            if streamer is not None:
+                streamer.put(torch.tensor([token]))
+            if token in eos_token_ids or len(ids) - prompt_len >= max_new_tokens:
+                finished = True
+            elif stop_sequences:
+                tail = tokenizer.decode(ids[prompt_len:][-window:], skip_special_tokens=True)
+                finished = find_stop_sequence(tail, stop_sequences) != -1
+            if finished:
+                break
+
+        cached_len = min(valid_len, len(ids) - 1)
+        cache = _crop_cache(out.past_key_values, cached_len)
+
+    if streamer is not None:
+        streamer.end()
+
+    generated = len(ids) - prompt_len
+    counters = {
+        'generated_tokens': generated,
+        'proposed_tokens': proposed,
+        'accepted_tokens': accepted,
+        'target_passes': passes,
+    }
+    output_ids = torch.tensor([ids], dtype=torch.long, device=input_ids.device)
+    return output_ids, cache, counters
+
+
+def _unwrap_peft(model):
+    """PeftModel 返回底层因果语言模型，便于挂载前向计数钩子"""
+    get_base_model = getattr(model, "get_base_model", None)
+    return get_base_model() if callable(get_base_model) else model
+
+
 def extract_final(text: str) -> Optional[str]:
     t = text.strip()
     start = t.find("<final>")
@@ -243,6 +1113,29 @@ def extract_final(text: str) -> Optional[str]:
     return None
 
 
+def _encode_messages(tokenizer, messages: List[Dict[str, str]]):
+    """套用 chat template 并 tokenize（对 DeepSeek-R1 系列模型尝试禁用 thinking）"""
+    # 尝试禁用 thinking 模式（对于 DeepSeek-R1 系列模型）
+    try:
+        return tokenizer.apply_chat_template(
+            messages,
+            tokenize=True,
+            add_generation_prompt=True,
+            return_tensors="pt",
+            return_dict=True,
+            enable_thinking=False,  # 尝试禁用思考模式
+        )
+    except TypeError:
+        # 如果不支持 enable_thinking 参数，使用默认方式
+        return tokenizer.apply_chat_template(
+            messages,
+            tokenize=True,
+            add_generation_prompt=True,
+            return_tensors="pt",
+            return_dict=True,
+        )
+
+
 def generate_with_retries(
     model,
     tokenizer,
@@ -251,10 +1144,34 @@ def generate_with_retries(
     temperature: float,
     top_p: float,
     assistant_role: str,
+    scheduler=None,
+    prefix_cache=None,
+    session_cache=None,
+    session_id: Optional[str] = None,
+    stop_sequences: Optional[List[str]] = None,
+    assistant_model=None,
+    spec_stats: Optional[SpeculativeStats] = None,
+    prompt_lookup_num_tokens: int = 0,
+    prompt_lookup_max_ngram: int = 3,
+    gen_info: Optional[Dict[str, Any]] = None,
+    adapter_name: Optional[str] = None,
+    banned_phrases: Optional[List[str]] = None,
+    previous_speeches: Optional[List[str]] = None,
+    repetition_config: Optional[Dict[str, Any]] = None,
 ) -> str:
     """
     生成回复，直接返回结果，不进行思考过程检测和重试。
+
+    stop_sequences / banned_phrases / repetition_config 为 None 时按 assistant_role 使用默认值
+    （见 default_stop_sequences / default_banned_phrases / resolve_repetition_config）。
+    previous_speeches 为同一角色此前的发言，解码时避免复现其中的长 n-gram。
     """
+    if stop_sequences is None:
+        stop_sequences = default_stop_sequences(assistant_role)
+    if banned_phrases is None:
+        banned_phrases = default_banned_phrases(assistant_role)
+    if repetition_config is None:
+        repetition_config = resolve_repetition_config(assistant_role)
     ans = generate_one(
         model=model,
         tokenizer=tokenizer,
@@ -262,6 +1179,20 @@ def generate_with_retries(
         max_new_tokens=max_new_tokens,
         temperature=temperature,
         top_p=top_p,
+        scheduler=scheduler,
+        prefix_cache=prefix_cache,
+        session_cache=session_cache,
+        session_id=session_id,
+        stop_sequences=stop_sequences,
+        assistant_model=assistant_model,
+        spec_stats=spec_stats,
+        prompt_lookup_num_tokens=prompt_lookup_num_tokens,
+        prompt_lookup_max_ngram=prompt_lookup_max_ngram,
+        gen_info=gen_info,
+        adapter_name=adapter_name,
+        banned_phrases=banned_phrases,
+        previous_speeches=previous_speeches,
+        repetition_config=repetition_config,
     )
     
     # 尝试提取 <final> 标签中的内容
@@ -280,29 +1211,90 @@ def generate_one(
     max_new_tokens: int,
     temperature: float,
     top_p: float,
+    scheduler=None,
+    prefix_cache=None,
+    session_cache=None,
+    session_id: Optional[str] = None,
+    streamer=None,
+    stop_sequences: Optional[List[str]] = None,
+    assistant_model=None,
+    spec_stats: Optional[SpeculativeStats] = None,
+    prompt_lookup_num_tokens: int = 0,
+    prompt_lookup_max_ngram: int = 3,
+    gen_info: Optional[Dict[str, Any]] = None,
+    adapter_name: Optional[str] = None,
+    banned_phrases: Optional[List[str]] = None,
+    previous_speeches: Optional[List[str]] = None,
+    repetition_config: Optional[Dict[str, Any]] = None,
 ) -> str:
     """
     生成回复。对于 DeepSeek-R1 系列模型，尝试禁用 thinking 机制。
+
+    如果传入 scheduler（batch_scheduler.ContinuousBatchScheduler），则把请求交给调度器，
+    与其他并发请求合并在同一个解码批次中执行。
+    如果传入 prefix_cache（kv_cache.PrefixKVCache），系统提示词部分的 KV 会被缓存并在后续请求中复用。
+    如果传入 session_cache（kv_cache.SessionKVCache）和 session_id，会话上一轮的 KV 会被复用，
+    本轮只 prefill 新追加的部分，生成结束后再把本轮 KV 写回会话缓存。
+    如果传入 streamer（transformers 的 BaseStreamer），新 token 会在解码过程中实时推送给它。
+    如果传入 stop_sequences，生成内容中出现任一停止序列即停止解码，返回的文本在该处截断
+    （</final> 保留在结果中）。
+    如果传入 assistant_model（与目标模型共用 tokenizer 的小模型），使用投机解码：
+    草稿模型提出候选 token，目标模型一次前向完成验证，输出分布不变；统计累计到 spec_stats。
+    连续批处理调度器不支持投机解码，同时传入 scheduler 时以调度器为准；投机解码时不复用前缀/会话 KV 缓存。
+    如果 prompt_lookup_num_tokens > 0（且没有草稿模型），使用 prompt lookup 解码：用末尾 n-gram 在提示词
+    （案件背景、对话历史）中查找候选续写，目标模型一次前向验证，适合人名、日期、金额、法条等原文引用。
+    如果传入 gen_info（dict），生成结束后写入本次请求的 token 数与耗时（prompt_tokens、cached_tokens、
+    generated_tokens、prefill_sec、ttft_sec、decode_tokens_per_sec 等，见 _generation_stats）和结束原因
+    stop_reason（eos / stop_sequence / length），走调度器时另有排队耗时 queue_sec，
+    投机解码时另有本次请求的接受率统计 gen_info['speculative']。
+    如果传入 adapter_name（已通过 PeftModel.load_adapter 加载的 LoRA 适配器名），本次请求只使用该适配器，
+    不改变模型的激活适配器，因此不同适配器的请求可以并发、也可以在调度器中混合成批；
+    前缀/会话 KV 缓存按适配器隔离。
+    如果传入 banned_phrases，解码时屏蔽会让新生成内容出现这些短语的 token（见 BannedPhraseLogitsProcessor）。
+    如果传入 previous_speeches（同一角色此前的发言）和 repetition_config，解码时屏蔽或惩罚会复现其中
+    长 n-gram 的 token（见 RepeatedNgramLogitsProcessor）。
     """
-    # 尝试禁用 thinking 模式（对于 DeepSeek-R1 系列模型）
-    try:
-        enc = tokenizer.apply_chat_template(
-            messages,
-            tokenize=True,
-            add_generation_prompt=True,
-            return_tensors="pt",
-            return_dict=True,
-            enable_thinking=False,  # 尝试禁用思考模式
-        )
-    except TypeError:
-        # 如果不支持 enable_thinking 参数，使用默认方式
-        enc = tokenizer.apply_chat_template(
-            messages,
-            tokenize=True,
-            add_generation_prompt=True,
-            return_tensors="pt",
-            return_dict=True,
+    start = time.perf_counter()
+    enc = _encode_messages(tokenizer, messages)
+    banned_index = compile_banned_phrases(tokenizer, banned_phrases)
+    repeat_index = compile_repeated_ngrams(tokenizer, previous_speeches, repetition_config)
+    tokenize_sec = time.perf_counter() - start
+    # 需要统计时包一层 streamer 记录第一个新 token 的时间
+    timer = _TimingStreamer(streamer) if gen_info is not None else None
+    
+    prefix_len = _system_prefix_length(tokenizer, messages, enc["input_ids"][0]) if prefix_cache is not None else 0
+    if adapter_name and session_id:
+        # 不同适配器产生的 KV 不能互相复用
+        session_id = f"{adapter_name}:{session_id}"
+    
+    # 连续批处理：由调度器负责设备放置、prefill 和解码
+    if scheduler is not None:
+        sched_info: Optional[Dict[str, Any]] = {} if gen_info is not None else None
+        new_tokens = scheduler.generate(
+            enc["input_ids"][0].tolist(),
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            prefix_len=prefix_len,
+            session_id=session_id if session_cache is not None else None,
+            streamer=timer or streamer,
+            stop_sequences=stop_sequences,
+            adapter_name=adapter_name,
+            logits_processor=_decode_constraints(
+                tokenizer, banned_index, repeat_index, repetition_config, prompt_len=enc["input_ids"].shape[-1]
+            ),
+            gen_info=sched_info,
         )
+        if gen_info is not None:
+            gen_info.update(_generation_stats(
+                enc["input_ids"].shape[-1], sched_info.get('cached_tokens', 0), len(new_tokens),
+                start, timer.first_token_time, time.perf_counter(), prefill_sec=sched_info.get('prefill_sec'),
+                tokenize_sec=tokenize_sec,
+            ))
+            gen_info['queue_sec'] = sched_info.get('queue_sec')
+            gen_info['stop_reason'] = sched_info.get('stop_reason')
+        text = tokenizer.decode(new_tokens, skip_special_tokens=True)
+        return truncate_at_stop_sequence(text, stop_sequences).strip()
     
     # 确定模型所在的设备 - 通过检查模型参数的实际设备
     first_param = next(model.parameters())
@@ -345,37 +1337,488 @@ def generate_one(
         if attention_mask is not None:
             attention_mask = attention_mask.to(device)
 
-    with torch.inference_mode():
-        # 对于量化模型，使用torch.cuda.amp.autocast可能有助于性能
+    eos_token_ids = resolve_eos_token_ids(model, tokenizer)
+
+    gen_kwargs = dict(
+        input_ids=input_ids,
+        attention_mask=attention_mask,
+        max_new_tokens=max_new_tokens,
+        do_sample=temperature > 0,
+        temperature=temperature if temperature > 0 else None,
+        top_p=top_p,
+        pad_token_id=tokenizer.eos_token_id,
+        eos_token_id=eos_token_ids,
+        streamer=timer or streamer,
+    )
+    if stop_sequences:
+        gen_kwargs["stopping_criteria"] = StoppingCriteriaList([
+            StopSequenceCriteria(tokenizer, stop_sequences, prompt_len=input_ids.shape[-1])
+        ])
+
+    # 对于量化模型，使用torch.cuda.amp.autocast可能有助于性能
+    if torch.cuda.is_available() and device.type == 'cuda':
+        autocast_ctx = torch.cuda.amp.autocast()
+    else:
+        autocast_ctx = contextlib.nullcontext()
+
+    if assistant_model is not None:
+        gen_kwargs["assistant_model"] = assistant_model
+    if adapter_name:
+        gen_kwargs["adapter_names"] = [adapter_name]
+    constraints = _decode_constraints(
+        tokenizer, banned_index, repeat_index, repetition_config, prompt_len=input_ids.shape[-1]
+    )
+    if constraints is not None:
+        gen_kwargs["logits_processor"] = constraints
+
+    # transformers 的辅助生成（投机解码）不能正确处理外部传入的 past_key_values，投机解码时不复用 KV 缓存
+    reuse_kv = assistant_model is None
+    use_session = session_cache is not None and bool(session_id) and reuse_kv
+
+    with torch.inference_mode(), autocast_ctx:
+        prefill_start = time.perf_counter()
+        # 优先复用会话 KV（只 prefill 新追加的轮次）；未命中或历史分叉时退回系统提示词前缀缓存
+        past_layers = None
+        if use_session:
+            _, past_layers = session_cache.lookup(session_id, input_ids[0].tolist())
+        if past_layers is None and prefix_cache is not None and prefix_len and reuse_kv:
+            past_layers = prefix_cache.get_or_prefill(
+                model, input_ids[0, :prefix_len].tolist(), device, adapter_name=adapter_name
+            )
+        if past_layers is not None:
+            gen_kwargs["past_key_values"] = _layers_to_cache(past_layers)
+        if use_session:
+            gen_kwargs["return_dict_in_generate"] = True
+
+        spec_counters = None
+        if assistant_model is not None:
+            with _ForwardCounter(_unwrap_peft(model)) as target_calls, _ForwardCounter(assistant_model) as draft_calls:
+                output = model.generate(**gen_kwargs)
+        elif prompt_lookup_num_tokens > 0:
+            output_ids, final_cache, spec_counters = _prompt_lookup_generate(
+                model,
+                tokenizer,
+                input_ids,
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                past_key_values=gen_kwargs.get("past_key_values"),
+                streamer=timer or streamer,
+                stop_sequences=stop_sequences,
+                num_tokens=prompt_lookup_num_tokens,
+                max_ngram=prompt_lookup_max_ngram,
+                adapter_name=adapter_name,
+                logits_processor=constraints,
+            )
+        else:
+            output = model.generate(**gen_kwargs)
+
+        if spec_counters is None:
+            if use_session:
+                output_ids, final_cache = output.sequences, output.past_key_values
+            else:
+                output_ids = output
+
+        if use_session:
+            # 缓存覆盖 提示词+已生成 token（最后一个采样 token 尚未写入 KV）
+            session_layers = _cache_to_layers(final_cache)
+            if session_layers:
+                cached_len = session_layers[0][0].shape[-2]
+                session_cache.put(session_id, output_ids[0, :cached_len].tolist(), session_layers)
+
+    new_tokens = output_ids[0, input_ids.shape[-1] :]
+    text = tokenizer.decode(new_tokens, skip_special_tokens=True)
+    if gen_info is not None:
+        end = time.perf_counter()
+        gen_info.update(_generation_stats(
+            input_ids.shape[-1], past_layers[0][0].shape[-2] if past_layers else 0, int(new_tokens.shape[-1]),
+            start, timer.first_token_time, end,
+            prefill_sec=(timer.first_token_time or end) - prefill_start, tokenize_sec=tokenize_sec,
+        ))
+        gen_info['stop_reason'] = _stop_reason(
+            new_tokens.tolist(), eos_token_ids, text, stop_sequences, max_new_tokens
+        )
+    if assistant_model is not None:
+        spec_counters = {
+            'generated_tokens': int(new_tokens.shape[-1]),
+            'proposed_tokens': draft_calls.count,
+            'target_passes': target_calls.count,
+        }
+    if spec_counters is not None:
+        request_spec = (spec_stats if spec_stats is not None else SpeculativeStats()).record(**spec_counters)
+        if gen_info is not None:
+            gen_info['speculative'] = request_spec
+    return truncate_at_stop_sequence(text, stop_sequences).strip()
+
+
+def stream_generate(
+    model,
+    tokenizer,
+    messages: List[Dict[str, str]],
+    max_new_tokens: int,
+    temperature: float,
+    top_p: float,
+    scheduler=None,
+    prefix_cache=None,
+    session_cache=None,
+    session_id: Optional[str] = None,
+    stop_sequences: Optional[List[str]] = None,
+    assistant_model=None,
+    spec_stats: Optional[SpeculativeStats] = None,
+    prompt_lookup_num_tokens: int = 0,
+    prompt_lookup_max_ngram: int = 3,
+    adapter_name: Optional[str] = None,
+    banned_phrases: Optional[List[str]] = None,
+    previous_speeches: Optional[List[str]] = None,
+    repetition_config: Optional[Dict[str, Any]] = None,
+    gen_info: Optional[Dict[str, Any]] = None,
+) -> Iterator[str]:
+    """
+    流式生成：在后台线程中调用 generate_one，边解码边产出文本增量。
+    传入 gen_info 时，迭代结束后其中为本次生成的统计（见 generate_one）。
+
+    产出的是模型原始输出（未提取 <final> 标签、未做后处理）。解码会在停止序列处结束，
+    但命中的停止序列本身已被推送，调用方需要用 truncate_at_stop_sequence 截断。
+    生成过程中的异常会在迭代结束后重新抛出。
+    """
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    errors: List[BaseException] = []
+
+    def _run():
+        try:
+            generate_one(
+                model=model,
+                tokenizer=tokenizer,
+                messages=messages,
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                scheduler=scheduler,
+                prefix_cache=prefix_cache,
+                session_cache=session_cache,
+                session_id=session_id,
+                streamer=streamer,
+                stop_sequences=stop_sequences,
+                assistant_model=assistant_model,
+                spec_stats=spec_stats,
+                prompt_lookup_num_tokens=prompt_lookup_num_tokens,
+                prompt_lookup_max_ngram=prompt_lookup_max_ngram,
+                adapter_name=adapter_name,
+                banned_phrases=banned_phrases,
+                previous_speeches=previous_speeches,
+                repetition_config=repetition_config,
+                gen_info=gen_info,
+            )
+        except BaseException as e:
+            errors.append(e)
+            # 解除消费端的阻塞
+            streamer.end()
+
+    thread = threading.Thread(target=_run, name="stream-generate", daemon=True)
+    thread.start()
+    for text in streamer:
+        if text:
+            yield text
+    thread.join()
+    if errors:
+        raise errors[0]
+
+
+def generate_candidates(
+    model,
+    tokenizer,
+    messages: List[Dict[str, str]],
+    num_candidates: int,
+    max_new_tokens: int,
+    temperature: float,
+    top_p: float,
+    assistant_role: str,
+    scheduler=None,
+    prefix_cache=None,
+    session_cache=None,
+    session_id: Optional[str] = None,
+    stop_sequences: Optional[List[str]] = None,
+    adapter_name: Optional[str] = None,
+    banned_phrases: Optional[List[str]] = None,
+    previous_speeches: Optional[List[str]] = None,
+    repetition_config: Optional[Dict[str, Any]] = None,
+    gen_info: Optional[Dict[str, Any]] = None,
+) -> List[str]:
+    """
+    best-of-N：一次批量采样 num_candidates 个候选回复，每个候选按 generate_with_retries 的方式处理
+    （在停止序列处截断、提取 <final> 中的内容）。
+
+    提示词只 prefill 一次：其 KV 复制 num_candidates 份后在同一批次中解码，各行独立采样、
+    独立在 EOS / 停止序列处结束。传入 scheduler 时把 N 条请求同时提交，由调度器合批解码
+    （系统提示词前缀/会话 KV 同样复用）。两种方式下会话 KV 都只读取不写回：采用哪个候选由调用方决定，
+    不能让某个未被采用的候选覆盖会话缓存。
+    禁用短语与重复 n-gram 约束对每个候选分别生效，参数含义同 generate_with_retries。
+    传入 gen_info 时写入整批的统计（generated_tokens 为各候选之和，ttft_sec 为最早的首 token），
+    另有 num_candidates 和每个候选的结束原因 stop_reasons。
+    """
+    if stop_sequences is None:
+        stop_sequences = default_stop_sequences(assistant_role)
+    if banned_phrases is None:
+        banned_phrases = default_banned_phrases(assistant_role)
+    if repetition_config is None:
+        repetition_config = resolve_repetition_config(assistant_role)
+    start = time.perf_counter()
+    banned_index = compile_banned_phrases(tokenizer, banned_phrases)
+    repeat_index = compile_repeated_ngrams(tokenizer, previous_speeches, repetition_config)
+    enc = _encode_messages(tokenizer, messages)
+    tokenize_sec = time.perf_counter() - start
+    prefix_len = _system_prefix_length(tokenizer, messages, enc["input_ids"][0]) if prefix_cache is not None else 0
+    eos_token_ids = resolve_eos_token_ids(model, tokenizer)
+    if adapter_name and session_id:
+        session_id = f"{adapter_name}:{session_id}"
+
+    if scheduler is not None:
+        timers = [_TimingStreamer() if gen_info is not None else None for _ in range(num_candidates)]
+        infos: List[Optional[Dict[str, Any]]] = [{} if gen_info is not None else None for _ in range(num_candidates)]
+        futures = [
+            scheduler.submit(
+                enc["input_ids"][0].tolist(),
+                max_new_tokens,
+                temperature,
+                top_p,
+                prefix_len=prefix_len,
+                session_id=session_id if session_cache is not None else None,
+                stop_sequences=stop_sequences,
+                adapter_name=adapter_name,
+                logits_processor=_decode_constraints(
+                    tokenizer, banned_index, repeat_index, repetition_config, prompt_len=enc["input_ids"].shape[-1]
+                ),
+                streamer=timers[i],
+                gen_info=infos[i],
+                update_session=False,
+            )
+            for i in range(num_candidates)
+        ]
+        outputs = [future.result() for future in futures]
+        if gen_info is not None:
+            first_times = [t.first_token_time for t in timers if t.first_token_time is not None]
+            gen_info.update(_generation_stats(
+                enc["input_ids"].shape[-1], max(info.get('cached_tokens', 0) for info in infos),
+                sum(len(tokens) for tokens in outputs), start, min(first_times, default=None), time.perf_counter(),
+                prefill_sec=max(info.get('prefill_sec', 0.0) for info in infos), tokenize_sec=tokenize_sec,
+            ))
+            gen_info['queue_sec'] = max(info.get('queue_sec', 0.0) for info in infos)
+            gen_info['stop_reasons'] = [info.get('stop_reason') for info in infos]
+    else:
+        device = next(model.parameters()).device
+        input_ids = enc["input_ids"].to(device)
+        prompt_len = input_ids.shape[-1]
+        forward_kwargs = {"adapter_names": [adapter_name]} if adapter_name else {}
         if torch.cuda.is_available() and device.type == 'cuda':
-            with torch.cuda.amp.autocast():
-                output_ids = model.generate(
-                    input_ids=input_ids,
-                    attention_mask=attention_mask,
-                    max_new_tokens=max_new_tokens,
-                    do_sample=temperature > 0,
-                    temperature=temperature if temperature > 0 else None,
-                    top_p=top_p,
-                    pad_token_id=tokenizer.eos_token_id,
-                    eos_token_id=tokenizer.eos_token_id,
-                )
+            autocast_ctx = torch.cuda.amp.autocast()
         else:
-            output_ids = model.generate(
-                input_ids=input_ids,
-                attention_mask=attention_mask,
+            autocast_ctx = contextlib.nullcontext()
+
+        timer = _TimingStreamer() if gen_info is not None else None
+        with torch.inference_mode(), autocast_ctx:
+            prefill_start = time.perf_counter()
+            reuse_len, past_layers = 0, None
+            if session_cache is not None and session_id:
+                reuse_len, past_layers = session_cache.lookup(session_id, input_ids[0].tolist())
+            if past_layers is None and prefix_cache is not None and 0 < prefix_len < prompt_len:
+                past_layers = prefix_cache.get_or_prefill(
+                    model, input_ids[0, :prefix_len].tolist(), device, adapter_name=adapter_name
+                )
+                reuse_len = prefix_len
+            # 共享 prefill：最后一个提示词 token 之前的部分只计算一次，最后一个 token 留给 generate 逐行处理
+            if reuse_len < prompt_len - 1:
+                out = model(
+                    input_ids=input_ids[:, reuse_len:prompt_len - 1],
+                    past_key_values=_layers_to_cache(past_layers) if past_layers is not None else None,
+                    use_cache=True,
+                    **forward_kwargs,
+                )
+                past_layers = _cache_to_layers(out.past_key_values)
+
+            gen_kwargs = dict(
+                input_ids=input_ids.repeat(num_candidates, 1),
+                attention_mask=torch.ones((num_candidates, prompt_len), dtype=torch.long, device=device),
                 max_new_tokens=max_new_tokens,
                 do_sample=temperature > 0,
                 temperature=temperature if temperature > 0 else None,
                 top_p=top_p,
                 pad_token_id=tokenizer.eos_token_id,
-                eos_token_id=tokenizer.eos_token_id,
+                eos_token_id=eos_token_ids,
+                streamer=timer,
             )
+            if past_layers is not None:
+                gen_kwargs["past_key_values"] = _layers_to_cache([
+                    (k.repeat(num_candidates, 1, 1, 1), v.repeat(num_candidates, 1, 1, 1)) for k, v in past_layers
+                ])
+            if stop_sequences:
+                gen_kwargs["stopping_criteria"] = StoppingCriteriaList([
+                    StopSequenceCriteria(tokenizer, stop_sequences, prompt_len=prompt_len)
+                ])
+            if adapter_name:
+                gen_kwargs["adapter_names"] = [adapter_name] * num_candidates
+            constraints = _decode_constraints(tokenizer, banned_index, repeat_index, repetition_config, prompt_len)
+            if constraints is not None:
+                gen_kwargs["logits_processor"] = constraints
+            output_ids = model.generate(**gen_kwargs)
+        outputs = []
+        for row in output_ids[:, prompt_len:].tolist():
+            # 先结束的行其后用 EOS 填充，只保留到第一个 EOS；
+            # 因停止序列结束的行，其后的 EOS 是填充而不是生成的 token，不计入输出（否则结束原因会被判为 eos）
+            end = next((i for i, token in enumerate(row) if token in eos_token_ids), None)
+            if end is not None:
+                stopped = stop_sequences and find_stop_sequence(
+                    tokenizer.decode(row[:end], skip_special_tokens=True), stop_sequences
+                ) != -1
+                row = row[:end] if stopped else row[:end + 1]
+            outputs.append(row)
+        if gen_info is not None:
+            end = time.perf_counter()
+            gen_info.update(_generation_stats(
+                prompt_len, reuse_len if past_layers is not None else 0, sum(len(tokens) for tokens in outputs),
+                start, timer.first_token_time, end, prefill_sec=(timer.first_token_time or end) - prefill_start,
+                tokenize_sec=tokenize_sec,
+            ))
 
-    new_tokens = output_ids[0, input_ids.shape[-1] :]
-    return tokenizer.decode(new_tokens, skip_special_tokens=True).strip()
+    candidates = []
+    stop_reasons = []
+    for new_tokens in outputs:
+        raw = tokenizer.decode(new_tokens, skip_special_tokens=True)
+        stop_reasons.append(_stop_reason(new_tokens, eos_token_ids, raw, stop_sequences, max_new_tokens))
+        text = truncate_at_stop_sequence(raw, stop_sequences).strip()
+        candidates.append(extract_final(text) or text)
+    if gen_info is not None:
+        gen_info['num_candidates'] = num_candidates
+        gen_info.setdefault('stop_reasons', stop_reasons)
+    return candidates
+
+
+# ==================== 合并导出 ====================
+
+MERGED_MANIFEST_NAME = "merged_manifest.json"
+
+
+def _sha256_file(path: str, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def export_merged(
+    adapter_dir: str,
+    output_dir: str,
+    base_model: Optional[str] = None,
+    dtype: str = "float16",
+    max_shard_size: str = "4GB",
+) -> Dict[str, Any]:
+    """
+    把 LoRA 适配器合并进基础模型权重，导出为自包含的 safetensors 检查点。
+
+    输出目录包含模型权重（safetensors 分片）、config、tokenizer，以及记录来源和文件校验和的
+    merged_manifest.json。加载合并后的模型不再需要 PEFT，解码时也没有额外的 LoRA 矩阵乘。
+
+    Returns:
+        写入的 manifest 内容
+    """
+    import peft
+    import transformers
+
+    base_model_name = _load_base_model_name(adapter_dir, base_model)
+    torch_dtype = getattr(torch, dtype)
+    print(f"[信息] 基础模型: {base_model_name}")
+    print(f"[信息] 适配器目录: {adapter_dir}")
+    print(f"[信息] 合并精度: {dtype}（在 CPU 上合并，不使用量化）")
+
+    model = AutoModelForCausalLM.from_pretrained(
+        base_model_name,
+        dtype=torch_dtype,
+        device_map="cpu",
+        low_cpu_mem_usage=True,
+        trust_remote_code=True,
+    )
+    model = PeftModel.from_pretrained(model, adapter_dir)
+    print(f"[信息] 正在合并 LoRA 权重...")
+    model = model.merge_and_unload()
+    model.eval()
+
+    os.makedirs(output_dir, exist_ok=True)
+    print(f"[信息] 正在写入 {output_dir} ...")
+    model.save_pretrained(output_dir, safe_serialization=True, max_shard_size=max_shard_size)
+    tokenizer = AutoTokenizer.from_pretrained(adapter_dir, use_fast=True)
+    tokenizer.save_pretrained(output_dir)
+
+    adapter_files = {}
+    for name in ("adapter_config.json", "adapter_model.safetensors", "adapter_model.bin"):
+        path = os.path.join(adapter_dir, name)
+        if os.path.exists(path):
+            adapter_files[name] = _sha256_file(path)
+
+    weight_files = {}
+    for name in sorted(os.listdir(output_dir)):
+        if name.endswith(".safetensors"):
+            path = os.path.join(output_dir, name)
+            weight_files[name] = {"size": os.path.getsize(path), "sha256": _sha256_file(path)}
+
+    manifest = {
+        "format": "court_debate_merged",
+        "version": 1,
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "base_model": base_model_name,
+        "adapter_dir": os.path.abspath(adapter_dir),
+        "adapter_files": adapter_files,
+        "dtype": dtype,
+        "weight_files": weight_files,
+        "versions": {
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "peft": peft.__version__,
+        },
+    }
+    with open(os.path.join(output_dir, MERGED_MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    total_gb = sum(info["size"] for info in weight_files.values()) / 1024**3
+    print(f"[信息] 导出完成: {len(weight_files)} 个权重文件，共 {total_gb:.2f}GB")
+    return manifest
+
+
+def load_merged_manifest(model_dir: str) -> Optional[Dict[str, Any]]:
+    """读取合并导出目录中的 manifest，不存在时返回 None"""
+    path = os.path.join(model_dir, MERGED_MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def export_merged_main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(prog="infer.py export-merged", description="合并 LoRA 适配器并导出 safetensors 检查点")
+    parser.add_argument("--adapter_dir", default="court_debate_model", help="LoRA 适配器目录")
+    parser.add_argument("--output_dir", default="court_debate_model_merged", help="导出目录")
+    parser.add_argument("--base_model", default=None, help="可选：覆盖 adapter_config.json 里的 base model")
+    parser.add_argument("--dtype", default="float16", choices=["float16", "bfloat16", "float32"], help="合并与保存的精度")
+    parser.add_argument("--max_shard_size", default="4GB", help="单个 safetensors 分片的最大大小")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.adapter_dir):
+        print(f"[错误] 找不到适配器目录: {args.adapter_dir}")
+        return 2
+    export_merged(
+        adapter_dir=args.adapter_dir,
+        output_dir=args.output_dir,
+        base_model=args.base_model,
+        dtype=args.dtype,
+        max_shard_size=args.max_shard_size,
+    )
+    return 0
 
 
 def main() -> int:
+    # 子命令：python infer.py export-merged --adapter_dir ... --output_dir ...
+    if len(sys.argv) > 1 and sys.argv[1] == "export-merged":
+        return export_merged_main(sys.argv[2:])
+
     parser = argparse.ArgumentParser()
     parser.add_argument("--adapter_dir", default="court_debate_model", help="LoRA 适配器目录")
     parser.add_argument("--base_model", default=None, help="可选：覆盖 adapter_config.json 里的 base model")
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+推理路径中的 KV 缓存复用
+
+- PrefixKVCache：以（适配器名, 渲染后的系统提示词前缀 token id）为键，缓存其 past_key_values。
+  同一场庭审中同一角色每轮的系统提示词完全相同，命中后只需 prefill 对话部分。
+  在内存预算内按 LRU 顺序淘汰。
+- SessionKVCache：以庭审/会话 id 为键，保存该会话上一轮"提示词+生成内容"的 KV。
+  庭审对话是只追加的，下一轮只需 prefill 新追加的部分；历史发生分叉（如客户端截断 context）
+  时只复用最长公共前缀，完全不匹配则回退为完整 prefill。支持 TTL 与 LRU 淘汰。
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
+
+import torch
+
+from infer import _cache_to_layers
+
+
+def _layers_nbytes(layers: List[Any]) -> int:
+    """计算每层 (key, value) 张量占用的字节数"""
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in layers)
+
+
+def _common_prefix_len(a: torch.Tensor, b: torch.Tensor) -> int:
+    """两个一维 token id 张量的最长公共前缀长度"""
+    n = min(a.shape[-1], b.shape[-1])
+    if n == 0:
+        return 0
+    diff = (a[:n] != b[:n]).nonzero()
+    return int(diff[0].item()) if diff.numel() else n
+
+
+class PrefixKVCache:
+    """
+    系统提示词前缀 KV 缓存（线程安全，LRU 淘汰）
+
+    缓存的张量不会被原地修改：生成时总是基于它们重新构建缓存对象，
+    DynamicCache 追加新 token 时会产生新的张量。
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        Args:
+            max_bytes: 缓存张量的总内存预算（字节），超出后按 LRU 顺序淘汰
+        """
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple[Any, ...], Tuple[List[Any], int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, prefix_ids: List[int], adapter_name: Optional[str] = None) -> Optional[List[Any]]:
+        """按前缀 token id 查找缓存，命中时返回每层 (key, value)；不同适配器的 KV 互不共享"""
+        key = (adapter_name or "",) + tuple(prefix_ids)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+    def put(self, prefix_ids: List[int], layers: List[Any], adapter_name: Optional[str] = None):
+        """写入缓存；单条超过预算时不缓存"""
+        key = (adapter_name or "",) + tuple(prefix_ids)
+        nbytes = _layers_nbytes(layers)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (layers, nbytes)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes and self._entries:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self._bytes -= evicted_bytes
+                self._evictions += 1
+
+    @torch.inference_mode()
+    def get_or_prefill(
+        self,
+        model,
+        prefix_ids: List[int],
+        device: torch.device,
+        adapter_name: Optional[str] = None,
+    ) -> List[Any]:
+        """命中则直接返回缓存；否则对前缀执行一次 prefill（使用指定的适配器）并写入缓存"""
+        layers = self.get(prefix_ids, adapter_name)
+        if layers is None:
+            input_ids = torch.tensor([prefix_ids], dtype=torch.long, device=device)
+            extra = {"adapter_names": [adapter_name]} if adapter_name else {}
+            out = model(input_ids=input_ids, use_cache=True, **extra)
+            layers = _cache_to_layers(out.past_key_values)
+            self.put(prefix_ids, layers, adapter_name)
+        return layers
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+            }
+
+
+class SessionKVCache:
+    """
+    会话级增量 KV 缓存（线程安全）
+
+    每个会话只保留最近一次生成结束时的 KV（提示词 + 已生成 token）。
+    淘汰策略：超过 ttl_sec 未访问的会话被丢弃；超过 max_sessions 或 max_bytes 时按 LRU 淘汰。
+    """
+
+    def __init__(self, max_bytes: int, max_sessions: int = 64, ttl_sec: float = 1800.0, min_reuse_tokens: int = 16):
+        """
+        Args:
+            max_bytes: 缓存张量的总内存预算（字节）
+            max_sessions: 最多同时缓存的会话数
+            ttl_sec: 会话空闲超过该秒数后失效
+            min_reuse_tokens: 公共前缀短于该长度时视为分叉，直接回退为完整 prefill
+        """
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self.ttl_sec = ttl_sec
+        self.min_reuse_tokens = min_reuse_tokens
+        # session_id -> (token_ids[CPU LongTensor], layers, nbytes, last_access)
+        self._entries: "OrderedDict[str, Tuple[torch.Tensor, List[Any], int, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._diverged = 0
+        self._reused_tokens = 0
+        self._evictions = 0
+
+    def _expire_locked(self, now: float):
+        expired = [sid for sid, entry in self._entries.items() if now - entry[3] > self.ttl_sec]
+        for sid in expired:
+            self._bytes -= self._entries.pop(sid)[2]
+            self._evictions += 1
+
+    def lookup(self, session_id: str, input_ids: List[int]) -> Tuple[int, Optional[List[Any]]]:
+        """
+        查找可复用的 KV。
+
+        Returns:
+            (reuse_len, layers)：layers 为截取到 reuse_len 个 token 的每层 (key, value)；
+            未命中或历史分叉时返回 (0, None)。reuse_len 总是小于 len(input_ids)，保证至少 prefill 一个 token。
+        """
+        now = time.time()
+        with self._lock:
+            self._expire_locked(now)
+            entry = self._entries.get(session_id)
+            if entry is None:
+                self._misses += 1
+                return 0, None
+            cached_ids, layers, nbytes, _ = entry
+            self._entries[session_id] = (cached_ids, layers, nbytes, now)
+            self._entries.move_to_end(session_id)
+
+        new_ids = torch.tensor(input_ids, dtype=torch.long)
+        reuse_len = min(_common_prefix_len(cached_ids, new_ids), len(input_ids) - 1)
+        if reuse_len < self.min_reuse_tokens:
+            with self._lock:
+                self._diverged += 1
+            return 0, None
+
+        with self._lock:
+            self._hits += 1
+            self._reused_tokens += reuse_len
+        return reuse_len, [(k[:, :, :reuse_len, :], v[:, :, :reuse_len, :]) for k, v in layers]
+
+    def put(self, session_id: str, token_ids: List[int], layers: List[Any]):
+        """保存会话最新的 KV；token_ids 与 layers 的序列长度必须一致"""
+        if not layers:
+            return
+        if layers[0][0].shape[-2] != len(token_ids):
+            raise ValueError(f"KV 长度({layers[0][0].shape[-2]})与 token 数({len(token_ids)})不一致")
+        nbytes = _layers_nbytes(layers)
+        now = time.time()
+        with self._lock:
+            old = self._entries.pop(session_id, None)
+            if old is not None:
+                self._bytes -= old[2]
+            if nbytes > self.max_bytes:
+                return
+            self._entries[session_id] = (torch.tensor(token_ids, dtype=torch.long), layers, nbytes, now)
+            self._bytes += nbytes
+            self._expire_locked(now)
+            while self._entries and (self._bytes > self.max_bytes or len(self._entries) > self.max_sessions):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted[2]
+                self._evictions += 1
+
+    def drop(self, session_id: str):
+        """主动丢弃某个会话（如庭审结束）"""
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+            if entry is not None:
+                self._bytes -= entry[2]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'sessions': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'max_sessions': self.max_sessions,
+                'ttl_sec': self.ttl_sec,
+                'hits': self._hits,
+                'misses': self._misses,
+                'diverged': self._diverged,
+                'reused_tokens': self._reused_tokens,
+                'evictions': self._evictions,
+            }
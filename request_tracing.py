@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+请求级阶段追踪
+
+- Trace：一次请求的追踪记录，按阶段（构建提示词、解析上下文、tokenize、prefill、解码、后处理、重复检测等）
+  记录 span。同名阶段可出现多次（如重试时的多次生成），汇总时累加耗时并记录次数。
+- Trace.server_timing()：生成 Server-Timing 响应头（浏览器开发者工具可直接展示各阶段耗时）。
+- TraceExporter：把完成的追踪按行追加写入 JSONL 文件，便于离线分析慢请求（经队列由后台线程写入）。
+
+追踪只记录 time.perf_counter() 的差值，开销为每个阶段两次计时，不影响生成路径。
+"""
+
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, List, Optional
+
+# Server-Timing 中的指标名只能是 token 字符
+_SERVER_TIMING_UNSAFE = str.maketrans({c: '_' for c in ' \t,;="\\/()<>@:?[]{}'})
+
+# 从生成统计（infer._generation_stats）拆出的子阶段，按时间先后排列
+GENERATION_STAGES = ('tokenize', 'queue', 'prefill', 'decode')
+
+
+def new_request_id() -> str:
+    """生成请求 id（32 位十六进制）"""
+    return uuid.uuid4().hex
+
+
+class Trace:
+    """一次请求的阶段追踪（线程安全：流式生成时 span 可能在另一个线程中结束）"""
+
+    def __init__(self, request_id: Optional[str] = None, name: str = ''):
+        self.request_id = request_id or new_request_id()
+        self.name = name
+        self.started_at = time.time()
+        self.attrs: Dict[str, Any] = {}
+        self._start = time.perf_counter()
+        self._end: Optional[float] = None
+        self._spans: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def _offset_ms(self, t: float) -> float:
+        return round((t - self._start) * 1000, 3)
+
+    def add_span(self, name: str, start: float, end: float, **attrs):
+        """记录一个已结束的阶段（start/end 为 time.perf_counter() 的值）"""
+        span = {'name': name, 'start_ms': self._offset_ms(start), 'dur_ms': round((end - start) * 1000, 3)}
+        if attrs:
+            span.update(attrs)
+        with self._lock:
+            self._spans.append(span)
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """用 with 语句记录一个阶段；阶段内抛出异常时同样记录，并带上 error 字段"""
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            self.add_span(name, start, time.perf_counter(), error=type(e).__name__, **attrs)
+            raise
+        self.add_span(name, start, time.perf_counter(), **attrs)
+
+    def add_generation(self, gen_info: Optional[Dict[str, Any]], end: Optional[float] = None):
+        """
+        按生成统计拆出 tokenize / queue / prefill / decode 子阶段
+
+        gen_info 只有各阶段耗时，这里以生成结束时刻（默认为调用时刻）倒推各阶段的起点。
+        """
+        if not gen_info:
+            return
+        end = time.perf_counter() if end is None else end
+        durations = {
+            'tokenize': gen_info.get('tokenize_sec') or 0.0,
+            'queue': gen_info.get('queue_sec') or 0.0,
+            'prefill': gen_info.get('prefill_sec') or 0.0,
+            'decode': gen_info.get('decode_sec') or 0.0,
+        }
+        t = end - sum(durations.values())
+        for stage in GENERATION_STAGES:
+            if stage == 'queue' and 'queue_sec' not in gen_info:
+                continue
+            self.add_span(stage, t, t + durations[stage])
+            t += durations[stage]
+
+    def set(self, key: str, value: Any):
+        """附加属性（如角色、重试次数），随 JSON 导出"""
+        with self._lock:
+            self.attrs[key] = value
+
+    def finish(self):
+        """标记请求结束（重复调用只记录第一次）"""
+        with self._lock:
+            if self._end is None:
+                self._end = time.perf_counter()
+
+    @property
+    def total_ms(self) -> float:
+        end = self._end if self._end is not None else time.perf_counter()
+        return round((end - self._start) * 1000, 3)
+
+    def stages(self) -> Dict[str, Dict[str, Any]]:
+        """按阶段名汇总：{name: {'dur_ms': 累计耗时, 'count': 次数}}，按第一次出现的顺序"""
+        with self._lock:
+            spans = list(self._spans)
+        stages: Dict[str, Dict[str, Any]] = {}
+        for span in spans:
+            entry = stages.setdefault(span['name'], {'dur_ms': 0.0, 'count': 0})
+            entry['dur_ms'] = round(entry['dur_ms'] + span['dur_ms'], 3)
+            entry['count'] += 1
+        return stages
+
+    def server_timing(self) -> str:
+        """Server-Timing 响应头的值（各阶段累计耗时，多次出现时在 desc 中注明次数，最后为 total）"""
+        parts = []
+        for name, entry in self.stages().items():
+            part = f"{name.translate(_SERVER_TIMING_UNSAFE)};dur={entry['dur_ms']:.1f}"
+            if entry['count'] > 1:
+                part += f';desc="x{entry["count"]}"'
+            parts.append(part)
+        parts.append(f"total;dur={self.total_ms:.1f}")
+        return ", ".join(parts)
+
+    def as_dict(self) -> Dict[str, Any]:
+        """可 JSON 序列化的追踪记录（响应中的 timings 字段与 JSONL 导出使用同一结构）"""
+        with self._lock:
+            spans = [dict(span) for span in self._spans]
+            attrs = dict(self.attrs)
+        return {
+            'request_id': self.request_id,
+            'name': self.name,
+            'started_at': round(self.started_at, 3),
+            'total_ms': self.total_ms,
+            'attrs': attrs,
+            'stages': self.stages(),
+            'spans': spans,
+        }
+
+
+class TraceExporter:
+    """
+    把完成的追踪按行追加到 JSONL 文件（线程安全）
+
+    与 async_logging.PromptLog 相同：export() 只把序列化后的一行放入队列，由后台线程写入文件，
+    请求线程（call_on_close 回调）不等待磁盘写入。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._written = 0
+        # 不注册到 logging 的 logger 树中：每个导出器独立，不受全局日志配置影响
+        self._logger = logging.Logger(f"{__name__}.export")
+        handler = logging.FileHandler(path, 'a', encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+        self._logger.addHandler(QueueHandler(log_queue))
+        self._listener: Optional[QueueListener] = QueueListener(log_queue, handler)
+        self._listener.start()
+        atexit.register(self.close)
+
+    def export(self, trace: Trace):
+        """把一条追踪放入写入队列（不阻塞请求线程）"""
+        line = json.dumps(trace.as_dict(), ensure_ascii=False)
+        with self._lock:
+            if self._listener is None:
+                return
+            self._logger.info(line)
+            self._written += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'path': self.path, 'written': self._written}
+
+    def close(self):
+        """停止后台线程（会先写完队列中的记录）并关闭文件"""
+        with self._lock:
+            listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+服务运行指标（Prometheus 文本格式）
+
+- Counter / Gauge / Histogram：带标签的线程安全指标，接口与 prometheus_client 的常用部分一致
+  （labels(...).inc() / set() / observe()），方便以后直接替换。
+- MetricsRegistry：汇总所有指标，render() 输出 text/plain; version=0.0.4 的暴露格式，
+  供 /metrics 接口直接返回。
+- Gauge 可以传入 callback，在抓取时实时读取（如调度器队列深度），避免在热路径里维护。
+
+不依赖 prometheus_client，服务侧只需在请求/生成/外部调用的关键位置打点。
+"""
+
+import bisect
+import math
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE_LATEST = "text/plain; version=0.0.4; charset=utf-8"
+
+# 请求与生成耗时的默认分桶（秒），覆盖从健康检查到长文本生成
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _format_value(value: float) -> str:
+    """按暴露格式输出数值（整数不带小数点，特殊值使用 +Inf/-Inf/NaN）"""
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{_escape_label(extra[1])}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    """指标基类：按标签值元组保存子序列"""
+
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children: Dict[Tuple[str, ...], object] = {}
+
+    def _key(self, args: Tuple[str, ...], kwargs: Dict[str, str]) -> Tuple[str, ...]:
+        if args and kwargs:
+            raise ValueError("labels() 不能同时使用位置参数和关键字参数")
+        if kwargs:
+            if set(kwargs) != set(self.labelnames):
+                raise ValueError(f"{self.name} 的标签应为 {self.labelnames}，实际为 {tuple(kwargs)}")
+            return tuple(str(kwargs[n]) for n in self.labelnames)
+        if len(args) != len(self.labelnames):
+            raise ValueError(f"{self.name} 需要 {len(self.labelnames)} 个标签值")
+        return tuple(str(a) for a in args)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *args, **kwargs):
+        """返回指定标签值对应的子序列（不存在时创建）"""
+        key = self._key(args, kwargs)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._new_child()
+                self._children[key] = child
+            return child
+
+    def _default(self):
+        """无标签指标直接操作自身的唯一子序列"""
+        if self.labelnames:
+            raise ValueError(f"{self.name} 带有标签，请先调用 labels()")
+        return self.labels()
+
+    def _samples(self) -> List[Tuple[str, Tuple[str, ...], Optional[Tuple[str, str]], float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for suffix, values, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, values, extra)} {_format_value(value)}")
+        return lines
+
+
+class _ValueChild:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        with self._lock:
+            self.value = float(value)
+
+
+class Counter(_Metric):
+    """单调递增计数器"""
+
+    type_name = "counter"
+
+    def _new_child(self):
+        return _ValueChild()
+
+    def inc(self, amount: float = 1.0):
+        if amount < 0:
+            raise ValueError("计数器只能增加")
+        self._default().inc(amount)
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._children.items())
+        return [("", key, None, child.value) for key, child in items]
+
+
+class Gauge(_Metric):
+    """
+    可增可减的瞬时值
+
+    传入 callback 时为无标签指标，抓取时调用 callback() 取值（返回 None 表示暂不输出）。
+    """
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 callback: Optional[Callable[[], Optional[float]]] = None):
+        super().__init__(name, documentation, labelnames)
+        if callback is not None and self.labelnames:
+            raise ValueError("带 callback 的 Gauge 不支持标签")
+        self.callback = callback
+
+    def _new_child(self):
+        return _ValueChild()
+
+    def inc(self, amount: float = 1.0):
+        self._default().inc(amount)
+
+    def dec(self, amount: float = 1.0):
+        self._default().dec(amount)
+
+    def set(self, value: float):
+        self._default().set(value)
+
+    def _samples(self):
+        if self.callback is not None:
+            try:
+                value = self.callback()
+            except Exception:
+                value = None
+            return [] if value is None else [("", (), None, float(value))]
+        with self._lock:
+            items = list(self._children.items())
+        return [("", key, None, child.value) for key, child in items]
+
+
+class _HistogramChild:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if idx < len(self.counts):
+                self.counts[idx] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+
+class Histogram(_Metric):
+    """分桶直方图（输出累计的 _bucket、_sum、_count）"""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        if "le" in self.labelnames:
+            raise ValueError("直方图不能使用 le 作为标签名")
+        self.buckets = tuple(sorted(float(b) for b in buckets if not math.isinf(b)))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._children.items())
+        samples = []
+        for key, child in items:
+            counts, total, count = child.snapshot()
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                samples.append(("_bucket", key, ("le", _format_value(bound)), cumulative))
+            samples.append(("_bucket", key, ("le", "+Inf"), count))
+            samples.append(("_sum", key, None, total))
+            samples.append(("_count", key, None, count))
+        return samples
+
+
+class MetricsRegistry:
+    """指标注册表：按注册顺序渲染全部指标"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"指标重复注册: {metric.name}")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+              callback: Optional[Callable[[], Optional[float]]] = None) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames, callback=callback))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                  buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets=buckets))
+
+    def render(self) -> str:
+        """输出 Prometheus 文本暴露格式"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+庭审级近似重复发言索引（MinHash + LSH）
+
+- 每条发言去除空白后切成字符 k-gram（shingle），用 MinHash 压缩为固定长度的签名；
+  签名按 band 切分放入 LSH 桶，查询时只取落入相同桶的发言作为候选，再用 shingle 集合的精确 Jaccard 确认。
+  查询开销与历史长度基本无关，追加一条发言只需计算一次签名。
+- SpeechIndex：一场庭审的索引，sync() 按内容把请求 context 中尚未索引的发言追加进来（只追加，
+  客户端截断或滑动窗口不会丢失更早的发言）。
+- SpeechIndexStore：按 trial_id 保存索引，TTL 过期与 LRU 淘汰（与 kv_cache.SessionKVCache 相同的策略）。
+
+过短的发言（如"请辩护人发言"、审判员每轮宣布辩论开始的程序用语）在同一庭审中本来就会按模板重复出现，
+不参与索引与查询。默认阈值的取值依据：同一角色围绕同一案情的不同发言（共享人名、法条、金额）
+字符 3-gram Jaccard 在 0.15 以下，审判员按模板宣布的不同轮次可达 0.77（约 60 字，低于 min_chars），
+模型几乎原样重复较早发言时在 0.8 以上；见 ai_service/test_speech_index.py 中的样例。
+"""
+
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+DEFAULT_SHINGLE_SIZE = 3
+DEFAULT_NUM_BANDS = 32
+DEFAULT_ROWS_PER_BAND = 3
+DEFAULT_MIN_CHARS = 80
+DEFAULT_THRESHOLD = 0.7
+
+_PRIME = (1 << 31) - 1
+
+
+def speech_shingles(text: str, shingle_size: int = DEFAULT_SHINGLE_SIZE) -> np.ndarray:
+    """去除空白后的字符 k-gram 哈希（去重、升序的 uint64 数组）"""
+    text = ''.join(text.split())
+    if not text:
+        return np.empty(0, dtype=np.uint64)
+    if len(text) <= shingle_size:
+        grams: Iterable[str] = (text,)
+    else:
+        grams = {text[i:i + shingle_size] for i in range(len(text) - shingle_size + 1)}
+    hashes = np.fromiter((zlib.crc32(g.encode('utf-8')) for g in grams), dtype=np.uint64)
+    return np.unique(hashes)
+
+
+def shingle_jaccard(a: np.ndarray, b: np.ndarray) -> float:
+    """两个 shingle 集合（speech_shingles 的结果）的 Jaccard 相似度"""
+    if not a.size or not b.size:
+        return 0.0
+    inter = np.intersect1d(a, b, assume_unique=True).size
+    return inter / (a.size + b.size - inter)
+
+
+class MinHasher:
+    """MinHash 签名：num_perm 个形如 (a·x + b) mod p 的哈希函数，取每个函数在集合上的最小值"""
+
+    def __init__(self, num_perm: int, seed: int = 1):
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self._a = rng.randint(1, _PRIME, size=num_perm).astype(np.uint64)
+        self._b = rng.randint(0, _PRIME, size=num_perm).astype(np.uint64)
+
+    def signature(self, shingles: np.ndarray) -> np.ndarray:
+        if not shingles.size:
+            return np.full(self.num_perm, _PRIME, dtype=np.uint64)
+        x = (shingles % _PRIME)[:, None]
+        # x、a、b 都小于 2^31，乘积不会溢出 uint64
+        return ((x * self._a + self._b) % _PRIME).min(axis=0)
+
+
+class SpeechIndex:
+    """一场庭审的发言索引（线程安全）"""
+
+    def __init__(self, shingle_size: int = DEFAULT_SHINGLE_SIZE, num_bands: int = DEFAULT_NUM_BANDS,
+                 rows_per_band: int = DEFAULT_ROWS_PER_BAND, min_chars: int = DEFAULT_MIN_CHARS,
+                 hasher: Optional[MinHasher] = None):
+        """
+        Args:
+            shingle_size: 字符 k-gram 的长度
+            num_bands / rows_per_band: LSH 分段；签名长度为两者之积，
+                Jaccard 约为 (1/num_bands)^(1/rows_per_band) 以上的发言大概率成为候选
+            min_chars: 去除空白后短于该长度的发言不参与索引与查询
+            hasher: 共享的 MinHasher（签名长度须为 num_bands * rows_per_band）
+        """
+        self.shingle_size = shingle_size
+        self.num_bands = num_bands
+        self.rows_per_band = rows_per_band
+        self.min_chars = min_chars
+        self.hasher = hasher or MinHasher(num_bands * rows_per_band)
+        self._speeches: List[Tuple[str, str, np.ndarray]] = []
+        self._seen: Set[Tuple[str, str]] = set()
+        self._buckets: Dict[Tuple[int, bytes], List[int]] = {}
+        self._lock = threading.Lock()
+        self.last_used = time.time()
+
+    def __len__(self) -> int:
+        return len(self._speeches)
+
+    def _band_keys(self, signature: np.ndarray) -> List[Tuple[int, bytes]]:
+        r = self.rows_per_band
+        return [(band, signature[band * r:(band + 1) * r].tobytes()) for band in range(self.num_bands)]
+
+    def _indexable(self, text: str) -> bool:
+        return len(text) - sum(1 for ch in text if ch.isspace()) >= self.min_chars
+
+    def add(self, role: str, text: str) -> bool:
+        """追加一条发言，返回是否新加入索引（过短或已存在的发言不加入）"""
+        text = (text or '').strip()
+        key = (role, text)
+        with self._lock:
+            self.last_used = time.time()
+            if key in self._seen:
+                return False
+            self._seen.add(key)
+        if not self._indexable(text):
+            return False
+        shingles = speech_shingles(text, self.shingle_size)
+        signature = self.hasher.signature(shingles)
+        with self._lock:
+            idx = len(self._speeches)
+            self._speeches.append((role, text, shingles))
+            for band_key in self._band_keys(signature):
+                self._buckets.setdefault(band_key, []).append(idx)
+        return True
+
+    def sync(self, speeches: Iterable[Tuple[str, str]]) -> int:
+        """把 [(角色, 文本)] 中尚未索引的发言追加到索引，返回新加入的条数"""
+        return sum(1 for role, text in speeches if self.add(role, text))
+
+    def near_duplicates(self, text: str, role: Optional[str] = None, threshold: float = DEFAULT_THRESHOLD,
+                        ) -> List[Tuple[str, str, float]]:
+        """
+        查找与 text 近似重复的历史发言
+
+        Args:
+            role: 只在该角色的发言中查找，None 表示所有角色
+            threshold: shingle 集合 Jaccard 相似度阈值
+
+        Returns:
+            [(角色, 文本, Jaccard)]，按相似度从高到低
+        """
+        text = (text or '').strip()
+        if not self._indexable(text):
+            return []
+        shingles = speech_shingles(text, self.shingle_size)
+        signature = self.hasher.signature(shingles)
+        with self._lock:
+            self.last_used = time.time()
+            candidates: Set[int] = set()
+            for band_key in self._band_keys(signature):
+                candidates.update(self._buckets.get(band_key, ()))
+            entries = [self._speeches[i] for i in candidates]
+        matches = []
+        for entry_role, entry_text, entry_shingles in entries:
+            if role is not None and entry_role != role:
+                continue
+            jaccard = shingle_jaccard(shingles, entry_shingles)
+            if jaccard >= threshold:
+                matches.append((entry_role, entry_text, jaccard))
+        matches.sort(key=lambda m: -m[2])
+        return matches
+
+
+class SpeechIndexStore:
+    """按 trial_id 保存 SpeechIndex（线程安全，TTL 过期 + LRU 淘汰）"""
+
+    def __init__(self, max_trials: int = 256, ttl_sec: float = 3600.0, **index_kwargs):
+        self.max_trials = max_trials
+        self.ttl_sec = ttl_sec
+        self._index_kwargs = index_kwargs
+        # 所有索引共用一组哈希函数
+        self._hasher = MinHasher(
+            index_kwargs.get('num_bands', DEFAULT_NUM_BANDS) * index_kwargs.get('rows_per_band', DEFAULT_ROWS_PER_BAND)
+        )
+        self._indexes: "OrderedDict[str, SpeechIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._expired = 0
+        self._evictions = 0
+
+    def new_index(self) -> SpeechIndex:
+        """创建一个不保存的索引（请求没有 trial_id 时从 context 临时构建）"""
+        return SpeechIndex(hasher=self._hasher, **self._index_kwargs)
+
+    def get(self, trial_id: str) -> SpeechIndex:
+        """取出（不存在或已过期时新建）该庭审的索引"""
+        now = time.time()
+        with self._lock:
+            index = self._indexes.get(trial_id)
+            if index is not None and self.ttl_sec > 0 and now - index.last_used > self.ttl_sec:
+                del self._indexes[trial_id]
+                self._expired += 1
+                index = None
+            if index is None:
+                index = self.new_index()
+                self._indexes[trial_id] = index
+                self._created += 1
+                while len(self._indexes) > self.max_trials:
+                    self._indexes.popitem(last=False)
+                    self._evictions += 1
+            else:
+                self._indexes.move_to_end(trial_id)
+            return index
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'trials': len(self._indexes),
+                'speeches': sum(len(index) for index in self._indexes.values()),
+                'max_trials': self.max_trials,
+                'ttl_sec': self.ttl_sec,
+                'created': self._created,
+                'expired': self._expired,
+                'evictions': self._evictions,
+            }
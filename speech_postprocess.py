@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+模型输出的后处理规则（导入时编译一次）
+
+- 特殊标记：<|im_end|>、<|im_start|> 及其残缺形式合并为一个正则，一遍替换。
+- 角色前缀：开头的"角色名：角色名："（同一角色重复）一次匹配去除，不再逐角色递归。
+- 审判员口吻：方括号内容（如"[审判员总结辩论]"）与阶段转换语、总结性表达各合并为一个交替正则，
+  先用一遍 search 判断是否命中（绝大多数发言不命中，到此结束）；命中时再按 JUDGE_STYLE_RULES 的顺序逐条执行
+  预编译的删除规则（前面规则的删除可能使后面的规则产生新的匹配，顺序不能改变）。
+  与最初 filter_judge_style_speech 的一致性由 ai_service/test_speech_postprocess.py 在随机输入上检查。
+- SpeechPostprocessor.process / process_batch：完整流程，批量接口用于离线处理语料。
+- IncrementalJudgeStyleFilter：流式输出使用同一套规则，按句（。！？或换行）增量过滤，
+  未结束的句子从第一个可能的匹配起点开始暂缓输出，已完成的句子只处理一次。
+
+审判员口吻的固定短语与解码期约束共用 infer.JUDGE_STYLE_PHRASES / JUDGE_STYLE_BRACKET_PREFIXES，
+由调用方传入（本模块不依赖 torch）。
+"""
+
+import re
+from typing import Iterable, List, Sequence, Tuple
+
+ROLE_NAMES = ('审判员', '公诉人', '辩护人')
+
+# 完整与残缺的聊天模板标记：<|im_end|>、<|im_end|、|im_end|>（im_start 同理）
+SPECIAL_TOKEN_RE = re.compile(r'<\|im_(?:end|start)\|>?|\|im_(?:end|start)\|>')
+
+# 开头同一角色的一个或多个前缀（支持中英文冒号及其后的空白），如"公诉人：公诉人: "
+ROLE_PREFIX_RE = re.compile(r'^(' + '|'.join(re.escape(name) for name in ROLE_NAMES) + r')[：:]\s*(?:\1[：:]\s*)*')
+
+# 审判员式的阶段转换语和总结性表达：(匹配起点的固定文字, 规则)
+# 顺序即删除的执行顺序（前面规则的删除会影响后面规则的匹配），与最初的 filter_judge_style_speech 保持一致，
+# 调用方传入的其他固定短语排在这些规则之后
+JUDGE_STYLE_RULES = (
+    ('现在进入辩论环节', r'现在进入辩论环节[。，]?'),
+    ('现在进行法庭辩论', r'现在进行法庭辩论[。，]?'),
+    ('首先由', r'首先由.*?发表.*?意见[。，]?'),
+    ('现在宣布', r'现在宣布.*?[。，]?'),
+    ('现在开始', r'现在开始.*?[。，]?'),
+    ('进入', r'进入.*?环节[。，]?'),
+    ('现在', r'现在.*?环节[。，]?'),
+    ('审判员总结', r'审判员总结.*?[。，]?'),
+    ('总结辩论', r'总结辩论[。，]?'),
+    ('总结', r'总结.*?辩论[。，]?'),
+    ('本庭总结', r'本庭总结[。，]?'),
+    ('法庭总结', r'法庭总结[。，]?'),
+)
+
+# 需要整段移除的方括号内容的开头（顺序同上），调用方传入的其他开头排在后面
+JUDGE_STYLE_BRACKET_RULES = ('[审判员', '[总结', '[法庭', '[本庭')
+
+# 流式过滤的分段位置（句末标点或换行之后）
+_SEGMENT_END_RE = re.compile(r'[\n。！？!?]')
+
+
+class SpeechPostprocessor:
+    """编译好的后处理流程（无状态，可在线程间共享）"""
+
+    def __init__(self, judge_style_phrases: Sequence[str] = (), bracket_prefixes: Sequence[str] = (),
+                 min_filtered_len: int = 10):
+        """
+        Args:
+            judge_style_phrases: 非审判员角色不应出现的固定短语（infer.JUDGE_STYLE_PHRASES），
+                已在 JUDGE_STYLE_RULES 中的不重复添加，其余排在其后
+            bracket_prefixes: 需要整段移除的方括号内容的开头（infer.JUDGE_STYLE_BRACKET_PREFIXES），
+                已在 JUDGE_STYLE_BRACKET_RULES 中的不重复添加，其余排在其后
+            min_filtered_len: 过滤审判员口吻后不足该长度时保留原文
+        """
+        self.min_filtered_len = min_filtered_len
+        style_triggers = [trigger for trigger, _ in JUDGE_STYLE_RULES]
+        bracket_prefixes = list(JUDGE_STYLE_BRACKET_RULES) + [
+            prefix for prefix in bracket_prefixes if prefix not in JUDGE_STYLE_BRACKET_RULES]
+        bracket_patterns = [re.escape(prefix) + r'.*?\]' for prefix in bracket_prefixes]
+        style_patterns = [pattern for _, pattern in JUDGE_STYLE_RULES]
+        style_patterns += [re.escape(phrase) + r'[。，]?' for phrase in judge_style_phrases if phrase not in style_triggers]
+        # 检测用的合并正则（一遍扫描）
+        self._bracket_any_re = re.compile('|'.join(bracket_patterns))
+        self._style_any_re = re.compile('|'.join(style_patterns))
+        # 命中后按顺序执行的删除规则：删除匹配内容及其后的空白和换行，再删除行尾的匹配（连同前面的空白）
+        self._bracket_res = [re.compile(pattern) for pattern in bracket_patterns]
+        self._style_res = [
+            (re.compile(pattern + r'[\s\n]*', re.IGNORECASE),
+             re.compile(r'[\s\n]*' + pattern + r'$', re.IGNORECASE | re.MULTILINE))
+            for pattern in style_patterns
+        ]
+        # 任何一条规则的匹配都从这些固定文字之一开始（流式输出据此决定从哪里开始暂缓）
+        triggers = set(judge_style_phrases) | set(bracket_prefixes) | set(style_triggers)
+        self._triggers = sorted(triggers, key=len, reverse=True)
+        self._trigger_re = re.compile('|'.join(re.escape(t) for t in self._triggers), re.IGNORECASE)
+        self._max_trigger_len = max(len(t) for t in self._triggers)
+
+    @staticmethod
+    def clean_special_tokens(text: str) -> str:
+        """移除特殊标记并去除首尾空白"""
+        if not text:
+            return text
+        return SPECIAL_TOKEN_RE.sub('', text).strip()
+
+    @staticmethod
+    def strip_role_prefix(text: str) -> str:
+        """去除开头（重复）的角色前缀；去除后为空时返回空字符串，由调用方决定是否保留原文"""
+        if not text:
+            return text
+        match = ROLE_PREFIX_RE.match(text)
+        if not match:
+            return text
+        return text[match.end():].lstrip()
+
+    def _remove_judge_style(self, text: str) -> Tuple[str, List[str], List[str]]:
+        brackets: List[str] = []
+        if self._bracket_any_re.search(text):
+            for pattern_re in self._bracket_res:
+                found = pattern_re.findall(text)
+                if found:
+                    brackets.extend(found)
+                    text = pattern_re.sub('', text)
+        styles = self._style_any_re.findall(text)
+        if styles:
+            for sub_re, tail_re in self._style_res:
+                text = sub_re.sub('', text)
+                text = tail_re.sub('', text)
+        return text, brackets, styles
+
+    def filter_judge_style(self, text: str) -> Tuple[str, List[str], List[str]]:
+        """
+        移除审判员式的发言内容
+
+        Returns:
+            (过滤后的文本, 移除的方括号内容, 命中的审判员式表达)；
+            去除审判员式表达后不足 min_filtered_len 个字符时保留原文（仍返回命中的内容）
+        """
+        if not text:
+            return text, [], []
+        filtered, brackets, styles = self._remove_judge_style(text)
+        if styles and len(filtered.strip()) < self.min_filtered_len:
+            filtered = text
+        return filtered.strip(), brackets, styles
+
+    def process(self, text: str, agent_role: str) -> str:
+        """完整后处理：特殊标记 → 角色前缀 → 审判员口吻（审判员本人不做该项）"""
+        text = self.clean_special_tokens(text)
+        if not text:
+            return text
+        text = self.strip_role_prefix(text) or text
+        if agent_role != '审判员':
+            text = self.filter_judge_style(text)[0]
+        return text
+
+    def process_batch(self, texts: Iterable[str], agent_role: str) -> List[str]:
+        """批量后处理（离线语料），结果与逐条 process 相同"""
+        return [self.process(text, agent_role) for text in texts]
+
+    def filter_segment(self, segment: str) -> str:
+        """对一句（不跨句）执行审判员口吻过滤，不做过短回退（流式输出用）"""
+        return self._remove_judge_style(segment)[0]
+
+    def safe_prefix_len(self, text: str) -> int:
+        """未结束的句子中确定不会被任何规则删除的前缀长度"""
+        # 后续输出最早可能在 start 处补全一个匹配：已有匹配的起点、末尾可能是起点文字前半部分的位置，或文本末尾
+        start = len(text)
+        match = self._trigger_re.search(text)
+        if match:
+            start = match.start()
+        for n in range(min(len(text), self._max_trigger_len - 1), 0, -1):
+            if any(trigger.startswith(text[len(text) - n:]) for trigger in self._triggers):
+                start = min(start, len(text) - n)
+                break
+        # 删除匹配后，前后文字可能拼出新的起点文字，行尾匹配还会连同前面的空白一起删除；
+        # 起点之前同样暂缓 _max_trigger_len - 1 个字符，文本变长时返回值不会变小（已发送的内容不会被删除）
+        end = max(0, start - (self._max_trigger_len - 1))
+        while end > 0 and text[end - 1].isspace():
+            end -= 1
+        return end
+
+
+class IncrementalJudgeStyleFilter:
+    """
+    流式输出的审判员口吻过滤：每次传入目前为止的全部文本，返回可以发送的过滤结果
+
+    以句为单位过滤，已完成的句子结果会缓存，不会重复处理；返回值总是以上一次的返回值为前缀。
+    跨句的匹配和过短回退只在非流式（完整文本）处理中生效，流结束时以完整文本的处理结果为准。
+    """
+
+    def __init__(self, postprocessor: SpeechPostprocessor):
+        self.postprocessor = postprocessor
+        self._source = ''
+        self._filtered = ''
+
+    def render(self, text: str, final: bool = False) -> str:
+        if not text.startswith(self._source):
+            self._source, self._filtered = '', ''
+        if final:
+            done = len(text)
+        else:
+            done = len(self._source)
+            for match in _SEGMENT_END_RE.finditer(text, done):
+                done = match.end()
+        if done > len(self._source):
+            segments = []
+            start = len(self._source)
+            for match in _SEGMENT_END_RE.finditer(text, start, done):
+                segments.append(self.postprocessor.filter_segment(text[start:match.end()]))
+                start = match.end()
+            if start < done:
+                segments.append(self.postprocessor.filter_segment(text[start:done]))
+            self._filtered += ''.join(segments)
+            self._source = text[:done]
+        pending = text[done:]
+        return self._filtered + pending[:self.postprocessor.safe_prefix_len(pending)]
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+发言相似度（重复发言检测）
+
+相似度 = 0.4 × 字符集合重叠率（Jaccard） + 0.6 × LCS 长度 / 较长文本长度，与 ai_service 中原有的
+calculate_text_similarity 的公式和浮点运算顺序完全一致。
+
+- LCS 使用位并行算法（Hyyrö 2004）：把模式串每个字符出现的位置编码为一个整数位图，
+  扫描另一文本时每个字符只需几次整数位运算，内存 O(n)，代替 (m+1)×(n+1) 的 Python 二维表。
+- 阈值判断（at_least）在扫描过程中利用 LCS 的上下界提前结束：已扫描部分的 LCS 即为下界，
+  加上剩余字符数为上界，阈值已确定达到或不可能达到时立即返回。
+- SpeechSimilarity：对一条新发言预先计算字符集合与位图，与多条历史发言比较时复用。
+- 批量比较（scores / first_at_least）：把多条历史发言打包进同一组多字位图（每条占一段，段间留一个保护位隔断进位），
+  只扫描一遍新发言即可同时得到与每条历史发言的 LCS；first_at_least 对每段分别用上下界提前判定。
+  打包结果按历史发言缓存，同一组历史发言与多个候选比较时只打包一次。
+"""
+
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+CHAR_OVERLAP_WEIGHT = 0.4
+LCS_WEIGHT = 0.6
+
+# 阈值判断时每扫描多少个字符检查一次上下界（popcount 比位运算本身更贵，不必每个字符都检查）
+_BOUND_CHECK_INTERVAL = 32
+
+if hasattr(int, 'bit_count'):
+    _popcount = int.bit_count
+else:  # Python < 3.10
+    def _popcount(x: int) -> int:
+        return bin(x).count('1')
+
+
+class _Packed:
+    """多条文本打包后的位图（见 _pack）"""
+
+    __slots__ = ('masks', 'full', 'lanes', 'chars')
+
+    def __init__(self, masks: Dict[str, int], full: int, lanes: List[Tuple[int, int]], chars: List[frozenset]):
+        self.masks = masks
+        self.full = full
+        self.lanes = lanes  # 每段的 (起始位, 长度)
+        self.chars = chars  # 每条文本的字符集合
+
+
+@lru_cache(maxsize=64)
+def _pack(texts: Tuple[str, ...]) -> _Packed:
+    """
+    把多条文本打包成同一组位图：第 i 条占据 [base_i, base_i + len_i) 位，base_i - 1 为恒为 0 的保护位，
+    低位段 v + u 的进位只会落到保护位上（随后被掩码清除），各段互不影响
+
+    打包的开销与逐条扫描相当，按文本元组缓存：同一组历史发言与多个候选（best-of-N、重新生成）比较时只打包一次。
+    """
+    masks: Dict[str, int] = {}
+    lanes: List[Tuple[int, int]] = []
+    full = 0
+    base = 1
+    for text in texts:
+        local: Dict[str, int] = {}
+        for i, ch in enumerate(text):
+            local[ch] = local.get(ch, 0) | (1 << i)
+        for ch, bits in local.items():
+            masks[ch] = masks.get(ch, 0) | (bits << base)
+        full |= ((1 << len(text)) - 1) << base
+        lanes.append((base, len(text)))
+        base += len(text) + 1
+    return _Packed(masks, full, lanes, [frozenset(text) for text in texts])
+
+
+def _combine(char_overlap: float, lcs_len: int, max_len: int) -> float:
+    """按原公式组合两部分得分（保持相同的运算顺序，保证浮点结果一致）"""
+    lcs_ratio = lcs_len / max_len if max_len > 0 else 0.0
+    return CHAR_OVERLAP_WEIGHT * char_overlap + LCS_WEIGHT * lcs_ratio
+
+
+class SpeechSimilarity:
+    """
+    一条文本（通常是新生成的发言）与其他文本的相似度计算器
+
+    构造时预先计算字符集合和每个字符的位置位图，score / at_least 可对多条文本重复调用。
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.length = len(text)
+        self.chars = frozenset(text)
+        masks: Dict[str, int] = {}
+        for i, ch in enumerate(text):
+            masks[ch] = masks.get(ch, 0) | (1 << i)
+        self._masks = masks
+        self._full = (1 << self.length) - 1
+
+    def _char_overlap(self, other: str) -> float:
+        return self._chars_overlap(set(other))
+
+    def _chars_overlap(self, other_chars) -> float:
+        intersection = len(self.chars & other_chars)
+        union = len(self.chars | other_chars)
+        return intersection / union if union > 0 else 0.0
+
+    def _scan(self, other: str, bound: Optional[Tuple[float, float, int]] = None) -> Tuple[int, Optional[bool]]:
+        """
+        位并行 LCS：V 中为 0 的位数即当前 LCS 长度
+
+        bound 为 (char_overlap, threshold, max_len) 时，在能确定结果后提前返回 (当前 LCS, 是否达到阈值)；
+        否则扫描完整文本，返回 (LCS, None)。
+        """
+        masks = self._masks
+        full = self._full
+        m = self.length
+        v = full
+        n = len(other)
+        for k, ch in enumerate(other, 1):
+            match = masks.get(ch)
+            if match is not None:
+                u = v & match
+                v = ((v + u) | (v - u)) & full
+            if bound is not None and k % _BOUND_CHECK_INTERVAL == 0 and k < n:
+                lcs_len = m - _popcount(v)
+                char_overlap, threshold, max_len = bound
+                if _combine(char_overlap, lcs_len, max_len) >= threshold:
+                    return lcs_len, True
+                if _combine(char_overlap, min(lcs_len + n - k, m), max_len) < threshold:
+                    return lcs_len, False
+        return m - _popcount(v), None
+
+    def _scan_packed(self, packed: _Packed, check=None) -> List[int]:
+        """
+        与打包的多条文本的 LCS：扫描一遍 self.text，各段同时更新，返回每段的 LCS
+
+        check(k, lane_lcs) 每扫描 _BOUND_CHECK_INTERVAL 个字符调用一次（k 为已扫描字符数，lane_lcs(j) 为第 j 段
+        当前的 LCS），返回 True 时提前结束，此时返回的是已扫描部分的 LCS。
+        """
+        masks = packed.masks
+        full = packed.full
+        lanes = packed.lanes
+        n = self.length
+        v = full
+
+        def lane_lcs(j: int) -> int:
+            base, length = lanes[j]
+            return length - _popcount((v >> base) & ((1 << length) - 1))
+
+        for k, ch in enumerate(self.text, 1):
+            match = masks.get(ch)
+            if match is not None:
+                u = v & match
+                v = ((v + u) | (v - u)) & full
+            if check is not None and k % _BOUND_CHECK_INTERVAL == 0 and k < n and check(k, lane_lcs):
+                break
+        return [lane_lcs(j) for j in range(len(lanes))]
+
+    def lcs_length(self, other: str) -> int:
+        """与 other 的最长公共子序列长度"""
+        if not self.length or not other:
+            return 0
+        return self._scan(other)[0]
+
+    def score(self, other: str) -> float:
+        """相似度（0-1），与 ai_service 的 calculate_text_similarity 结果完全一致"""
+        if not self.text or not other:
+            return 0.0
+        if self.text == other:
+            return 1.0
+        lcs_len, _ = self._scan(other)
+        return _combine(self._char_overlap(other), lcs_len, max(self.length, len(other)))
+
+    def at_least(self, other: str, threshold: float) -> bool:
+        """相似度是否 >= threshold（等价于 score(other) >= threshold，能确定时提前结束 LCS 扫描）"""
+        if not self.text or not other:
+            return 0.0 >= threshold
+        if self.text == other:
+            return 1.0 >= threshold
+        char_overlap = self._char_overlap(other)
+        max_len = max(self.length, len(other))
+        # LCS 不会超过较短文本的长度：上界都达不到阈值时无需扫描
+        if _combine(char_overlap, min(self.length, len(other)), max_len) < threshold:
+            return False
+        if _combine(char_overlap, 0, max_len) >= threshold:
+            return True
+        lcs_len, decided = self._scan(other, bound=(char_overlap, threshold, max_len))
+        if decided is not None:
+            return decided
+        return _combine(char_overlap, lcs_len, max_len) >= threshold
+
+    def _batch(self, others: List[str]) -> Tuple[List[int], Optional[_Packed]]:
+        """需要计算 LCS 的文本下标（非空且与 self.text 不同）及其打包位图"""
+        if not self.text:
+            return [], None
+        batch = [i for i, other in enumerate(others) if other and other != self.text]
+        return batch, (_pack(tuple(others[i] for i in batch)) if batch else None)
+
+    def scores(self, others: Iterable[str]) -> List[float]:
+        """与多条文本的相似度（与逐条调用 score 结果完全一致，所有 LCS 在一次打包扫描中得到）"""
+        others = list(others)
+        results = [1.0 if self.text and other == self.text else 0.0 for other in others]
+        batch, packed = self._batch(others)
+        if packed is not None:
+            for i, chars, lcs_len in zip(batch, packed.chars, self._scan_packed(packed)):
+                results[i] = _combine(self._chars_overlap(chars), lcs_len, max(self.length, len(others[i])))
+        return results
+
+    def first_at_least(self, others: Iterable[str], threshold: float) -> Optional[int]:
+        """
+        第一条相似度 >= threshold 的文本下标，没有时返回 None（与按顺序逐条调用 at_least 结果一致）
+
+        所有文本打包后一起扫描，每段按 at_least 的上下界分别提前判定；
+        排在前面的文本都已判定为否、且某条文本判定为是时立即返回。
+        """
+        others = list(others)
+        n = self.length
+        decided: List[Optional[bool]] = [
+            (1.0 if self.text and other == self.text else 0.0) >= threshold for other in others
+        ]
+        batch, packed = self._batch(others)
+        pending: List[Tuple[int, int, float, int]] = []  # (段号, 下标, 字符重叠率, 较长文本长度)
+        for j, i in enumerate(batch):
+            char_overlap = self._chars_overlap(packed.chars[j])
+            max_len = max(n, len(others[i]))
+            # LCS 不会超过较短文本的长度：上界都达不到阈值时无需扫描
+            if _combine(char_overlap, min(n, len(others[i])), max_len) < threshold:
+                decided[i] = False
+            elif _combine(char_overlap, 0, max_len) >= threshold:
+                decided[i] = True
+            else:
+                decided[i] = None
+                pending.append((j, i, char_overlap, max_len))
+
+        def first_decided() -> Tuple[bool, Optional[int]]:
+            """(结果是否已确定, 结果)"""
+            for i, result in enumerate(decided):
+                if result is None:
+                    return False, None
+                if result:
+                    return True, i
+            return True, None
+
+        def check(k: int, lane_lcs) -> bool:
+            for j, i, char_overlap, max_len in pending:
+                if decided[i] is not None:
+                    continue
+                lcs_len = lane_lcs(j)
+                if _combine(char_overlap, lcs_len, max_len) >= threshold:
+                    decided[i] = True
+                elif _combine(char_overlap, min(lcs_len + n - k, len(others[i])), max_len) < threshold:
+                    decided[i] = False
+            return first_decided()[0]
+
+        done, first = first_decided()
+        if done:
+            return first
+        lcs_list = self._scan_packed(packed, check)
+        done, first = first_decided()
+        if done:
+            return first
+        # 扫描完整：剩余各段的 LCS 已是最终值
+        for j, i, char_overlap, max_len in pending:
+            if decided[i] is None:
+                decided[i] = _combine(char_overlap, lcs_list[j], max_len) >= threshold
+        return first_decided()[1]
+
+
+def text_similarity(text1: str, text2: str) -> float:
+    """两个文本的相似度（0-1），见模块说明"""
+    if not text1 or not text2:
+        return 0.0
+    if text1 == text2:
+        return 1.0
+    # 位图按较短的文本构建，位运算的整数更小
+    if len(text2) < len(text1):
+        text1, text2 = text2, text1
+    return SpeechSimilarity(text1).score(text2)
+
+
+def lcs_length(text1: str, text2: str) -> int:
+    """两个文本的最长公共子序列长度"""
+    if len(text2) < len(text1):
+        text1, text2 = text2, text1
+    return SpeechSimilarity(text1).lcs_length(text2)